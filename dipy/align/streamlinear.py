@@ -4,6 +4,7 @@ from dipy.utils.six import with_metaclass
 from dipy.core.optimize import Optimizer
 from dipy.align.bundlemin import (_bundle_minimum_distance,
                                   distance_matrix_mdf)
+from dipy.tracking import Streamlines
 from dipy.tracking.streamline import (transform_streamlines,
                                       unlist_streamlines,
                                       center_streamlines)
@@ -16,6 +17,14 @@ MAX_DIST = 1e10
 LOG_MAX_DIST = np.log(MAX_DIST)
 
 
+def _streamline_lengths(streamlines):
+    """Number of points of each streamline, read from the lengths buffer of
+    `Streamlines`"""
+    if isinstance(streamlines, Streamlines):
+        return np.asarray(streamlines._lengths)
+    return np.array(list(map(len, streamlines)))
+
+
 class StreamlineDistanceMetric(with_metaclass(abc.ABCMeta, object)):
 
     def __init__(self, num_threads=None):
@@ -302,13 +311,16 @@ class StreamlineLinearRegistration(object):
         msg = 'need to have the same number of points. Use '
         msg += 'set_number_of_points from dipy.tracking.streamline'
 
-        if not np.all(np.array(list(map(len, static))) == static[0].shape[0]):
+        static_lengths = _streamline_lengths(static)
+        moving_lengths = _streamline_lengths(moving)
+
+        if not np.all(static_lengths == static_lengths[0]):
             raise ValueError('Static streamlines ' + msg)
 
-        if not np.all(np.array(list(map(len, moving))) == moving[0].shape[0]):
+        if not np.all(moving_lengths == moving_lengths[0]):
             raise ValueError('Moving streamlines ' + msg)
 
-        if not np.all(np.array(list(map(len, moving))) == static[0].shape[0]):
+        if not np.all(moving_lengths == static_lengths[0]):
             raise ValueError('Static and moving streamlines ' + msg)
 
         if mat is None:
@@ -21,6 +21,7 @@ from dipy.tracking.streamline import (center_streamlines,
                                       set_number_of_points)
 
 from dipy.core.geometry import compose_matrix
+from dipy.tracking import Streamlines
 
 from dipy.data import get_data, two_cingulum_bundles
 from nibabel import trackvis as tv
@@ -77,6 +78,27 @@ def test_rigid_parallel_lines():
     evaluate_convergence(bundle, new_bundle2)
 
 
+def test_rigid_packed_streamlines():
+
+    bundle, shift = center_streamlines(simulated_bundle())
+    mat = compose_matrix44([20, 0, 10, 0, 40, 0])
+    bundle2 = transform_streamlines(bundle, mat)
+
+    srr = StreamlineLinearRegistration(x0=np.zeros(6))
+    expected = srr.optimize(bundle, bundle2)
+    srm = srr.optimize(Streamlines(bundle), Streamlines(bundle2))
+    assert_array_almost_equal(srm.matrix, expected.matrix)
+
+    new_bundle2 = srm.transform(Streamlines(bundle2))
+    assert_(isinstance(new_bundle2, Streamlines))
+    evaluate_convergence(bundle, new_bundle2)
+
+    A = Streamlines([np.random.rand(10, 3), np.random.rand(20, 3)])
+    C = Streamlines([np.random.rand(10, 3), np.random.rand(10, 3)])
+    assert_raises(ValueError, srr.optimize, A, C)
+    assert_raises(ValueError, srr.optimize, C, A)
+
+
 def test_rigid_real_bundles():
 
     bundle_initial = fornix_streamlines()[:20]
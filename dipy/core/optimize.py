@@ -4,12 +4,14 @@ Only L-BFGS-B and Powell is supported in this class for versions of
 Scipy < 0.12. All optimizers are available for scipy >= 0.12.
 """
 import abc
+import os
 from distutils.version import LooseVersion
 import numpy as np
 import scipy
 import scipy.sparse as sps
 import scipy.optimize as opt
 from dipy.utils.six import with_metaclass
+from dipy.core.sparsespeed import csr_matvec, csr_rmatvec
 
 SCIPY_LESS_0_12 = LooseVersion(scipy.version.short_version) < '0.12'
 
@@ -294,6 +296,37 @@ def spdot(A, B):
         return np.dot(A, B)
 
 
+def sparse_matvec(A, x, transpose=False, num_threads=None):
+    """The product of a sparse matrix and a vector, computed in parallel
+
+    Parameters
+    ----------
+    A : sparse matrix of shape (n, m)
+        Converted to CSR format if it is not already.
+    x : 1-d array of shape (m,), or (n,) if `transpose`
+    transpose : bool, optional
+        Whether to compute ``A.T.dot(x)`` instead of ``A.dot(x)``.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    1-d array of float64, of shape (n,), or (m,) if `transpose`
+    """
+    A = sps.csr_matrix(A)
+    if A.dtype != np.float32 and A.dtype != np.float64:
+        A = A.astype(np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    if transpose:
+        out = np.empty(A.shape[1])
+        csr_rmatvec(A.data, A.indices, A.indptr, x, out, num_threads)
+    else:
+        out = np.empty(A.shape[0])
+        csr_matvec(A.data, A.indices, A.indptr, x, out, num_threads)
+    return out
+
+
 def sparse_nnls(y, X,
                 momentum=1,
                 step_size=0.01,
@@ -446,3 +479,192 @@ class NonNegativeLeastSquares(SKLearnLinearSolver):
         coef, rnorm = opt.nnls(X, y)
         self.coef_ = coef
         return self
+
+
+class SparseNonNegativeLeastSquares(SKLearnLinearSolver):
+    r"""
+    Projected accelerated gradient solver of non-negative least squares,
+    for large sparse design matrices
+
+    Minimizes $\frac{1}{2} \|Xh - y\|^2$ for $h \geq 0$. Each iteration
+    takes one product with $X$ and one with $X^T$, computed in parallel with
+    `sparse_matvec`. The residual is updated from these products instead of
+    being recomputed.
+    """
+    def __init__(self, method='fista', max_iter=1000, tol=1e-6,
+                 num_threads=None, checkpoint=None, checkpoint_iter=100):
+        """
+        Parameters
+        ----------
+        method : str, optional
+            'fista' (default) for the fast iterative shrinkage-thresholding
+            algorithm [Beck2009]_, restarted whenever the error goes up
+            [ODonoghue2015]_, or 'bb' for projected gradient descent with
+            Barzilai-Borwein steps [Barzilai1988]_.
+        max_iter : int, optional
+            The maximal number of iterations. Default: 1000.
+        tol : float, optional
+            Convergence is reached when the sum of squared errors decreases by
+            less than this fraction in an iteration. Default: 1e-6.
+        num_threads : int, optional
+            Number of threads of the sparse products. If None (default) the
+            default number of OpenMP threads is used.
+        checkpoint : str, optional
+            Name of a .npz file in which the solution is saved every
+            `checkpoint_iter` iterations and at the end. If the file exists
+            when `fit` is called, the fit resumes from the solution it holds.
+        checkpoint_iter : int, optional
+            The number of iterations between checkpoints. Default: 100.
+
+        Notes
+        -----
+        After `fit`, the attributes `n_iter_` (the number of iterations),
+        `converged_` (whether the tolerance was reached before `max_iter`)
+        and `objective_` (half the sum of squared errors after each
+        iteration) give the convergence diagnostics.
+
+        References
+        ----------
+        .. [Beck2009] Beck A. and Teboulle M., A fast iterative
+           shrinkage-thresholding algorithm for linear inverse problems, SIAM
+           Journal on Imaging Sciences 2(1), 183-202, 2009.
+        .. [ODonoghue2015] O'Donoghue B. and Candes E., Adaptive restart for
+           accelerated gradient schemes, Foundations of Computational
+           Mathematics 15(3), 715-732, 2015.
+        .. [Barzilai1988] Barzilai J. and Borwein J.M., Two-point step size
+           gradient methods, IMA Journal of Numerical Analysis 8(1), 141-148,
+           1988.
+        """
+        if method not in ('fista', 'bb'):
+            raise ValueError("method must be 'fista' or 'bb'")
+        SKLearnLinearSolver.__init__(self)
+        self.method = method
+        self.max_iter = max_iter
+        self.tol = tol
+        self.num_threads = num_threads
+        self.checkpoint = checkpoint
+        self.checkpoint_iter = checkpoint_iter
+
+    def _lipschitz(self, X, n_iter=20):
+        """An upper estimate of the largest eigenvalue of $X^T X$"""
+        v = np.random.RandomState(0).rand(X.shape[1])
+        norm = 0
+        for i in range(n_iter):
+            v_norm = np.sqrt(np.dot(v, v))
+            if v_norm == 0:
+                break
+            v = sparse_matvec(X, sparse_matvec(X, v / v_norm,
+                                               num_threads=self.num_threads),
+                              transpose=True, num_threads=self.num_threads)
+            norm = np.sqrt(np.dot(v, v))
+        # The power iteration estimate is from below:
+        return 1.1 * norm
+
+    def _save(self, coef, n_iter, objective):
+        np.savez(self.checkpoint, coef=coef, n_iter=n_iter,
+                 objective=objective)
+
+    def fit(self, X, y):
+        """
+        Fit the non-negative least squares model to data
+
+        Parameters
+        ----------
+        X : sparse matrix or array of shape (n, m)
+            The regressors.
+        y : 1-d array of shape (n,)
+            The data.
+        """
+        X = sps.csr_matrix(X)
+        # Converted once here rather than at each product
+        if X.dtype != np.float32 and X.dtype != np.float64:
+            X = X.astype(np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        num_threads = self.num_threads
+        coef = np.zeros(X.shape[1])
+        objective = []
+        start = 0
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            with np.load(self.checkpoint) as saved:
+                if saved['coef'].shape == coef.shape:
+                    coef = saved['coef']
+                    start = int(saved['n_iter'])
+                    objective = list(saved['objective'])
+
+        L = self._lipschitz(X)
+        residual = sparse_matvec(X, coef, num_threads=num_threads) - y
+        sse = np.dot(residual, residual) / 2
+        self.converged_ = L == 0
+        if self.method == 'fista':
+            z = coef
+            z_residual = residual
+            t = 1.
+        else:
+            gradient = sparse_matvec(X, residual, transpose=True,
+                                     num_threads=num_threads)
+            step = 1. / L if L else 0.
+
+        n_iter = start
+        while n_iter < self.max_iter and not self.converged_:
+            n_iter += 1
+            if self.method == 'fista':
+                gradient = sparse_matvec(X, z_residual, transpose=True,
+                                         num_threads=num_threads)
+                new_coef = np.maximum(z - gradient / L, 0)
+                new_residual = sparse_matvec(X, new_coef,
+                                             num_threads=num_threads) - y
+                new_sse = np.dot(new_residual, new_residual) / 2
+                if new_sse > sse:
+                    if t == 1:
+                        # Even a plain gradient step went too far
+                        L *= 2
+                    # Restart the momentum from the last solution
+                    z, z_residual, t = coef, residual, 1.
+                    objective.append(sse)
+                    continue
+                new_t = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+                beta = (t - 1) / new_t
+                z = new_coef + beta * (new_coef - coef)
+                z_residual = new_residual + beta * (new_residual - residual)
+                t = new_t
+            else:
+                new_coef = np.maximum(coef - step * gradient, 0)
+                new_residual = sparse_matvec(X, new_coef,
+                                             num_threads=num_threads) - y
+                new_sse = np.dot(new_residual, new_residual) / 2
+                new_gradient = sparse_matvec(X, new_residual, transpose=True,
+                                             num_threads=num_threads)
+                s = new_coef - coef
+                sw = np.dot(s, new_gradient - gradient)
+                step = np.dot(s, s) / sw if sw > 0 else 1. / L
+                gradient = new_gradient
+
+            self.converged_ = abs(sse - new_sse) <= self.tol * sse
+            coef, residual, sse = new_coef, new_residual, new_sse
+            objective.append(sse)
+            if (self.checkpoint is not None and
+                    n_iter % self.checkpoint_iter == 0):
+                self._save(coef, n_iter, objective)
+
+        if self.checkpoint is not None:
+            self._save(coef, n_iter, objective)
+        self.coef_ = coef
+        self.n_iter_ = n_iter
+        self.objective_ = np.array(objective)
+        return self
+
+    def predict(self, X):
+        """
+        Predict using the result of the model
+
+        Parameters
+        ----------
+        X : sparse matrix or array of shape (n_samples, n_features)
+            Samples.
+
+        Returns
+        -------
+        C : array, shape = (n_samples,)
+            Predicted values.
+        """
+        return sparse_matvec(X, self.coef_, num_threads=self.num_threads)
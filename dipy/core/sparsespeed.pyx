@@ -0,0 +1,93 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""Multi-threaded products of sparse matrices and vectors.
+
+The matrices are given by the ``data``, ``indices`` and ``indptr`` arrays of
+a ``scipy.sparse.csr_matrix``.
+"""
+import numpy as np
+cimport numpy as cnp
+cimport cython
+from cython.parallel import parallel, prange, threadid
+
+from dipy.utils.omp import thread_count
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+
+ctypedef fused index_t:
+    cnp.int32_t
+    cnp.int64_t
+
+
+def csr_matvec(cython.floating[:] data, index_t[:] indices, index_t[:] indptr,
+               double[:] x, double[::1] out, num_threads=None):
+    """Computes ``out = A.dot(x)`` for a CSR matrix ``A``.
+
+    Parameters
+    ----------
+    data, indices, indptr : arrays
+        The CSR matrix ``A``, of shape (n, m).
+    x : array (m,)
+        The vector.
+    out : array (n,)
+        The result.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+    """
+    cdef:
+        cnp.npy_intp n_rows = indptr.shape[0] - 1
+        cnp.npy_intp i, j
+        double acc
+
+    set_num_threads(num_threads)
+    try:
+        with nogil:
+            for i in prange(n_rows, schedule='guided'):
+                acc = 0
+                for j in range(indptr[i], indptr[i + 1]):
+                    acc = acc + data[j] * x[indices[j]]
+                out[i] = acc
+    finally:
+        restore_default_num_threads()
+
+
+def csr_rmatvec(cython.floating[:] data, index_t[:] indices, index_t[:] indptr,
+                double[:] r, double[::1] out, num_threads=None):
+    """Computes ``out = A.T.dot(r)`` for a CSR matrix ``A``.
+
+    Each thread sums the rows it is given into its own vector, the vectors
+    are summed at the end.
+
+    Parameters
+    ----------
+    data, indices, indptr : arrays
+        The CSR matrix ``A``, of shape (n, m).
+    r : array (n,)
+        The vector.
+    out : array (m,)
+        The result.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+    """
+    cdef:
+        cnp.npy_intp n_rows = indptr.shape[0] - 1
+        cnp.npy_intp n_cols = out.shape[0]
+        cnp.npy_intp i, j, c, tid
+        double ri
+        double[:, ::1] partial
+
+    set_num_threads(num_threads)
+    try:
+        partial = np.zeros((thread_count(), n_cols))
+        with nogil, parallel():
+            tid = threadid()
+            for i in prange(n_rows, schedule='static'):
+                ri = r[i]
+                if ri != 0:
+                    for j in range(indptr[i], indptr[i + 1]):
+                        c = indices[j]
+                        partial[tid, c] = partial[tid, c] + data[j] * ri
+    finally:
+        restore_default_num_threads()
+    np.sum(partial, axis=0, out=np.asarray(out))
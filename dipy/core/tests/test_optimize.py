@@ -2,7 +2,10 @@ import numpy as np
 import scipy.sparse as sps
 
 import numpy.testing as npt
-from dipy.core.optimize import Optimizer, SCIPY_LESS_0_12, sparse_nnls, spdot
+from nibabel.tmpdirs import InTemporaryDirectory
+from dipy.core.optimize import (Optimizer, SCIPY_LESS_0_12, sparse_nnls,
+                                spdot, sparse_matvec,
+                                SparseNonNegativeLeastSquares)
 import dipy.core.optimize as opt
 
 
@@ -165,5 +168,67 @@ def test_sparse_nnls():
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
 
 
+def test_sparse_matvec():
+    rng = np.random.RandomState(0)
+    A = rng.randn(200, 30) * (rng.rand(200, 30) < 0.1)
+    x = rng.randn(30)
+    r = rng.randn(200)
+    for dtype in [np.float32, np.float64]:
+        for index_dtype in [np.int32, np.int64]:
+            A_sparse = sps.csr_matrix(A.astype(dtype))
+            A_sparse.indices = A_sparse.indices.astype(index_dtype)
+            A_sparse.indptr = A_sparse.indptr.astype(index_dtype)
+            for num_threads in [1, 2, None]:
+                npt.assert_array_almost_equal(
+                    sparse_matvec(A_sparse, x, num_threads=num_threads),
+                    np.dot(A, x), decimal=5)
+                npt.assert_array_almost_equal(
+                    sparse_matvec(A_sparse, r, transpose=True,
+                                  num_threads=num_threads),
+                    np.dot(A.T, r), decimal=5)
+    # Other formats are converted:
+    npt.assert_array_almost_equal(sparse_matvec(sps.coo_matrix(A), x),
+                                  np.dot(A, x))
+    # And other dtypes
+    A_int = np.round(A * 10).astype(int)
+    npt.assert_array_almost_equal(sparse_matvec(sps.csr_matrix(A_int), x),
+                                  np.dot(A_int, x))
+
+
+def test_sparse_non_negative_least_squares():
+    rng = np.random.RandomState(1)
+    X = rng.rand(500, 40) * (rng.rand(500, 40) < 0.3)
+    beta = rng.rand(40) * (rng.rand(40) < 0.5)
+    y = np.dot(X, beta) + 0.01 * rng.randn(500)
+    expected = opt.opt.nnls(X, y)[0]
+    for method in ['fista', 'bb']:
+        solver = SparseNonNegativeLeastSquares(method, max_iter=5000,
+                                               tol=1e-12)
+        solver.fit(sps.csr_matrix(X), y)
+        npt.assert_(solver.converged_)
+        npt.assert_equal(len(solver.objective_), solver.n_iter_)
+        npt.assert_array_almost_equal(solver.coef_, expected, decimal=3)
+        npt.assert_array_almost_equal(solver.predict(X), np.dot(X, expected),
+                                      decimal=2)
+        # FISTA never increases the error
+        if method == 'fista':
+            npt.assert_(np.all(np.diff(solver.objective_) <= 0))
+
+    # The fit can be checkpointed and resumed
+    with InTemporaryDirectory():
+        solver = SparseNonNegativeLeastSquares(max_iter=10, tol=0,
+                                               checkpoint='fit.npz',
+                                               checkpoint_iter=3)
+        solver.fit(X, y)
+        npt.assert_equal(np.load('fit.npz')['n_iter'], 10)
+        solver.max_iter = 25
+        solver.fit(X, y)
+        npt.assert_equal(solver.n_iter_, 25)
+        npt.assert_equal(len(solver.objective_), 25)
+        npt.assert_(solver.objective_[-1] <= solver.objective_[9])
+
+    npt.assert_raises(ValueError, SparseNonNegativeLeastSquares, 'newton')
+
+
 if __name__ == '__main__':
     npt.run_module_suite()
@@ -0,0 +1,527 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+Probability mass functions (pmf) on the sphere, and the sampling of tracking
+directions from them, for the direction getters of
+:mod:`dipy.direction.probabilistic_direction_getter`.
+"""
+import numpy as np
+cimport numpy as cnp
+cimport cython
+
+from libc.math cimport floor, ldexp, INFINITY, NAN
+
+from dipy.reconst.shm import order_from_ncoef, sph_harm_lookup
+from dipy.tracking.local.direction_getter cimport DirectionGetter
+
+
+cdef inline double _half_to_double(cnp.uint16_t h) nogil:
+    """Decodes the bits of an IEEE 754 half precision float"""
+    cdef:
+        int exponent = (h >> 10) & 0x1f
+        int mantissa = h & 0x3ff
+        double value
+    if exponent == 0:
+        value = ldexp(mantissa, -24)
+    elif exponent == 31:
+        value = NAN if mantissa else INFINITY
+    else:
+        value = ldexp(mantissa + 1024, exponent - 25)
+    return -value if h >> 15 else value
+
+
+cdef inline int _trilinear_weights(double *point, cnp.npy_intp[:] shape,
+                                   cnp.npy_intp index[3][2],
+                                   double weight[3][2]) nogil:
+    """Voxels and weights of the trilinear interpolation at `point`, as in
+    :func:`dipy.tracking.local.interpolation.trilinear_interpolate4d`.
+    Returns -1 if `point` is outside the volume."""
+    cdef:
+        cnp.npy_intp i, flr
+        double rem
+    for i in range(3):
+        if point[i] < -.5 or point[i] >= (shape[i] - .5):
+            return -1
+        flr = <cnp.npy_intp> floor(point[i])
+        rem = point[i] - flr
+        index[i][0] = flr + (flr == -1)
+        index[i][1] = flr + (flr != (shape[i] - 1))
+        weight[i][0] = 1 - rem
+        weight[i][1] = rem
+    return 0
+
+
+cdef class PmfGen:
+    """Base class of the generators of pmfs on a sphere.
+
+    Subclasses implement ``get_pmf_c``. Python subclasses can instead
+    override ``get_pmf``.
+    """
+    cdef:
+        public cnp.npy_intp n_vertices
+        cnp.npy_intp[::1] shape
+
+    def get_pmf(self, double[::1] point):
+        """The pmf at `point`.
+
+        Parameters
+        ----------
+        point : ndarray, shape (3,)
+            The point in voxel coordinates.
+
+        Returns
+        -------
+        pmf : ndarray, shape (n_vertices,)
+        """
+        pmf = np.empty(self.n_vertices)
+        cdef double[::1] out = pmf
+        if point.shape[0] != 3:
+            raise ValueError("Point must be a 1d array with shape (3,).")
+        if self.get_pmf_c(&point[0], &out[0]) < 0:
+            raise IndexError("The point point is outside data")
+        return pmf
+
+    cdef int get_pmf_c(self, double *point, double *out) except -2:
+        """Writes the pmf at `point` in `out`. Returns -1 if `point` is
+        outside the data."""
+        raise NotImplementedError()
+
+
+cdef class SimplePmfGen(PmfGen):
+    """Trilinear interpolation of a volume of pmfs.
+
+    The volume can be float64, float32, float16 or uint8. uint8 volumes hold
+    quantized pmfs that are multiplied by the `scale` of their voxel. The
+    volume can be a memory-map (opened in 'c' or 'r+' mode).
+    """
+    cdef:
+        readonly object pmf_array, scale
+        int kind
+        double[:, :, :, ::1] _f64
+        float[:, :, :, ::1] _f32
+        cnp.uint16_t[:, :, :, ::1] _f16
+        cnp.uint8_t[:, :, :, ::1] _u8
+        float[:, :, ::1] _scale
+
+    def __init__(self, pmf_array, scale=None):
+        """
+        Parameters
+        ----------
+        pmf_array : array, 4d
+            The pmf of each voxel.
+        scale : array, 3d, optional
+            The scale of the quantized pmfs of each voxel, if `pmf_array` is
+            uint8. Default: 1.
+        """
+        if pmf_array.dtype.kind == 'f' and pmf_array.min() < 0:
+            raise ValueError("pmf should not have negative values")
+        if pmf_array.dtype not in (np.float32, np.float16, np.uint8):
+            pmf_array = np.asarray(pmf_array, dtype=np.float64)
+        if not pmf_array.flags.c_contiguous:
+            pmf_array = np.ascontiguousarray(pmf_array)
+        self.pmf_array = pmf_array
+        self.shape = np.array(pmf_array.shape[:3], dtype=np.intp)
+        self.n_vertices = pmf_array.shape[3]
+        if pmf_array.dtype == np.float64:
+            self.kind = 0
+            self._f64 = pmf_array
+        elif pmf_array.dtype == np.float32:
+            self.kind = 1
+            self._f32 = pmf_array
+        elif pmf_array.dtype == np.float16:
+            self.kind = 2
+            self._f16 = pmf_array.view(np.uint16)
+        else:
+            self.kind = 3
+            self._u8 = pmf_array
+            if scale is None:
+                scale = np.ones(pmf_array.shape[:3], dtype=np.float32)
+            scale = np.ascontiguousarray(scale, dtype=np.float32)
+            if scale.shape != pmf_array.shape[:3]:
+                raise ValueError("scale should have the shape of the volume")
+            self.scale = scale
+            self._scale = scale
+
+    cdef int get_pmf_c(self, double *point, double *out) except -2:
+        cdef:
+            cnp.npy_intp index[3][2]
+            double weight[3][2]
+            cnp.npy_intp i, j, k, v, x, y, z
+            double w
+
+        if _trilinear_weights(point, self.shape, index, weight) < 0:
+            return -1
+        for v in range(self.n_vertices):
+            out[v] = 0
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    w = weight[0][i] * weight[1][j] * weight[2][k]
+                    if w == 0:
+                        continue
+                    x = index[0][i]
+                    y = index[1][j]
+                    z = index[2][k]
+                    if self.kind == 0:
+                        for v in range(self.n_vertices):
+                            out[v] += w * self._f64[x, y, z, v]
+                    elif self.kind == 1:
+                        for v in range(self.n_vertices):
+                            out[v] += w * self._f32[x, y, z, v]
+                    elif self.kind == 2:
+                        for v in range(self.n_vertices):
+                            out[v] += w * _half_to_double(self._f16[x, y, z,
+                                                                    v])
+                    else:
+                        w = w * self._scale[x, y, z]
+                        for v in range(self.n_vertices):
+                            out[v] += w * self._u8[x, y, z, v]
+        return 0
+
+
+cdef class SHCoeffPmfGen(PmfGen):
+    """Pmfs evaluated on the fly from spherical harmonics coefficients.
+
+    The spherical function of the voxels used by the trilinear interpolation
+    are kept in a least recently used (LRU) cache. As the evaluation is
+    linear, the pmf is the same as when the coefficients are interpolated.
+    """
+    cdef:
+        readonly object shcoeff
+        readonly object sphere
+        readonly cnp.npy_intp cache_size
+        public cnp.npy_intp cache_hits, cache_misses
+        double[:, :, :, ::1] _coeff
+        double[:, ::1] _B
+        double[::1] _interp
+        # The cache: the voxel and the value of each slot, with a doubly
+        # linked list of the slots from the most to the least recently used
+        dict _slots
+        cnp.npy_intp[::1] _keys, _prev, _next
+        double[:, ::1] _values
+        cnp.npy_intp _head, _tail, _used
+
+    def __init__(self, shcoeff, sphere, basis_type, cache_size=1000):
+        """
+        Parameters
+        ----------
+        shcoeff : array, 4d
+            The spherical harmonics coefficients of each voxel.
+        sphere : Sphere
+            The pmfs are evaluated on the vertices of `sphere`.
+        basis_type : name of basis
+            The basis that ``shcoeff`` are associated with.
+        cache_size : int, optional
+            The number of voxels whose spherical function is cached. If 0,
+            the coefficients are interpolated and evaluated at each call.
+            Default: 1000.
+        """
+        self.shcoeff = shcoeff
+        self.sphere = sphere
+        sh_order = order_from_ncoef(shcoeff.shape[3])
+        try:
+            basis = sph_harm_lookup[basis_type]
+        except KeyError:
+            raise ValueError("%s is not a known basis type." % basis_type)
+        B, m, n = basis(sh_order, sphere.theta, sphere.phi)
+        self._B = np.ascontiguousarray(B, dtype=np.float64)
+        self._coeff = np.ascontiguousarray(shcoeff, dtype=np.float64)
+        self._interp = np.empty(shcoeff.shape[3])
+        self.shape = np.array(shcoeff.shape[:3], dtype=np.intp)
+        self.n_vertices = B.shape[0]
+        self.cache_size = max(cache_size, 0)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._slots = {}
+        self._keys = np.empty(self.cache_size, dtype=np.intp)
+        self._prev = np.empty(self.cache_size, dtype=np.intp)
+        self._next = np.empty(self.cache_size, dtype=np.intp)
+        self._values = np.empty((self.cache_size, self.n_vertices))
+        self._head = -1
+        self._tail = -1
+        self._used = 0
+
+    @property
+    def B(self):
+        """The spherical harmonics evaluated on the vertices of the sphere"""
+        return np.asarray(self._B)
+
+    cdef void _unlink(self, cnp.npy_intp slot):
+        if self._prev[slot] >= 0:
+            self._next[self._prev[slot]] = self._next[slot]
+        else:
+            self._head = self._next[slot]
+        if self._next[slot] >= 0:
+            self._prev[self._next[slot]] = self._prev[slot]
+        else:
+            self._tail = self._prev[slot]
+
+    cdef void _push_front(self, cnp.npy_intp slot):
+        self._prev[slot] = -1
+        self._next[slot] = self._head
+        if self._head >= 0:
+            self._prev[self._head] = slot
+        self._head = slot
+        if self._tail < 0:
+            self._tail = slot
+
+    cdef double *_voxel_sf(self, cnp.npy_intp x, cnp.npy_intp y,
+                           cnp.npy_intp z):
+        """The (cached) spherical function of a voxel"""
+        cdef:
+            cnp.npy_intp key, slot, v, c
+            double acc
+        key = (x * self.shape[1] + y) * self.shape[2] + z
+        found = self._slots.get(key)
+        if found is not None:
+            slot = found
+            self.cache_hits += 1
+            if slot != self._head:
+                self._unlink(slot)
+                self._push_front(slot)
+            return &self._values[slot, 0]
+
+        self.cache_misses += 1
+        if self._used < self.cache_size:
+            slot = self._used
+            self._used += 1
+        else:
+            # Evict the least recently used voxel
+            slot = self._tail
+            self._unlink(slot)
+            del self._slots[self._keys[slot]]
+        for v in range(self.n_vertices):
+            acc = 0
+            for c in range(self._B.shape[1]):
+                acc += self._B[v, c] * self._coeff[x, y, z, c]
+            self._values[slot, v] = acc
+        self._keys[slot] = key
+        self._slots[key] = slot
+        self._push_front(slot)
+        return &self._values[slot, 0]
+
+    cdef int get_pmf_c(self, double *point, double *out) except -2:
+        cdef:
+            cnp.npy_intp index[3][2]
+            double weight[3][2]
+            cnp.npy_intp i, j, k, v, c
+            double w, acc
+            double *sf
+
+        if _trilinear_weights(point, self.shape, index, weight) < 0:
+            return -1
+
+        if self.cache_size == 0:
+            # Interpolate the coefficients, then evaluate them
+            for c in range(self._coeff.shape[3]):
+                self._interp[c] = 0
+            for i in range(2):
+                for j in range(2):
+                    for k in range(2):
+                        w = weight[0][i] * weight[1][j] * weight[2][k]
+                        for c in range(self._coeff.shape[3]):
+                            self._interp[c] += w * self._coeff[index[0][i],
+                                                               index[1][j],
+                                                               index[2][k], c]
+            for v in range(self.n_vertices):
+                acc = 0
+                for c in range(self._coeff.shape[3]):
+                    acc += self._B[v, c] * self._interp[c]
+                out[v] = acc if acc > 0 else 0
+            return 0
+
+        for v in range(self.n_vertices):
+            out[v] = 0
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    w = weight[0][i] * weight[1][j] * weight[2][k]
+                    if w == 0:
+                        continue
+                    sf = self._voxel_sf(index[0][i], index[1][j], index[2][k])
+                    for v in range(self.n_vertices):
+                        out[v] += w * sf[v]
+        for v in range(self.n_vertices):
+            if out[v] < 0:
+                out[v] = 0
+        return 0
+
+    def precompute(self, dtype=np.float64, filename=None):
+        """Evaluates the pmfs of all the voxels.
+
+        Parameters
+        ----------
+        dtype : float64, float32, float16 or uint8, optional
+            The type of the pmf volume. uint8 pmfs are quantized with a scale
+            for each voxel, so the largest value of each pmf is 255.
+        filename : str, optional
+            If given, the volume is written to this .npy file and
+            memory-mapped instead of being held in memory.
+
+        Returns
+        -------
+        pmf_gen : SimplePmfGen
+            Interpolates the pmfs of the voxels. The pmfs are clipped to
+            positive values before they are interpolated rather than after.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float64, np.float32, np.float16, np.uint8):
+            raise ValueError("dtype should be float64, float32, float16 or "
+                             "uint8")
+        shape = tuple(self.shape) + (self.n_vertices,)
+        if filename is None:
+            pmf = np.empty(shape, dtype=dtype)
+        else:
+            pmf = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                            shape=shape)
+        scale = None
+        if dtype == np.uint8:
+            scale = np.zeros(shape[:3], dtype=np.float32)
+        B = self.B
+        coeff = np.asarray(self._coeff)
+        # One slab at a time, to bound the memory used
+        for x in range(shape[0]):
+            sf = np.dot(coeff[x], B.T)
+            sf.clip(0, out=sf)
+            if dtype == np.uint8:
+                scale[x] = sf.max(-1) / 255.
+                nonzero = scale[x] > 0
+                sf[nonzero] /= scale[x][nonzero][:, None]
+                sf = np.round(sf)
+            pmf[x] = sf
+        if filename is not None:
+            pmf.flush()
+            del pmf
+            # Opened copy-on-write, as the volume needs a writable buffer
+            pmf = np.load(filename, mmap_mode='c')
+        return SimplePmfGen(pmf, scale)
+
+
+cdef class PmfDirectionGetter(DirectionGetter):
+    """Samples tracking directions from the pmfs of a `PmfGen`.
+
+    The directions within the maximal angle of each vertex are precomputed
+    as an adjacency list, so that only these are visited at each step.
+    """
+    cdef:
+        public double pmf_threshold
+        public object pmf_gen
+        PmfGen _pmf_gen
+        double[:, ::1] _vertices
+        cnp.npy_intp[::1] _adj_indptr, _adj_indices
+        dict _vertex_index
+        double[::1] _pmf
+        bint _maximum
+
+    def _set_pmf_gen(self, pmf_gen, vertices, cos_similarity, pmf_threshold,
+                     maximum=False):
+        """Sets the pmf generator and precomputes the cones of directions.
+
+        Parameters
+        ----------
+        pmf_gen : PmfGen
+        vertices : array (N, 3)
+            The directions of the pmfs.
+        cos_similarity : float
+            The cosine of the maximal angle between two steps.
+        pmf_threshold : float
+            Pmf values below this threshold are ignored.
+        maximum : bool, optional
+            Whether to take the most probable direction instead of sampling.
+        """
+        self.pmf_gen = pmf_gen
+        self.pmf_threshold = pmf_threshold
+        self._maximum = maximum
+        # The pmf of PmfGen subclasses overriding get_pmf in Python is not
+        # computed in C
+        if (isinstance(pmf_gen, PmfGen) and
+                type(pmf_gen).get_pmf is PmfGen.get_pmf):
+            self._pmf_gen = pmf_gen
+        else:
+            self._pmf_gen = None
+        vertices = np.array(vertices, dtype=np.float64, order='C')
+        self._vertices = vertices
+        self._pmf = np.empty(len(vertices))
+        adjacency = abs(np.dot(vertices, vertices.T)) >= cos_similarity
+        self._adj_indptr = np.concatenate(
+            [[0], np.cumsum(adjacency.sum(1))]).astype(np.intp)
+        self._adj_indices = np.nonzero(adjacency)[1].astype(np.intp)
+        self._vertex_index = {}
+        for i in range(len(vertices) - 1, -1, -1):
+            self._vertex_index[tuple(-vertices[i])] = i
+        for i in range(len(vertices) - 1, -1, -1):
+            self._vertex_index[tuple(vertices[i])] = i
+
+    cpdef int get_direction(self,
+                            double[::1] point,
+                            double[::1] direction) except -1:
+        """Samples a pmf to updates ``direction`` array with a new direction.
+
+        Parameters
+        ----------
+        point : memory-view (or ndarray), shape (3,)
+            The point in an image at which to lookup tracking directions.
+        direction : memory-view (or ndarray), shape (3,)
+            Previous tracking direction.
+
+        Returns
+        -------
+        status : int
+            Returns 0 `direction` was updated with a new tracking direction, or
+            1 otherwise.
+        """
+        cdef:
+            double[::1] pmf
+            cnp.npy_intp vertex, idx, j, n
+            double total, value, best, dot
+
+        if self._pmf_gen is not None:
+            pmf = self._pmf
+            if self._pmf_gen.get_pmf_c(&point[0], &pmf[0]) < 0:
+                raise IndexError("The point point is outside data")
+        else:
+            pmf = np.asarray(self.pmf_gen.get_pmf(point), dtype=np.float64)
+
+        vertex = self._vertex_index[(direction[0], direction[1],
+                                     direction[2])]
+        idx = -1
+        if self._maximum:
+            # The first of the most probable directions in the cone
+            best = 0
+            for j in range(self._adj_indptr[vertex],
+                           self._adj_indptr[vertex + 1]):
+                n = self._adj_indices[j]
+                value = pmf[n]
+                if value >= self.pmf_threshold and value > best:
+                    best = value
+                    idx = n
+        else:
+            total = 0
+            for j in range(self._adj_indptr[vertex],
+                           self._adj_indptr[vertex + 1]):
+                value = pmf[self._adj_indices[j]]
+                if value >= self.pmf_threshold:
+                    total += value
+            if total > 0:
+                # Sample the cumulative distribution of the cone
+                value = np.random.random() * total
+                total = 0
+                for j in range(self._adj_indptr[vertex],
+                               self._adj_indptr[vertex + 1]):
+                    n = self._adj_indices[j]
+                    if pmf[n] >= self.pmf_threshold:
+                        total += pmf[n]
+                        idx = n
+                        if total > value:
+                            break
+        if idx < 0:
+            return 1
+
+        dot = 0
+        for j in range(3):
+            dot += self._vertices[idx, j] * direction[j]
+        for j in range(3):
+            if dot > 0:
+                direction[j] = self._vertices[idx, j]
+            else:
+                direction[j] = -self._vertices[idx, j]
+        return 0
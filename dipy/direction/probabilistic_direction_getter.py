@@ -3,50 +3,9 @@ Implementation of a probabilistic direction getter based on sampling from
 discrete distribution (pmf) at each step of the tracking."""
 import numpy as np
 from dipy.direction.peaks import peak_directions, default_sphere
-from dipy.reconst.shm import order_from_ncoef, sph_harm_lookup
+from dipy.direction.pmf import (PmfGen, SimplePmfGen, SHCoeffPmfGen,
+                                PmfDirectionGetter)
 from dipy.tracking.local.direction_getter import DirectionGetter
-from dipy.tracking.local.interpolation import trilinear_interpolate4d
-
-
-def _asarray(cython_memview):
-    # TODO: figure out the best way to get an array from a memory view.
-    # `np.array(view)` works, but is quite slow. Views are also "array_like",
-    # but using them as arrays seems to also be quite slow.
-    return np.fromiter(cython_memview, float)
-
-
-class PmfGen(object):
-    pass
-
-
-class SimplePmfGen(PmfGen):
-
-    def __init__(self, pmf_array):
-        if pmf_array.min() < 0:
-            raise ValueError("pmf should not have negative values")
-        self.pmf_array = pmf_array
-
-    def get_pmf(self, point):
-        return trilinear_interpolate4d(self.pmf_array, point)
-
-
-class SHCoeffPmfGen(PmfGen):
-
-    def __init__(self, shcoeff, sphere, basis_type):
-        self.shcoeff = shcoeff
-        self.sphere = sphere
-        sh_order = order_from_ncoef(shcoeff.shape[-1])
-        try:
-            basis = sph_harm_lookup[basis_type]
-        except KeyError:
-            raise ValueError("%s is not a known basis type." % basis_type)
-        self._B, m, n = basis(sh_order, sphere.theta, sphere.phi)
-
-    def get_pmf(self, point):
-        coeff = trilinear_interpolate4d(self.shcoeff, point)
-        pmf = np.dot(self._B, coeff)
-        pmf.clip(0, out=pmf)
-        return pmf
 
 
 class PeakDirectionGetter(DirectionGetter):
@@ -69,7 +28,7 @@ class PeakDirectionGetter(DirectionGetter):
         return peak_directions(blob, self.sphere, **self._pf_kwargs)[0]
 
 
-class ProbabilisticDirectionGetter(PeakDirectionGetter):
+class ProbabilisticDirectionGetter(PmfDirectionGetter, PeakDirectionGetter):
     """Randomly samples direction of a sphere based on probability mass
     function (pmf).
 
@@ -79,7 +38,13 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
     directions more than ``max_angle`` degrees from the incoming direction are
     set to 0 and the result is normalized.
 
+    The pmf can be evaluated on the fly, or precomputed for all the voxels
+    (see ``from_shcoeff``). Only the directions within ``max_angle`` degrees
+    of the incoming direction are visited at each step.
+
     """
+    _maximum = False
+
     @classmethod
     def from_pmf(klass, pmf, max_angle, sphere, pmf_threshold=0.1, **kwargs):
         """Constructor for making a DirectionGetter from an array of Pmfs
@@ -87,7 +52,8 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
         Parameters
         ----------
         pmf : array, 4d
-            The pmf to be used for tracking at each voxel.
+            The pmf to be used for tracking at each voxel. float64, float32
+            and float16 arrays, including memory-maps, are used as they are.
         max_angle : float, [0, 90]
             The maximum allowed angle between incoming direction and new
             direction.
@@ -109,7 +75,9 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
 
 
         """
-        pmf = np.asarray(pmf, dtype=float)
+        pmf = np.asarray(pmf)
+        if pmf.dtype not in (np.float32, np.float16, np.uint8):
+            pmf = np.asarray(pmf, dtype=float)
         if pmf.ndim != 4:
             raise ValueError("pmf should be a 4d array.")
         if pmf.shape[3] != len(sphere.theta):
@@ -121,7 +89,8 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
 
     @classmethod
     def from_shcoeff(klass, shcoeff, max_angle, sphere, pmf_threshold=0.1,
-                     basis_type=None, **kwargs):
+                     basis_type=None, precompute=False, pmf_dtype=np.float64,
+                     filename=None, cache_size=1000, **kwargs):
         """Probabilistic direction getter from a distribution of directions
         on the sphere.
 
@@ -145,6 +114,19 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
         basis_type : name of basis
             The basis that ``shcoeff`` are associated with.
             ``dipy.reconst.shm.real_sym_sh_basis`` is used by default.
+        precompute : bool, optional
+            Whether to evaluate the pmf of all the voxels before tracking,
+            rather than at each step. The pmf of each voxel is then clipped to
+            positive values before it is interpolated. Default: False.
+        pmf_dtype : float64, float32, float16 or uint8, optional
+            The type of the precomputed pmfs. uint8 pmfs are quantized with a
+            scale for each voxel. Default: float64.
+        filename : str, optional
+            If given, the precomputed pmfs are saved to this .npy file and
+            memory-mapped.
+        cache_size : int, optional
+            If the pmf is not precomputed, the number of voxels whose pmf is
+            kept in a least recently used cache. Default: 1000.
         relative_peak_threshold : float in [0., 1.]
             Used for extracting initial tracking directions. Passed to
             peak_directions.
@@ -157,7 +139,10 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
         dipy.direction.peaks.peak_directions
 
         """
-        pmf_gen = SHCoeffPmfGen(shcoeff, sphere, basis_type)
+        pmf_gen = SHCoeffPmfGen(shcoeff, sphere, basis_type,
+                                cache_size=cache_size)
+        if precompute:
+            pmf_gen = pmf_gen.precompute(pmf_dtype, filename)
         return klass(pmf_gen, max_angle, sphere, pmf_threshold, **kwargs)
 
     def __init__(self, pmf_gen, max_angle, sphere=None, pmf_threshold=0.1,
@@ -190,24 +175,11 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
 
         """
         PeakDirectionGetter.__init__(self, sphere, **kwargs)
-        self.pmf_gen = pmf_gen
-        self.pmf_threshold = pmf_threshold
         # The vertices need to be in a contiguous array
         self.vertices = self.sphere.vertices.copy()
         cos_similarity = np.cos(np.deg2rad(max_angle))
-        self._set_adjacency_matrix(sphere, cos_similarity)
-
-    def _set_adjacency_matrix(self, sphere, cos_similarity):
-        """Creates a dictionary where each key is a direction from sphere and
-        each value is a boolean array indicating which directions are less than
-        max_angle degrees from the key"""
-        matrix = np.dot(sphere.vertices, sphere.vertices.T)
-        matrix = abs(matrix) >= cos_similarity
-        keys = [tuple(v) for v in sphere.vertices]
-        adj_matrix = dict(zip(keys, matrix))
-        keys = [tuple(-v) for v in sphere.vertices]
-        adj_matrix.update(zip(keys, matrix))
-        self._adj_matrix = adj_matrix
+        self._set_pmf_gen(pmf_gen, self.vertices, cos_similarity,
+                          pmf_threshold, self._maximum)
 
     def initial_direction(self, point):
         """Returns best directions at seed location to start tracking.
@@ -227,73 +199,9 @@ class ProbabilisticDirectionGetter(PeakDirectionGetter):
         pmf = self.pmf_gen.get_pmf(point)
         return self._peak_directions(pmf)
 
-    def get_direction(self, point, direction):
-        """Samples a pmf to updates ``direction`` array with a new direction.
-
-        Parameters
-        ----------
-        point : memory-view (or ndarray), shape (3,)
-            The point in an image at which to lookup tracking directions.
-        direction : memory-view (or ndarray), shape (3,)
-            Previous tracking direction.
-
-        Returns
-        -------
-        status : int
-            Returns 0 `direction` was updated with a new tracking direction, or
-            1 otherwise.
-
-        """
-        # point and direction are passed in as cython memory views
-        pmf = self.pmf_gen.get_pmf(point)
-        pmf[pmf < self.pmf_threshold] = 0
-        cdf = (self._adj_matrix[tuple(direction)] * pmf).cumsum()
-        if cdf[-1] == 0:
-            return 1
-        random_sample = np.random.random() * cdf[-1]
-        idx = cdf.searchsorted(random_sample, 'right')
-
-        newdir = self.vertices[idx]
-        # Update direction and return 0 for error
-        if np.dot(newdir, _asarray(direction)) > 0:
-            direction[:] = newdir
-        else:
-            direction[:] = -newdir
-        return 0
-
 
 class DeterministicMaximumDirectionGetter(ProbabilisticDirectionGetter):
     """Return direction of a sphere with the highest probability mass
     function (pmf).
     """
-    def get_direction(self, point, direction):
-        """Find direction with the highest pmf to updates ``direction`` array
-        with a new direction.
-        Parameters
-        ----------
-        point : memory-view (or ndarray), shape (3,)
-            The point in an image at which to lookup tracking directions.
-        direction : memory-view (or ndarray), shape (3,)
-            Previous tracking direction.
-        Returns
-        -------
-        status : int
-            Returns 0 `direction` was updated with a new tracking direction, or
-            1 otherwise.
-        """
-        # point and direction are passed in as cython memory views
-        pmf = self.pmf_gen.get_pmf(point)
-        pmf[pmf < self.pmf_threshold] = 0
-        cdf = self._adj_matrix[tuple(direction)] * pmf
-        idx = np.argmax(cdf)
-
-        if pmf[idx] == 0:
-            return 1
-
-        newdir = self.vertices[idx]
-        # Update direction and return 0 for error
-        if np.dot(newdir, _asarray(direction)) > 0:
-            direction[:] = newdir
-        else:
-            direction[:] = -newdir
-        return 0
+    _maximum = True
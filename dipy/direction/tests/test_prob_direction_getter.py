@@ -1,9 +1,16 @@
 import numpy as np
 import numpy.testing as npt
 
+from nibabel.tmpdirs import InTemporaryDirectory
+
 from dipy.core.sphere import unit_octahedron
-from dipy.reconst.shm import SphHarmFit, SphHarmModel
-from dipy.direction import ProbabilisticDirectionGetter
+from dipy.data import get_sphere
+from dipy.reconst.shm import SphHarmFit, SphHarmModel, sph_harm_lookup
+from dipy.direction import (ProbabilisticDirectionGetter,
+                            DeterministicMaximumDirectionGetter)
+from dipy.direction.probabilistic_direction_getter import (SimplePmfGen,
+                                                           SHCoeffPmfGen)
+from dipy.tracking.local.interpolation import trilinear_interpolate4d
 
 
 def test_ProbabilisticDirectionGetter():
@@ -62,3 +69,77 @@ def test_ProbabilisticDirectionGetter():
                       fit.shm_coeff, 90, unit_octahedron,
                       pmf_threshold=0.1,
                       basis_type="not a basis")
+
+
+def test_PmfGen():
+    # The pmf generators agree with the interpolation of the pmfs
+    sphere = get_sphere('repulsion100')
+    rng = np.random.RandomState(0)
+    shcoeff = rng.randn(4, 4, 4, 15)
+    B, m, n = sph_harm_lookup[None](4, sphere.theta, sphere.phi)
+    sf = np.dot(shcoeff, B.T)
+    pmf = sf.clip(0)
+    points = rng.uniform(-.5, 3.4, (50, 3))
+
+    simple = SimplePmfGen(pmf)
+    for point in points:
+        npt.assert_array_almost_equal(simple.get_pmf(point),
+                                      trilinear_interpolate4d(pmf, point))
+    npt.assert_raises(IndexError, simple.get_pmf, np.array([-1., 0, 0]))
+
+    # The cached spherical functions give the same pmfs
+    for cache_size in [0, 2, 1000]:
+        pmf_gen = SHCoeffPmfGen(shcoeff, sphere, None, cache_size=cache_size)
+        for point in points:
+            expected = trilinear_interpolate4d(sf, point).clip(0)
+            npt.assert_array_almost_equal(pmf_gen.get_pmf(point), expected)
+    npt.assert_(pmf_gen.cache_hits > 0)
+    npt.assert_equal(pmf_gen.cache_misses, 4 ** 3)
+
+    # Precomputed pmfs, in memory or memory-mapped
+    pmf_gen = SHCoeffPmfGen(shcoeff, sphere, None)
+    with InTemporaryDirectory():
+        for dtype, decimal in [(np.float64, 10), (np.float32, 5),
+                               (np.float16, 2), (np.uint8, 1)]:
+            for filename in [None, 'pmf.npy']:
+                pre = pmf_gen.precompute(dtype, filename)
+                npt.assert_equal(pre.pmf_array.dtype, dtype)
+                for point in points:
+                    npt.assert_array_almost_equal(
+                        pre.get_pmf(point),
+                        trilinear_interpolate4d(pmf, point), decimal)
+            del pre
+    npt.assert_raises(ValueError, pmf_gen.precompute, np.int32)
+
+
+def test_DirectionGetter_precompute():
+    # Tracking directions within the cone of the incoming direction
+    sphere = get_sphere('repulsion100')
+    shcoeff = np.random.RandomState(1).randn(3, 3, 3, 15)
+    point = np.ones(3)
+    cos_similarity = np.cos(np.deg2rad(30))
+    for klass in [ProbabilisticDirectionGetter,
+                  DeterministicMaximumDirectionGetter]:
+        for kwargs in [{}, {'cache_size': 0},
+                       {'precompute': True, 'pmf_dtype': np.float16}]:
+            dg = klass.from_shcoeff(shcoeff, 30, sphere, pmf_threshold=0.,
+                                    **kwargs)
+            for v in sphere.vertices:
+                direction = v.copy()
+                if dg.get_direction(point, direction) == 0:
+                    npt.assert_(np.dot(v, direction) >= cos_similarity - 1e-7)
+                    cos = abs(np.dot(sphere.vertices, direction)).max()
+                    npt.assert_almost_equal(cos, 1)
+
+    # No direction is returned if the pmf of the cone is below the threshold
+    pmf = np.zeros((3, 3, 3, len(sphere.vertices)))
+    pmf[..., 0] = 1
+    far = np.argmin(abs(np.dot(sphere.vertices, sphere.vertices[0])))
+    for klass in [ProbabilisticDirectionGetter,
+                  DeterministicMaximumDirectionGetter]:
+        dg = klass.from_pmf(pmf.astype(np.float32), 30, sphere)
+        direction = sphere.vertices[far].copy()
+        npt.assert_equal(dg.get_direction(point, direction), 1)
+        direction = sphere.vertices[0].copy()
+        npt.assert_equal(dg.get_direction(point, direction), 0)
+        npt.assert_array_almost_equal(direction, sphere.vertices[0])
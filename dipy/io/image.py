@@ -1,5 +1,11 @@
 from __future__ import division, print_function, absolute_import
 
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
 import nibabel as nib
 
 
@@ -21,3 +27,91 @@ def load_nifti(fname, return_img=False, return_voxsize=False):
 def save_nifti(fname, data, affine, hdr=None):
     result_img = nib.Nifti1Image(data, affine, header=hdr)
     result_img.to_filename(fname)
+
+
+class NiftiSlabWriter(object):
+    """Writes a NIfTI image to disk one piece at a time
+
+    The header is written when the writer is created and the data are
+    memory-mapped, so the image never needs to be held in memory. Assign to
+    the writer like to an array of shape `shape` and call ``close`` (or use
+    the writer as a context manager) when done. Images with a ``.gz``
+    extension are first written to an uncompressed temporary file in the
+    same directory, which is compressed on ``close``.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name, ``.nii`` or ``.nii.gz``.
+    shape : tuple
+        Shape of the image.
+    affine : ndarray (4, 4)
+        Affine of the image.
+    dtype : dtype, optional
+        Data type of the image. Default: float32.
+    hdr : Nifti1Header, optional
+        Header used as a template for the image header.
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'slabs.nii.gz')
+    >>> with NiftiSlabWriter(fname, (2, 3, 4), np.eye(4)) as writer:
+    ...     for z in range(4):
+    ...         writer[:, :, z] = z
+    >>> nib.load(fname).get_data()[1, 2]
+    array([ 0.,  1.,  2.,  3.], dtype=float32)
+    """
+    def __init__(self, fname, shape, affine, dtype=np.float32, hdr=None):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        img = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                              affine, header=hdr)
+        header = img.header
+        header.set_data_shape(shape)
+        header.set_data_dtype(dtype)
+        # The data are written as is, so drop any scaling of the template
+        header.set_slope_inter(None, None)
+        offset = int(header.single_vox_offset +
+                     header.extensions.get_sizeondisk())
+        header['vox_offset'] = offset
+        self.fname = fname
+        if fname.endswith('.gz'):
+            fd, self._raw_fname = tempfile.mkstemp(
+                suffix='.nii', dir=os.path.dirname(os.path.abspath(fname)))
+            os.close(fd)
+        else:
+            self._raw_fname = fname
+        with open(self._raw_fname, 'wb') as f:
+            header.write_to(f)
+            f.write(b'\x00' * (offset - f.tell()))
+        self._data = np.memmap(self._raw_fname, dtype=dtype, mode='r+',
+                               offset=offset, shape=shape, order='F')
+
+    @property
+    def shape(self):
+        return self._data.shape
+
+    def __setitem__(self, index, value):
+        self._data[index] = value
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def close(self):
+        """Flushes the data to disk, compressing them if needed"""
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+        if self._raw_fname != self.fname:
+            with open(self._raw_fname, 'rb') as raw:
+                with gzip.open(self.fname, 'wb') as compressed:
+                    shutil.copyfileobj(raw, compressed)
+            os.remove(self._raw_fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,481 @@
+"""Streaming writers and lazy readers for tractography files
+
+The writers accept streamlines one at a time (or from any iterable, such as
+the generator returned by ``LocalTracking``) and only keep a bounded number
+of points in memory. Buffered streamlines are transformed and encoded
+together and written to disk with a single call, and the number of
+streamlines stored in the header is patched when the writer is closed.
+
+``LazyStreamlines`` reads TRK and TCK files through a memory map and an index
+of the position of each streamline in the file, so any subset of the
+streamlines can be read without reading the rest of the file.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+from dipy.tracking._utils import _from_packed
+from dipy.tracking.streamline import compress_streamlines
+from dipy.tracking.streamlinespeed import _trk_index as _trk_record_index
+
+
+class _StreamlineWriter(object):
+    """Buffers streamlines and writes them to a file in large blocks
+
+    Subclasses write the header in ``_write_header``, encode a block of
+    streamlines in ``_encode`` and patch the header in ``_finalize``.
+    """
+    def __init__(self, fname, affine=None, n_properties=0,
+                 buffer_size=2 ** 20, compress=None):
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be a positive integer")
+        self.fname = fname
+        self.affine = None if affine is None else np.asarray(affine, float)
+        self.n_properties = n_properties
+        self.buffer_size = buffer_size
+        self.compress = compress
+        self.n_streamlines = 0
+        self._streamlines = []
+        self._properties = []
+        self._n_points = 0
+        self._file = open(fname, 'wb')
+        try:
+            self._write_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    def write(self, streamline, properties=None):
+        """Adds one streamline to the file
+
+        Parameters
+        ----------
+        streamline : array (N, 3)
+            Points of the streamline.
+        properties : array-like (n_properties,), optional
+            Values stored with the streamline.
+        """
+        if self._file is None:
+            raise ValueError("I/O operation on a closed writer")
+        streamline = np.asarray(streamline, dtype=float)
+        if streamline.ndim != 2 or streamline.shape[1] != 3:
+            raise ValueError("streamlines must be arrays of shape (N, 3)")
+        if self.n_properties:
+            if properties is None:
+                raise ValueError("this file stores %d properties per "
+                                 "streamline" % self.n_properties)
+            properties = np.asarray(properties, dtype=np.float32).ravel()
+            if properties.shape != (self.n_properties,):
+                raise ValueError("expected %d properties, got %d" %
+                                 (self.n_properties, properties.size))
+            self._properties.append(properties)
+        elif properties is not None:
+            raise ValueError("this file does not store properties")
+        self._streamlines.append(streamline)
+        self._n_points += len(streamline)
+        self.n_streamlines += 1
+        if self._n_points >= self.buffer_size:
+            self.flush()
+
+    def write_streamlines(self, streamlines, properties=None):
+        """Adds all the streamlines of an iterable to the file
+
+        Parameters
+        ----------
+        streamlines : iterable of arrays (N, 3)
+            Streamlines, for example a generator. Only `buffer_size` points
+            are held in memory at once.
+        properties : iterable of array-like (n_properties,), optional
+            Values stored with each streamline.
+        """
+        if properties is None:
+            for s in streamlines:
+                self.write(s)
+        else:
+            for s, p in zip(streamlines, properties):
+                self.write(s, p)
+
+    def flush(self):
+        """Writes the buffered streamlines to disk"""
+        if not self._streamlines:
+            return
+        streamlines = self._streamlines
+        if self.compress is not None:
+            streamlines = compress_streamlines(streamlines, self.compress)
+        lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+        points = np.concatenate(streamlines)
+        if self.affine is not None:
+            points = np.dot(points, self.affine[:3, :3].T)
+            points += self.affine[:3, 3]
+        if self.n_properties:
+            properties = np.array(self._properties, dtype=np.float32)
+        else:
+            properties = None
+        self._file.write(self._encode(points, lengths, properties).tobytes())
+        self._streamlines = []
+        self._properties = []
+        self._n_points = 0
+
+    def close(self):
+        """Writes the remaining streamlines and completes the header"""
+        if self._file is None:
+            return
+        try:
+            self.flush()
+            self._finalize()
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrkWriter(_StreamlineWriter):
+    """Writes a TrackVis file one streamline at a time
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    vox_to_ras : ndarray (4, 4)
+        Voxel to RAS+ (world) affine of the reference image. Streamlines are
+        given in world coordinates.
+    shape : tuple of 3 ints
+        Shape of the reference image.
+    properties : sequence of str or int, optional
+        Names of the values stored with each streamline (at most 10), or
+        their number. Default: none.
+    buffer_size : int, optional
+        Number of points buffered before they are written to disk.
+        Default: 2 ** 20.
+    compress : float, optional
+        If given, streamlines are compressed by linearization with this
+        tolerance error in mm before being written (see
+        ``dipy.tracking.streamline.compress_streamlines``).
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'tracks.trk')
+    >>> streamlines = (np.ones((n, 3)) * n for n in range(2, 5))
+    >>> with TrkWriter(fname, np.eye(4), (5, 5, 5)) as writer:
+    ...     writer.write_streamlines(streamlines)
+    >>> tracks, hdr = nib.trackvis.read(fname)
+    >>> int(hdr['n_count'])
+    3
+    """
+    def __init__(self, fname, vox_to_ras, shape, properties=None,
+                 buffer_size=2 ** 20, compress=None):
+        vox_to_ras = np.asarray(vox_to_ras, dtype=float)
+        voxel_order = "".join(nib.orientations.aff2axcodes(vox_to_ras))
+
+        # Compute the vox_to_ras of "trackvis space"
+        zooms = np.sqrt((vox_to_ras * vox_to_ras).sum(0))
+        vox_to_trk = np.diag(zooms)
+        vox_to_trk[3, 3] = 1
+        vox_to_trk[:3, 3] = zooms[:3] / 2.
+
+        if properties is None:
+            properties = []
+        elif isinstance(properties, int):
+            properties = [''] * properties
+        if len(properties) > 10:
+            raise ValueError("TrackVis files store at most 10 properties")
+
+        hdr = nib.trackvis.empty_header()
+        hdr['dim'] = shape
+        hdr['voxel_order'] = voxel_order
+        hdr['voxel_size'] = zooms[:3]
+        hdr['n_properties'] = len(properties)
+        for i, name in enumerate(properties):
+            hdr['property_name'][i] = name
+        self.header = hdr
+
+        affine = np.dot(vox_to_trk, np.linalg.inv(vox_to_ras))
+        _StreamlineWriter.__init__(self, fname, affine, len(properties),
+                                   buffer_size, compress)
+
+    def _write_header(self):
+        self._file.write(self.header.tostring())
+
+    def _encode(self, points, lengths, properties):
+        # Each record is the int32 number of points followed by the float32
+        # points and properties
+        sizes = 1 + 3 * lengths + self.n_properties
+        starts = np.cumsum(sizes) - sizes
+        out = np.empty(sizes.sum(), dtype='<f4')
+        out.view('<i4')[starts] = lengths
+        point_starts = np.repeat(starts + 1 - 3 * (np.cumsum(lengths) -
+                                                   lengths), 3 * lengths)
+        out[point_starts + np.arange(3 * len(points))] = points.ravel()
+        if self.n_properties:
+            first = starts + 1 + 3 * lengths
+            out[first[:, None] + np.arange(self.n_properties)] = properties
+        return out
+
+    def _finalize(self):
+        offset = self.header.dtype.fields['n_count'][1]
+        self._file.seek(offset)
+        self._file.write(np.array(self.n_streamlines, '<i4').tobytes())
+        self._file.seek(0, 2)
+
+
+class TckWriter(_StreamlineWriter):
+    """Writes an MRtrix tracks file one streamline at a time
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    affine : ndarray (4, 4), optional
+        Affine mapping the streamlines to world (RAS+) coordinates, in which
+        the TCK format stores them. Default: streamlines are already in world
+        coordinates.
+    buffer_size : int, optional
+        Number of points buffered before they are written to disk.
+        Default: 2 ** 20.
+    compress : float, optional
+        If given, streamlines are compressed by linearization with this
+        tolerance error, in the units of the streamlines, before being
+        written (see ``dipy.tracking.streamline.compress_streamlines``).
+
+    Notes
+    -----
+    The TCK format does not store values per streamline.
+    """
+    _count_width = 10
+
+    def __init__(self, fname, affine=None, buffer_size=2 ** 20,
+                 compress=None):
+        _StreamlineWriter.__init__(self, fname, affine, 0, buffer_size,
+                                   compress)
+
+    def _header(self, count):
+        lines = ["mrtrix tracks",
+                 "count: %0*d" % (self._count_width, count),
+                 "datatype: Float32LE",
+                 "file: . %d",
+                 "END", ""]
+        header = "\n".join(lines)
+        # The offset of the data is part of the header itself
+        offset = len(header)
+        while len(header % offset) != offset:
+            offset = len(header % offset)
+        return (header % offset).encode('latin-1')
+
+    def _write_header(self):
+        self._file.write(self._header(0))
+
+    def _encode(self, points, lengths, properties):
+        # Streamlines are separated by a row of NaNs
+        n = len(lengths)
+        out = np.empty((len(points) + n, 3), dtype='<f4')
+        out[np.arange(len(points)) + np.repeat(np.arange(n), lengths)] = points
+        out[np.cumsum(lengths + 1) - 1] = np.nan
+        return out
+
+    def _finalize(self):
+        if self.n_streamlines >= 10 ** self._count_width:
+            raise ValueError("too many streamlines for a TCK file")
+        # A row of infinities marks the end of the data
+        self._file.write(np.full(3, np.inf, dtype='<f4').tobytes())
+        self._file.seek(0)
+        self._file.write(self._header(self.n_streamlines))
+        self._file.seek(0, 2)
+
+
+_tck_dtypes = {'Float32LE': '<f4', 'Float32BE': '>f4',
+               'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+
+def _read_trk_layout(fname):
+    """Returns the header, dtype and record layout of a TrackVis file"""
+    with open(fname, 'rb') as f:
+        raw = f.read(1000)
+    hdr = np.ndarray((), nib.trackvis.header_2_dtype, raw)
+    if hdr['hdr_size'] != 1000:
+        hdr = hdr.newbyteorder()
+        if hdr['hdr_size'] != 1000:
+            raise ValueError("%s is not a TrackVis file" % fname)
+    endian = hdr.dtype.fields['hdr_size'][0].str[0]
+    return hdr, endian + 'f4', 1000, 3 + int(hdr['n_scalars'])
+
+
+def _read_tck_layout(fname):
+    """Returns the header, dtype and data offset of an MRtrix tracks file"""
+    header = {}
+    with open(fname, 'rb') as f:
+        if f.readline().strip() != b'mrtrix tracks':
+            raise ValueError("%s is not an MRtrix tracks file" % fname)
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header[key.strip()] = value.strip()
+    try:
+        dtype = _tck_dtypes[header['datatype']]
+        offset = int(header['file'].split()[1])
+    except (KeyError, IndexError, ValueError):
+        raise ValueError("Unsupported MRtrix tracks header in %s" % fname)
+    return header, dtype, offset, 3
+
+
+def _trk_index(data, stride, n_properties):
+    """Finds the offset and length of each record of a TrackVis file"""
+    return _trk_record_index(data.view(np.int32), stride, n_properties,
+                             not data.dtype.isnative)
+
+
+def _tck_index(data, step=2 ** 20):
+    """Finds the offset and length of each streamline of an MRtrix tracks
+    file, one block of `step` points at a time"""
+    rows = data.reshape(-1, 3)
+    separators = []
+    for start in range(0, len(rows), step):
+        x = rows[start:start + step, 0]
+        ends = np.flatnonzero(np.isinf(x))
+        if len(ends):
+            x = x[:ends[0]]
+        separators.append(np.flatnonzero(np.isnan(x)) + start)
+        if len(ends):
+            break
+    separators = np.concatenate(separators + [[]]).astype(np.intp)
+    starts = np.concatenate([[0], separators[:-1] + 1])
+    starts = starts[:len(separators)]
+    return 3 * starts, separators - starts
+
+
+class LazyStreamlines(object):
+    """Random access to the streamlines of a TRK or TCK file
+
+    The position of every streamline in the file is found when the file is
+    first opened and cached in a sidecar file, from which it is loaded the
+    next times. Streamlines are then read through a memory map, so indexing
+    only reads the requested streamlines.
+
+    Parameters
+    ----------
+    fname : str
+        TrackVis (``.trk``) or MRtrix (``.tck``) file.
+    index_fname : str, optional
+        Sidecar file caching the index. Default: `fname` followed by
+        ``.index.npz``.
+    cache : bool, optional
+        Whether the index is saved to `index_fname` when it is built.
+        Default: True.
+
+    Attributes
+    ----------
+    header : ndarray or dict
+        Header of the file.
+    lengths : ndarray (N,)
+        Number of points of each streamline.
+
+    Notes
+    -----
+    Points are returned as stored in the file: in TrackVis space for TRK
+    files and in world coordinates for TCK files. Values stored for each
+    point or streamline of a TRK file are not read.
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'tracks.tck')
+    >>> with TckWriter(fname) as writer:
+    ...     writer.write_streamlines(np.ones((n, 3)) * n for n in range(2, 6))
+    >>> streamlines = LazyStreamlines(fname)
+    >>> len(streamlines)
+    4
+    >>> streamlines[1].shape
+    (3, 3)
+    >>> [len(s) for s in streamlines[[3, 0]]]
+    [5, 2]
+    """
+    def __init__(self, fname, index_fname=None, cache=True):
+        is_tck = fname.endswith('.tck')
+        if fname.endswith('.trk'):
+            self.header, dtype, offset, stride = _read_trk_layout(fname)
+        elif is_tck:
+            self.header, dtype, offset, stride = _read_tck_layout(fname)
+        else:
+            raise ValueError("Unknown streamline file format: %s" % fname)
+        self.fname = fname
+        self._stride = stride
+        dtype = np.dtype(dtype)
+        size = os.path.getsize(fname)
+        n_values = (size - offset) // dtype.itemsize
+        if n_values > 0:
+            self._data = np.memmap(fname, dtype, 'r', offset, (n_values,))
+        else:
+            self._data = np.empty(0, dtype)
+
+        if index_fname is None:
+            index_fname = fname + '.index.npz'
+        stat = np.array([size, os.path.getmtime(fname)])
+        index = None
+        if os.path.exists(index_fname):
+            with np.load(index_fname) as saved:
+                if np.array_equal(saved['stat'], stat):
+                    index = saved['offsets'], saved['lengths']
+        if index is not None:
+            offsets, lengths = index
+        else:
+            if is_tck:
+                offsets, lengths = _tck_index(self._data)
+            else:
+                offsets, lengths = _trk_index(
+                    self._data, stride, int(self.header['n_properties']))
+            if cache:
+                try:
+                    with open(index_fname, 'wb') as f:
+                        np.savez(f, offsets=offsets, lengths=lengths,
+                                 stat=stat)
+                except (IOError, OSError):
+                    pass
+        self._offsets = np.asarray(offsets, dtype=np.intp)
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _read(self, i):
+        start = self._offsets[i]
+        points = self._data[start:start + self.lengths[i] * self._stride]
+        return np.array(points.reshape(-1, self._stride)[:, :3])
+
+    def __getitem__(self, index):
+        """Reads one streamline, or `Streamlines` for a slice, an array of
+        indices or a boolean mask"""
+        if isinstance(index, (int, np.integer)):
+            n = len(self)
+            if not -n <= index < n:
+                raise IndexError("streamline index out of range")
+            return self._read(index % n)
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = index.astype(np.intp, copy=False)
+        offsets = self._offsets[index]
+        lengths = self.lengths[index]
+        starts = np.cumsum(lengths) - lengths
+        n_points = lengths.sum()
+        rows = np.repeat(offsets - starts * self._stride, lengths)
+        rows += np.arange(n_points) * self._stride
+        columns = rows[:, None] + np.arange(3)
+        points = np.asarray(self._data[columns.ravel()]).reshape(-1, 3)
+        return _from_packed(points, starts, lengths)
+
+    def __iter__(self, step=10000):
+        for start in range(0, len(self), step):
+            for s in self[start:start + step]:
+                yield s
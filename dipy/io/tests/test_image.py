@@ -0,0 +1,38 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import numpy.testing as npt
+import nibabel as nib
+
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from dipy.io.image import NiftiSlabWriter
+
+
+def test_nifti_slab_writer():
+    data = np.arange(2 * 3 * 4, dtype=np.float32).reshape((2, 3, 4))
+    affine = np.diag([2., 3., 4., 1.])
+
+    # Template header with an extension and a scaling of its own data
+    hdr = nib.Nifti1Header()
+    hdr.extensions.append(nib.nifti1.Nifti1Extension('comment',
+                                                     b'a' * 30))
+    hdr.set_slope_inter(2., 10.)
+
+    with InTemporaryDirectory():
+        for fname in ['slabs.nii', 'slabs.nii.gz']:
+            with NiftiSlabWriter(fname, data.shape, affine,
+                                 hdr=hdr) as writer:
+                npt.assert_equal(writer.shape, data.shape)
+                for z in range(data.shape[2]):
+                    writer[..., z] = data[..., z]
+            img = nib.load(fname)
+            npt.assert_array_equal(img.get_data(), data)
+            npt.assert_array_almost_equal(img.affine, affine)
+            npt.assert_equal(len(img.header.extensions), 1)
+            npt.assert_equal(img.header.extensions[0].get_content(),
+                             b'a' * 30)
+
+
+if __name__ == '__main__':
+    npt.run_module_suite()
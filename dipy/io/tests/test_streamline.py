@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import numpy.testing as npt
+
+from nibabel.tmpdirs import InTemporaryDirectory
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
+
+from dipy.io.streamline import LazyStreamlines, TrkWriter, TckWriter
+from dipy.io.trackvis import save_trk
+from dipy.tracking import Streamlines
+from dipy.tracking.streamline import compress_streamlines
+
+
+def _streamlines(n=50):
+    rng = np.random.RandomState(1234)
+    return [rng.rand(rng.randint(1, 20), 3) * 10 for i in range(n)]
+
+
+def test_trk_writer():
+    streamlines = _streamlines()
+    vox_to_ras = np.diag([2., 3., 1.5, 1.])
+    vox_to_ras[:3, 3] = [1, 2, 3]
+    with InTemporaryDirectory():
+        # Small buffers give the same file as a single write
+        with TrkWriter('big.trk', vox_to_ras, (10, 10, 10)) as writer:
+            writer.write_streamlines(streamlines)
+        with TrkWriter('small.trk', vox_to_ras, (10, 10, 10),
+                       buffer_size=7) as writer:
+            writer.write_streamlines(iter(streamlines))
+        assert_equal(open('big.trk', 'rb').read(),
+                     open('small.trk', 'rb').read())
+
+        # The file matches the one written by nibabel
+        tracks = [(nib.affines.apply_affine(writer.affine, s), None, None)
+                  for s in streamlines]
+        nib.trackvis.write('nib.trk', tracks, writer.header)
+        assert_equal(open('big.trk', 'rb').read(),
+                     open('nib.trk', 'rb').read())
+
+        # save_trk counts streamlines given by a generator
+        save_trk('gen.trk', (s for s in streamlines), vox_to_ras,
+                 (10, 10, 10))
+        tracks, hdr = nib.trackvis.read('gen.trk')
+        assert_equal(hdr['n_count'], len(streamlines))
+        assert_equal(len(tracks), len(streamlines))
+
+        # Properties are stored with each streamline
+        properties = np.random.rand(len(streamlines), 2)
+        with TrkWriter('props.trk', vox_to_ras, (10, 10, 10), ['a', 'b'],
+                       buffer_size=13) as writer:
+            writer.write_streamlines(streamlines, properties)
+            assert_raises(ValueError, writer.write, streamlines[0])
+            assert_raises(ValueError, writer.write, streamlines[0], [1.])
+        tracks, hdr = nib.trackvis.read('props.trk')
+        assert_equal(hdr['n_properties'], 2)
+        npt.assert_array_almost_equal(np.array([t[2] for t in tracks]),
+                                      properties)
+        for t, s in zip(tracks, streamlines):
+            npt.assert_array_almost_equal(
+                t[0], nib.affines.apply_affine(writer.affine, s), 4)
+
+        assert_raises(ValueError, writer.write, streamlines[0])
+        assert_raises(ValueError, TrkWriter, 'bad.trk', vox_to_ras,
+                      (10, 10, 10), 11)
+
+
+def test_tck_writer():
+    streamlines = _streamlines()
+    affine = np.diag([2., 2., 2., 1.])
+    with InTemporaryDirectory():
+        with TckWriter('tracks.tck', affine, buffer_size=10) as writer:
+            writer.write_streamlines(iter(streamlines))
+            assert_raises(ValueError, writer.write, streamlines[0], [1.])
+        tck = nib.streamlines.load('tracks.tck')
+        assert_equal(int(tck.header['count']), len(streamlines))
+        assert_equal(len(tck.streamlines), len(streamlines))
+        for t, s in zip(tck.streamlines, streamlines):
+            npt.assert_array_almost_equal(t, 2 * s, 5)
+
+        # Streamlines can be compressed before they are written
+        with TckWriter('compressed.tck', compress=0.1) as writer:
+            writer.write_streamlines(streamlines)
+        tck = nib.streamlines.load('compressed.tck')
+        for t, s in zip(tck.streamlines,
+                        compress_streamlines(streamlines, 0.1)):
+            npt.assert_array_almost_equal(t, s, 5)
+
+        # An empty file is still valid
+        TckWriter('empty.tck').close()
+        tck = nib.streamlines.load('empty.tck')
+        assert_equal(len(tck.streamlines), 0)
+
+
+def test_lazy_streamlines():
+    streamlines = _streamlines(100)
+    properties = np.random.rand(len(streamlines), 2)
+    with InTemporaryDirectory():
+        with TckWriter('tracks.tck', buffer_size=10) as writer:
+            writer.write_streamlines(streamlines)
+        with TrkWriter('tracks.trk', np.eye(4), (10, 10, 10), 2) as writer:
+            writer.write_streamlines(streamlines, properties)
+        # Per-point scalars are skipped
+        tracks = [(s + 0.5, np.ones((len(s), 2)), p)
+                  for s, p in zip(streamlines, properties)]
+        hdr = writer.header.copy()
+        hdr['n_scalars'] = 2
+        nib.trackvis.write('scalars.trk', tracks, hdr)
+
+        for fname in ['tracks.tck', 'tracks.trk', 'scalars.trk']:
+            expected = streamlines
+            if fname.endswith('.trk'):
+                expected = [s + 0.5 for s in streamlines]
+            for i in range(2):
+                # The index is built, then loaded from the sidecar file
+                lazy = LazyStreamlines(fname)
+                assert_true(os.path.exists(fname + '.index.npz'))
+                assert_equal(len(lazy), len(streamlines))
+                npt.assert_array_equal(lazy.lengths,
+                                       [len(s) for s in streamlines])
+            npt.assert_array_almost_equal(lazy[3], expected[3], 5)
+            npt.assert_array_almost_equal(lazy[-1], expected[-1], 5)
+            assert_raises(IndexError, lazy.__getitem__, len(streamlines))
+            for index in [slice(5, 50, 3), [7, 2, 2, 90],
+                          np.arange(100) % 3 == 0, []]:
+                subset = lazy[index]
+                assert_true(isinstance(subset, Streamlines))
+                idx = np.arange(len(streamlines))[index]
+                assert_equal(len(subset), len(idx))
+                for s, i in zip(subset, idx):
+                    npt.assert_array_almost_equal(s, expected[i], 5)
+            for s, e in zip(lazy, expected):
+                npt.assert_array_almost_equal(s, e, 5)
+
+        # A stale sidecar is rebuilt
+        with TckWriter('tracks.tck') as writer:
+            writer.write_streamlines(streamlines[:10])
+        os.utime('tracks.tck', (0, 0))
+        assert_equal(len(LazyStreamlines('tracks.tck')), 10)
+
+        # Without caching, no sidecar is written
+        lazy = LazyStreamlines('tracks.trk', index_fname='other.npz',
+                               cache=False)
+        assert_equal(len(lazy), len(streamlines))
+        assert_false(os.path.exists('other.npz'))
+        assert_raises(ValueError, LazyStreamlines, 'tracks.txt')
+
+        # Big endian files are indexed as well
+        hdr = {'dim': (10, 10, 10), 'voxel_size': (1, 1, 1),
+               'vox_to_ras': np.eye(4)}
+        nib.trackvis.write('big_endian.trk',
+                           [(s + 0.5, None, None) for s in streamlines], hdr,
+                           endianness='>')
+        lazy = LazyStreamlines('big_endian.trk', cache=False)
+        npt.assert_array_equal(lazy.lengths, [len(s) for s in streamlines])
+        npt.assert_array_almost_equal(lazy[7], streamlines[7] + 0.5, 5)
+
+        # Truncated files are detected
+        with open('tracks.trk', 'rb') as f:
+            raw = f.read()
+        with open('truncated.trk', 'wb') as f:
+            f.write(raw[:-4])
+        assert_raises(ValueError, LazyStreamlines, 'truncated.trk')
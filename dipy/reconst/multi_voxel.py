@@ -4,6 +4,7 @@ from numpy.lib.stride_tricks import as_strided
 
 from dipy.core.ndindex import ndindex
 from dipy.reconst.quick_squash import quick_squash as _squash
+from dipy.reconst.quick_squash import quick_gather as _gather
 from dipy.reconst.base import ReconstFit
 
 
@@ -48,11 +49,29 @@ class MultiVoxelFit(ReconstFit):
         return self.fit_array.shape
 
     def __getattr__(self, attr):
-        result = CallableArray(self.fit_array.shape, dtype=object)
-        for ijk in ndindex(result.shape):
-            if self.mask[ijk]:
-                result[ijk] = getattr(self.fit_array[ijk], attr)
-        return _squash(result, self.mask)
+        first = self._first_fit()
+        if first is None:
+            # No voxel is fitted, there is no way to tell a method from an
+            # attribute: the result is an array of None that can be called
+            result = CallableArray(self.fit_array.shape, dtype=object)
+            return _squash(result, self.mask)
+        value = getattr(first, attr)
+        if callable(value):
+            return MultiVoxelMethod(self.fit_array, self.mask, attr)
+
+        def get(fit):
+            # The attribute of the first fit is not evaluated again
+            if fit is first:
+                return value
+            return getattr(fit, attr)
+        return _gather(self.fit_array, get, self.mask)
+
+    def _first_fit(self):
+        """The fit of the first voxel in the mask, None if there is none"""
+        if self.fit_array.size == 0:
+            return None
+        i = np.argmax(self.mask.reshape(-1))
+        return self.fit_array.reshape(-1)[i]
 
     def __getitem__(self, index):
         item = self.fit_array[index]
@@ -99,12 +118,33 @@ class MultiVoxelFit(ReconstFit):
         return result
 
 
+class MultiVoxelMethod(object):
+    """Calls a method of every fit in a multi voxel fit
+
+    Calling a `MultiVoxelMethod` stacks the results of the method of each
+    fit, with zeros outside the mask. The result array is allocated once
+    from the result of the first fit, or an existing array can be reused by
+    passing it as the `out` keyword argument.
+    """
+    def __init__(self, fit_array, mask, name):
+        self.fit_array = fit_array
+        self.mask = mask
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        out = kwargs.pop('out', None)
+        name = self.name
+
+        def call(fit):
+            return getattr(fit, name)(*args, **kwargs)
+        return _gather(self.fit_array, call, self.mask, out=out)
+
+
 class CallableArray(np.ndarray):
     """An array which can be called like a function"""
     def __call__(self, *args, **kwargs):
-        result = np.empty(self.shape, dtype=object)
-        for ijk in ndindex(self.shape):
-            item = self[ijk]
-            if item is not None:
-                result[ijk] = item(*args, **kwargs)
-        return _squash(result)
+        out = kwargs.pop('out', None)
+
+        def call(item):
+            return item(*args, **kwargs)
+        return _gather(self.view(np.ndarray), call, out=out)
@@ -125,3 +125,61 @@ cdef class PeaksAndMetricsDirectionGetter(DirectionGetter):
             return 0
         else:
             return 1
+
+    def _prepare_nogil(self):
+        if not self.initialized:
+            self._initialize()
+        return self._ind.shape[3]
+
+    @cython.initializedcheck(False)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int initial_direction_c(self, double *point, double *directions,
+                                 int max_directions) nogil:
+        cdef:
+            np.npy_intp i, j, numpeaks, peak_index
+            np.npy_intp ijk[3]
+
+        for i in range(3):
+            ijk[i] = <np.npy_intp> dpy_rint(point[i])
+            if ijk[i] < 0 or ijk[i] >= self._ind.shape[i]:
+                return -1
+
+        numpeaks = 0
+        while (numpeaks < max_directions and
+               numpeaks < self._ind.shape[3] and
+               self._ind[ijk[0], ijk[1], ijk[2], numpeaks] >= 0):
+            peak_index = <np.npy_intp> self._ind[ijk[0], ijk[1], ijk[2],
+                                                 numpeaks]
+            for j in range(3):
+                directions[3 * numpeaks + j] = self._odf_vertices[peak_index,
+                                                                  j]
+            numpeaks += 1
+        return numpeaks
+
+    @cython.initializedcheck(False)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int get_direction_c(self, double *point, double *direction) nogil:
+        cdef:
+            np.npy_intp s
+            double newdirection[3]
+            np.npy_intp qa_shape[4]
+            np.npy_intp qa_strides[4]
+
+        for i in range(4):
+            qa_shape[i] = self._qa.shape[i]
+            qa_strides[i] = self._qa.strides[i]
+
+        s = _propagation_direction(point, direction,
+                                   &self._qa[0, 0, 0, 0],
+                                   &self._ind[0, 0, 0, 0],
+                                   &self._odf_vertices[0, 0], self.qa_thr,
+                                   self.ang_thr, qa_shape, qa_strides,
+                                   newdirection, self.total_weight)
+        if s:
+            for i in range(3):
+                direction[i] = newdirection[i]
+            return 0
+        else:
+            return 1
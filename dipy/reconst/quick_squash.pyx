@@ -4,6 +4,7 @@ from functools import reduce
 
 cimport numpy as cnp
 cimport cython
+from libc.string cimport memcpy
 
 import numpy as np
 
@@ -133,3 +134,181 @@ def quick_squash(obj_arr, mask=None, fill=0):
         else:
             result[i] = e
     return result.reshape(obj_arr.shape + common_shape)
+
+
+cdef inline int _is_valid(object e, int have_mask, char [:] flat_mask,
+                          cnp.npy_intp i):
+    if have_mask:
+        return flat_mask[i] != 0
+    return e is not None
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def quick_gather(obj_arr, func, mask=None, fill=0, out=None):
+    """Apply `func` to every item of an object array and stack the results
+
+    The result is the same as ``quick_squash`` applied to an object array
+    holding ``func(item)`` for every valid item, but the output array is
+    allocated up front from the shape and dtype of the first valid result and
+    filled in place, so no intermediate object array is built. If a later
+    result does not fit in the output array (different shape or a dtype that
+    cannot be cast safely), the results are squashed with ``quick_squash``
+    instead.
+
+    Parameters
+    ----------
+    obj_arr : array, dtype=object
+        The items to which `func` is applied.
+    func : callable
+        Called with each valid item of `obj_arr`.
+    mask : array, dtype=bool, optional
+       Items are valid where mask is nonzero. If None, items that are not
+       None are valid.
+    fill : number, optional
+        Value of the result for invalid items.
+    out : ndarray, optional
+        Array in which to place the result. Must have the shape and a dtype
+        able to hold the stacked results. It is only written once all the
+        results are gathered, so it is left unchanged when one of them does
+        not fit.
+
+    Returns
+    -------
+    result : array
+
+    Examples
+    --------
+    >>> arr = np.empty(3, dtype=object)
+    >>> arr.fill(2)
+    >>> arr[0] = None
+    >>> quick_gather(arr, lambda x: np.arange(x))
+    array([[0, 0],
+           [0, 1],
+           [0, 1]])
+    """
+    cdef:
+        cnp.npy_intp i, j, N, item_bytes
+        object [:] flat_obj
+        char [:] flat_mask
+        int have_mask = not mask is None
+        int copy_back
+        object result, flat_result
+        cnp.ndarray v_arr
+        char *result_data
+        object e, v
+        object common_shape
+        cnp.dtype dtype
+    if have_mask:
+        flat_mask = np.array(mask.reshape(-1), dtype=np.int8)
+    else:
+        flat_mask = np.empty((0,), dtype=np.int8)
+    N = obj_arr.size
+    flat_obj = obj_arr.reshape((-1))
+    # Find first valid value to learn the shape and dtype of the results
+    for i in range(N):
+        e = flat_obj[i]
+        if _is_valid(e, have_mask, flat_mask, i):
+            v = func(e)
+            break
+    else:  # Nothing outside mask / all None
+        if out is not None:
+            out[...] = fill
+            return out
+        return obj_arr
+    t = type(v)
+    if issubclass(t, np.generic) or t in SCALAR_TYPES:
+        common_shape = ()
+        dtype = np.dtype(t)
+    elif t == cnp.ndarray:
+        common_shape = v.shape
+        dtype = v.dtype
+    else:
+        return _gather_objects(obj_arr, func, mask, fill, out, i, v)
+    # Create output array
+    if out is None:
+        result = np.empty(obj_arr.shape + common_shape, dtype=dtype)
+    else:
+        result = out
+        if result.shape != obj_arr.shape + common_shape:
+            raise ValueError("out has shape %s, expected %s" %
+                             (result.shape, obj_arr.shape + common_shape))
+        if not np.can_cast(dtype, result.dtype):
+            raise ValueError("Cannot store results of type %s in out" %
+                             dtype)
+        dtype = result.dtype
+    copy_back = out is not None or not result.flags.c_contiguous
+    if copy_back:
+        flat_result = np.empty((N,) + common_shape, dtype=dtype)
+    else:
+        flat_result = result.reshape((N,) + common_shape)
+    flat_result[:i] = fill
+    flat_result[i] = v
+    result_data = <char *>cnp.PyArray_DATA(<cnp.ndarray>flat_result)
+    item_bytes = flat_result.itemsize * (flat_result.size // N if N else 0)
+    # Fill the rest of the output
+    for j in range(i + 1, N):
+        e = flat_obj[j]
+        if not _is_valid(e, have_mask, flat_mask, j):
+            flat_result[j] = fill
+            continue
+        v = func(e)
+        t = type(v)
+        if t == cnp.ndarray:
+            v_arr = v
+            if v.shape != common_shape:
+                break
+            if v_arr.dtype == dtype and v_arr.flags.c_contiguous:
+                memcpy(result_data + j * item_bytes,
+                       cnp.PyArray_DATA(v_arr), item_bytes)
+                continue
+            if not np.can_cast(v_arr.dtype, dtype):
+                break
+        elif issubclass(t, np.generic) or t in SCALAR_TYPES:
+            if common_shape != () or not np.can_cast(np.dtype(t), dtype):
+                break
+        else:
+            break
+        flat_result[j] = v
+    else:
+        if copy_back:
+            result[...] = flat_result.reshape(result.shape)
+        return result
+    # A result does not fit in the output array, squash the results instead
+    if out is not None:
+        raise ValueError("Results of different shapes or types cannot be "
+                         "stored in out")
+    objs = np.empty(N, dtype=object)
+    for i in range(j):
+        if _is_valid(flat_obj[i], have_mask, flat_mask, i):
+            objs[i] = flat_result[i]
+    objs[j] = v
+    return _gather_objects(obj_arr, func, mask, fill, out, j, objs)
+
+
+def _gather_objects(obj_arr, func, mask, fill, out, start, done):
+    """Collect ``func(item)`` in an object array from `start` and squash it
+
+    `done` is either the result for item `start` or an object array holding
+    the results of all items up to and including `start`.
+    """
+    if out is not None:
+        raise ValueError("Results of different shapes or types cannot be "
+                         "stored in out")
+    flat_obj = obj_arr.reshape(-1)
+    if isinstance(done, np.ndarray) and done.dtype == object:
+        objs = done
+    else:
+        objs = np.empty(obj_arr.size, dtype=object)
+        objs[start] = done
+    flat_mask = None if mask is None else mask.reshape(-1)
+    for i in range(start + 1, obj_arr.size):
+        e = flat_obj[i]
+        if flat_mask is None and e is None:
+            continue
+        if flat_mask is not None and not flat_mask[i]:
+            continue
+        objs[i] = func(e)
+    result = obj_arr.copy()
+    result.reshape(-1)[...] = objs
+    return quick_squash(result, mask, fill)
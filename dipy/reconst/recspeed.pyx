@@ -12,6 +12,9 @@ cimport numpy as cnp
 
 from libc.stdlib cimport malloc, free
 from libc.string cimport memcpy
+from cython.parallel import prange
+
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
@@ -20,6 +23,8 @@ cdef extern from "dpy_math.h" nogil:
     double sin(double x)
     float acos(float x )
     double sqrt(double x)
+    double log(double x)
+    double pow(double x, double y)
     double DPY_PI
 
 
@@ -610,3 +615,84 @@ def argmax_from_countarrs(cnp.ndarray vals,
         return np.array([])
     # fancy indexing always produces a copy
     return maxinds[argsort(maxes[:n_maxes])]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sh_power_metrics_block(double[:, ::1] coeffs, double power,
+                           double log_norm, int non_negative,
+                           float[::1] log_ap, float[::1] gfa,
+                           float[:, ::1] spectrum, num_threads=None):
+    """Anisotropic power, GFA and power spectrum of a block of SH coefficients
+
+    All three metrics are computed in a single pass over the coefficients of
+    each voxel, without temporary arrays.
+
+    Parameters
+    ----------
+    coeffs : ndarray (N, C)
+        Coefficients of N voxels in a normalized, symmetric SH basis of even
+        orders ``0, 2, ..., L``.
+    power : double
+        Power to which the absolute value of the coefficients is raised.
+    log_norm : double
+        Log of the normalization factor subtracted from the log of the
+        anisotropic power.
+    non_negative : int
+        If nonzero, negative log anisotropic power values are set to 0.
+    log_ap : ndarray (N,), float32
+        Output log anisotropic power.
+    gfa : ndarray (N,), float32
+        Output generalized fractional anisotropy.
+    spectrum : ndarray (N, L // 2 + 1), float32
+        Output mean of ``|a_lm| ** power`` over the coefficients of each
+        order.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+    """
+    cdef:
+        cnp.npy_intp i, j, k, start, n_orders, n_voxels = coeffs.shape[0]
+        double total, ap, value, power_sum, sq_sum
+        int square = power == 2.
+
+    n_orders = spectrum.shape[1]
+    if (coeffs.shape[1] != n_orders * (2 * n_orders - 1) or
+            log_ap.shape[0] != n_voxels or gfa.shape[0] != n_voxels or
+            spectrum.shape[0] != n_voxels):
+        raise ValueError("Inconsistent shapes of coefficients and outputs")
+
+    set_num_threads(num_threads)
+    with nogil:
+        for i in prange(n_voxels, schedule='static'):
+            total = 0
+            ap = 0
+            start = 0
+            for k in range(n_orders):
+                power_sum = 0
+                sq_sum = 0
+                for j in range(start, start + 4 * k + 1):
+                    value = coeffs[i, j] * coeffs[i, j]
+                    sq_sum = sq_sum + value
+                    if square:
+                        power_sum = power_sum + value
+                    else:
+                        power_sum = power_sum + pow(fabs(coeffs[i, j]), power)
+                start = start + 4 * k + 1
+                spectrum[i, k] = power_sum / (4 * k + 1)
+                total = total + sq_sum
+                if k > 0:
+                    ap = ap + power_sum / (4 * k + 1)
+            if total == 0:
+                gfa[i] = 0
+            else:
+                gfa[i] = sqrt(1. - coeffs[i, 0] * coeffs[i, 0] / total)
+            if ap > 0:
+                value = log(ap) - log_norm
+                if non_negative and value < 0:
+                    value = 0
+                log_ap[i] = value
+            else:
+                log_ap[i] = 0
+    restore_default_num_threads()
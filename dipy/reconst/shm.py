@@ -33,6 +33,7 @@ from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.core.geometry import cart2sphere
 from dipy.core.onetime import auto_attr
 from dipy.reconst.cache import Cache
+from dipy.reconst.recspeed import sh_power_metrics_block
 
 from distutils.version import LooseVersion
 import scipy
@@ -849,6 +850,191 @@ class ResidualBootstrapWrapper(object):
         return signal
 
 
+def _mix64(z):
+    """SplitMix64 finalizer, applied in place to an array of uint64"""
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xBF58476D1CE4E5B9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return z
+
+
+def _bootstrap_permutations(random_seed, voxel_index, n_boot, n_dwi):
+    """Draws the residual resampling indices of voxels from their index
+
+    Each draw is a hash of ``(random_seed, voxel index, sample, dwi)``, so
+    the draws of a voxel don't depend on the other voxels drawn with it.
+
+    Returns
+    -------
+    permute : ndarray (V, n_boot, n_dwi) of intp
+        Random integers between 0 and `n_dwi` - 1.
+    """
+    voxel_index = np.asarray(voxel_index, dtype=np.uint64)
+    key = _mix64(np.array([random_seed % 2 ** 64], dtype=np.uint64))
+    counter = np.arange(n_boot * n_dwi, dtype=np.uint64)
+    z = (voxel_index[:, None] * np.uint64(n_boot * n_dwi)) + counter
+    z *= np.uint64(0x9E3779B97F4A7C15)
+    z += key
+    _mix64(z)
+    # The high 32 bits scaled to [0, n_dwi)
+    z >>= np.uint64(32)
+    z *= np.uint64(n_dwi)
+    z >>= np.uint64(32)
+    return z.astype(np.intp).reshape((len(voxel_index), n_boot, n_dwi))
+
+
+def _bootstrap_block(data, voxel_index, H, R, n_boot, min_signal=None,
+                     random_seed=None):
+    """Draws `n_boot` residual bootstrap samples for a block of voxels
+
+    Parameters
+    ----------
+    data : ndarray (V, N)
+        Normalized signals of V voxels.
+    voxel_index : ndarray (V,)
+        Flat index of each voxel in the full volume. The samples of a voxel
+        are drawn from its index when `random_seed` is given.
+    H, R : ndarray (N, N)
+        Hat matrix and leveraged centered residual matrix.
+    n_boot : int
+        Number of bootstrap samples per voxel.
+    min_signal : float, optional
+        If given, bootstrap samples are clipped to ``[min_signal, 1]``.
+    random_seed : int, optional
+        Seed of the samples of every voxel.
+
+    Returns
+    -------
+    boot_data : ndarray (V, n_boot, N)
+        Residual bootstrap samples of the signal.
+    """
+    n_vox, n_dwi = data.shape
+    if random_seed is None:
+        permute = randint(n_dwi, size=(n_vox, n_boot, n_dwi))
+    else:
+        permute = _bootstrap_permutations(random_seed, voxel_index, n_boot,
+                                          n_dwi)
+
+    fitted = dot(data, H.T)
+    residuals = dot(data, R.T)
+    permute += (np.arange(n_vox) * n_dwi)[:, None, None]
+    boot_data = residuals.ravel()[permute]
+    boot_data += fitted[:, None, :]
+    if min_signal is not None:
+        boot_data.clip(min_signal, 1., out=boot_data)
+    return boot_data
+
+
+def _bootstrap_blocks(data, mask, step):
+    """Yields (flat voxel indices, signals) of voxels in mask, step at a time
+    """
+    if mask is None:
+        index = np.arange(np.prod(data.shape[:-1], dtype=int))
+    else:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        index = np.flatnonzero(mask)
+    data = data.reshape((-1, data.shape[-1]))
+    for start in range(0, len(index), step):
+        block_index = index[start:start + step]
+        yield block_index, data[block_index]
+
+
+def bootstrap_sh_coeff(data, B, n_boot=100, mask=None, min_signal=None,
+                       random_seed=None, step=1000):
+    """Residual bootstrap samples of the SH coefficients of many voxels
+
+    All `n_boot` samples of a block of `step` voxels are drawn and fitted in a
+    single vectorized operation using the hat and leveraged centered residual
+    matrices of `B` (see `bootstrap_data_array`).
+
+    Parameters
+    ----------
+    data : ndarray (..., N)
+        Normalized diffusion weighted signals, ie 0 < data <= 1.
+    B : ndarray (N, C)
+        Design matrix of the linear spherical harmonics model.
+    n_boot : int, optional
+        Number of bootstrap samples per voxel. Default: 100.
+    mask : ndarray, optional
+        Boolean mask with the shape of ``data.shape[:-1]``. Coefficients
+        outside the mask are zero.
+    min_signal : float, optional
+        If given, bootstrap samples of the signal are clipped to
+        ``[min_signal, 1]`` before fitting, as in `ResidualBootstrapWrapper`.
+    random_seed : int, optional
+        When given, the samples of each voxel are drawn from
+        ``(random_seed, voxel index)`` so that results are reproducible and
+        depend neither on `step` nor on `mask`.
+    step : int, optional
+        Number of voxels bootstrapped at once. Memory usage is proportional
+        to ``step * n_boot * N``. Default: 1000.
+
+    Returns
+    -------
+    coeff : ndarray (..., n_boot, C)
+        SH coefficients of every bootstrap sample.
+    """
+    H = hat(B)
+    R = lcr_matrix(H)
+    invB = pinv(B)
+    data = np.asarray(data)
+    coeff = np.zeros(data.shape[:-1] + (n_boot, B.shape[1]))
+    flat_coeff = coeff.reshape((-1, n_boot, B.shape[1]))
+    for index, block in _bootstrap_blocks(data, mask, step):
+        boot_data = _bootstrap_block(block, index, H, R, n_boot, min_signal,
+                                     random_seed)
+        flat_coeff[index] = dot(boot_data, invB.T)
+    return coeff
+
+
+def bootstrap_odf_stats(data, B, sampling_matrix, n_boot=100, mask=None,
+                        min_signal=None, random_seed=None, step=1000):
+    """Mean and standard deviation of the ODF under the residual bootstrap
+
+    Like `bootstrap_sh_coeff`, but the bootstrap samples are reduced block by
+    block so the stack of coefficients is never held for the whole volume.
+
+    Parameters
+    ----------
+    data : ndarray (..., N)
+        Normalized diffusion weighted signals, ie 0 < data <= 1.
+    B : ndarray (N, C)
+        Design matrix of the linear spherical harmonics model.
+    sampling_matrix : ndarray (M, C)
+        Matrix evaluating the SH coefficients on M sphere vertices, for
+        example the output of ``SphHarmModel.sampling_matrix(sphere)``.
+    n_boot, mask, min_signal, random_seed, step :
+        See `bootstrap_sh_coeff`.
+
+    Returns
+    -------
+    odf_mean : ndarray (..., M)
+        Mean of the bootstrap ODFs.
+    odf_std : ndarray (..., M)
+        Standard deviation of the bootstrap ODFs.
+    """
+    H = hat(B)
+    R = lcr_matrix(H)
+    odf_matrix = dot(sampling_matrix, pinv(B))
+    data = np.asarray(data)
+    shape = data.shape[:-1] + (sampling_matrix.shape[0],)
+    odf_mean = np.zeros(shape)
+    odf_std = np.zeros(shape)
+    flat_mean = odf_mean.reshape((-1, shape[-1]))
+    flat_std = odf_std.reshape((-1, shape[-1]))
+    for index, block in _bootstrap_blocks(data, mask, step):
+        boot_data = _bootstrap_block(block, index, H, R, n_boot, min_signal,
+                                     random_seed)
+        boot_odf = dot(boot_data, odf_matrix.T)
+        flat_mean[index] = boot_odf.mean(1)
+        flat_std[index] = boot_odf.std(1)
+    return odf_mean, odf_std
+
+
 def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
     """Spherical function to spherical harmonics (SH).
 
@@ -1083,3 +1269,86 @@ def anisotropic_power(sh_coeffs, norm_factor=0.00001, power=2,
             if log_ap < 0:
                 return 0
     return log_ap
+
+
+def sh_power_metrics(sh_coeffs, norm_factor=0.00001, power=2,
+                     non_negative=True, mask=None, step=100000,
+                     num_threads=None):
+    """Rotation invariant metrics of SH coefficients computed in one pass
+
+    Computes the log anisotropic power (as `anisotropic_power`), the GFA (as
+    the `gfa` of a `SphHarmFit`) and the power spectrum of each voxel in a
+    single compiled pass over blocks of `step` voxels. The outputs are
+    float32 and no full-size temporary arrays are created, which makes this
+    function suitable for producing these maps for many subjects.
+
+    Parameters
+    ----------
+    sh_coeffs : ndarray (..., C)
+        SH coefficients in a normalized symmetric basis, such as the one
+        returned by `real_sym_sh_basis`.
+    norm_factor : float, optional
+        The value to normalize the ap values. Default is 10^-5.
+    power : int, optional
+        The degree to which power maps are calculated. Default: 2.
+    non_negative : bool, optional
+        Whether to rectify the log anisotropic power to be non-negative.
+        Default: True.
+    mask : ndarray, optional
+        Boolean mask with the shape of ``sh_coeffs.shape[:-1]``. Metrics
+        outside the mask are zero.
+    step : int, optional
+        Number of voxels processed at once. Default: 100000.
+    num_threads : int, optional
+        Number of threads used to process each block. If None (default) the
+        default number of OpenMP threads is used.
+
+    Returns
+    -------
+    log_ap : ndarray (...), float32
+        The log of the anisotropic power.
+    gfa : ndarray (...), float32
+        The generalized fractional anisotropy.
+    spectrum : ndarray (..., L // 2 + 1), float32
+        The mean of ``|a_lm| ** power`` over the coefficients of each even
+        order l, from order 0 to the maximal order L.
+
+    See Also
+    --------
+    anisotropic_power
+    """
+    sh_coeffs = np.asarray(sh_coeffs)
+    shape = sh_coeffs.shape[:-1]
+    n_orders = calculate_max_order(sh_coeffs.shape[-1]) // 2 + 1
+    log_ap = np.zeros(shape, dtype=np.float32)
+    gfa = np.zeros(shape, dtype=np.float32)
+    spectrum = np.zeros(shape + (n_orders,), dtype=np.float32)
+    flat_coeffs = sh_coeffs.reshape((-1, sh_coeffs.shape[-1]))
+    flat_ap = log_ap.reshape(-1)
+    flat_gfa = gfa.reshape(-1)
+    flat_spectrum = spectrum.reshape((-1, n_orders))
+    if mask is None:
+        index = None
+        n_voxels = flat_coeffs.shape[0]
+    else:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != shape:
+            raise ValueError("mask and sh_coeffs shape do not match")
+        index = np.flatnonzero(mask)
+        n_voxels = len(index)
+    log_norm = np.log(norm_factor)
+    for start in range(0, n_voxels, step):
+        block = slice(start, start + step)
+        if index is not None:
+            block = index[block]
+        block_ap = np.empty(len(flat_ap[block]), dtype=np.float32)
+        block_gfa = np.empty_like(block_ap)
+        block_spectrum = np.empty((len(block_ap), n_orders), dtype=np.float32)
+        sh_power_metrics_block(
+            np.ascontiguousarray(flat_coeffs[block], dtype=np.float64),
+            power, log_norm, non_negative, block_ap, block_gfa,
+            block_spectrum, num_threads)
+        flat_ap[block] = block_ap
+        flat_gfa[block] = block_gfa
+        flat_spectrum[block] = block_spectrum
+    return log_ap, gfa, spectrum
@@ -0,0 +1,168 @@
+"""Tools to fit models to volumes that do not fit in memory
+
+The data are read, fitted and written one slab of axial slices at a time, so
+peak memory scales with the size of a slab instead of the size of the volume.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+import nibabel as nib
+
+from dipy.io.image import NiftiSlabWriter
+from dipy.utils.six import string_types
+
+
+def iter_slabs(n_slices, slab_size):
+    """Yields slices covering ``range(n_slices)`` in steps of `slab_size`
+
+    Examples
+    --------
+    >>> list(iter_slabs(5, 2))
+    [slice(0, 2, None), slice(2, 4, None), slice(4, 5, None)]
+    """
+    if slab_size < 1:
+        raise ValueError("slab_size must be a positive integer")
+    for start in range(0, n_slices, slab_size):
+        yield slice(start, min(start + slab_size, n_slices))
+
+
+def _fit_slab(model, data, mask, z):
+    """Reads the slab `z` of the data and mask and fits the model to it"""
+    slab = np.asarray(data[:, :, z])
+    if mask is None:
+        return model.fit(slab)
+    return model.fit(slab, mask=np.asarray(mask[:, :, z], dtype=bool))
+
+
+def fit_slabs(model, data, metrics, out, mask=None, slab_size=8):
+    """Fits a model to a 4D volume one slab of z slices at a time
+
+    Parameters
+    ----------
+    model : ReconstModel
+        Model fitted to each slab.
+    data : array-like (X, Y, Z, N)
+        Diffusion data. Only one slab is read at a time, so this can be a
+        memory-mapped array or the ``dataobj`` of a nibabel image.
+    metrics : dict
+        Maps output names to functions taking the fit of a slab and returning
+        the corresponding slab of the output map.
+    out : dict
+        Maps output names to writable array-likes of shape ``(X, Y, Z, ...)``
+        such as `NiftiSlabWriter` instances or memory-mapped arrays.
+    mask : array-like (X, Y, Z), optional
+        Voxels in which the model is fitted.
+    slab_size : int, optional
+        Number of z slices fitted at once. Default: 8.
+    """
+    for z in iter_slabs(data.shape[2], slab_size):
+        fit = _fit_slab(model, data, mask, z)
+        for name, func in metrics.items():
+            out[name][:, :, z] = func(fit)
+
+
+def fit_nifti_slabs(model, fname, metrics, out_fnames, mask=None,
+                    slab_size=8, dtypes=None):
+    """Fits a model to a NIfTI file and writes output maps slab by slab
+
+    Parameters
+    ----------
+    model : ReconstModel
+        Model fitted to the data.
+    fname : str
+        Path to the 4D diffusion image. Uncompressed images are
+        memory-mapped; compressed images are decompressed again for each
+        slab, so they are much slower to process.
+    metrics : dict
+        Maps output names to functions taking the fit of a slab and returning
+        the corresponding slab of the output map.
+    out_fnames : dict
+        Maps output names to the file names of the output maps.
+    mask : str or array-like, optional
+        Path to a mask image, or the mask itself.
+    slab_size : int, optional
+        Number of z slices fitted at once. Default: 8.
+    dtypes : dict, optional
+        Maps output names to the data type of the output maps. Default:
+        float32.
+    """
+    img = nib.load(fname)
+    if isinstance(mask, string_types):
+        mask = nib.load(mask).dataobj
+    dtypes = {} if dtypes is None else dtypes
+
+    writers = {}
+    try:
+        for z in iter_slabs(img.shape[2], slab_size):
+            fit = _fit_slab(model, img.dataobj, mask, z)
+            for name, func in metrics.items():
+                value = np.asarray(func(fit))
+                if name not in writers:
+                    # The shape of each map is known once a slab is fitted
+                    writers[name] = NiftiSlabWriter(
+                        out_fnames[name], img.shape[:3] + value.shape[3:],
+                        img.affine, dtypes.get(name, np.float32))
+                writers[name][:, :, z] = value
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def peaks_from_model_slabs(model, data, sphere, relative_peak_threshold,
+                           min_separation_angle, mask=None, slab_size=8,
+                           **kwargs):
+    """Computes peaks and metrics with `peaks_from_model` slab by slab
+
+    Only one slab of the data is read at a time; the peaks and metrics of
+    the whole volume are gathered in memory.
+
+    Parameters
+    ----------
+    model, sphere, relative_peak_threshold, min_separation_angle :
+        See `peaks_from_model`.
+    data : array-like (X, Y, Z, N)
+        Diffusion data, for example the ``dataobj`` of a nibabel image.
+    mask : array-like (X, Y, Z), optional
+        Voxels in which the model is fitted.
+    slab_size : int, optional
+        Number of z slices fitted at once. Default: 8.
+    kwargs :
+        Other arguments of `peaks_from_model`.
+
+    Returns
+    -------
+    pam : PeaksAndMetrics
+
+    Notes
+    -----
+    As with ``peaks_from_model(..., parallel=True)``, the QA of each slab is
+    normalized by the largest peak of that slab.
+    """
+    from dipy.direction.peaks import peaks_from_model, PeaksAndMetrics
+
+    pam = None
+    names = ['gfa', 'qa', 'peak_dirs', 'peak_values', 'peak_indices',
+             'shm_coeff', 'odf']
+    for z in iter_slabs(data.shape[2], slab_size):
+        slab_mask = None
+        if mask is not None:
+            slab_mask = np.asarray(mask[:, :, z], dtype=bool)
+        slab_pam = peaks_from_model(model, np.asarray(data[:, :, z]), sphere,
+                                    relative_peak_threshold,
+                                    min_separation_angle, mask=slab_mask,
+                                    parallel=False, **kwargs)
+        if pam is None:
+            pam = PeaksAndMetrics()
+            pam.sphere = sphere
+            pam.B = slab_pam.B
+            for name in names:
+                value = getattr(slab_pam, name)
+                if value is not None:
+                    value = np.zeros(data.shape[:3] + value.shape[3:],
+                                     dtype=value.dtype)
+                setattr(pam, name, value)
+        for name in names:
+            value = getattr(slab_pam, name)
+            if value is not None:
+                getattr(pam, name)[:, :, z] = value
+    return pam
@@ -5,7 +5,8 @@ from functools import reduce
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.multi_voxel import _squash, multi_voxel_fit, CallableArray
+from dipy.reconst.multi_voxel import (_squash, _gather, multi_voxel_fit,
+                                      CallableArray)
 from dipy.core.sphere import unit_icosahedron
 
 
@@ -89,6 +90,65 @@ def test_squash():
                            obj_masked)
 
 
+def test_gather():
+    obj_arr = np.empty((2, 3), dtype=object)
+    obj_arr.fill(3)
+    obj_arr[0, 1] = None
+    expected = np.empty((2, 3, 3))
+    expected[:] = np.arange(3)
+    expected[0, 1] = 0
+    result = _gather(obj_arr, np.arange)
+    npt.assert_array_equal(result, expected)
+    npt.assert_equal(result.dtype, np.arange(3).dtype)
+
+    # Same as squashing the results
+    def half(x):
+        return x / 2.
+    halves = np.empty((2, 3), dtype=object)
+    halves.fill(1.5)
+    halves[0, 1] = None
+    squashed = _squash(halves, fill=99)
+    npt.assert_array_equal(_gather(obj_arr, half, fill=99), squashed)
+    npt.assert_equal(_gather(obj_arr, half).dtype, np.float64)
+    msk = np.ones((2, 3), dtype=bool)
+    msk[0, 1] = False
+    msk[1, 1] = False
+    expected[1, 1] = 0
+    npt.assert_array_equal(_gather(obj_arr, np.arange, msk), expected)
+    expected[1, 1] = np.arange(3)
+
+    # Results are written to out
+    out = np.ones((2, 3, 3))
+    result = _gather(obj_arr, np.arange, out=out)
+    npt.assert_(result is out)
+    npt.assert_array_equal(out, _gather(obj_arr, np.arange))
+    out = np.ones((3, 2, 3)).transpose(1, 0, 2)
+    npt.assert_array_equal(_gather(obj_arr, np.arange, out=out), out)
+    npt.assert_array_equal(out, _gather(obj_arr, np.arange))
+    npt.assert_raises(ValueError, _gather, obj_arr, np.arange,
+                      out=np.ones((2, 3, 4)))
+    npt.assert_raises(ValueError, _gather, obj_arr, np.arange,
+                      out=np.ones((2, 3, 3), dtype=np.int8))
+
+    # Results with different dtypes are promoted to a common dtype
+    obj_arr[1, 2] = 3.
+    result = _gather(obj_arr, np.arange)
+    npt.assert_equal(result.dtype, np.float64)
+    npt.assert_array_equal(result, expected)
+
+    # Results with different shapes can't be stacked
+    obj_arr[1, 2] = 4
+    result = _gather(obj_arr, np.arange)
+    npt.assert_equal(result.dtype, object)
+    npt.assert_array_equal(result[1, 2], np.arange(4))
+    npt.assert_array_equal(result[0, 0], np.arange(3))
+    npt.assert_equal(result[0, 1], None)
+    out = np.ones((2, 3, 3))
+    npt.assert_raises(ValueError, _gather, obj_arr, np.arange, out=out)
+    # out is left unchanged
+    npt.assert_array_equal(out, 1)
+
+
 def test_CallableArray():
     callarray = CallableArray((2, 3), dtype=object)
 
@@ -103,6 +163,11 @@ def test_CallableArray():
     expected[0, 0] = 0
     npt.assert_array_equal(callarray(4), expected)
 
+    # Test with out
+    out = np.ones([2, 3, 4])
+    npt.assert_(callarray(4, out=out) is out)
+    npt.assert_array_equal(out, expected)
+
 
 def test_multi_voxel_fit():
 
@@ -122,6 +187,12 @@ def test_multi_voxel_fit():
             self.data = data
 
         model_attr = 2.
+        n_evaluated = 0
+
+        @property
+        def counted_attr(self):
+            SillyFit.n_evaluated += 1
+            return 1.
 
         def odf(self, sphere):
             return np.ones(len(sphere.phi))
@@ -168,10 +239,26 @@ def test_multi_voxel_fit():
     npt.assert_equal(odf.shape, (3, 3, 3, 12))
     npt.assert_array_equal(odf[~mask], 0)
     npt.assert_array_equal(odf[mask], 1)
+    out = np.empty((3, 3, 3, 12))
+    npt.assert_(fit.odf(unit_icosahedron, out=out) is out)
+    npt.assert_array_equal(out, odf)
     predicted = np.zeros(data.shape)
     predicted[mask] = S0
     npt.assert_equal(fit.predict(S0=S0), predicted)
 
+    # Each attribute is evaluated once per fitted voxel
+    npt.assert_array_equal(fit.counted_attr, mask)
+    npt.assert_equal(SillyFit.n_evaluated, mask.sum())
+
+    # Test with an empty mask
+    empty_fit = model.fit(data, np.zeros((3, 3, 3), dtype=bool))
+    attr = empty_fit.model_attr
+    npt.assert_equal(attr.shape, (3, 3, 3))
+    npt.assert_(all(a is None for a in attr.ravel()))
+    odf = empty_fit.odf(unit_icosahedron)
+    npt.assert_equal(odf.shape, (3, 3, 3))
+    npt.assert_(all(o is None for o in odf.ravel()))
+
     # Test fit.shape
     npt.assert_equal(fit.shape, (3, 3, 3))
 
@@ -25,9 +25,11 @@ from dipy.reconst.shm import (real_sph_harm, real_sym_sh_basis,
                               OpdtModel, normalize_data, hat, lcr_matrix,
                               smooth_pinv, bootstrap_data_array,
                               bootstrap_data_voxel, ResidualBootstrapWrapper,
+                              bootstrap_sh_coeff, bootstrap_odf_stats,
                               CsaOdfModel, QballModel, SphHarmFit,
                               spherical_harmonics, anisotropic_power,
-                              calculate_max_order)
+                              calculate_max_order, sh_power_metrics, _gfa_sh,
+                              _bootstrap_permutations)
 
 
 def test_order_from_ncoeff():
@@ -353,6 +355,55 @@ def test_ResidualBootstrapWrapper():
     assert_array_almost_equal(boot_obj[1], dhat[1].clip(ms, 1))
 
 
+def test_bootstrap_sh_coeff():
+    hemi = hemi_icosahedron.subdivide(2)
+    m, n = sph_harm_ind_list(4)
+    B = real_sph_harm(m, n, hemi.theta[:, None], hemi.phi[:, None])
+    H = hat(B)
+    data = np.random.random((3, 4, len(hemi.theta))) * .5 + .25
+    coeff = bootstrap_sh_coeff(data, B, n_boot=5, random_seed=1234, step=5)
+    assert_equal(coeff.shape, (3, 4, 5, B.shape[1]))
+
+    # Results only depend on the seed, not on the blocks or the mask
+    for step in [1, 5, 7, 1000]:
+        coeff2 = bootstrap_sh_coeff(data, B, n_boot=5, random_seed=1234,
+                                    step=step)
+        assert_array_almost_equal(coeff, coeff2)
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[1, 2] = True
+    coeff2 = bootstrap_sh_coeff(data, B, n_boot=5, mask=mask,
+                                random_seed=1234)
+    assert_array_almost_equal(coeff[1, 2], coeff2[1, 2])
+    coeff2 = bootstrap_sh_coeff(data, B, n_boot=5, random_seed=4321)
+    assert_true(np.abs(coeff - coeff2).max() > 1e-3)
+
+    # Each sample is the fit of a residual bootstrap of the voxel's signal
+    R = lcr_matrix(H)
+    permute = _bootstrap_permutations(1234, [6], 5, data.shape[-1])[0]
+    boot_data = bootstrap_data_voxel(data[1, 2], H, R, permute[3])
+    assert_array_almost_equal(np.dot(B, coeff[1, 2, 3]),
+                              np.dot(H, boot_data))
+
+    # Signals in the span of B have no residuals
+    dhat = np.dot(data, H.T)
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[0, :2] = True
+    coeff = bootstrap_sh_coeff(dhat, B, n_boot=3, mask=mask)
+    expected = np.dot(dhat, npl.pinv(B).T)
+    assert_array_almost_equal(coeff[mask],
+                              expected[mask][:, None].repeat(3, 1))
+    assert_array_equal(coeff[~mask], 0)
+    assert_raises(ValueError, bootstrap_sh_coeff, dhat, B, 3, mask[0])
+
+    sampling_matrix = real_sph_harm(m, n, hemi.theta[:10, None],
+                                    hemi.phi[:10, None])
+    odf_mean, odf_std = bootstrap_odf_stats(dhat, B, sampling_matrix,
+                                            n_boot=3, mask=mask)
+    assert_array_almost_equal(odf_mean[mask],
+                              np.dot(expected[mask], sampling_matrix.T))
+    assert_array_almost_equal(odf_std, 0)
+
+
 def test_sf_to_sh():
     # Subdividing a hemi_icosahedron twice produces 81 unique points, which
     # is more than enough to fit a order 8 (45 coefficients) spherical harmonic
@@ -456,6 +507,36 @@ def test_anisotropic_power():
         assert len(w) == 0
 
 
+def test_sh_power_metrics():
+    coeffs = np.random.randn(4, 5, 3, 28)
+    coeffs[0, 0, 0] = 0
+    for power in [2, 3]:
+        for non_negative in [True, False]:
+            log_ap, gfa, spectrum = sh_power_metrics(
+                coeffs, power=power, non_negative=non_negative, step=7)
+            npt.assert_equal(log_ap.dtype, np.float32)
+            npt.assert_array_almost_equal(
+                log_ap, anisotropic_power(coeffs, power=power,
+                                          non_negative=non_negative), 4)
+            npt.assert_array_almost_equal(gfa, _gfa_sh(coeffs), 5)
+            npt.assert_equal(spectrum.shape, (4, 5, 3, 4))
+            start = 0
+            for i, L in enumerate(range(0, 7, 2)):
+                npt.assert_array_almost_equal(
+                    spectrum[..., i],
+                    np.mean(np.abs(coeffs[..., start:start + 2 * L + 1]) **
+                            power, -1), 4)
+                start += 2 * L + 1
+
+    mask = np.random.random((4, 5, 3)) > .5
+    log_ap, gfa, spectrum = sh_power_metrics(coeffs, mask=mask, step=5,
+                                             num_threads=2)
+    npt.assert_array_equal(log_ap[~mask], 0)
+    npt.assert_array_equal(spectrum[~mask], 0)
+    npt.assert_array_almost_equal(gfa[mask], _gfa_sh(coeffs[mask]), 5)
+    assert_raises(ValueError, sh_power_metrics, coeffs, mask=mask[0])
+
+
 def test_calculate_max_order():
     """Based on the table in:
     http://jdtournier.github.io/mrtrix-0.2/tractography/preprocess.html
@@ -0,0 +1,88 @@
+from os.path import join
+
+import numpy as np
+import numpy.testing as npt
+import nibabel as nib
+from nibabel.tmpdirs import TemporaryDirectory
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_data, get_sphere
+from dipy.direction.peaks import peaks_from_model
+from dipy.reconst.dti import TensorModel, fractional_anisotropy
+from dipy.reconst.shm import CsaOdfModel
+from dipy.reconst.slabs import (iter_slabs, fit_slabs, fit_nifti_slabs,
+                                peaks_from_model_slabs)
+
+
+def test_iter_slabs():
+    npt.assert_equal(list(iter_slabs(4, 4)), [slice(0, 4)])
+    npt.assert_equal(list(iter_slabs(4, 10)), [slice(0, 4)])
+    npt.assert_equal(list(iter_slabs(7, 3)),
+                     [slice(0, 3), slice(3, 6), slice(6, 7)])
+    npt.assert_raises(ValueError, list, iter_slabs(4, 0))
+
+
+def test_fit_slabs():
+    data_path, bval_path, bvec_path = get_data('small_25')
+    img = nib.load(data_path)
+    data = img.get_data()
+    gtab = gradient_table(bval_path, bvec_path)
+    model = TensorModel(gtab)
+    mask = data[..., 0] > 100
+
+    fit = model.fit(data, mask)
+    metrics = {'fa': lambda f: fractional_anisotropy(f.evals),
+               'evals': lambda f: f.evals}
+    out = {'fa': np.zeros(data.shape[:3]),
+           'evals': np.zeros(data.shape[:3] + (3,))}
+    fit_slabs(model, data, metrics, out, mask, slab_size=2)
+    npt.assert_array_almost_equal(out['fa'], fractional_anisotropy(fit.evals))
+    npt.assert_array_almost_equal(out['evals'], fit.evals)
+
+    with TemporaryDirectory() as out_dir:
+        # Uncompressed input is memory-mapped, outputs may be compressed
+        nii_path = join(out_dir, 'dwi.nii')
+        nib.save(nib.Nifti1Image(data, img.affine), nii_path)
+        mask_path = join(out_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), img.affine),
+                 mask_path)
+        out_fnames = {'fa': join(out_dir, 'fa.nii'),
+                      'evals': join(out_dir, 'evals.nii.gz')}
+        fit_nifti_slabs(model, nii_path, metrics, out_fnames, mask_path,
+                        slab_size=3, dtypes={'evals': np.float64})
+        fa_img = nib.load(out_fnames['fa'])
+        npt.assert_equal(fa_img.get_data_dtype(), np.float32)
+        npt.assert_array_almost_equal(fa_img.affine, img.affine)
+        npt.assert_array_almost_equal(fa_img.get_data(), out['fa'], 5)
+        evals_img = nib.load(out_fnames['evals'])
+        npt.assert_equal(evals_img.shape, data.shape[:3] + (3,))
+        npt.assert_array_almost_equal(evals_img.get_data(), fit.evals)
+
+
+def test_peaks_from_model_slabs():
+    data_path, bval_path, bvec_path = get_data('small_64D')
+    img = nib.load(data_path)
+    data = img.get_data()
+    gtab = gradient_table(bval_path, bvec_path)
+    model = CsaOdfModel(gtab, 6)
+    sphere = get_sphere('repulsion100')
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[:, :, 1:] = True
+
+    expected = peaks_from_model(model, data, sphere, .5, 25, mask=mask,
+                                sh_order=6, return_odf=True)
+    pam = peaks_from_model_slabs(model, img.dataobj, sphere, .5, 25,
+                                 mask=mask, slab_size=1, sh_order=6,
+                                 return_odf=True)
+    for name in ['gfa', 'peak_dirs', 'peak_values', 'peak_indices',
+                 'shm_coeff', 'odf']:
+        npt.assert_array_almost_equal(getattr(pam, name),
+                                      getattr(expected, name))
+    npt.assert_array_almost_equal(pam.B, expected.B)
+    npt.assert_equal(pam.qa.shape, expected.qa.shape)
+    npt.assert_array_equal(pam.qa[~mask], 0)
+
+    pam = peaks_from_model_slabs(model, data, sphere, .5, 25, slab_size=2,
+                                 return_sh=False)
+    npt.assert_equal(pam.shm_coeff, None)
+    npt.assert_equal(pam.odf, None)
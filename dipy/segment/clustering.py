@@ -1,3 +1,4 @@
+import itertools
 import operator
 import numpy as np
 
@@ -508,3 +509,424 @@ class QuickBundles(Clustering):
 
         cluster_map.refdata = streamlines
         return cluster_map
+
+
+class StreamingQuickBundles(QuickBundles):
+    r""" Clusters streamlines given chunk by chunk using QuickBundles.
+
+    The streamlines are assigned as by `QuickBundles`, in the order they are
+    given, but only the centroids and the sizes of the bundles are kept with
+    the index of the bundle of each streamline, in an int32 array. Tractograms
+    that do not fit in memory can then be clustered from a generator, like
+    the streamlines of a lazily loaded tractogram file.
+
+    Parameters
+    ----------
+    threshold : float
+        The maximum distance from a bundle for a streamline to be still
+        considered as part of it.
+    metric : str or `Metric` object (optional)
+        The distance metric to use when comparing two streamlines. By default,
+        the Minimum average Direct-Flip (MDF) distance [Garyfallidis12]_ is
+        used and streamlines are automatically resampled so they have
+        12 points.
+    max_nb_clusters : int
+        Limits the creation of bundles.
+
+    Examples
+    --------
+    >>> from dipy.segment.clustering import StreamingQuickBundles
+    >>> from dipy.data import get_data
+    >>> from nibabel import trackvis as tv
+    >>> streams, hdr = tv.read(get_data('fornix'))
+    >>> qb = StreamingQuickBundles(threshold=10.)
+    >>> labels = qb.cluster_stream((s[0] for s in streams), chunk_size=100)
+    >>> list(qb.clusters_sizes)
+    [61, 191, 47, 1]
+    >>> labels[:5]
+    array([0, 1, 1, 1, 1], dtype=int32)
+
+    References
+    ----------
+    .. [Garyfallidis12] Garyfallidis E. et al., QuickBundles a method for
+                        tractography simplification, Frontiers in Neuroscience,
+                        vol 6, no 175, 2012.
+    """
+
+    def __init__(self, threshold, metric="MDF_12points",
+                 max_nb_clusters=np.iinfo('i4').max):
+        super(StreamingQuickBundles, self).__init__(threshold, metric,
+                                                    max_nb_clusters)
+        self.nb_clusters = 0
+        self.nb_streamlines = 0
+        self._centroids = None
+        self._sizes = np.zeros(0, dtype=np.intp)
+        self._labels = np.zeros(0, dtype=np.int32)
+
+    @property
+    def centroids(self):
+        """ Centroids of the bundles, shape (nb_clusters, N, D). """
+        if self._centroids is None:
+            return np.zeros((0, 0, 0), dtype=np.float32)
+        return self._centroids[:self.nb_clusters]
+
+    @property
+    def clusters_sizes(self):
+        """ Number of streamlines in each bundle. """
+        return self._sizes[:self.nb_clusters]
+
+    @property
+    def labels(self):
+        """ Index of the bundle of each streamline clustered so far. """
+        return self._labels[:self.nb_streamlines]
+
+    def partial_cluster(self, streamlines):
+        """ Clusters a chunk of streamlines, after the previous ones.
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays or `Streamlines`
+            The next streamlines.
+
+        Returns
+        -------
+        labels : ndarray of int32
+            Index of the bundle of each streamline of the chunk.
+        """
+        from dipy.segment.clustering_algorithms import quickbundles_chunk
+        self._centroids, self._sizes, self.nb_clusters, labels = \
+            quickbundles_chunk(streamlines, self.metric, self.threshold,
+                               self.max_nb_clusters, self._centroids,
+                               self._sizes, self.nb_clusters)
+
+        end = self.nb_streamlines + len(labels)
+        if end > len(self._labels):
+            grown = np.zeros(max(end, 2 * len(self._labels)), dtype=np.int32)
+            grown[:self.nb_streamlines] = self.labels
+            self._labels = grown
+        self._labels[self.nb_streamlines:end] = labels
+        self.nb_streamlines = end
+        return labels
+
+    def cluster_stream(self, streamlines, chunk_size=10000, checkpoint=None,
+                       checkpoint_interval=100):
+        """ Clusters the streamlines of an iterable, chunk by chunk.
+
+        Parameters
+        ----------
+        streamlines : iterable of 2D arrays
+            All the streamlines, from the first one. The ``nb_streamlines``
+            streamlines already clustered, e.g. by a run that was stopped
+            and reloaded from a checkpoint, are skipped.
+        chunk_size : int, optional
+            Number of streamlines in memory at a time.
+        checkpoint : str, optional
+            File name where the clustering is saved every
+            `checkpoint_interval` chunks and at the end, to be resumed with
+            `load`.
+        checkpoint_interval : int, optional
+            Number of chunks between checkpoints.
+
+        Returns
+        -------
+        labels : ndarray of int32
+            Index of the bundle of each streamline.
+        """
+        streamlines = iter(streamlines)
+        for _ in itertools.islice(streamlines, self.nb_streamlines):
+            pass
+        for i in itertools.count(1):
+            chunk = list(itertools.islice(streamlines, chunk_size))
+            if not chunk:
+                break
+            self.partial_cluster(chunk)
+            if checkpoint is not None and i % checkpoint_interval == 0:
+                self.save(checkpoint)
+        if checkpoint is not None:
+            self.save(checkpoint)
+        return self.labels
+
+    def cluster_map(self, refdata=None):
+        """ Returns the bundles as a `ClusterMapCentroid`.
+
+        Parameters
+        ----------
+        refdata : list, optional
+            The streamlines the indices of the bundles refer to.
+        """
+        cluster_map = ClusterMapCentroid()
+        order = np.argsort(self.labels, kind='mergesort')
+        ends = np.cumsum(self.clusters_sizes)
+        for i, indices in enumerate(np.split(order, ends[:-1])):
+            centroid = self.centroids[i].copy()
+            cluster_map.add_cluster(ClusterCentroid(centroid, id=i,
+                                                    indices=indices.tolist()))
+        if refdata is not None:
+            cluster_map.refdata = refdata
+        return cluster_map
+
+    def save(self, fname):
+        """ Saves the clustering to a ``.npz`` file. """
+        np.savez(fname, threshold=self.threshold,
+                 max_nb_clusters=self.max_nb_clusters,
+                 centroids=self.centroids, sizes=self.clusters_sizes,
+                 labels=self.labels)
+
+    @classmethod
+    def load(cls, fname, metric="MDF_12points"):
+        """ Loads a clustering saved with ``save``, to resume it.
+
+        Parameters
+        ----------
+        fname : str
+            The ``.npz`` file.
+        metric : str or `Metric` object (optional)
+            The metric of the saved clustering, which is not saved with it.
+        """
+        with np.load(fname) as data:
+            qb = cls(float(data['threshold']), metric,
+                     int(data['max_nb_clusters']))
+            qb.nb_clusters = len(data['sizes'])
+            qb.nb_streamlines = len(data['labels'])
+            if qb.nb_clusters:
+                qb._centroids = data['centroids'].astype(np.float32)
+            qb._sizes = data['sizes'].astype(np.intp)
+            qb._labels = data['labels'].astype(np.int32)
+        return qb
+
+
+class TreeCluster(ClusterCentroid):
+    """ A node of a `TreeClusterMap`.
+
+    Parameters
+    ----------
+    centroid : 2D array
+        Centroid of the streamlines of this node.
+    threshold : float
+        Threshold of the level of this node.
+    level : int
+        Depth of this node in the tree, 0 for the root.
+    parent : `TreeCluster` object (optional)
+        The node this node is a child of, None for the root.
+    id : int
+        Index of this node in its `TreeClusterMap` object.
+    indices : list of int (optional)
+        Indices of the streamlines of this node.
+    refdata : list (optional)
+        Actual elements that clustered indices refer to.
+    """
+    def __init__(self, centroid, threshold, level, parent=None, id=0,
+                 indices=None, refdata=Identity()):
+        super(TreeCluster, self).__init__(centroid, id, indices, refdata)
+        self.threshold = threshold
+        self.level = level
+        self.parent = parent
+        self.children = []
+
+    @property
+    def is_leaf(self):
+        return len(self.children) == 0
+
+
+class TreeClusterMap(ClusterMapCentroid):
+    """ The tree of clusters made by `QuickBundlesX`.
+
+    The clusters of the map are the leaves of the tree, the other nodes are
+    reached from `root` or from `nodes`, and `get_clusters` gives all the
+    nodes of a level.
+
+    Parameters
+    ----------
+    nodes : list of `TreeCluster` objects
+        The nodes of the tree, the root first, each node before its children.
+    metric : `Metric` object
+        The metric used to build the tree.
+    first_child, next_sibling : ndarray of intp
+        The children of each node, as returned by `quickbundlesx`.
+    refdata : list (optional)
+        Actual elements that clustered indices refer to.
+    """
+    def __init__(self, nodes, metric, first_child, next_sibling,
+                 refdata=Identity()):
+        self.nodes = nodes
+        self.metric = metric
+        self._first_child = first_child
+        self._next_sibling = next_sibling
+        self._centroids = np.array([node.centroid for node in nodes],
+                                   dtype=np.float32)
+        super(TreeClusterMap, self).__init__(refdata)
+        self._clusters = [node for node in nodes
+                          if node.is_leaf and node.level > 0]
+
+    @property
+    def root(self):
+        return self.nodes[0]
+
+    @property
+    def refdata(self):
+        return self._refdata
+
+    @refdata.setter
+    def refdata(self, value):
+        if value is None:
+            value = Identity()
+
+        self._refdata = value
+        for node in self.nodes:
+            node.refdata = self._refdata
+
+    def get_clusters(self, level):
+        """ Returns the nodes of a level of the tree.
+
+        Parameters
+        ----------
+        level : int
+            Depth in the tree, 0 being the root.
+
+        Returns
+        -------
+        `ClusterMapCentroid` object
+            The clusters made with the threshold of this level.
+        """
+        clusters = ClusterMapCentroid()
+        clusters.add_cluster(*[node for node in self.nodes
+                               if node.level == level])
+        clusters.refdata = self.refdata
+        return clusters
+
+    def query(self, streamlines):
+        """ Finds the nearest leaf to each streamline, going down the tree.
+
+        Only the children of one node per level are compared with a
+        streamline, instead of all the leaves.
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays or `Streamlines`
+            Streamlines to look up.
+
+        Returns
+        -------
+        leaves : ndarray of int32
+            Index in `nodes` of the nearest leaf of each streamline.
+        dists : ndarray of float64
+            Distance between each streamline and the centroid of its leaf.
+        """
+        from dipy.segment.clustering_algorithms import quickbundlesx_query
+        return quickbundlesx_query(streamlines, self.metric, self._centroids,
+                                   self._first_child, self._next_sibling)
+
+    def find_nearest_leaf(self, streamline):
+        """ Returns the nearest leaf to a streamline, as a `TreeCluster`. """
+        leaves, _ = self.query([np.asarray(streamline)])
+        return self.nodes[leaves[0]]
+
+
+class QuickBundlesX(Clustering):
+    r""" Clusters streamlines in a tree of bundles using QuickBundlesX.
+
+    Each level of the tree has a threshold, the thresholds decreasing from
+    the root to the leaves. Each streamline is assigned, in a single pass, to
+    the nearest child of its bundle at each level, as QuickBundles would with
+    this level's threshold, or to a new child if the nearest one is farther
+    than the threshold. Assigning a streamline takes
+    $\mathcal{O}(\sum_l b_l)$ distances where $b_l$ is the number of children
+    of its bundle at level $l$, instead of one per bundle at the last level.
+
+    Parameters
+    ----------
+    thresholds : sequence of float
+        The maximum distance from a bundle for a streamline to be still
+        considered as part of it, at each level. They must be decreasing.
+    metric : str or `Metric` object (optional)
+        The distance metric to use when comparing two streamlines. By default,
+        the Minimum average Direct-Flip (MDF) distance [Garyfallidis12]_ is
+        used and streamlines are automatically resampled so they have
+        12 points.
+
+    Examples
+    --------
+    >>> from dipy.segment.clustering import QuickBundlesX
+    >>> from dipy.data import get_data
+    >>> from nibabel import trackvis as tv
+    >>> streams, hdr = tv.read(get_data('fornix'))
+    >>> streamlines = [i[0] for i in streams]
+    >>> qbx = QuickBundlesX(thresholds=[15., 10., 5.])
+    >>> tree = qbx.cluster(streamlines)
+    >>> list(map(len, tree.get_clusters(1)))
+    [282, 18]
+    >>> list(map(len, tree.get_clusters(2)))
+    [57, 189, 36, 14, 4]
+    >>> len(tree)
+    18
+    >>> # Nearest bundle at the last level, without comparing all of them
+    >>> leaf = tree.find_nearest_leaf(streamlines[0])
+    >>> leaf.level, leaf.threshold
+    (3, 5.0)
+
+    References
+    ----------
+    .. [Garyfallidis12] Garyfallidis E. et al., QuickBundles a method for
+                        tractography simplification, Frontiers in Neuroscience,
+                        vol 6, no 175, 2012.
+    """
+
+    def __init__(self, thresholds, metric="MDF_12points"):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+        if len(self.thresholds) == 0:
+            raise ValueError("At least one threshold is needed")
+        if np.any(np.diff(self.thresholds) >= 0):
+            raise ValueError("The thresholds must be decreasing")
+
+        if isinstance(metric, Metric):
+            self.metric = metric
+        elif metric == "MDF_12points":
+            feature = ResampleFeature(nb_points=12)
+            self.metric = AveragePointwiseEuclideanMetric(feature)
+        else:
+            raise ValueError("Unknown metric: {0}".format(metric))
+
+    def cluster(self, streamlines, ordering=None):
+        """ Clusters `streamlines` into a tree of bundles.
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays or `Streamlines`
+            Each 2D array represents a sequence of 3D points (points, 3).
+        ordering : iterable of indices
+            Specifies the order in which data points will be clustered.
+
+        Returns
+        -------
+        `TreeClusterMap` object
+            Result of the clustering.
+        """
+        from dipy.segment.clustering_algorithms import quickbundlesx
+        (parents, levels, first_child, next_sibling, centroids, sizes,
+         labels) = quickbundlesx(streamlines, self.metric, self.thresholds,
+                                 ordering=ordering)
+
+        root_indices = np.flatnonzero(labels[:, 0] >= 0)
+        nodes = [TreeCluster(centroids[0], np.inf, 0,
+                             indices=root_indices.tolist())]
+        starts = np.zeros(len(parents), dtype=np.intp)
+        orders = [None]
+        for level in range(1, len(self.thresholds) + 1):
+            # Streamline indices sorted by node, in increasing order per node
+            order = np.argsort(labels[:, level - 1], kind='mergesort')
+            orders.append(order)
+            at_level = np.flatnonzero(levels == level)
+            starts[at_level] = np.searchsorted(labels[order, level - 1],
+                                               at_level)
+
+        for i in range(1, len(parents)):
+            parent = nodes[parents[i]]
+            indices = orders[levels[i]][starts[i]:starts[i] + sizes[i]]
+            node = TreeCluster(centroids[i], self.thresholds[levels[i] - 1],
+                               levels[i], parent=parent, id=i,
+                               indices=indices.tolist())
+            parent.children.append(node)
+            nodes.append(node)
+
+        return TreeClusterMap(nodes, self.metric, first_child, next_sibling,
+                              refdata=streamlines)
@@ -4,10 +4,11 @@
 import itertools
 import numpy as np
 
-from cythonutils cimport Data2D, shape2tuple
+from cythonutils cimport Data2D, Shape, shape2tuple, tuple2shape, same_shape
 from metricspeed cimport Metric
 from clusteringspeed cimport ClustersCentroid, Centroid, QuickBundles
 from dipy.segment.clustering import ClusterMapCentroid, ClusterCentroid
+from dipy.tracking import Streamlines
 
 DTYPE = np.float32
 DEF BIGGEST_DOUBLE = 1.7976931348623157e+308  # np.finfo('f8').max
@@ -50,13 +51,34 @@ def peek(iterable):
     return first, iterator
 
 
+def _as_float32_streamlines(streamlines):
+    """ Returns a function giving the i-th streamline as a writeable float32
+    array, slicing `Streamlines` from their converted points. """
+    if isinstance(streamlines, Streamlines):
+        data = streamlines._data
+        if not data.flags.writeable or data.dtype != DTYPE:
+            data = data.astype(DTYPE)
+        offsets = streamlines._offsets
+        ends = offsets + streamlines._lengths
+        return lambda idx: data[offsets[idx]:ends[idx]]
+
+    def get(idx):
+        streamline = streamlines[idx]
+        if not streamline.flags.writeable or streamline.dtype != DTYPE:
+            streamline = streamline.astype(DTYPE)
+        return streamline
+    return get
+
+
 def quickbundles(streamlines, Metric metric, double threshold, long max_nb_clusters=BIGGEST_INT, ordering=None):
     """ Clusters streamlines using QuickBundles.
 
     Parameters
     ----------
-    streamlines : list of 2D arrays
-        List of streamlines to cluster.
+    streamlines : list of 2D arrays or `Streamlines`
+        List of streamlines to cluster. The points of `Streamlines` are
+        converted to float32 at once and each streamline is sliced directly
+        from the converted points.
     metric : `Metric` object
         Tells how to compute the distance between two streamlines.
     threshold : double
@@ -95,14 +117,417 @@ def quickbundles(streamlines, Metric metric, double threshold, long max_nb_clust
     cdef QuickBundles qb = QuickBundles(features_shape, metric, threshold, max_nb_clusters)
     cdef int idx
 
+    get_streamline = _as_float32_streamlines(streamlines)
     for idx in ordering:
-        streamline = streamlines[idx]
-        if not streamline.flags.writeable or streamline.dtype != DTYPE:
-            streamline = streamline.astype(DTYPE)
-
+        streamline = get_streamline(idx)
         cluster_id = qb.assignment_step(streamline, idx)
         # The update step is performed right after the assignement step instead
         # of after all streamlines have been assigned like k-means algorithm.
         qb.update_step(cluster_id)
 
     return clusters_centroid2clustermap_centroid(qb.clusters)
+
+
+cdef int _nearest_centroid(Metric metric, float[:, :, ::1] centroids,
+                           Py_ssize_t nb_clusters, Data2D features,
+                           double *dist) nogil except -2:
+    """ Index of the nearest centroid to `features`, -1 if there are none.
+    """
+    cdef:
+        Py_ssize_t k
+        int nearest = -1
+        double d
+    dist[0] = BIGGEST_DOUBLE
+    for k in range(nb_clusters):
+        d = metric.c_dist(centroids[k], features)
+        if d < dist[0]:
+            dist[0] = d
+            nearest = k
+    return nearest
+
+
+def quickbundles_chunk(streamlines, Metric metric, double threshold,
+                       long max_nb_clusters, centroids, sizes,
+                       Py_ssize_t nb_clusters):
+    """ Clusters a chunk of streamlines with QuickBundles, given the clusters
+    of the previous chunks.
+
+    Each streamline is assigned as in `quickbundles` and the centroid of its
+    cluster is updated at once, so that clustering the chunks one after the
+    other gives the same clusters as clustering all the streamlines at once.
+    Only the centroids and the sizes of the clusters are kept.
+
+    Parameters
+    ----------
+    streamlines : list of 2D arrays or `Streamlines`
+        Chunk of streamlines to cluster.
+    metric : `Metric` object
+        Tells how to compute the distance between two streamlines.
+    threshold : double
+        The maximum distance from a cluster for a streamline to be still
+        considered as part of it.
+    max_nb_clusters : int
+        Limits the creation of bundles.
+    centroids : ndarray of float32, shape (C, N, D)
+        Centroids of the clusters, for ``C >= nb_clusters``. The extra rows
+        are room for new clusters. If None, the shape of the features is
+        inferred from the first streamline.
+    sizes : ndarray of intp, shape (C,)
+        Number of streamlines in each cluster.
+    nb_clusters : int
+        Number of clusters.
+
+    Returns
+    -------
+    centroids, sizes : ndarray
+        The updated arrays. They are reallocated, twice as large, when new
+        clusters do not fit in them.
+    nb_clusters : int
+        The updated number of clusters.
+    labels : ndarray of int32
+        Index of the cluster of each streamline of the chunk.
+    """
+    # Threshold of np.inf is not supported, set it to 'biggest_double'
+    threshold = min(threshold, BIGGEST_DOUBLE)
+    # Threshold of -np.inf is not supported, set it to 0
+    threshold = max(threshold, 0)
+
+    if len(streamlines) == 0:
+        return centroids, sizes, nb_clusters, np.zeros(0, dtype=np.int32)
+    if centroids is None:
+        first = np.asarray(streamlines[0]).astype(DTYPE)
+        centroids = np.zeros((0,) + shape2tuple(
+            metric.feature.c_infer_shape(first)), dtype=DTYPE)
+
+    cdef:
+        Py_ssize_t i, n, d, c, N, D
+        int nearest, nearest_flip
+        double dist, dist_flip
+        float[:, :, ::1] centroids_view = centroids
+        Py_ssize_t[::1] sizes_view = sizes
+        int[::1] labels = np.empty(len(streamlines), dtype=np.int32)
+        Shape features_shape = tuple2shape(centroids.shape[1:])
+        Shape shape
+        Data2D streamline, features_to_add
+        Data2D features = np.empty(centroids.shape[1:], dtype=DTYPE)
+        Data2D features_flip = np.empty(centroids.shape[1:], dtype=DTYPE)
+
+    N = features.shape[0]
+    D = features.shape[1]
+    get_streamline = _as_float32_streamlines(streamlines)
+    for i in range(len(streamlines)):
+        streamline = get_streamline(i)
+        shape = metric.feature.c_infer_shape(streamline)
+        if not same_shape(shape, features_shape):
+            raise ValueError("All features do not have the same shape! "
+                             "QuickBundles requires this to compute "
+                             "centroids!")
+        if not metric.c_are_compatible(shape, features_shape):
+            raise ValueError("Data features' shapes must be compatible "
+                             "according to the metric used!")
+
+        metric.feature.c_extract(streamline, features)
+        nearest = _nearest_centroid(metric, centroids_view, nb_clusters,
+                                    features, &dist)
+        features_to_add = features
+        if not metric.feature.is_order_invariant:
+            metric.feature.c_extract(streamline[::-1], features_flip)
+            nearest_flip = _nearest_centroid(metric, centroids_view,
+                                             nb_clusters, features_flip,
+                                             &dist_flip)
+            if dist_flip < dist:
+                nearest = nearest_flip
+                dist = dist_flip
+                features_to_add = features_flip
+
+        if not (dist < threshold or nb_clusters >= max_nb_clusters):
+            if nb_clusters == centroids.shape[0]:
+                grown = np.zeros((2 * nb_clusters + 1,) + centroids.shape[1:],
+                                 dtype=DTYPE)
+                grown[:nb_clusters] = centroids[:nb_clusters]
+                centroids = grown
+                sizes = np.concatenate([sizes, np.zeros(nb_clusters + 1,
+                                                        dtype=sizes.dtype)])
+                centroids_view = centroids
+                sizes_view = sizes
+            nearest = nb_clusters
+            nb_clusters += 1
+
+        # Same running average as ClustersCentroid.c_assign
+        c = sizes_view[nearest]
+        for n in range(N):
+            for d in range(D):
+                centroids_view[nearest, n, d] = (
+                    (centroids_view[nearest, n, d] * c) +
+                    features_to_add[n, d]) / (c + 1)
+        sizes_view[nearest] += 1
+        labels[i] = nearest
+
+    return centroids, sizes, nb_clusters, np.asarray(labels)
+
+
+cdef int _nearest_child(Metric metric, float[:, :, ::1] centroids,
+                        Py_ssize_t[::1] first_child,
+                        Py_ssize_t[::1] next_sibling, Py_ssize_t node,
+                        Data2D features, double *dist) nogil except -2:
+    """ Index of the nearest child of `node` to `features`, -1 if there are
+    none. """
+    cdef:
+        Py_ssize_t k = first_child[node]
+        int nearest = -1
+        double d
+    dist[0] = BIGGEST_DOUBLE
+    while k != -1:
+        d = metric.c_dist(centroids[k], features)
+        if d < dist[0]:
+            dist[0] = d
+            nearest = k
+        k = next_sibling[k]
+    return nearest
+
+
+def _grow(array, Py_ssize_t n, fill=0):
+    """ Copies the first `n` rows of `array` in an array of ``2 * n + 1``
+    rows, the others being set to `fill`. """
+    grown = np.full((2 * n + 1,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:n] = array[:n]
+    return grown
+
+
+def quickbundlesx(streamlines, Metric metric, thresholds, ordering=None):
+    """ Clusters streamlines in a tree of clusters using QuickBundlesX.
+
+    The nodes at level ``l + 1`` of the tree are the clusters made by
+    QuickBundles with ``thresholds[l]`` within each node of level ``l``, the
+    root being a cluster of all the streamlines. Each streamline is assigned
+    from the root down to a leaf, to the nearest child of its cluster at
+    each level, in a single pass.
+
+    Parameters
+    ----------
+    streamlines : list of 2D arrays or `Streamlines`
+        List of streamlines to cluster.
+    metric : `Metric` object
+        Tells how to compute the distance between two streamlines.
+    thresholds : sequence of double
+        The maximum distance from a cluster for a streamline to be still
+        considered as part of it, at each level of the tree.
+    ordering : iterable of indices, optional
+        Iterate through `data` using the given ordering.
+
+    Returns
+    -------
+    parents : ndarray of intp, shape (M,)
+        Parent of each node, -1 for the root, which is node 0. The children
+        of a node come after it, in the order they were created.
+    levels : ndarray of intp, shape (M,)
+        Level of each node, 0 for the root.
+    first_child, next_sibling : ndarray of intp, shape (M,)
+        The children of each node as a linked list, -1 marking its end.
+    centroids : ndarray of float32, shape (M, N, D)
+        Centroid of each node. The root has no centroid, its row is zero.
+    sizes : ndarray of intp, shape (M,)
+        Number of streamlines in each node.
+    labels : ndarray of int32, shape (len(streamlines), len(thresholds))
+        Node of each streamline at each level below the root, -1 for the
+        streamlines that are not in `ordering`.
+    """
+    # Threshold of np.inf is not supported, set it to 'biggest_double'
+    # Threshold of -np.inf is not supported, set it to 0
+    thresholds = np.clip(np.asarray(thresholds, dtype=np.float64).ravel(),
+                         0, BIGGEST_DOUBLE)
+    if ordering is None:
+        ordering = xrange(len(streamlines))
+
+    cdef:
+        Py_ssize_t L = len(thresholds)
+        Py_ssize_t i, l, n, d, c, N, D, node, nb_nodes = 1
+        int nearest, nearest_flip
+        double dist, dist_flip
+        bint order_invariant = metric.feature.is_order_invariant
+        double[::1] thresholds_view = thresholds
+        int[:, ::1] labels = np.full((len(streamlines), L), -1,
+                                     dtype=np.int32)
+        Shape features_shape, shape
+        Data2D streamline, features_to_add, features, features_flip
+        float[:, :, ::1] centroids_view
+        Py_ssize_t[::1] sizes_view, parents_view, levels_view
+        Py_ssize_t[::1] first_child_view, last_child_view, next_sibling_view
+
+    # Check if `ordering` or `streamlines` are empty
+    first_idx, ordering = peek(ordering)
+    if first_idx is None or len(streamlines) == 0:
+        features_shape = tuple2shape((0, 0))
+    else:
+        features_shape = metric.feature.c_infer_shape(
+            np.asarray(streamlines[first_idx]).astype(DTYPE))
+
+    centroids = np.zeros((1,) + shape2tuple(features_shape), dtype=DTYPE)
+    sizes = np.zeros(1, dtype=np.intp)
+    parents = np.full(1, -1, dtype=np.intp)
+    levels = np.zeros(1, dtype=np.intp)
+    first_child = np.full(1, -1, dtype=np.intp)
+    last_child = np.full(1, -1, dtype=np.intp)
+    next_sibling = np.full(1, -1, dtype=np.intp)
+    if first_idx is None or len(streamlines) == 0:
+        return (parents, levels, first_child, next_sibling, centroids, sizes,
+                np.asarray(labels))
+
+    centroids_view = centroids
+    sizes_view = sizes
+    parents_view = parents
+    levels_view = levels
+    first_child_view = first_child
+    last_child_view = last_child
+    next_sibling_view = next_sibling
+    features = np.empty(centroids.shape[1:], dtype=DTYPE)
+    features_flip = np.empty(centroids.shape[1:], dtype=DTYPE)
+    N = features.shape[0]
+    D = features.shape[1]
+
+    get_streamline = _as_float32_streamlines(streamlines)
+    for i in ordering:
+        streamline = get_streamline(i)
+        shape = metric.feature.c_infer_shape(streamline)
+        if not same_shape(shape, features_shape):
+            raise ValueError("All features do not have the same shape! "
+                             "QuickBundlesX requires this to compute "
+                             "centroids!")
+        if not metric.c_are_compatible(shape, features_shape):
+            raise ValueError("Data features' shapes must be compatible "
+                             "according to the metric used!")
+
+        metric.feature.c_extract(streamline, features)
+        if not order_invariant:
+            metric.feature.c_extract(streamline[::-1], features_flip)
+
+        sizes_view[0] += 1
+        node = 0
+        for l in range(L):
+            nearest = _nearest_child(metric, centroids_view, first_child_view,
+                                     next_sibling_view, node, features, &dist)
+            features_to_add = features
+            if not order_invariant:
+                nearest_flip = _nearest_child(metric, centroids_view,
+                                              first_child_view,
+                                              next_sibling_view, node,
+                                              features_flip, &dist_flip)
+                if dist_flip < dist:
+                    nearest = nearest_flip
+                    dist = dist_flip
+                    features_to_add = features_flip
+
+            if not dist < thresholds_view[l]:
+                if nb_nodes == centroids.shape[0]:
+                    centroids = _grow(centroids, nb_nodes)
+                    sizes = _grow(sizes, nb_nodes)
+                    parents = _grow(parents, nb_nodes, -1)
+                    levels = _grow(levels, nb_nodes)
+                    first_child = _grow(first_child, nb_nodes, -1)
+                    last_child = _grow(last_child, nb_nodes, -1)
+                    next_sibling = _grow(next_sibling, nb_nodes, -1)
+                    centroids_view = centroids
+                    sizes_view = sizes
+                    parents_view = parents
+                    levels_view = levels
+                    first_child_view = first_child
+                    last_child_view = last_child
+                    next_sibling_view = next_sibling
+                nearest = nb_nodes
+                nb_nodes += 1
+                parents_view[nearest] = node
+                levels_view[nearest] = l + 1
+                if first_child_view[node] == -1:
+                    first_child_view[node] = nearest
+                else:
+                    next_sibling_view[last_child_view[node]] = nearest
+                last_child_view[node] = nearest
+
+            # Same running average as ClustersCentroid.c_assign
+            c = sizes_view[nearest]
+            for n in range(N):
+                for d in range(D):
+                    centroids_view[nearest, n, d] = (
+                        (centroids_view[nearest, n, d] * c) +
+                        features_to_add[n, d]) / (c + 1)
+            sizes_view[nearest] += 1
+            labels[i, l] = nearest
+            node = nearest
+
+    return (parents[:nb_nodes], levels[:nb_nodes], first_child[:nb_nodes],
+            next_sibling[:nb_nodes], centroids[:nb_nodes], sizes[:nb_nodes],
+            np.asarray(labels))
+
+
+def quickbundlesx_query(streamlines, Metric metric, centroids, first_child,
+                        next_sibling):
+    """ Finds the nearest leaf of a QuickBundlesX tree to each streamline.
+
+    Each streamline goes down the tree from the root to the nearest child of
+    its node, flipped or not, until a leaf is reached. This takes
+    O(levels x branching) distances instead of one per leaf.
+
+    Parameters
+    ----------
+    streamlines : list of 2D arrays or `Streamlines`
+        Streamlines to look up.
+    metric : `Metric` object
+        The metric used to build the tree.
+    centroids, first_child, next_sibling : ndarray
+        The tree, as returned by `quickbundlesx`.
+
+    Returns
+    -------
+    leaves : ndarray of int32
+        Nearest leaf of each streamline.
+    dists : ndarray of float64
+        Distance between each streamline and the centroid of its leaf.
+    """
+    centroids = np.ascontiguousarray(centroids, dtype=DTYPE)
+    cdef:
+        Py_ssize_t i, node
+        int nearest, nearest_flip
+        double dist, dist_flip
+        bint order_invariant = metric.feature.is_order_invariant
+        float[:, :, ::1] centroids_view = centroids
+        Py_ssize_t[::1] first_child_view = np.asarray(first_child,
+                                                      dtype=np.intp)
+        Py_ssize_t[::1] next_sibling_view = np.asarray(next_sibling,
+                                                       dtype=np.intp)
+        int[::1] leaves = np.zeros(len(streamlines), dtype=np.int32)
+        double[::1] dists = np.zeros(len(streamlines))
+        Shape features_shape = tuple2shape(centroids.shape[1:])
+        Shape shape
+        Data2D streamline
+        Data2D features = np.empty(centroids.shape[1:], dtype=DTYPE)
+        Data2D features_flip = np.empty(centroids.shape[1:],
+                                        dtype=DTYPE)
+
+    get_streamline = _as_float32_streamlines(streamlines)
+    for i in range(len(streamlines)):
+        streamline = get_streamline(i)
+        shape = metric.feature.c_infer_shape(streamline)
+        if not same_shape(shape, features_shape):
+            raise ValueError("The features of the streamlines do not have "
+                             "the shape of the centroids!")
+        metric.feature.c_extract(streamline, features)
+        if not order_invariant:
+            metric.feature.c_extract(streamline[::-1], features_flip)
+
+        node = 0
+        while first_child_view[node] != -1:
+            nearest = _nearest_child(metric, centroids_view, first_child_view,
+                                     next_sibling_view, node, features, &dist)
+            if not order_invariant:
+                nearest_flip = _nearest_child(metric, centroids_view,
+                                              first_child_view,
+                                              next_sibling_view, node,
+                                              features_flip, &dist_flip)
+                if dist_flip < dist:
+                    nearest = nearest_flip
+                    dist = dist_flip
+            node = nearest
+            dists[i] = dist
+        leaves[i] = node
+
+    return np.asarray(leaves), np.asarray(dists)
@@ -3,15 +3,19 @@ import itertools
 
 
 from nose.tools import assert_equal, assert_raises
-from numpy.testing import assert_array_equal, run_module_suite
+from numpy.testing import (assert_array_equal, assert_almost_equal,
+                           run_module_suite)
 from dipy.testing.memory import get_type_refcount
 from dipy.testing import assert_arrays_equal
+from nibabel.tmpdirs import InTemporaryDirectory
 
-from dipy.segment.clustering import QuickBundles
+from dipy.segment.clustering import (QuickBundles, StreamingQuickBundles,
+                                     QuickBundlesX)
 
 import dipy.segment.metric as dipymetric
 from dipy.segment.clustering_algorithms import quickbundles
 import dipy.tracking.streamline as streamline_utils
+from dipy.tracking import Streamlines
 
 
 dtype = "float32"
@@ -151,6 +155,28 @@ def test_quickbundles_streamlines():
         assert_equal(clusters.centroids[0].dtype, np.float32)
 
 
+def test_quickbundles_packed_streamlines():
+    rdata = streamline_utils.set_number_of_points(data, 10)
+    qb = QuickBundles(threshold=2*threshold)
+    expected = qb.cluster(rdata)
+
+    for packed in [Streamlines(rdata),
+                   Streamlines([d.astype(np.float64) for d in rdata]),
+                   Streamlines(rdata[::-1])[::-1]]:
+        clusters = qb.cluster(packed)
+        assert_equal(clusters.refdata, packed)
+        assert_equal(len(clusters), len(expected))
+        for cluster, cluster_expected in zip(clusters, expected):
+            assert_array_equal(cluster.indices, cluster_expected.indices)
+            assert_array_equal(cluster.centroid, cluster_expected.centroid)
+
+    ordering = np.arange(len(rdata))[::-1]
+    clusters = qb.cluster(Streamlines(rdata), ordering=ordering)
+    expected = qb.cluster(rdata, ordering=ordering)
+    assert_array_equal([c.indices for c in clusters],
+                       [c.indices for c in expected])
+
+
 def test_quickbundles_with_not_order_invariant_metric():
     metric = dipymetric.AveragePointwiseEuclideanMetric()
     qb = QuickBundles(threshold=np.inf, metric=metric)
@@ -163,6 +189,132 @@ def test_quickbundles_with_not_order_invariant_metric():
     assert_array_equal(clusters[0].centroid, streamline)
 
 
+def test_streaming_quickbundles():
+    rng = np.random.RandomState(42)
+    streamlines = [rng.randn(rng.randint(5, 20), 3).astype(dtype) * 3 +
+                   rng.randint(0, 3) * 10 for i in range(200)]
+    for metric in ["MDF_12points",
+                   dipymetric.SumPointwiseEuclideanMetric(
+                       dipymetric.ResampleFeature(nb_points=5))]:
+        for max_nb_clusters in [np.iinfo('i4').max, 4]:
+            qb = QuickBundles(5., metric, max_nb_clusters)
+            expected = qb.cluster(streamlines)
+            sqb = StreamingQuickBundles(5., metric, max_nb_clusters)
+            labels = sqb.cluster_stream(iter(streamlines), chunk_size=13)
+            assert_equal(labels.dtype, np.int32)
+            assert_equal(sqb.nb_streamlines, 200)
+            clusters = sqb.cluster_map(streamlines)
+            assert_equal(len(clusters), len(expected))
+            assert_array_equal(sqb.clusters_sizes,
+                               list(map(len, expected)))
+            assert_array_equal(clusters.centroids, expected.centroids)
+            for cluster, expected_cluster in zip(clusters, expected):
+                assert_array_equal(cluster.indices, expected_cluster.indices)
+                assert_array_equal(labels[cluster.indices], cluster.id)
+
+    # Chunk by chunk, with `Streamlines`
+    labels = StreamingQuickBundles(5.).cluster_stream(streamlines)
+    sqb = StreamingQuickBundles(5.)
+    for i in range(0, 200, 50):
+        chunk_labels = sqb.partial_cluster(Streamlines(streamlines[i:i + 50]))
+        assert_array_equal(chunk_labels, labels[i:i + 50])
+    assert_array_equal(sqb.partial_cluster([]), [])
+
+    # Resuming from a checkpoint
+    with InTemporaryDirectory():
+        sqb = StreamingQuickBundles(5.)
+        sqb.cluster_stream(streamlines[:70], chunk_size=20,
+                           checkpoint='qb.npz', checkpoint_interval=2)
+        sqb = StreamingQuickBundles.load('qb.npz')
+        assert_equal(sqb.nb_streamlines, 70)
+        assert_array_equal(sqb.cluster_stream(streamlines), labels)
+
+    # Features that are not 2D
+    metric = dipymetric.EuclideanMetric(dipymetric.CenterOfMassFeature())
+    sqb = StreamingQuickBundles(5., metric)
+    sqb.cluster_stream(streamlines)
+    assert_array_equal(sqb.cluster_map().centroids,
+                       QuickBundles(5., metric).cluster(streamlines).centroids)
+
+    assert_raises(ValueError, StreamingQuickBundles(5., metric=dipymetric.
+                  AveragePointwiseEuclideanMetric()).partial_cluster, data)
+
+
+def test_quickbundlesx():
+    rng = np.random.RandomState(42)
+    streamlines = [rng.randn(rng.randint(5, 20), 3).astype(dtype) * 3 +
+                   rng.randint(0, 3) * 10 for i in range(200)]
+
+    # With a single threshold, the leaves are the bundles of QuickBundles
+    for metric in ["MDF_12points",
+                   dipymetric.SumPointwiseEuclideanMetric(
+                       dipymetric.ResampleFeature(nb_points=5))]:
+        expected = QuickBundles(5., metric).cluster(streamlines)
+        tree = QuickBundlesX([5.], metric).cluster(streamlines)
+        assert_equal(len(tree), len(expected))
+        assert_array_equal(tree.centroids, expected.centroids)
+        for cluster, expected_cluster in zip(tree, expected):
+            assert_array_equal(cluster.indices, expected_cluster.indices)
+            assert_equal(cluster.parent, tree.root)
+        assert_arrays_equal(tree[0], expected[0])
+
+    thresholds = [20., 10., 5.]
+    tree = QuickBundlesX(thresholds).cluster(streamlines)
+    assert_array_equal(tree.root.indices, range(200))
+    for level, threshold in enumerate(thresholds, 1):
+        clusters = tree.get_clusters(level)
+        assert_array_equal(sorted(itertools.chain(*[c.indices
+                                                    for c in clusters])),
+                           range(200))
+        for cluster in clusters:
+            assert_equal(cluster.threshold, threshold)
+            assert_equal(set(cluster.indices) <= set(cluster.parent.indices),
+                         True)
+            assert_equal(cluster.is_leaf, level == len(thresholds))
+    assert_equal(len(tree), len(tree.get_clusters(len(thresholds))))
+
+    # The second level is QuickBundles within each bundle of the first one
+    for cluster in tree.get_clusters(1):
+        expected = QuickBundles(10.).cluster(streamlines,
+                                             ordering=cluster.indices)
+        assert_array_equal([c.indices for c in cluster.children],
+                           [c.indices for c in expected])
+
+    # Going down the tree finds the nearest leaf when bundles are apart
+    offsets = (np.arange(4)[:, None, None] * [100, 0, 0] +
+               [[0, 0, 0], [0, 30, 0]]).reshape((-1, 1, 3))
+    bundles = [np.linspace(0, 20, 12)[:, None] * [[1, 0, 0]] + offsets[i // 10]
+               for i in range(80)]
+    bundles = [(s + rng.rand(*s.shape)).astype(dtype) for s in bundles]
+    tree = QuickBundlesX([50., 5.]).cluster(bundles)
+    assert_equal(len(tree.get_clusters(1)), 4)
+    assert_equal(len(tree), 8)
+    queries = [(s + rng.rand(*s.shape)).astype(dtype) for s in bundles]
+    queries = [s if i % 2 else s[::-1] for i, s in enumerate(queries)]
+    leaves, dists = tree.query(queries)
+    feature = tree.metric.feature
+    for i, s in enumerate(queries):
+        features = feature.extract(s)
+        flipped = feature.extract(s[::-1].copy())
+        brute = [min(tree.metric.dist(c, features),
+                     tree.metric.dist(c, flipped)) for c in tree.centroids]
+        assert_equal(tree.nodes[leaves[i]], tree[np.argmin(brute)])
+        assert_almost_equal(dists[i], np.min(brute), decimal=5)
+        assert_equal(tree.find_nearest_leaf(s), tree.nodes[leaves[i]])
+
+    # Only the streamlines of `ordering` are clustered
+    tree = QuickBundlesX(thresholds).cluster(streamlines, ordering=range(50))
+    assert_array_equal(tree.root.indices, range(50))
+    assert_equal(tree[0][0] is streamlines[tree[0].indices[0]], True)
+
+    tree = QuickBundlesX(thresholds).cluster([])
+    assert_equal(len(tree), 0)
+    assert_equal(len(tree.root), 0)
+    assert_raises(ValueError, QuickBundlesX, [5., 10.])
+    assert_raises(ValueError, QuickBundlesX, [5., 5.])
+    assert_raises(ValueError, QuickBundlesX, [])
+
+
 def test_quickbundles_memory_leaks():
     qb = QuickBundles(threshold=2*threshold)
 
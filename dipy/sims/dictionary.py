@@ -0,0 +1,332 @@
+""" Dictionaries of simulated signals for simulation-based fitting
+
+A `SignalDictionary` holds a large number of simulated multi-compartment
+signals (the atoms) for one gradient table, together with the model
+parameters used to simulate each atom. Signals are simulated in vectorized
+blocks and can be stored in memory-mapped ``.npy`` files, so dictionaries with
+millions of atoms can be built and reused without fitting in memory. Matching
+measured signals to their nearest atom gives fast initial guesses for
+non-linear fits (IVIM, free water DTI, DKI) or a whole-volume
+dictionary-matching reconstruction.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+from dipy.sims.voxel import multi_tensor_signals, all_tensor_evecs
+from dipy.reconst.dti import decompose_tensor
+
+# Indices of the 15 independent elements of the kurtosis tensor, in the order
+# used by dipy.reconst.dki
+_kt_indices = np.array([[0, 0, 0, 0], [1, 1, 1, 1], [2, 2, 2, 2],
+                        [0, 0, 0, 1], [0, 0, 0, 2], [0, 1, 1, 1],
+                        [1, 1, 1, 2], [0, 2, 2, 2], [1, 2, 2, 2],
+                        [0, 0, 1, 1], [0, 0, 2, 2], [1, 1, 2, 2],
+                        [0, 0, 1, 2], [0, 1, 1, 2], [0, 1, 2, 2]])
+
+
+class SignalDictionary(object):
+    """ Simulated signals and the parameters used to simulate them
+
+    Parameters
+    ----------
+    signals : array (M, N)
+        Signals of the M atoms, simulated with ``S0 = 1``.
+    params : array (M, P)
+        Model parameters of each atom.
+    """
+    def __init__(self, signals, params):
+        if len(signals) != len(params):
+            raise ValueError("signals and params must have the same length")
+        self.signals = signals
+        self.params = params
+
+    def __len__(self):
+        return len(self.signals)
+
+    @classmethod
+    def from_blocks(cls, blocks, n_atoms, n_dwi, n_params, fname=None,
+                    dtype=np.float32):
+        """ Builds a dictionary from blocks of atoms
+
+        Parameters
+        ----------
+        blocks : iterable
+            Yields ``(signals, params)`` pairs of arrays holding consecutive
+            atoms, until `n_atoms` atoms are produced.
+        n_atoms, n_dwi, n_params : int
+            Number of atoms, of gradient directions and of parameters.
+        fname : str, optional
+            If given, the signals and parameters are written to memory-mapped
+            files ``fname + '_signals.npy'`` and ``fname + '_params.npy'``
+            instead of being kept in memory.
+        dtype : dtype, optional
+            Data type of the stored signals. Default: float32.
+        """
+        if fname is None:
+            signals = np.empty((n_atoms, n_dwi), dtype=dtype)
+            params = np.empty((n_atoms, n_params))
+        else:
+            open_memmap = np.lib.format.open_memmap
+            signals = open_memmap(fname + '_signals.npy', mode='w+',
+                                  dtype=dtype, shape=(n_atoms, n_dwi))
+            params = open_memmap(fname + '_params.npy', mode='w+',
+                                 dtype=np.float64, shape=(n_atoms, n_params))
+        start = 0
+        for block_signals, block_params in blocks:
+            stop = start + len(block_signals)
+            signals[start:stop] = block_signals
+            params[start:stop] = block_params
+            start = stop
+        if start != n_atoms:
+            raise ValueError("Expected %d atoms, got %d" % (n_atoms, start))
+        if fname is not None:
+            signals.flush()
+            params.flush()
+        return cls(signals, params)
+
+    @classmethod
+    def load(cls, fname, mmap_mode='r'):
+        """ Loads a dictionary saved with ``from_blocks(..., fname=fname)``
+        """
+        return cls(np.load(fname + '_signals.npy', mmap_mode=mmap_mode),
+                   np.load(fname + '_params.npy', mmap_mode=mmap_mode))
+
+    def match(self, data, mask=None, step=1000, atom_step=100000):
+        """ Finds the atom closest to the signal of each voxel
+
+        Atoms are compared to the data up to a scaling factor: the matched
+        atom maximizes the normalized inner product with the signal of the
+        voxel, and the returned S0 is the least-squares scaling of that atom.
+
+        Parameters
+        ----------
+        data : array (..., N)
+            Measured signals.
+        mask : array (...), optional
+            Voxels to match. Other voxels get index -1 and S0 0.
+        step : int, optional
+            Number of voxels matched at once.
+        atom_step : int, optional
+            Number of atoms read from the dictionary at once. Memory usage is
+            proportional to ``atom_step * (N + step)``.
+
+        Returns
+        -------
+        index : array (...), int
+            Index of the matched atom of each voxel.
+        S0 : array (...)
+            Unweighted signal estimated for each voxel.
+        """
+        data = np.asarray(data)
+        shape = data.shape[:-1]
+        if data.shape[-1] != self.signals.shape[1]:
+            raise ValueError("data and dictionary signals do not match")
+        flat_data = data.reshape((-1, data.shape[-1]))
+        if mask is None:
+            voxels = np.arange(flat_data.shape[0])
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != shape:
+                raise ValueError("mask and data shape do not match")
+            voxels = np.flatnonzero(mask)
+        index = -np.ones(flat_data.shape[0], dtype=np.intp)
+        S0 = np.zeros(flat_data.shape[0])
+        dtype = self.signals.dtype
+        for start in range(0, len(voxels), step):
+            block = voxels[start:start + step]
+            X = flat_data[block].astype(dtype)
+            best = np.full(len(block), -np.inf)
+            best_index = np.zeros(len(block), dtype=np.intp)
+            best_S0 = np.zeros(len(block))
+            for atom_start in range(0, len(self), atom_step):
+                atoms = np.asarray(
+                    self.signals[atom_start:atom_start + atom_step])
+                norms = np.sqrt((atoms.astype(float) ** 2).sum(-1))
+                norms[norms == 0] = 1
+                dots = np.dot(X, atoms.T)
+                score = dots / norms.astype(dtype)
+                i = score.argmax(-1)
+                rows = np.arange(len(block))
+                better = score[rows, i] > best
+                best[better] = score[rows, i][better]
+                best_index[better] = atom_start + i[better]
+                best_S0[better] = (dots[rows, i] / norms[i] ** 2)[better]
+            index[block] = best_index
+            S0[block] = best_S0
+        return index.reshape(shape), S0.reshape(shape)
+
+
+def _grid_blocks(shape, step):
+    """ Yields the indices of blocks of at most `step` points of a grid
+
+    Each block is an array (n, len(shape)) of indices into the axes of the
+    grid, in C order.
+    """
+    n_points = int(np.prod(shape))
+    for start in range(0, n_points, step):
+        flat = np.arange(start, min(start + step, n_points))
+        yield np.column_stack(np.unravel_index(flat, shape))
+
+
+def ivim_dictionary(gtab, f, D_star, D, fname=None, step=10000):
+    """ Dictionary of IVIM signals on a grid of parameters
+
+    Parameters
+    ----------
+    gtab : GradientTable
+    f, D_star, D : array
+        Values of the perfusion fraction, pseudo-diffusion and diffusion
+        coefficients. Atoms are simulated for every combination of values.
+    fname : str, optional
+        Prefix of the files in which the dictionary is memory-mapped.
+    step : int, optional
+        Number of atoms simulated at once.
+
+    Returns
+    -------
+    dictionary : SignalDictionary
+        Atoms with parameters ``[S0, f, D_star, D]`` as in
+        `dipy.reconst.ivim`, with ``S0 = 1``.
+    """
+    f, D_star, D = (np.asarray(a, dtype=float) for a in (f, D_star, D))
+    n_atoms = len(f) * len(D_star) * len(D)
+
+    def blocks():
+        for grid in _grid_blocks((len(f), len(D_star), len(D)), step):
+            f_, D_star_, D_ = f[grid[:, 0]], D_star[grid[:, 1]], D[grid[:, 2]]
+            tensors = np.zeros((len(grid), 2, 3, 3))
+            tensors[:, 0] = D_star_[:, None, None] * np.eye(3)
+            tensors[:, 1] = D_[:, None, None] * np.eye(3)
+            fractions = 100 * np.column_stack([f_, 1 - f_])
+            params = np.column_stack([np.ones(len(grid)), f_, D_star_, D_])
+            yield multi_tensor_signals(gtab, tensors, fractions), params
+
+    return SignalDictionary.from_blocks(blocks(), n_atoms, len(gtab.bvals), 4,
+                                        fname)
+
+
+def fwdti_dictionary(gtab, evals, directions, f, Diso=3.0e-3, fname=None,
+                     step=10000):
+    """ Dictionary of free water DTI signals
+
+    Parameters
+    ----------
+    gtab : GradientTable
+    evals : array (E, 3)
+        Eigenvalues of the tissue tensor.
+    directions : array (V, 3)
+        Unit vectors along the principal axis of the tissue tensor.
+    f : array (F,)
+        Free water volume fractions, between 0 and 1.
+    Diso : float, optional
+        Diffusivity of free water.
+    fname : str, optional
+        Prefix of the files in which the dictionary is memory-mapped.
+    step : int, optional
+        Number of atoms simulated at once.
+
+    Returns
+    -------
+    dictionary : SignalDictionary
+        ``E * V * F`` atoms with parameters laid out as in
+        `dipy.reconst.fwdti`: the 3 eigenvalues, the 9 elements of the
+        eigenvectors and the free water fraction.
+    """
+    evals = np.asarray(evals, dtype=float)
+    evecs = np.array([all_tensor_evecs(d) for d in np.asarray(directions)])
+    f = np.asarray(f, dtype=float)
+    n_atoms = len(evals) * len(evecs) * len(f)
+
+    def blocks():
+        for grid in _grid_blocks((len(evals), len(evecs), len(f)), step):
+            e, R, fw = evals[grid[:, 0]], evecs[grid[:, 1]], f[grid[:, 2]]
+            tensors = np.zeros((len(grid), 2, 3, 3))
+            tensors[:, 0] = np.einsum('...ij,...j,...kj->...ik', R, e, R)
+            tensors[:, 1] = Diso * np.eye(3)
+            fractions = 100 * np.column_stack([1 - fw, fw])
+            params = np.column_stack([e, R.reshape(-1, 9), fw])
+            yield multi_tensor_signals(gtab, tensors, fractions), params
+
+    return SignalDictionary.from_blocks(blocks(), n_atoms, len(gtab.bvals),
+                                        13, fname)
+
+
+def multi_tensor_kurtosis(D_comps, fractions):
+    """ Diffusion and kurtosis tensors of many multi-tensor voxels
+
+    Vectorized version of `dipy.sims.voxel.kurtosis_element` computing all
+    15 kurtosis tensor elements of many voxels at once.
+
+    Parameters
+    ----------
+    D_comps : array (..., K, 3, 3)
+        Diffusion tensor of each compartment.
+    fractions : array (..., K)
+        Percentage of the contribution of each compartment.
+
+    Returns
+    -------
+    DT : array (..., 3, 3)
+        Diffusion tensor of each voxel.
+    kt : array (..., 15)
+        Kurtosis tensor elements of each voxel.
+    """
+    D_comps = np.asarray(D_comps, dtype=float)
+    frac = np.asarray(fractions, dtype=float) / 100.
+    DT = (frac[..., None, None] * D_comps).sum(-3)
+    MD = np.trace(DT, axis1=-2, axis2=-1) / 3
+    i, j, k, l = _kt_indices.T
+
+    def pairs(T):
+        return (T[..., i, j] * T[..., k, l] + T[..., i, k] * T[..., j, l] +
+                T[..., i, l] * T[..., j, k])
+
+    kt = (frac[..., None] * pairs(D_comps)).sum(-2) - pairs(DT)
+    return DT, kt / (MD ** 2)[..., None]
+
+
+def dki_dictionary(gtab, mevals, sticks, fractions, fname=None, step=10000):
+    """ Dictionary of multi-compartment signals with their DKI parameters
+
+    Parameters
+    ----------
+    gtab : GradientTable
+    mevals : array (M, K, 3)
+        Eigenvalues of each of the K compartments of each atom.
+    sticks : array (M, K, 3)
+        Unit vector along the principal axis of each compartment.
+    fractions : array (M, K)
+        Percentage of the contribution of each compartment.
+    fname : str, optional
+        Prefix of the files in which the dictionary is memory-mapped.
+    step : int, optional
+        Number of atoms simulated at once.
+
+    Returns
+    -------
+    dictionary : SignalDictionary
+        Atoms with parameters laid out as in `dipy.reconst.dki`: the 3
+        eigenvalues and 9 eigenvector elements of the diffusion tensor and the
+        15 elements of the kurtosis tensor of the voxel.
+    """
+    mevals = np.asarray(mevals, dtype=float)
+    sticks = np.asarray(sticks, dtype=float)
+    fractions = np.asarray(fractions, dtype=float)
+    n_atoms = len(mevals)
+
+    def blocks():
+        for start in range(0, n_atoms, step):
+            block = slice(start, start + step)
+            e, s = mevals[block], sticks[block]
+            R = np.array([all_tensor_evecs(d) for d in s.reshape(-1, 3)])
+            R = R.reshape(s.shape + (3,))
+            tensors = np.einsum('...ij,...j,...kj->...ik', R, e, R)
+            DT, kt = multi_tensor_kurtosis(tensors, fractions[block])
+            evals, evecs = decompose_tensor(DT)
+            params = np.column_stack([evals, evecs.reshape(-1, 9), kt])
+            signals = multi_tensor_signals(gtab, tensors, fractions[block])
+            yield signals, params
+
+    return SignalDictionary.from_blocks(blocks(), n_atoms, len(gtab.bvals),
+                                        27, fname)
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+from nibabel.tmpdirs import TemporaryDirectory
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_data, get_sphere
+from dipy.io.gradients import read_bvals_bvecs
+from dipy.reconst.fwdti import fwdti_prediction
+from dipy.reconst.ivim import ivim_prediction
+from dipy.sims.voxel import (multi_tensor, multi_tensor_dki,
+                             multi_tensor_signals, all_tensor_evecs)
+from dipy.sims.dictionary import (SignalDictionary, ivim_dictionary,
+                                  fwdti_dictionary, dki_dictionary,
+                                  multi_tensor_kurtosis)
+
+
+fimg, fbvals, fbvecs = get_data('small_64D')
+bvals, bvecs = read_bvals_bvecs(fbvals, fbvecs)
+bvals_2s = np.concatenate((bvals, bvals * 2), axis=0)
+bvecs_2s = np.concatenate((bvecs, bvecs), axis=0)
+gtab_2s = gradient_table(bvals_2s, bvecs_2s)
+
+mevals = np.array([[0.00099, 0, 0], [0.00226, 0.00087, 0.00087]])
+sticks = np.array([[1, 0, 0], [0, 0.6, 0.8]])
+fractions = np.array([40, 60])
+
+
+def test_multi_tensor_signals():
+    S, _ = multi_tensor(gtab_2s, mevals, S0=100, angles=sticks,
+                        fractions=fractions, snr=None)
+    D = np.array([np.dot(np.dot(all_tensor_evecs(s), np.diag(e)),
+                         all_tensor_evecs(s).T)
+                  for e, s in zip(mevals, sticks)])
+    npt.assert_array_almost_equal(
+        multi_tensor_signals(gtab_2s, D, fractions, S0=100), S)
+    stacked = multi_tensor_signals(gtab_2s, np.array([D, D[::-1]]),
+                                   [fractions, fractions[::-1]], [100, 50])
+    npt.assert_array_almost_equal(stacked[0], S)
+    npt.assert_array_almost_equal(stacked[1], S / 2)
+
+
+def test_multi_tensor_kurtosis():
+    _, dt, kt = multi_tensor_dki(gtab_2s, mevals, angles=sticks,
+                                 fractions=fractions, snr=None)
+    D = np.array([np.dot(np.dot(all_tensor_evecs(s), np.diag(e)),
+                         all_tensor_evecs(s).T)
+                  for e, s in zip(mevals, sticks)])
+    DT, kt2 = multi_tensor_kurtosis(D[None], fractions[None])
+    npt.assert_array_almost_equal(kt2[0], kt)
+    npt.assert_array_almost_equal(DT[0][np.tril_indices(3)],
+                                  dt[[0, 1, 2, 3, 4, 5]])
+
+
+def test_ivim_dictionary():
+    f = np.linspace(0.05, 0.3, 6)
+    D_star = np.linspace(0.005, 0.02, 4)
+    D = np.linspace(0.0005, 0.002, 7)
+    bvals = np.array([0., 10., 20., 30., 40., 60., 80., 100., 120., 140.,
+                      160., 180., 200., 300., 400., 500., 600., 700., 800.,
+                      900., 1000.])
+    gtab = gradient_table(bvals, np.array([[1., 0, 0]] * len(bvals)))
+    dictionary = ivim_dictionary(gtab, f, D_star, D, step=17)
+    npt.assert_equal(len(dictionary), 6 * 4 * 7)
+    npt.assert_array_almost_equal(
+        dictionary.signals[50], ivim_prediction(dictionary.params[50], gtab))
+
+    data = np.array([ivim_prediction([150., f[2], D_star[1], D[3]], gtab),
+                     ivim_prediction([80., f[5], D_star[3], D[0]], gtab)])
+    index, S0 = dictionary.match(data, step=1, atom_step=25)
+    npt.assert_array_almost_equal(dictionary.params[index[0], 1:],
+                                  [f[2], D_star[1], D[3]])
+    npt.assert_array_almost_equal(dictionary.params[index[1], 1:],
+                                  [f[5], D_star[3], D[0]])
+    npt.assert_array_almost_equal(S0, [150., 80.], 3)
+
+    index, S0 = dictionary.match(data, mask=np.array([False, True]))
+    npt.assert_equal(index[0], -1)
+    npt.assert_equal(S0[0], 0)
+    npt.assert_raises(ValueError, dictionary.match, data[:, :5])
+
+
+def test_fwdti_dictionary():
+    sphere = get_sphere('repulsion100')
+    evals = [[1.6e-3, 0.5e-3, 0.3e-3], [1.2e-3, 0.7e-3, 0.6e-3]]
+    f = np.linspace(0, 1, 11)
+    with TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'fwdti')
+        dictionary = fwdti_dictionary(gtab_2s, evals, sphere.vertices, f,
+                                      fname=fname, step=64)
+        npt.assert_equal(len(dictionary), 2 * 100 * 11)
+        npt.assert_array_almost_equal(
+            dictionary.signals[789],
+            fwdti_prediction(dictionary.params[789], gtab_2s), 6)
+
+        loaded = SignalDictionary.load(fname)
+        npt.assert_(isinstance(loaded.signals, np.memmap))
+        npt.assert_array_equal(loaded.params, dictionary.params)
+        data = 200 * fwdti_prediction(dictionary.params[1234], gtab_2s)
+        index, S0 = loaded.match(data)
+        npt.assert_equal(index, 1234)
+        npt.assert_almost_equal(S0, 200, 3)
+        del loaded, dictionary
+
+
+def test_dki_dictionary():
+    n_atoms = 5
+    atom_mevals = np.array([mevals] * n_atoms)
+    atom_sticks = np.array([sticks] * n_atoms)
+    atom_fractions = np.array([fractions] * n_atoms)
+    atom_fractions[2] = [70, 30]
+    dictionary = dki_dictionary(gtab_2s, atom_mevals, atom_sticks,
+                                atom_fractions, step=2)
+    S, dt, kt = multi_tensor_dki(gtab_2s, mevals, angles=sticks,
+                                 fractions=[70, 30], snr=None)
+    npt.assert_array_almost_equal(dictionary.params[2, 12:], kt)
+    S, _ = multi_tensor(gtab_2s, mevals, angles=sticks, fractions=[70, 30],
+                        snr=None)
+    npt.assert_array_almost_equal(dictionary.signals[2], S, 6)
+    evals = dictionary.params[2, :3]
+    evecs = dictionary.params[2, 3:12].reshape(3, 3)
+    DT = np.dot(np.dot(evecs, np.diag(evals)), evecs.T)
+    npt.assert_array_almost_equal(DT[np.tril_indices(3)], dt)
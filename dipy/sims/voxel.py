@@ -430,6 +430,51 @@ def multi_tensor(gtab, mevals, S0=1., angles=[(0, 0), (90, 0)],
     return add_noise(S, snr, S0), sticks
 
 
+def multi_tensor_signals(gtab, D, fractions, S0=1.):
+    r""" Simulate the signals of many multi-tensor voxels at once.
+
+    Unlike `multi_tensor`, which simulates one voxel with Python loops over
+    the compartments and gradients, all signals are computed with a single
+    product between the tensors and the b-matrix of the gradient table.
+
+    Parameters
+    -----------
+    gtab : GradientTable
+    D : array (..., K, 3, 3)
+        Diffusion tensor of each of the K compartments of each voxel.
+    fractions : array (..., K)
+        Percentage of the contribution of each compartment. The fractions of
+        each voxel should sum to 100%.
+    S0 : float or array (...)
+        Unweighted signal value (b0 signal).
+
+    Returns
+    --------
+    S : (..., N) ndarray
+        Simulated signals, without noise.
+
+    Examples
+    --------
+    >>> from dipy.core.gradients import gradient_table
+    >>> gtab = gradient_table([0, 1000, 1000], [[0, 0, 0], [1, 0, 0],
+    ...                                         [0, 1, 0]])
+    >>> D = np.zeros((2, 1, 3, 3))
+    >>> D[0, 0] = np.diag([1.5e-3, 0.3e-3, 0.3e-3])
+    >>> D[1, 0] = np.diag([0.3e-3, 1.5e-3, 0.3e-3])
+    >>> S = multi_tensor_signals(gtab, D, [[100], [100]])
+    >>> np.allclose(S[0], single_tensor(gtab, evals=[1.5e-3, 0.3e-3, 0.3e-3]))
+    True
+    """
+    D = np.asarray(D, dtype=float)
+    fractions = np.asarray(fractions, dtype=float) / 100.
+    g = gtab.bvecs
+    # The signal of each compartment is exp(-b g^T D g)
+    bmatrix = gtab.bvals[:, None, None] * g[:, :, None] * g[:, None, :]
+    adc = np.dot(D.reshape(D.shape[:-2] + (9,)), bmatrix.reshape(-1, 9).T)
+    S = (fractions[..., None] * np.exp(-adc)).sum(-2)
+    return np.asarray(S0)[..., None] * S
+
+
 def multi_tensor_dki(gtab, mevals, S0=1., angles=[(90., 0.), (90., 0.)],
                      fractions=[50, 50], snr=20):
     r""" Simulate the diffusion-weight signal, diffusion and kurtosis tensors
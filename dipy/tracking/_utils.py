@@ -4,6 +4,8 @@ from __future__ import division, print_function, absolute_import
 from warnings import warn
 import numpy as np
 
+from dipy.tracking import Streamlines
+
 
 def _voxel_size_deprecated():
     m = DeprecationWarning('the voxel_size argument to this function is '
@@ -64,3 +66,59 @@ def _to_voxel_coordinates(streamline, lin_T, offset):
         raise IndexError('streamline has points that map to negative voxel'
                          ' indices')
     return inds.astype(int)
+
+
+def _packed(streamlines):
+    """Returns the points of `Streamlines` packed in the order of the
+    streamlines.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        The points of the streamlines can be stored anywhere in the buffer of
+        `streamlines`, as for slices or fancy indexing of a `Streamlines`.
+
+    Returns
+    -------
+    points : array (P, 3)
+        The points of all the streamlines, one streamline after the other.
+        This is the buffer of `streamlines` when it is already packed, a copy
+        otherwise.
+    offsets : array (N,)
+        Index of the first point of each streamline in `points`.
+    lengths : array (N,)
+        Number of points of each streamline.
+    """
+    data = streamlines._data
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    starts = np.cumsum(lengths) - lengths
+    n_points = starts[-1] + lengths[-1] if len(lengths) else 0
+    if len(data) == n_points and np.array_equal(offsets, starts):
+        return data, starts, lengths
+    index = np.repeat(offsets - starts, lengths) + np.arange(n_points)
+    return data[index], starts, lengths
+
+
+def _from_packed(points, offsets, lengths):
+    """Creates `Streamlines` from packed points, offsets and lengths"""
+    streamlines = Streamlines()
+    streamlines._data = points
+    streamlines._offsets = offsets
+    streamlines._lengths = lengths
+    return streamlines
+
+
+def _reduce_packed(ufunc, values, offsets, lengths, empty):
+    """Reduces `values` defined for each point over each streamline
+
+    ``ufunc.reduceat`` of `values` on the streamlines given by packed
+    `offsets` and `lengths`. The result is `empty` for streamlines without
+    points.
+    """
+    out = np.empty(len(lengths), dtype=values.dtype)
+    out[...] = empty
+    nonempty = lengths > 0
+    if nonempty.any():
+        out[nonempty] = ufunc.reduceat(values, offsets[nonempty])
+    return out
@@ -22,7 +22,11 @@ from nibabel import trackvis as tv
 
 from dipy.tracking.streamline import (set_number_of_points,
                                       length,
-                                      compress_streamlines)
+                                      compress_streamlines,
+                                      transform_streamlines,
+                                      select_by_rois)
+from dipy.tracking.utils import target
+from dipy.segment.clustering import QuickBundles
 from dipy.tracking.tests.test_streamline import (set_number_of_points_python,
                                                  length_python,
                                                  compress_streamlines_python)
@@ -126,3 +130,36 @@ def bench_compress_streamlines():
     print("Python time: {0:.2}sec".format(python_time))
     print("Speed up of {0}x".format(python_time/cython_time))
     del streamlines
+
+
+def bench_packed_streamlines():
+    repeat = 5
+    nb_streamlines = DATA['nb_streamlines']
+    streamlines_list = DATA['streamlines']
+    streamlines_arrseq = DATA['streamlines_arrseq']
+    affine = np.eye(4)
+    affine[:3, 3] = (1, 2, 3)
+    mask = np.zeros((2, 2, 2), dtype=bool)
+    mask[0, 0, 0] = True
+    qb = QuickBundles(threshold=0.5)
+
+    benchmarks = [("transform_streamlines()",
+                   "transform_streamlines(streamlines, affine)", repeat),
+                  ("select_by_rois()",
+                   "list(select_by_rois(streamlines, [mask], [True], tol=1))",
+                   1),
+                  ("target()", "list(target(streamlines, mask, np.eye(4)))",
+                   repeat),
+                  ("QuickBundles.cluster()", "qb.cluster(streamlines)", 1)]
+
+    for name, code, times in benchmarks:
+        print("Timing {0} with {1:,} streamlines.".format(name,
+                                                         nb_streamlines))
+        streamlines = streamlines_list
+        list_time = measure(code, times)
+        print("List time: {0:.3}sec".format(list_time))
+
+        streamlines = streamlines_arrseq
+        arrseq_time = measure(code, times)
+        print("ArrSeq time: {0:.3}sec".format(arrseq_time))
+        print("Speed up of {0:.2f}x".format(list_time/arrseq_time))
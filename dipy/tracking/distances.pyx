@@ -6,14 +6,19 @@
 # cython: embedsignature=True
 
 cimport cython
+from cython.parallel import parallel, prange
 
-from libc.stdlib cimport calloc, realloc, free
+from libc.stdlib cimport malloc, calloc, realloc, free
 from libc.string cimport memcpy
 
 import time
 import numpy as np
 cimport numpy as cnp
 
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import _packed
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
@@ -450,9 +455,165 @@ def most_similar_track_mam(tracks,metric='avg'):
         track2others[j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
     return si, track2others
 
+def _packed_tracks(tracks):
+    """Points as float32, offsets and lengths of a sequence of tracks or
+    `Streamlines`"""
+    if isinstance(tracks, Streamlines):
+        points, offsets, lengths = _packed(tracks)
+    else:
+        tracks = [np.asarray(t) for t in tracks]
+        lengths = np.array([len(t) for t in tracks], dtype=np.intp)
+        offsets = np.cumsum(lengths) - lengths
+        points = (np.concatenate(tracks) if len(tracks)
+                  else np.zeros((0, 3)))
+    return (np.ascontiguousarray(points, dtype=f32_dt),
+            np.asarray(offsets, dtype=np.intp),
+            np.asarray(lengths, dtype=np.intp))
+
+
+def _metric_type(metric):
+    if metric == 'avg':
+        return 0
+    elif metric == 'min':
+        return 1
+    elif metric == 'max':
+        return 2
+    raise ValueError('Metric should be one of avg, min, max')
+
+
+DEF TILE_SIZE = 64
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def bundles_distances_mam(tracksA, tracksB, metric='avg'):
+def _bundles_distances_block(float[:, ::1] pointsA, cnp.npy_intp[:] offsetsA,
+                             cnp.npy_intp[:] lengthsA, float[:, ::1] pointsB,
+                             cnp.npy_intp[:] offsetsB,
+                             cnp.npy_intp[:] lengthsB, cnp.npy_intp start,
+                             int metric_type, cython.floating[:, ::1] DM):
+    """Distances between tracksA[start:start + len(DM)] and tracksB.
+
+    The pairs are visited in tiles of ``TILE_SIZE`` tracks of A by
+    ``TILE_SIZE`` tracks of B, so that the points of a tile of B are reused
+    while they are in cache. The tiles of A are shared between threads.
+    ``metric_type`` is -1 for MDF, otherwise the metric type of ``czhang``.
+    """
+    cdef:
+        cnp.npy_intp n_rows = DM.shape[0], n_cols = DM.shape[1]
+        cnp.npy_intp n_tiles = (n_rows + TILE_SIZE - 1) // TILE_SIZE
+        cnp.npy_intp tile, i0, j0, i, j, ia, max_len = 0
+        float *min_buffer
+        float *d
+        char[::1] failed = np.zeros(n_tiles, dtype=np.int8)
+
+    for i in range(lengthsA.shape[0]):
+        max_len = max(max_len, lengthsA[i])
+    for j in range(lengthsB.shape[0]):
+        max_len = max(max_len, lengthsB[j])
+
+    with nogil, parallel():
+        # Each thread has its own buffers, the two MDF distances at the end
+        min_buffer = <float *> malloc((2 * max_len + 2) * sizeof(float))
+        d = min_buffer + 2 * max_len
+        for tile in prange(n_tiles, schedule='dynamic'):
+            if min_buffer == NULL:
+                failed[tile] = 1
+                continue
+            i0 = tile * TILE_SIZE
+            for j0 in range(0, n_cols, TILE_SIZE):
+                for i in range(i0, min(i0 + TILE_SIZE, n_rows)):
+                    ia = start + i
+                    for j in range(j0, min(j0 + TILE_SIZE, n_cols)):
+                        if metric_type < 0:
+                            track_direct_flip_dist(
+                                &pointsA[offsetsA[ia], 0],
+                                &pointsB[offsetsB[j], 0], lengthsA[ia], d)
+                            DM[i, j] = min(d[0], d[1])
+                        else:
+                            DM[i, j] = czhang(
+                                lengthsA[ia], &pointsA[offsetsA[ia], 0],
+                                lengthsB[j], &pointsB[offsetsB[j], 0],
+                                min_buffer, metric_type)
+        free(min_buffer)
+    if np.any(failed):
+        raise MemoryError("could not allocate the distance buffers")
+
+
+def _packed_bundles(tracksA, tracksB, int metric_type):
+    """Packs two sequences of tracks for `_bundles_distances`"""
+    packedA = _packed_tracks(tracksA)
+    packedB = _packed_tracks(tracksB)
+    if metric_type < 0:
+        lengths = np.concatenate([packedA[2], packedB[2]])
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise ValueError("All tracks need to have the same number of "
+                             "points")
+    return packedA, packedB
+
+
+def _bundles_distances(packedA, packedB, start, stop, int metric_type, dtype,
+                       num_threads):
+    """Distances between the tracks ``start:stop`` of A and the tracks of B
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype should be float32 or float64")
+    pointsA, offsetsA, lengthsA = packedA
+    pointsB, offsetsB, lengthsB = packedB
+    DM = np.empty((stop - start, len(lengthsB)), dtype=dtype)
+    if DM.size == 0:
+        return DM
+    set_num_threads(num_threads)
+    try:
+        _bundles_distances_block(pointsA, offsetsA, lengthsA, pointsB,
+                                 offsetsB, lengthsB, start, metric_type, DM)
+    finally:
+        restore_default_num_threads()
+    return DM
+
+
+def _bundles_neighbors(tracksA, tracksB, int metric_type, k, max_dist,
+                       num_threads, block_size):
+    if k is None and max_dist is None:
+        raise ValueError("k or max_dist is needed")
+    if k is not None and k < 1:
+        raise ValueError("k must be a positive integer")
+    packedA, packedB = _packed_bundles(tracksA, tracksB, metric_type)
+    n_rows = len(packedA[2])
+    n_cols = len(packedB[2])
+    block_rows = max(1, block_size // max(n_cols, 1))
+    counts = [np.zeros(0, dtype=np.intp)]
+    indices = [np.zeros(0, dtype=np.intp)]
+    distances = [np.zeros(0, dtype=np.float32)]
+    for start in range(0, n_rows, block_rows):
+        DM = _bundles_distances(packedA, packedB, start,
+                                min(start + block_rows, n_rows), metric_type,
+                                np.float32, num_threads)
+        n = len(DM)
+        if k is not None and k < n_cols:
+            # Only the k closest tracks of B are kept
+            cols = np.argpartition(DM, k - 1, axis=1)[:, :k].ravel()
+            rows = np.repeat(np.arange(n), k)
+        elif max_dist is not None:
+            rows, cols = np.nonzero(DM <= max_dist)
+        else:
+            rows, cols = np.nonzero(np.ones(DM.shape, dtype=bool))
+        dist = DM[rows, cols]
+        if max_dist is not None:
+            keep = dist <= max_dist
+            rows, cols, dist = rows[keep], cols[keep], dist[keep]
+        order = np.lexsort((cols, dist, rows))
+        counts.append(np.bincount(rows, minlength=n))
+        indices.append(cols[order])
+        distances.append(dist[order])
+    counts = np.concatenate(counts)
+    indptr = np.zeros(len(counts) + 1, dtype=np.intp)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, np.concatenate(indices), np.concatenate(distances)
+
+
+def bundles_distances_mam(tracksA, tracksB, metric='avg', dtype=np.float64,
+                          num_threads=None):
     ''' Calculate distances between list of tracks A and list of tracks B
 
     Parameters
@@ -463,75 +624,31 @@ def bundles_distances_mam(tracksA, tracksB, metric='avg'):
        of tracks as arrays, shape (N1,3) .. (Nm,3)
     metric : str
        'avg', 'min', 'max'
+    dtype : float32 or float64, optional
+       Type of the returned distances. float32 halves the size of the matrix.
+       Default: float64.
+    num_threads : int, optional
+       Number of threads. If None (default) the default number of OpenMP
+       threads is used.
 
     Returns
     -------
     DM : array, shape (len(tracksA), len(tracksB))
         distances between tracksA and tracksB according to metric
 
-    '''
-    cdef:
-        size_t i, j, lentA, lentB
-        int metric_type
-    if metric=='avg':
-        metric_type = 0
-    elif metric == 'min':
-        metric_type = 1
-    elif metric == 'max':
-        metric_type = 2
-    else:
-        raise ValueError('Metric should be one of avg, min, max')
-    # preprocess tracks
-    cdef:
-        size_t longest_track_len = 0, track_len
-        size_t longest_track_lenA = 0, longest_track_lenB = 0
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout, find longest track
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-        track_len = tracksA32[i].shape[0]
-        if track_len > longest_track_lenA:
-            longest_track_lenA = track_len
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-        track_len = tracksB32[i].shape[0]
-        if track_len > longest_track_lenB:
-            longest_track_lenB = track_len
-    if longest_track_lenB > longest_track_lenA:
-        longest_track_lenA = longest_track_lenB
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=1] distances_buffer
-        cnp.float32_t *t1_ptr, *t2_ptr, *min_buffer
-    distances_buffer = np.zeros((longest_track_lenA*2,), dtype=np.float32)
-    min_buffer = <cnp.float32_t *> distances_buffer.data
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        size_t t1_len, t2_len
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        t1_len = t1.shape[0]
-        t1_ptr = <cnp.float32_t *>t1.data
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            t2_len = t2.shape[0]
-            t2_ptr = <cnp.float32_t *>t2.data
-            DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
+    See Also
+    --------
+    bundles_neighbors_mam
 
-    return DM
+    '''
+    metric_type = _metric_type(metric)
+    packedA, packedB = _packed_bundles(tracksA, tracksB, metric_type)
+    return _bundles_distances(packedA, packedB, 0, len(packedA[2]),
+                              metric_type, dtype, num_threads)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def bundles_distances_mdf(tracksA, tracksB):
+def bundles_distances_mdf(tracksA, tracksB, dtype=np.float64,
+                          num_threads=None):
     ''' Calculate distances between list of tracks A and list of tracks B
 
     All tracks need to have the same number of points
@@ -542,6 +659,12 @@ def bundles_distances_mdf(tracksA, tracksB):
        of tracks as arrays, [(N,3) .. (N,3)]
     tracksB : sequence
        of tracks as arrays, [(N,3) .. (N,3)]
+    dtype : float32 or float64, optional
+       Type of the returned distances. float32 halves the size of the matrix.
+       Default: float64.
+    num_threads : int, optional
+       Number of threads. If None (default) the default number of OpenMP
+       threads is used.
 
     Returns
     -------
@@ -550,55 +673,101 @@ def bundles_distances_mdf(tracksA, tracksB):
 
     See Also
     ---------
-    dipy.metrics.downsample
+    dipy.metrics.downsample, bundles_neighbors_mdf
 
     '''
-    cdef:
-        size_t i, j, lentA, lentB
-    # preprocess tracks
-    cdef:
-        size_t longest_track_len = 0, track_len
-        longest_track_lenA, longest_track_lenB
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.float32_t *t1_ptr, *t2_ptr, *min_buffer
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        size_t t1_len, t2_len
-        float d[2]
-    t_len = tracksA32[0].shape[0]
+    packedA, packedB = _packed_bundles(tracksA, tracksB, -1)
+    return _bundles_distances(packedA, packedB, 0, len(packedA[2]), -1,
+                              dtype, num_threads)
 
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        #t1_len = t1.shape[0]
-        t1_ptr = <cnp.float32_t *>t1.data
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            #t2_len = t2.shape[0]
-            t2_ptr = <cnp.float32_t *>t2.data
-            #DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
-            track_direct_flip_dist(t1_ptr, t2_ptr,t_len,<float *>d)
-            if d[0]<d[1]:
-                DM[i,j]=d[0]
-            else:
-                DM[i,j]=d[1]
-    return DM
 
+def bundles_neighbors_mam(tracksA, tracksB, metric='avg', k=None,
+                          max_dist=None, num_threads=None,
+                          block_size=2 ** 24):
+    ''' Closest tracks of B for each track of A, with the distances of
+    ``bundles_distances_mam``
+
+    The distances are computed by blocks of rows, so that the whole matrix
+    is never in memory.
+
+    Parameters
+    ----------
+    tracksA : sequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    tracksB : sequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    metric : str
+       'avg', 'min', 'max'
+    k : int, optional
+       Number of closest tracks of B to keep for each track of A.
+    max_dist : float, optional
+       Only the tracks of B within this distance are kept. At least one of
+       `k` and `max_dist` is needed.
+    num_threads : int, optional
+       Number of threads. If None (default) the default number of OpenMP
+       threads is used.
+    block_size : int, optional
+       Number of distances computed at a time. Default: 2 ** 24.
 
+    Returns
+    -------
+    indptr : array, shape (len(tracksA) + 1,)
+    indices : array of int
+    distances : array of float32
+        The neighbors of ``tracksA[i]`` are the tracks of B with indices
+        ``indices[indptr[i]:indptr[i + 1]]``, with distances
+        ``distances[indptr[i]:indptr[i + 1]]``, by increasing distance.
+
+    See Also
+    --------
+    bundles_distances_mam
+
+    '''
+    return _bundles_neighbors(tracksA, tracksB, _metric_type(metric), k,
+                              max_dist, num_threads, block_size)
+
+
+def bundles_neighbors_mdf(tracksA, tracksB, k=None, max_dist=None,
+                          num_threads=None, block_size=2 ** 24):
+    ''' Closest tracks of B for each track of A, with the distances of
+    ``bundles_distances_mdf``
+
+    All tracks need to have the same number of points. The distances are
+    computed by blocks of rows, so that the whole matrix is never in memory.
+
+    Parameters
+    ----------
+    tracksA : sequence
+       of tracks as arrays, [(N,3) .. (N,3)]
+    tracksB : sequence
+       of tracks as arrays, [(N,3) .. (N,3)]
+    k : int, optional
+       Number of closest tracks of B to keep for each track of A.
+    max_dist : float, optional
+       Only the tracks of B within this distance are kept. At least one of
+       `k` and `max_dist` is needed.
+    num_threads : int, optional
+       Number of threads. If None (default) the default number of OpenMP
+       threads is used.
+    block_size : int, optional
+       Number of distances computed at a time. Default: 2 ** 24.
+
+    Returns
+    -------
+    indptr : array, shape (len(tracksA) + 1,)
+    indices : array of int
+    distances : array of float32
+        The neighbors of ``tracksA[i]`` are the tracks of B with indices
+        ``indices[indptr[i]:indptr[i + 1]]``, with distances
+        ``distances[indptr[i]:indptr[i + 1]]``, by increasing distance.
+
+    See Also
+    --------
+    bundles_distances_mdf
+
+    '''
+    return _bundles_neighbors(tracksA, tracksB, -1, k, max_dist,
+                              num_threads, block_size)
 
 
 cdef cnp.float32_t inf = np.inf
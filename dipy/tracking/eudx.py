@@ -1,7 +1,8 @@
 import numpy as np
 
 from dipy.tracking import utils
-from dipy.tracking.propspeed import eudx_both_directions
+from dipy.tracking._utils import _from_packed
+from dipy.tracking.propspeed import eudx_both_directions, eudx_tracks
 from dipy.data import get_sphere
 
 
@@ -171,6 +172,67 @@ class EuDX(object):
         voxel_tracks = self._voxel_tracks(seed_voxels)
         return utils.move_streamlines(voxel_tracks, self.affine)
 
+    def to_streamlines(self, return_seed_ids=False, step=10000,
+                       num_threads=None):
+        """Tracks from all the seeds in parallel and returns the packed
+        streamlines
+
+        The seeds are tracked in compiled code without the GIL, with the
+        same streamlines, in the same order, as when iterating over this
+        object.
+
+        Parameters
+        ----------
+        return_seed_ids : bool, optional
+            If True, also return the index of the seed of each streamline.
+        step : int, optional
+            Number of seeds tracked between two copies of the streamlines into
+            the packed output. Default: 10000.
+        num_threads : int, optional
+            Number of threads. If None (default) the default number of OpenMP
+            threads is used.
+
+        Returns
+        -------
+        streamlines : Streamlines
+            The streamlines, in the point space given by ``affine``.
+        seed_ids : array, shape (N,)
+            The index of the seed of each streamline, in the seeds given or in
+            the random seeds drawn, if ``return_seed_ids`` is True.
+        """
+        x, y, z, g = self.a.shape
+        edge = np.array([x, y, z], dtype=np.float64) - 1.
+        if self.seed_list is not None:
+            inv = np.linalg.inv(self.affine)
+            seed_voxels = np.dot(self.seed_list, inv[:3, :3].T)
+            seed_voxels += inv[:3, 3]
+            outside = np.any((seed_voxels < 0.) | (seed_voxels > edge), -1)
+            if np.any(outside):
+                raise ValueError('Seed outside boundaries',
+                                 seed_voxels[np.argmax(outside)])
+        else:
+            # Drawn as the seeds of the iterator are
+            seed_voxels = np.random.rand(self.seed_no, 3) * edge
+
+        points, lengths, seed_ids = eudx_tracks(seed_voxels,
+                                                self.a,
+                                                self.ind,
+                                                self.odf_vertices,
+                                                self.a_low,
+                                                self.ang_thr,
+                                                self.step_sz,
+                                                self.total_weight,
+                                                self.max_points,
+                                                step=step,
+                                                num_threads=num_threads)
+        points = np.dot(points, self.affine[:3, :3].T)
+        points += self.affine[:3, 3]
+        streamlines = _from_packed(points, np.cumsum(lengths) - lengths,
+                                   lengths)
+        if return_seed_ids:
+            return streamlines, seed_ids
+        return streamlines
+
     def _voxel_tracks(self, seed_voxels):
         ''' This is were all the fun starts '''
         if seed_voxels is not None and seed_voxels.dtype != np.float64:
@@ -2,23 +2,27 @@ import numpy as np
 cimport numpy as cnp
 cimport cython
 
-cimport safe_openmp as openmp
-from safe_openmp cimport have_openmp
-from cython.parallel import parallel, prange, threadid
+from cython.parallel import parallel, prange
+from libc.math cimport NAN
 
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
 from scipy.interpolate import interp1d
-from math import sqrt, log
 
-from dipy.data import get_sphere
-from dipy.denoise.enhancement_kernel import EnhancementKernel
-from dipy.core.ndindex import ndindex
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import _packed
+from dipy.utils.omp import have_openmp
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 
 cdef class FBCMeasures:
 
-    cdef int [:] streamline_length
-    cdef double [:, :, :] streamline_points
-    cdef double [:, :] streamlines_lfbc
+    # The streamlines and their LFBC are packed: the points of streamline i
+    # are at streamline_offsets[i] for streamline_length[i] points. The LFBC
+    # of the last point of each streamline is NaN.
+    cdef cnp.npy_intp [:] streamline_length
+    cdef cnp.npy_intp [:] streamline_offsets
+    cdef double [:, :] streamline_points
+    cdef double [:] streamlines_lfbc
     cdef double [:] streamlines_rfbc
 
     def __init__(self,
@@ -33,7 +37,7 @@ cdef class FBCMeasures:
 
         Parameters
         ----------
-        streamlines : list
+        streamlines : list or Streamlines
             A collection of streamlines, each n by 3, with n being the number of
             nodes in the fiber.
         kernel : Kernel object
@@ -48,6 +52,13 @@ cdef class FBCMeasures:
         verbose : boolean
             Enable verbose mode.
 
+        Notes
+        -----
+        Only the pairs of points closer than the support of the kernel
+        contribute to the LFBC. The points are binned in a grid of cells as
+        large as the support, so that the LFBC of a point is computed from
+        the points of its cell and of the neighboring cells only.
+
         References
         ----------
         [Meesters2016_HBM] S. Meesters, G. Sanguinetti, E. Garyfallidis,
@@ -120,24 +131,20 @@ cdef class FBCMeasures:
         rfbc_out = []
         for i in range((self.streamlines_rfbc).shape[0]):
             rfbc = self.streamlines_rfbc[i]
-            lfbc = lfbc_log[i]
+            start = self.streamline_offsets[i]
+            stop = start + self.streamline_length[i] - 1
             if rfbc > threshold:
-                fiber = np.array(self.streamline_points[i])
-                fiber = fiber[0:self.streamline_length[i] - 1]
+                fiber = np.array(self.streamline_points[start:stop])
                 streamline_out.append(fiber)
 
                 rfbc_out.append(rfbc)
 
-                lfbc = lfbc[0:self.streamline_length[i] - 1]
+                lfbc = lfbc_log[start:stop]
                 lfbc_colors = np.transpose([fr(lfbc), fg(lfbc), fb(lfbc)])
                 color_out.append(lfbc_colors.tolist())
 
         return streamline_out, color_out, rfbc_out
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)
-    @cython.nonecheck(False)
-    @cython.cdivision(True)
     cdef void compute(self,
                       py_streamlines,
                       kernel,
@@ -150,7 +157,7 @@ cdef class FBCMeasures:
 
         Parameters
         ----------
-        py_streamlines : list
+        py_streamlines : list or Streamlines
             A collection of streamlines, each n by 3, with n being the number of
             nodes in the fiber.
         kernel : Kernel object
@@ -166,94 +173,64 @@ cdef class FBCMeasures:
             Enable verbose mode.
         """
         cdef:
-            int num_fibers, max_length, dim
-            double [:, :, :] streamlines
-            int [:] streamlines_length
-            double [:, :, :] streamlines_tangent
-            int [:, :] streamlines_nearestp
-            double [:, :] streamline_scores
-            double [:] tangent
-            int line_id, point_id
-            int line_id2, point_id2
-            double score
-            double [:] score_mp
-            int [:] xd_mp, yd_mp, zd_mp
-            int xd, yd, zd, N, hn
-            double [:, :, :, :, ::1] lut
-            int threads_to_use = -1
-            int all_cores = openmp.omp_get_num_procs()
-
-        if num_threads is not None:
-            threads_to_use = num_threads
-        else:
-            threads_to_use = all_cores
+            cnp.npy_intp num_fibers, num_points, hn
+            double cell_size
+            cnp.npy_intp [:] streamlines_length
 
-        if have_openmp:
-            openmp.omp_set_dynamic(0)
-            openmp.omp_set_num_threads(threads_to_use)
+        # pack the points of the streamlines, one streamline after the other
+        if not isinstance(py_streamlines, Streamlines):
+            py_streamlines = Streamlines(py_streamlines)
+        points, offsets, lengths = _packed(py_streamlines)
 
         # if the fibers are too short FBC measures cannot be applied,
         # remove these.
-        streamlines_length = np.array([x.shape[0] for x in py_streamlines],
-                                      dtype=np.int32)
-        min_length = min(streamlines_length)
-        if min_length < min_fiberlength:
+        if len(lengths) and lengths.min() < min_fiberlength:
             print("The minimum fiber length is 10 points. \
                     Shorter fibers were found and removed.")
-            py_streamlines = [x for x in py_streamlines
-                              if x.shape[0] >= min_fiberlength]
-            streamlines_length = np.array([x.shape[0] for x in py_streamlines],
-                                          dtype=np.int32)
-        num_fibers = len(py_streamlines)
+            keep = lengths >= min_fiberlength
+            points, offsets, lengths = _packed(py_streamlines[keep])
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        num_fibers = len(lengths)
+        streamlines_length = lengths
         self.streamline_length = streamlines_length
-        max_length = max(streamlines_length)
-
-        dim = 3
+        self.streamline_offsets = offsets
+        self.streamline_points = points
 
         # get lookup table info
         lut = kernel.get_lookup_table()
         N = lut.shape[2]
         hn = (N-1) / 2
 
-        # prepare numpy arrays for speed
-        streamlines = np.zeros((num_fibers, max_length, dim),
-                               dtype=np.float64) * np.nan
-        streamlines_tangents = np.zeros((num_fibers, max_length, dim),
-                                        dtype=np.float64)
-        streamlines_nearestp = np.zeros((num_fibers, max_length),
-                                        dtype=np.int32)
-        streamline_scores = np.zeros((num_fibers, max_length),
-                                     dtype=np.float64) * np.nan
-
-        # copy python streamlines into numpy array
-        for line_id in range(num_fibers):
-            for point_id in range(streamlines_length[line_id]):
-                for dim in range(3):
-                    streamlines[line_id, point_id, dim] = \
-                        py_streamlines[line_id][point_id][dim]
-        self.streamline_points = streamlines
-
-        # compute tangents
-        for line_id in range(num_fibers):
-            for point_id in range(streamlines_length[line_id] - 1):
-                tangent = np.subtract(streamlines[line_id, point_id + 1],
-                                      streamlines[line_id, point_id])
-                streamlines_tangents[line_id, point_id] = \
-                    np.divide(tangent,
-                              np.sqrt(np.dot(tangent, tangent)))
+        # the LFBC is computed at all the points but the last of each fiber,
+        # from the same points of the other fibers
+        nodes = lengths - 1
+        node_offsets = np.cumsum(nodes) - nodes
+        num_points = nodes.sum()
+        index = (np.repeat(offsets - node_offsets, nodes) +
+                 np.arange(num_points))
+        node_points = np.ascontiguousarray(points[index])
+        node_fibers = np.repeat(np.arange(num_fibers), nodes)
 
         # estimate which kernel LUT index corresponds to angles
-        tree = KDTree(kernel.get_orientations())
-        for line_id in range(num_fibers):
-            for point_id in range(streamlines_length[line_id] - 1):
-                streamlines_nearestp[line_id, point_id] = \
-                    tree.query(streamlines[line_id, point_id])[1]
-
-        # arrays for parallel computing
-        score_mp = np.zeros(num_fibers)
-        xd_mp = np.zeros(num_fibers, dtype=np.int32)
-        yd_mp = np.zeros(num_fibers, dtype=np.int32)
-        zd_mp = np.zeros(num_fibers, dtype=np.int32)
+        tree = cKDTree(kernel.get_orientations())
+        nearestp = np.empty(num_points, dtype=np.intp)
+        if num_points:
+            nearestp[:] = tree.query(node_points)[1]
+
+        # Displacements are rounded by truncating ``d + 0.5``: the kernel
+        # support is (-hn - 1.5, hn + 0.5) along each axis, so points in
+        # cells of this size interact only with the neighboring cells
+        cell_size = hn + 2
+        cells = np.floor(node_points / cell_size).astype(np.intp)
+        if num_points:
+            cells -= cells.min(0) - 1
+            grid = cells.max(0) + 2
+        else:
+            grid = np.ones(3, dtype=np.intp)
+        keys = (cells[:, 0] * grid[1] + cells[:, 1]) * grid[2] + cells[:, 2]
+        order = np.argsort(keys, kind='mergesort')
+        cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+        cell_starts = np.append(cell_starts, num_points)
 
         if verbose:
             if have_openmp:
@@ -261,57 +238,134 @@ cdef class FBCMeasures:
             else:
                 print("No OpenMP...")
 
-        # compute fiber LFBC measures
-        with nogil:
+        node_scores = np.empty(num_points)
+        set_num_threads(num_threads)
+        try:
+            _lfbc(node_points, node_fibers.astype(np.intp), nearestp, cells,
+                  grid.astype(np.intp), order.astype(np.intp),
+                  cell_keys.astype(np.intp), cell_starts.astype(np.intp),
+                  lut, hn, node_scores)
+        finally:
+            restore_default_num_threads()
 
-            for line_id in prange(num_fibers, schedule='guided'):
-                for point_id in range(streamlines_length[line_id] - 1):
-                    score_mp[line_id] = 0.0
-                    for line_id2 in range(num_fibers):
+        # Save LFBC as class member
+        streamline_scores = np.empty(len(points)) * np.nan
+        streamline_scores[index] = node_scores
+        self.streamlines_lfbc = streamline_scores
 
-                        # skip lfbc computation with itself
-                        if line_id == line_id2:
+        # compute RFBC for each fiber
+        self.streamlines_rfbc = _rfbc(lengths, node_scores, node_offsets,
+                                      max_windowsize)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef void _lfbc(double [:, ::1] points,
+                cnp.npy_intp [:] fibers,
+                cnp.npy_intp [:] nearestp,
+                cnp.npy_intp [:, :] cells,
+                cnp.npy_intp [:] grid,
+                cnp.npy_intp [:] order,
+                cnp.npy_intp [:] cell_keys,
+                cnp.npy_intp [:] cell_starts,
+                double [:, :, :, :, ::1] lut,
+                cnp.npy_intp hn,
+                double [:] scores):
+    """ Sums the kernel between each point and the points of the other fibers
+    in the neighboring cells. """
+    cdef:
+        cnp.npy_intp n = points.shape[0]
+        cnp.npy_intp n_cells = cell_keys.shape[0]
+        cnp.npy_intp p, q, j, key, lo, hi, mid
+        int dx, dy, dz, xd, yd, zd
+        double score
+
+    with nogil:
+        for p in prange(n, schedule='guided'):
+            score = 0
+            for dx in range(-1, 2):
+                for dy in range(-1, 2):
+                    for dz in range(-1, 2):
+                        key = (((cells[p, 0] + dx) * grid[1] +
+                                cells[p, 1] + dy) * grid[2] +
+                               cells[p, 2] + dz)
+                        # binary search of the cell
+                        lo = 0
+                        hi = n_cells
+                        while lo < hi:
+                            mid = (lo + hi) / 2
+                            if cell_keys[mid] < key:
+                                lo = mid + 1
+                            else:
+                                hi = mid
+                        if lo == n_cells or cell_keys[lo] != key:
                             continue
-
-                        for point_id2 in range(streamlines_length[line_id2] - 1):
+                        for j in range(cell_starts[lo], cell_starts[lo + 1]):
+                            q = order[j]
+                            # skip lfbc computation with itself
+                            if fibers[q] == fibers[p]:
+                                continue
                             # compute displacement
-                            xd_mp[line_id] = \
-                                int(streamlines[line_id, point_id, 0] -
-                                    streamlines[line_id2, point_id2, 0] + 0.5)
-                            yd_mp[line_id] = \
-                                int(streamlines[line_id, point_id, 1] -
-                                    streamlines[line_id2, point_id2, 1] + 0.5)
-                            zd_mp[line_id] = \
-                                int(streamlines[line_id, point_id, 2] -
-                                    streamlines[line_id2, point_id2, 2] + 0.5)
-
+                            xd = <int>(points[p, 0] - points[q, 0] + 0.5)
+                            yd = <int>(points[p, 1] - points[q, 1] + 0.5)
+                            zd = <int>(points[p, 2] - points[q, 2] + 0.5)
                             # if position is outside the kernel bounds, skip
-                            if xd_mp[line_id] > hn or -xd_mp[line_id] > hn or \
-                               yd_mp[line_id] > hn or -yd_mp[line_id] > hn or \
-                               zd_mp[line_id] > hn or -zd_mp[line_id] > hn:
+                            if (xd > hn or -xd > hn or yd > hn or -yd > hn or
+                                    zd > hn or -zd > hn):
                                 continue
-
                             # grab kernel value from LUT
-                            score_mp[line_id] += \
-                                lut[streamlines_nearestp[line_id, point_id],
-                                    streamlines_nearestp[line_id2, point_id2],
-                                    hn+xd_mp[line_id],
-                                    hn+yd_mp[line_id],
-                                    hn+zd_mp[line_id]]  # ang_v, ang_r, x, y, z
-
-                    streamline_scores[line_id, point_id] = score_mp[line_id]
+                            score = score + lut[nearestp[p], nearestp[q],
+                                                hn + xd, hn + yd, hn + zd]
+            scores[p] = score
 
-        # Reset number of OpenMP cores to default
-        if have_openmp and num_threads is not None:
-            openmp.omp_set_num_threads(all_cores)
 
-        # Save LFBC as class member
-        self.streamlines_lfbc = streamline_scores
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def _rfbc(cnp.npy_intp [:] lengths, double [:] scores,
+          cnp.npy_intp [:] offsets, max_windowsize=7):
+    """ Compute the RFBC of packed fibers, as ``compute_rfbc`` does for padded
+    fibers.
 
-        # compute RFBC for each fiber
-        self.streamlines_rfbc = compute_rfbc(streamlines_length,
-                                             streamline_scores,
-                                             max_windowsize)
+    ``scores[offsets[i]:offsets[i] + lengths[i] - 1]`` is the LFBC of fiber
+    ``i``. Negative LFBC values are ignored.
+    """
+    cdef:
+        cnp.npy_intp i, j, k, n, num_fibers = lengths.shape[0]
+        double total, lowest, value
+        double [:] cumsum
+        double [:] int_value = np.empty(num_fibers)
+        double [:] avg = np.empty(num_fibers)
+
+    if num_fibers == 0:
+        return np.empty(0)
+    n = min(np.min(lengths), max_windowsize)
+    cumsum = np.empty(max(np.max(lengths), 1))
+    with nogil:
+        for i in range(num_fibers):
+            # cumulative sum of the non-negative scores
+            k = 0
+            total = 0
+            for j in range(offsets[i], offsets[i] + lengths[i] - 1):
+                if scores[j] >= 0:
+                    total = total + scores[j]
+                    cumsum[k] = total
+                    k = k + 1
+            avg[i] = total / k if k > 0 else NAN
+            # lowest moving average over n scores
+            lowest = NAN
+            for j in range(n - 1, k):
+                value = cumsum[j] - cumsum[j - n] if j >= n else cumsum[j]
+                value = value / n
+                if j == n - 1 or value < lowest:
+                    lowest = value
+            int_value[i] = lowest
+    avg_total = np.mean(avg)
+    if not avg_total == 0:
+        return np.asarray(int_value) / avg_total
+    else:
+        return np.asarray(int_value)
 
 
 def compute_rfbc(streamlines_length, streamline_scores, max_windowsize=7):
@@ -12,9 +12,10 @@ import scipy.linalg as la
 
 from dipy.reconst.base import ReconstModel, ReconstFit
 from dipy.utils.six.moves import range
-from dipy.tracking.utils import unique_rows
+from dipy.core.sphere import HemiSphere
+from dipy.tracking.utils import unique_rows, _packed_points
 from dipy.tracking.streamline import transform_streamlines
-from dipy.tracking.vox2track import _voxel2streamline
+from dipy.tracking.vox2track import _life_matrix
 import dipy.data as dpd
 import dipy.core.optimize as opt
 from dipy.testing import setup_test
@@ -306,12 +307,133 @@ def voxel2streamline(streamline, transformed=False, affine=None,
             affine = np.eye(4)
         transformed_streamline = transform_streamlines(streamline, affine)
 
+    points, offsets, lengths = _packed_points(transformed_streamline)
+    coords = np.round(points).astype(np.intp)
     if unique_idx is None:
-        all_coords = np.concatenate(transformed_streamline)
-        unique_idx = unique_rows(np.round(all_coords))
+        unique_idx = unique_rows(coords)
+
+    node_voxel = _node_voxels(coords, np.asarray(unique_idx, dtype=np.intp))
+    nodes, pair_starts, pair_voxel, pair_fiber = \
+        _voxel_fiber_pairs(node_voxel, lengths)
+    # Nodes are numbered from the start of their streamline:
+    nodes = nodes - np.repeat(offsets, lengths)[nodes]
+    v2f = {}
+    v2fn = dict((s_idx, {}) for s_idx in range(len(lengths)))
+    for k, (v_idx, f_idx) in enumerate(zip(pair_voxel.tolist(),
+                                           pair_fiber.tolist())):
+        v2f.setdefault(v_idx, []).append(f_idx)
+        v2fn[f_idx][v_idx] = nodes[pair_starts[k]:pair_starts[k + 1]].tolist()
+    return v2f, v2fn
+
+
+def _node_voxels(coords, unique_idx):
+    """
+    The index of the voxel of each node in the unique voxel indices
+
+    Parameters
+    ----------
+    coords : int array (n, 3)
+        Voxel of each node.
+    unique_idx : int array (m, 3)
+        The unique voxel indices.
+
+    Returns
+    -------
+    node_voxel : array (n,)
+        ``unique_idx[node_voxel]`` is `coords`.
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.intp)
+    if len(unique_idx) == 0:
+        raise KeyError("the nodes are not in the unique indices")
+    low = np.minimum(coords.min(0), unique_idx.min(0))
+    dims = np.maximum(coords.max(0), unique_idx.max(0)) - low + 1
+    keys = np.ravel_multi_index((unique_idx - low).T, dims)
+    node_keys = np.ravel_multi_index((coords - low).T, dims)
+    order = np.argsort(keys)
+    pos = np.minimum(np.searchsorted(keys, node_keys, sorter=order),
+                     len(keys) - 1)
+    node_voxel = order[pos]
+    if np.any(keys[node_voxel] != node_keys):
+        raise KeyError("the nodes are not in the unique indices")
+    return node_voxel
+
+
+def _voxel_fiber_pairs(node_voxel, lengths):
+    """
+    Groups the nodes of the streamlines by voxel and streamline
 
-    return _voxel2streamline(transformed_streamline,
-                             unique_idx.astype(np.intp))
+    Parameters
+    ----------
+    node_voxel : array (n,)
+        Voxel of each node, the nodes being packed one streamline after the
+        other.
+    lengths : array (n_streamlines,)
+        Number of nodes of each streamline.
+
+    Returns
+    -------
+    nodes : array (n,)
+        The nodes, sorted by voxel, then streamline, then node.
+    pair_starts : array (n_pairs + 1,)
+        The nodes of the k-th pair of voxel and streamline are
+        ``nodes[pair_starts[k]:pair_starts[k + 1]]``.
+    pair_voxel, pair_fiber : arrays (n_pairs,)
+        Voxel and streamline of each pair.
+    """
+    n_fibers = len(lengths)
+    fiber = np.repeat(np.arange(n_fibers, dtype=np.intp), lengths)
+    keys = node_voxel * n_fibers + fiber
+    nodes = np.argsort(keys, kind='mergesort')
+    keys = keys[nodes]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    pair_starts = np.append(np.flatnonzero(first), len(keys))
+    pair_keys = keys[first]
+    return (nodes, pair_starts, pair_keys // max(n_fibers, 1),
+            pair_keys % max(n_fibers, 1))
+
+
+def _node_gradients(points, offsets, lengths):
+    """
+    The gradients along packed streamlines, as in `streamline_gradients`
+    """
+    grad = np.zeros(points.shape)
+    if len(points) < 2:
+        return grad
+    # Central differences inside the streamlines:
+    grad[1:-1] = (points[2:] - points[:-2]) / 2.
+    # First differences at their ends:
+    starts = offsets[lengths > 1]
+    ends = starts + lengths[lengths > 1] - 1
+    grad[starts] = points[starts + 1] - points[starts]
+    grad[ends] = points[ends] - points[ends - 1]
+    grad[offsets[lengths == 1]] = 0
+    return grad
+
+
+def _node_tensors(grad, evals):
+    """
+    The tensors of all the nodes, as in `grad_tensor`
+    """
+    # The rotations from [1, 0, 0] to each gradient:
+    R = np.linalg.svd(grad[:, None, :])[2]
+    return np.ascontiguousarray(np.einsum('nij,j,nkj->nik', R,
+                                          np.asarray(evals, dtype=float), R))
+
+
+def _closest_vertices(sphere, xyz, chunk_size=10000):
+    """
+    The closest vertex of `sphere` to each of `xyz`, as in
+    `Sphere.find_closest`
+    """
+    idx = np.empty(len(xyz), dtype=np.intp)
+    for start in range(0, len(xyz), chunk_size):
+        cos_sim = np.dot(xyz[start:start + chunk_size], sphere.vertices.T)
+        if isinstance(sphere, HemiSphere):
+            cos_sim = abs(cos_sim)
+        idx[start:start + chunk_size] = np.argmax(cos_sim, -1)
+    return idx
 
 
 class FiberModel(ReconstModel):
@@ -327,17 +449,44 @@ class FiberModel(ReconstModel):
         B.A. (2014). Validation and statistical inference in living
         connectomes. Nature Methods.
     """
-    def __init__(self, gtab):
+    def __init__(self, gtab, solver='sparse_nnls', num_threads=None):
         """
         Parameters
         ----------
         gtab : a GradientTable class instance
 
+        solver : string or dipy.core.optimize.SKLearnLinearSolver object
+            The algorithm used to solve for the fiber weights. If it is a
+            string it needs to be one of the following: {'sparse_nnls',
+            'fista', 'bb'}. 'fista' and 'bb' are the methods of
+            `dipy.core.optimize.SparseNonNegativeLeastSquares`, which scale
+            to whole-brain connectomes. Otherwise, it can be an object that
+            inherits from `dipy.core.optimize.SKLearnLinearSolver`.
+            Default: 'sparse_nnls'.
+
+        num_threads : int (optional)
+            The number of threads used to set up the model and by the 'fista'
+            and 'bb' solvers. If None (default) the default number of OpenMP
+            threads is used.
         """
         # Initialize the super-class:
         ReconstModel.__init__(self, gtab)
+        self.num_threads = num_threads
+        if solver == 'sparse_nnls':
+            self.solver = None
+        elif solver == 'fista' or solver == 'bb':
+            self.solver = opt.SparseNonNegativeLeastSquares(
+                method=solver, num_threads=num_threads)
+        elif isinstance(solver, opt.SKLearnLinearSolver):
+            self.solver = solver
+        else:
+            e_s = "The `solver` key-word argument needs to be: "
+            e_s += "'sparse_nnls', 'fista', 'bb', or a "
+            e_s += "`dipy.core.optimize.SKLearnLinearSolver` object"
+            raise ValueError(e_s)
 
-    def setup(self, streamline, affine, evals=[0.001, 0, 0], sphere=None):
+    def setup(self, streamline, affine, evals=[0.001, 0, 0], sphere=None,
+              dtype=np.float64, num_threads=None):
         """
         Set up the necessary components for the LiFE model: the matrix of
         fiber-contributions to the DWI signal, and the coordinates of voxels
@@ -359,68 +508,62 @@ class FiberModel(ReconstModel):
             gradients along the streamlines to calculate the matrix, instead of
             an approximation. Defaults to use the 724-vertex symmetric sphere
             from :mod:`dipy.data`
+        dtype : np.float64 or np.float32 (optional)
+            The type of the values of the matrix. float32 halves the memory
+            used by the values. Default: np.float64.
+        num_threads : int (optional)
+            The number of threads used to assemble the matrix. If None
+            (default) the default number of OpenMP threads is used.
         """
-        if sphere is not False:
-            SignalMaker = LifeSignalMaker(self.gtab,
-                                          evals=evals,
-                                          sphere=sphere)
-
         if affine is None:
             affine = np.eye(4)
         streamline = transform_streamlines(streamline, affine)
+        points, offsets, lengths = _packed_points(streamline)
+        del streamline
         # Assign some local variables, for shorthand:
-        all_coords = np.concatenate(streamline)
-        vox_coords = unique_rows(np.round(all_coords).astype(np.intp))
-        del all_coords
+        coords = np.round(points).astype(np.intp)
+        vox_coords = unique_rows(coords)
+        # For each voxel, the fibers going through it and their nodes in it:
+        nodes, pair_starts, pair_voxel, pair_fiber = \
+            _voxel_fiber_pairs(_node_voxels(coords, vox_coords), lengths)
+        del coords
         # We only consider the diffusion-weighted signals:
-        n_bvecs = self.gtab.bvals[~self.gtab.b0s_mask].shape[0]
-        v2f, v2fn = voxel2streamline(streamline, transformed=True,
-                                     affine=affine, unique_idx=vox_coords)
-        # How many fibers in each voxel (this will determine how many
-        # components are in the matrix):
-        n_unique_f = len(np.hstack(v2f.values()))
-        # Preallocate these, which will be used to generate the sparse
-        # matrix:
-        f_matrix_sig = np.zeros(n_unique_f * n_bvecs, dtype=np.float)
-        f_matrix_row = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-        f_matrix_col = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-
-        fiber_signal = []
-        for s_idx, s in enumerate(streamline):
-            if sphere is not False:
-                fiber_signal.append(SignalMaker.streamline_signal(s))
-            else:
-                fiber_signal.append(streamline_signal(s, self.gtab, evals))
-
-        del streamline
-        if sphere is not False:
+        bvecs = np.ascontiguousarray(self.gtab.bvecs[~self.gtab.b0s_mask],
+                                     dtype=np.float64)
+        bvals = np.ascontiguousarray(self.gtab.bvals[~self.gtab.b0s_mask],
+                                     dtype=np.float64)
+        n_bvecs = bvals.shape[0]
+
+        grad = _node_gradients(points, offsets, lengths)
+        if sphere is False:
+            # The signal of each node is computed from its own tensor:
+            signal_args = dict(tensors=_node_tensors(grad, evals))
+        else:
+            SignalMaker = LifeSignalMaker(self.gtab,
+                                          evals=evals,
+                                          sphere=sphere)
+            vertices = SignalMaker.sphere.vertices
+            node_signal = _closest_vertices(SignalMaker.sphere, grad)
+            signals = np.zeros((vertices.shape[0], n_bvecs))
+            for idx in np.unique(node_signal):
+                signals[idx] = SignalMaker.calc_signal(vertices[idx])
             del SignalMaker
-
-        keep_ct = 0
-        range_bvecs = np.arange(n_bvecs).astype(int)
-        # In each voxel:
-        for v_idx in range(vox_coords.shape[0]):
-            mat_row_idx = (range_bvecs + v_idx * n_bvecs).astype(np.intp)
-            # For each fiber in that voxel:
-            for f_idx in v2f[v_idx]:
-                # For each fiber-voxel combination, store the row/column
-                # indices in the pre-allocated linear arrays
-                f_matrix_row[keep_ct:keep_ct+n_bvecs] = mat_row_idx
-                f_matrix_col[keep_ct:keep_ct+n_bvecs] = f_idx
-
-                vox_fiber_sig = np.zeros(n_bvecs)
-                for node_idx in v2fn[f_idx][v_idx]:
-                    # Sum the signal from each node of the fiber in that voxel:
-                    vox_fiber_sig += fiber_signal[f_idx][node_idx]
-                # And add the summed thing into the corresponding rows:
-                f_matrix_sig[keep_ct:keep_ct+n_bvecs] += vox_fiber_sig
-                keep_ct = keep_ct + n_bvecs
-
-        del v2f, v2fn
+            signal_args = dict(signals=signals, node_signal=node_signal)
+        del grad
+
+        # The fiber-voxel combinations give the row/column indices and
+        # the summed signals of the matrix:
+        f_matrix_sig, f_matrix_row, f_matrix_col = _life_matrix(
+            nodes, pair_starts, pair_voxel, pair_fiber, offsets, lengths,
+            bvecs, bvals, dtype=dtype, num_threads=num_threads,
+            **signal_args)
+        del signal_args, nodes
         # Allocate the sparse matrix, using the more memory-efficient 'csr'
         # format:
         life_matrix = sps.csr_matrix((f_matrix_sig,
-                                     [f_matrix_row, f_matrix_col]))
+                                     [f_matrix_row, f_matrix_col]),
+                                     shape=(vox_coords.shape[0] * n_bvecs,
+                                            len(lengths)))
 
         return life_matrix, vox_coords
 
@@ -487,10 +630,14 @@ class FiberModel(ReconstModel):
         if affine is None:
             affine = np.eye(4)
         life_matrix, vox_coords = \
-            self.setup(streamline, affine, evals=evals, sphere=sphere)
+            self.setup(streamline, affine, evals=evals, sphere=sphere,
+                       num_threads=self.num_threads)
         (to_fit, weighted_signal, b0_signal, relative_signal, mean_sig,
          vox_data) = self._signals(data, vox_coords)
-        beta = opt.sparse_nnls(to_fit, life_matrix)
+        if self.solver is None:
+            beta = opt.sparse_nnls(to_fit, life_matrix)
+        else:
+            beta = self.solver.fit(life_matrix, to_fit).coef_
         return FiberFit(self, life_matrix, vox_coords, to_fit, beta,
                         weighted_signal, b0_signal, relative_signal, mean_sig,
                         vox_data, streamline, affine, evals)
@@ -549,12 +696,15 @@ class FiberFit(ReconstFit):
             _matrix = self.life_matrix
             gtab = self.model.gtab
         else:
-            _model = FiberModel(gtab)
+            _model = FiberModel(gtab, num_threads=self.model.num_threads)
             _matrix, _ = _model.setup(self.streamline,
                                       self.affine,
-                                      self.evals)
+                                      self.evals,
+                                      num_threads=self.model.num_threads)
 
-        pred_weighted = np.reshape(opt.spdot(_matrix, self.beta),
+        pred_weighted = opt.sparse_matvec(_matrix, self.beta,
+                                          num_threads=self.model.num_threads)
+        pred_weighted = np.reshape(pred_weighted,
                                    (self.vox_coords.shape[0],
                                     np.sum(~gtab.b0s_mask)))
 
@@ -1,8 +1,11 @@
 from .localtracking import LocalTracking
+from .localtrack import track_batch
 from .tissue_classifier import (ActTissueClassifier, BinaryTissueClassifier,
+                                LookupTissueClassifier,
                                 ThresholdTissueClassifier, TissueClassifier)
 from .direction_getter import DirectionGetter
 from dipy.tracking import utils
 
 __all__ = ["ActTissueClassifier", "BinaryTissueClassifier", "LocalTracking",
-           "ThresholdTissueClassifier"]
+           "LookupTissueClassifier", "ThresholdTissueClassifier",
+           "track_batch"]
@@ -17,3 +17,29 @@ cdef class DirectionGetter:
     cpdef np.ndarray[np.float_t, ndim=2] initial_direction(self,
                                                            double[::1] point):
         pass
+
+    def _prepare_nogil(self):
+        """Prepares the direction getter for ``get_direction_c`` and
+        ``initial_direction_c``
+
+        These C-level methods can be called without the GIL and from several
+        threads at once. Subclasses implementing them override this method to
+        return the maximum number of initial directions at any point.
+
+        Returns
+        -------
+        max_directions : int or None
+            None if the C-level methods are not implemented.
+        """
+        return None
+
+    cdef int get_direction_c(self, double *point, double *direction) nogil:
+        """Same as ``get_direction`` without the GIL"""
+        return 1
+
+    cdef int initial_direction_c(self, double *point, double *directions,
+                                 int max_directions) nogil:
+        """Writes up to `max_directions` initial directions at `point` in
+        `directions` and returns their number, or -1 if `point` is outside
+        the data"""
+        return 0
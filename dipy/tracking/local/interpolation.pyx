@@ -69,6 +69,52 @@ cdef int _trilinear_interpolate_c_4d(double[:, :, :, :] data, double[:] point,
     return 0
 
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+cdef int _trilinear_interpolate_c_3d(double[:, :, :] data, double *point,
+                                     double *result) nogil:
+    """Tri-linear interpolation of a 3d array
+
+    Same as ``_trilinear_interpolate_c_4d`` for a single volume, with the
+    point and the result given as pointers so that it can be called from
+    several threads at once.
+
+    Returns
+    -------
+    err : int
+         0 : successful interpolation.
+        -1 : point is outside the data area, meaning round(point) is not a
+             valid index to data.
+
+    """
+    cdef:
+        np.npy_intp flr
+        double rem
+        np.npy_intp index[3][2]
+        double weight[3][2]
+
+    for i in range(3):
+        if point[i] < -.5 or point[i] >= (data.shape[i] - .5):
+            return -1
+
+        flr = <np.npy_intp> floor(point[i])
+        rem = point[i] - flr
+
+        index[i][0] = flr + (flr == -1)
+        index[i][1] = flr + (flr != (data.shape[i] - 1))
+        weight[i][0] = 1 - rem
+        weight[i][1] = rem
+
+    result[0] = 0
+    for i in range(2):
+        for j in range(2):
+            for k in range(2):
+                result[0] += (weight[0][i] * weight[1][j] * weight[2][k] *
+                              data[index[0][i], index[1][j], index[2][k]])
+    return 0
+
 cpdef trilinear_interpolate4d(double[:, :, :, :] data, double[:] point,
                               np.ndarray out=None):
     """Tri-linear interpolation along the last dimension of a 4d array
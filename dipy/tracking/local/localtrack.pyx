@@ -1,8 +1,16 @@
 cimport cython
 cimport numpy as np
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
 from .direction_getter cimport DirectionGetter
 from .tissue_classifier cimport (TissueClassifier, TissueClass, TRACKPOINT,
                                  ENDPOINT, OUTSIDEIMAGE, INVALIDPOINT)
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+import numpy as np
+from nibabel.streamlines import ArraySequence as Streamlines
 
 
 cdef extern from "dpy_math.h" nogil:
@@ -185,3 +193,308 @@ def local_tracker(DirectionGetter dg, TissueClassifier tc,
         # maximum length of streamline has been reached, return everything
         i = streamline.shape[0]
     return i, tissue_class
+
+
+@cython.cdivision(True)
+cdef int _local_tracker_c(DirectionGetter dg, TissueClassifier tc,
+                          double *seed, double *first_step,
+                          double *voxel_size, double *streamline, int N,
+                          double stepsize, int fixedstep,
+                          TissueClass *tissue_class) nogil:
+    """Same as ``local_tracker`` using the C-level interface of `dg` and `tc`
+
+    `streamline` holds ``N`` points. The tissue class of the last point is
+    stored in `tissue_class`.
+    """
+    cdef:
+        int i, j
+        double point[3]
+        double dir[3]
+        double voxdir[3]
+        void (*step)(double*, double*, double) nogil
+
+    if fixedstep:
+        step = fixed_step
+    else:
+        step = step_to_boundary
+
+    for j in range(3):
+        streamline[j] = point[j] = seed[j]
+        dir[j] = first_step[j]
+
+    tissue_class[0] = TRACKPOINT
+    for i in range(1, N):
+        if dg.get_direction_c(point, dir):
+            break
+        for j in range(3):
+            voxdir[j] = dir[j] / voxel_size[j]
+        step(point, voxdir, stepsize)
+        copypoint(point, &streamline[3 * i])
+        tissue_class[0] = tc.check_point_c(point)
+        if tissue_class[0] == TRACKPOINT:
+            continue
+        elif (tissue_class[0] == ENDPOINT or
+              tissue_class[0] == INVALIDPOINT):
+            i += 1
+            break
+        elif tissue_class[0] == OUTSIDEIMAGE:
+            break
+    else:
+        i = N
+    return i
+
+
+cdef inline int _keep(TissueClass tissue_class, int return_all) nogil:
+    return (return_all or tissue_class == ENDPOINT or
+            tissue_class == OUTSIDEIMAGE)
+
+
+cdef double *_to_points(double *points, np.npy_intp n, double *affine,
+                        double *out) nogil:
+    """Applies the (3, 4) `affine` to `n` points and stores them in `out`"""
+    cdef:
+        np.npy_intp i
+        int j
+    for i in range(n):
+        for j in range(3):
+            out[3 * i + j] = (affine[4 * j] * points[3 * i] +
+                              affine[4 * j + 1] * points[3 * i + 1] +
+                              affine[4 * j + 2] * points[3 * i + 2] +
+                              affine[4 * j + 3])
+    return out + 3 * n
+
+
+cdef int _track_seed(DirectionGetter dg, TissueClassifier tc, double *seed,
+                     double *voxel_size, double stepsize, int fixedstep,
+                     int maxlen, int max_cross, int return_all,
+                     double *affine, double *F, double *B, double *directions,
+                     double **lines, np.npy_intp *lengths) nogil:
+    """Tracks all directions from a seed given in voxel coordinates
+
+    The streamlines are stored in point space in arrays allocated in
+    ``lines[:n]`` with their number of points in ``lengths[:n]``, where `n`
+    is the returned value. Returns -1 if the seed is outside the data and -2
+    if the streamlines could not be allocated, in which case nothing is
+    left allocated.
+    """
+    cdef:
+        int i, j, d, n_dirs, n = 0, stepsF, stepsB
+        double first_step[3]
+        double *out
+        TissueClass tissue_class
+
+    n_dirs = dg.initial_direction_c(seed, directions, max_cross)
+    if n_dirs < 0:
+        return -1
+    if n_dirs == 0 and return_all:
+        # only the seed position
+        lines[0] = <double *> malloc(3 * sizeof(double))
+        if lines[0] == NULL:
+            return -2
+        _to_points(seed, 1, affine, lines[0])
+        lengths[0] = 1
+        return 1
+
+    for d in range(n_dirs):
+        for j in range(3):
+            first_step[j] = directions[3 * d + j]
+        stepsF = _local_tracker_c(dg, tc, seed, first_step, voxel_size, F,
+                                  maxlen + 1, stepsize, fixedstep,
+                                  &tissue_class)
+        if not _keep(tissue_class, return_all):
+            continue
+        for j in range(3):
+            first_step[j] = -first_step[j]
+        stepsB = _local_tracker_c(dg, tc, seed, first_step, voxel_size, B,
+                                  maxlen + 1, stepsize, fixedstep,
+                                  &tissue_class)
+        if not _keep(tissue_class, return_all):
+            continue
+
+        # The backward half is reversed and its first point, the seed, is
+        # dropped as it starts the forward half
+        lengths[n] = stepsB - 1 + stepsF
+        lines[n] = <double *> malloc(3 * lengths[n] * sizeof(double))
+        if lines[n] == NULL:
+            for i in range(n):
+                free(lines[i])
+            return -2
+        out = lines[n]
+        for i in range(stepsB - 1, 0, -1):
+            out = _to_points(&B[3 * i], 1, affine, out)
+        _to_points(F, stepsF, affine, out)
+        n += 1
+    return n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def track_batch(seeds, DirectionGetter dg, TissueClassifier tc, affine,
+                double step_size, max_cross=None, int maxlen=500,
+                fixedstep=True, return_all=True, int step=10000,
+                num_threads=None):
+    """Tracks from a batch of seeds without the GIL
+
+    Generates the same streamlines as ``LocalTracking`` for direction getters
+    and tissue classifiers implementing the C-level interface
+    (``get_direction_c``, ``initial_direction_c`` and ``check_point_c``),
+    such as ``PeaksAndMetrics``, ``BinaryTissueClassifier``,
+    ``ThresholdTissueClassifier`` and ``ActTissueClassifier``. The seeds are
+    tracked in parallel with OpenMP and the streamlines are packed in a
+    single array of points in the order of the seeds.
+
+    Parameters
+    ----------
+    seeds : array (N, 3)
+        Points to seed the tracking, in point space of the track (see
+        ``affine``).
+    dg : DirectionGetter
+        Used to get directions for fiber tracking.
+    tc : TissueClassifier
+        Identifies endpoints and invalid points to inform tracking.
+    affine : array (4, 4)
+        Coordinate space for the streamline points with respect to voxel
+        indices of input data. It should not contain any shearing.
+    step_size : float
+        Step size used for tracking.
+    max_cross : int or None
+        The maximum number of direction to track from each seed in crossing
+        voxels. By default all initial directions are tracked.
+    maxlen : int
+        Maximum number of steps to track from seed.
+    fixedstep : bool
+        If true, a fixed stepsize is used, otherwise a variable step size
+        is used.
+    return_all : bool
+        If true, return all generated streamlines, otherwise only
+        streamlines reaching end points or exiting the image.
+    step : int, optional
+        Number of seeds tracked between two copies of the streamlines into
+        the packed output. Default: 10000.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    streamlines : Streamlines
+        The streamlines, with their points in ``streamlines._data``.
+    """
+    from dipy.tracking.local.localtracking import LocalTracking
+
+    cdef:
+        np.npy_intp i, k, start, stop, n_seeds, total, pos
+        int max_dirs, n_out, n_dirs
+        int fixed = fixedstep, all_lines = return_all
+        double[:, ::1] vox_seeds
+        double[::1] vs, point_affine
+        double[:, ::1] packed
+        int[::1] counts
+        np.npy_intp *lengths
+        double **lines
+        double *F
+        double *B
+        double *directions
+
+    max_dirs = dg._prepare_nogil() or 0
+    if max_dirs == 0:
+        raise TypeError("%s does not implement the C-level direction getter "
+                        "interface" % type(dg).__name__)
+    if not tc._prepare_nogil():
+        raise TypeError("%s does not implement the C-level tissue classifier "
+                        "interface" % type(tc).__name__)
+    if step < 1:
+        raise ValueError("step must be a positive integer")
+    affine = np.asarray(affine, dtype=float)
+    if affine.shape != (4, 4):
+        raise ValueError("affine should be a (4, 4) array.")
+    vs = LocalTracking._get_voxel_size(affine)
+    if max_cross is not None:
+        max_dirs = min(max_dirs, max_cross)
+    n_out = max(max_dirs, 1)
+
+    inv_A = np.linalg.inv(affine)
+    seeds = np.asarray(seeds, dtype=float).reshape((-1, 3))
+    vox_seeds = np.ascontiguousarray(np.dot(seeds, inv_A[:3, :3].T) +
+                                     inv_A[:3, 3])
+    point_affine = np.ascontiguousarray(affine[:3].ravel())
+    n_seeds = vox_seeds.shape[0]
+    step = min(step, max(n_seeds, 1))
+
+    counts = np.empty(step, dtype=np.intc)
+    lines = <double **> malloc(step * n_out * sizeof(double *))
+    lengths = <np.npy_intp *> malloc(step * n_out * sizeof(np.npy_intp))
+    if lines == NULL or lengths == NULL:
+        free(lines)
+        free(lengths)
+        raise MemoryError("could not allocate the streamline buffers")
+    chunks, chunk_lengths = [], []
+    set_num_threads(num_threads)
+    try:
+        for start in range(0, n_seeds, step):
+            stop = min(start + step, n_seeds)
+            with nogil, parallel():
+                F = <double *> malloc(3 * (maxlen + 1) * sizeof(double))
+                B = <double *> malloc(3 * (maxlen + 1) * sizeof(double))
+                directions = <double *> malloc(3 * n_out * sizeof(double))
+                for i in prange(start, stop, schedule='dynamic'):
+                    if F == NULL or B == NULL or directions == NULL:
+                        counts[i - start] = -2
+                        continue
+                    counts[i - start] = _track_seed(
+                        dg, tc, &vox_seeds[i, 0], &vs[0], step_size, fixed,
+                        maxlen, max_dirs, all_lines, &point_affine[0], F, B,
+                        directions, &lines[(i - start) * n_out],
+                        &lengths[(i - start) * n_out])
+                free(F)
+                free(B)
+                free(directions)
+
+            # Pack the streamlines of this batch in seed order
+            total = 0
+            outside = -1
+            failed = False
+            for i in range(stop - start):
+                if counts[i] == -2:
+                    failed = True
+                    counts[i] = 0
+                elif counts[i] < 0:
+                    if outside < 0:
+                        outside = start + i
+                    counts[i] = 0
+                for k in range(counts[i]):
+                    total += lengths[i * n_out + k]
+            if failed:
+                for i in range(stop - start):
+                    for k in range(counts[i]):
+                        free(lines[i * n_out + k])
+                raise MemoryError("could not allocate the streamlines")
+            packed = np.empty((total, 3))
+            batch_lengths = np.empty(np.sum(counts[:stop - start]),
+                                     dtype=np.intp)
+            pos = 0
+            n_dirs = 0
+            for i in range(stop - start):
+                for k in range(counts[i]):
+                    memcpy(&packed[pos, 0], lines[i * n_out + k],
+                           3 * lengths[i * n_out + k] * sizeof(double))
+                    free(lines[i * n_out + k])
+                    pos += lengths[i * n_out + k]
+                    batch_lengths[n_dirs] = lengths[i * n_out + k]
+                    n_dirs += 1
+            if outside >= 0:
+                raise IndexError("seed %d is outside the data" % outside)
+            chunks.append(np.asarray(packed))
+            chunk_lengths.append(batch_lengths)
+    finally:
+        restore_default_num_threads()
+        free(lines)
+        free(lengths)
+
+    streamlines = Streamlines()
+    if chunks:
+        streamlines._data = np.concatenate(chunks)
+        streamlines._lengths = np.concatenate(chunk_lengths)
+        streamlines._offsets = (np.cumsum(streamlines._lengths) -
+                                streamlines._lengths)
+    return streamlines
@@ -1,8 +1,12 @@
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 
 from dipy.tracking.local.localtrack import local_tracker
 from dipy.align import Bunch
-from dipy.tracking import utils
+from dipy.tracking import utils, Streamlines
 
 # enum TissueClass (tissue_classifier.pxd) is not accessible
 # from here. To be changed when minimal cython version > 0.21.
@@ -10,6 +14,33 @@ from dipy.tracking import utils
 # https://github.com/cython/cython/commit/50133b5a91eea348eddaaad22a606a7fa1c7c457
 TissueTypes = Bunch(OUTSIDEIMAGE=-1, INVALIDPOINT=0, TRACKPOINT=1, ENDPOINT=2)
 
+# Tracker used by the worker processes of a parallel LocalTracking. Direction
+# getters and tissue classifiers cannot always be pickled, so the tracker is
+# handed to the workers when they are forked instead of with each chunk.
+_worker_tracking = None
+
+
+def _init_worker(tracking):
+    global _worker_tracking
+    _worker_tracking = tracking
+
+
+def _track_chunk_worker(chunk):
+    return _worker_tracking._track_chunk(*chunk)
+
+
+def _iter_chunks(seeds, chunk_size):
+    """Yields ``(index, seeds)`` for consecutive chunks of `chunk_size` seeds
+    """
+    seeds = iter(seeds)
+    index = 0
+    while True:
+        chunk = list(islice(seeds, chunk_size))
+        if not chunk:
+            return
+        yield index, chunk
+        index += 1
+
 
 class LocalTracking(object):
     """A streamline generator for local tracking methods"""
@@ -34,7 +65,7 @@ class LocalTracking(object):
 
     def __init__(self, direction_getter, tissue_classifier, seeds, affine,
                  step_size, max_cross=None, maxlen=500, fixedstep=True,
-                 return_all=True):
+                 return_all=True, n_jobs=1, random_seed=None, chunk_size=1000):
         """Creates streamlines by using local fiber-tracking.
 
         Parameters
@@ -67,6 +98,25 @@ class LocalTracking(object):
         return_all : bool
             If true, return all generated streamlines, otherwise only
             streamlines reaching end points or exiting the image.
+        n_jobs : int or None, optional
+            Number of processes used to track the seeds. If None, all
+            available CPUs are used. Default: 1.
+        random_seed : int or None, optional
+            Seed of the random number generator. The seeds are tracked in
+            chunks of `chunk_size` seeds and the generator is reseeded from
+            `random_seed` and the index of the chunk before each chunk, so the
+            streamlines generated are the same for any value of `n_jobs`. If
+            None, the state of ``np.random`` is used as is when `n_jobs` is 1
+            and a random seed is drawn from it otherwise.
+        chunk_size : int, optional
+            Number of seeds tracked by a process at a time. Default: 1000.
+
+        Notes
+        -----
+        The streamlines are generated in the order of the seeds whatever the
+        number of processes. Parallel tracking relies on the worker processes
+        being forked, so it is only available on platforms where this is the
+        default start method of `multiprocessing`.
         """
         self.direction_getter = direction_getter
         self.tissue_classifier = tissue_classifier
@@ -80,14 +130,84 @@ class LocalTracking(object):
         self.max_cross = max_cross
         self.maxlen = maxlen
         self.return_all = return_all
+        if n_jobs is None:
+            n_jobs = cpu_count()
+        if n_jobs < 1:
+            raise ValueError("n_jobs must be a positive integer or None.")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer.")
+        self.n_jobs = n_jobs
+        self.random_seed = random_seed
+        self.chunk_size = chunk_size
 
     def __iter__(self):
         # Make tracks, move them to point space and return
         track = self._generate_streamlines()
         return utils.move_streamlines(track, self.affine)
 
+    def to_streamlines(self):
+        """Tracks from all the seeds and returns the packed streamlines
+
+        The streamlines are appended to a single buffer in voxel space and all
+        their points are moved to point space at once.
+
+        Returns
+        -------
+        streamlines : Streamlines
+        """
+        streamlines = Streamlines(self._generate_streamlines())
+        if len(streamlines):
+            lin_T = self.affine[:3, :3].T
+            streamlines._data = np.dot(streamlines._data, lin_T)
+            streamlines._data += self.affine[:3, 3]
+        return streamlines
+
     def _generate_streamlines(self):
         """A streamline generator"""
+        if self.n_jobs == 1 and self.random_seed is None:
+            return self._track_seeds(self.seeds)
+        return self._generate_chunked_streamlines()
+
+    def _generate_chunked_streamlines(self):
+        """Tracks the seeds chunk by chunk, in parallel if n_jobs > 1"""
+        random_seed = self.random_seed
+        if random_seed is None:
+            random_seed = np.random.randint(np.iinfo(np.int32).max)
+        chunks = ((random_seed, index, seeds) for index, seeds in
+                  _iter_chunks(self.seeds, self.chunk_size))
+        if self.n_jobs == 1:
+            for chunk in chunks:
+                for streamline in self._track_chunk(*chunk):
+                    yield streamline
+            return
+
+        # At most 2 * n_jobs chunks are submitted ahead of the one being
+        # yielded, so that the seeds are not all read at once
+        pool = Pool(self.n_jobs, initializer=_init_worker, initargs=(self,))
+        try:
+            pending = deque(pool.apply_async(_track_chunk_worker, (chunk,))
+                            for chunk in islice(chunks, 2 * self.n_jobs))
+            while pending:
+                streamlines = pending.popleft().get()
+                for chunk in islice(chunks, 1):
+                    pending.append(pool.apply_async(_track_chunk_worker,
+                                                    (chunk,)))
+                for streamline in streamlines:
+                    yield streamline
+        finally:
+            pool.terminate()
+
+    def _track_chunk(self, random_seed, index, seeds):
+        """Tracks a chunk of seeds with the generator reseeded for the chunk
+
+        Returns the list of streamlines so that no other user of
+        ``np.random`` can draw numbers while the chunk is tracked.
+        """
+        np.random.seed([random_seed, index])
+        return list(self._track_seeds(seeds))
+
+    def _track_seeds(self, seeds):
+        """Tracks from each seed and yields the streamlines in voxel space"""
         N = self.maxlen
         dg = self.direction_getter
         tc = self.tissue_classifier
@@ -103,7 +223,7 @@ class LocalTracking(object):
 
         F = np.empty((N + 1, 3), dtype=float)
         B = F.copy()
-        for s in self.seeds:
+        for s in seeds:
             s = np.dot(lin, s) + offset
             directions = dg.initial_direction(s)
             if directions.size == 0 and self.return_all:
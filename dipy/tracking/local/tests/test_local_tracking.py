@@ -8,9 +8,12 @@ from dipy.core.gradients import gradient_table
 from dipy.data import get_data
 from dipy.tracking.local import (LocalTracking, ThresholdTissueClassifier,
                                  DirectionGetter, TissueClassifier,
-                                 BinaryTissueClassifier)
+                                 BinaryTissueClassifier, ActTissueClassifier,
+                                 track_batch)
+from dipy.data import default_sphere
 from dipy.direction import (ProbabilisticDirectionGetter,
                             DeterministicMaximumDirectionGetter)
+from dipy.direction.peaks import PeaksAndMetrics
 from dipy.tracking.local.interpolation import trilinear_interpolate4d
 from dipy.tracking.local.localtracking import TissueTypes
 
@@ -272,6 +275,141 @@ def test_ProbabilisticOdfWeightedTracker():
         npt.assert_(np.allclose(sl, expected[1]))
 
 
+def test_parallel_tracking():
+    """Tracking in parallel gives the same streamlines in the same order as
+    tracking serially with the same random seed.
+    """
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    pmf_lookup = np.array([[0., 0., 1.],
+                           [1., 0., 0.],
+                           [0., 1., 0.],
+                           [.6, .4, 0.]])
+    simple_image = np.array([[0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 3, 2, 2, 2, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             ])
+    simple_image = simple_image[..., None]
+    pmf = pmf_lookup[simple_image]
+    seeds = [np.array([1., 1., 0.])] * 30 + [np.array([2., 3., 0.])] * 7
+    mask = (simple_image > 0).astype(float)
+    tc = ThresholdTissueClassifier(mask, .5)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+
+    def track(**kwargs):
+        return list(LocalTracking(dg, tc, seeds, np.eye(4), 1.,
+                                  random_seed=1234, chunk_size=4, **kwargs))
+
+    serial = track(n_jobs=1)
+    npt.assert_equal(len(serial), len(seeds))
+    # Both paths are taken from the crossing
+    npt.assert_equal(len(set(len(sl) for sl in serial[:30])), 2)
+    for n_jobs in [2, 3]:
+        parallel = track(n_jobs=n_jobs)
+        npt.assert_equal(len(parallel), len(serial))
+        for sl, expected in zip(parallel, serial):
+            npt.assert_array_equal(sl, expected)
+
+    # All the streamlines at once in point space
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [1., 2., 3.]
+    seeds_points = [np.dot(affine[:3, :3], s) + affine[:3, 3] for s in seeds]
+    streamlines = LocalTracking(dg, tc, seeds_points, affine, 2.,
+                                random_seed=1234, chunk_size=4)
+    packed = streamlines.to_streamlines()
+    npt.assert_equal(len(packed), len(serial))
+    for sl, expected in zip(packed, serial):
+        npt.assert_array_almost_equal(sl, np.dot(expected, affine[:3, :3].T) +
+                                      affine[:3, 3])
+
+    # Streamlines from a generator of seeds, cut short by the caller
+    streamlines = LocalTracking(dg, tc, iter(seeds), np.eye(4), 1.,
+                                n_jobs=2, random_seed=1234, chunk_size=4)
+    for sl, expected in zip(streamlines, serial[:5]):
+        npt.assert_array_equal(sl, expected)
+
+    # Only a few chunks of seeds are read ahead of the streamlines yielded
+    read = []
+
+    def seed_stream():
+        for s in seeds:
+            read.append(s)
+            yield s
+    streamlines = iter(LocalTracking(dg, tc, seed_stream(), np.eye(4), 1.,
+                                     n_jobs=2, random_seed=1234,
+                                     chunk_size=4))
+    npt.assert_array_equal(next(streamlines), serial[0])
+    npt.assert_equal(len(read) <= (2 * 2 + 1) * 4, True)
+    npt.assert_equal(len(list(streamlines)), len(serial) - 1)
+
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, np.eye(4),
+                      1., n_jobs=0)
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, np.eye(4),
+                      1., chunk_size=0)
+
+
+def test_track_batch():
+    """track_batch gives the same streamlines as LocalTracking"""
+    rng = np.random.RandomState(0)
+    shape = (12, 12, 12)
+    pam = PeaksAndMetrics()
+    pam.sphere = default_sphere
+    pam.peak_indices = -np.ones(shape + (3,))
+    pam.peak_indices[..., 0] = rng.randint(0, 3, shape)
+    pam.peak_indices[..., 1] = rng.randint(50, 53, shape)
+    pam.peak_values = np.zeros(shape + (3,))
+    pam.peak_values[..., :2] = rng.rand(*shape + (2,)) + .5
+    pam.peak_indices[5, 5, 5] = -1
+    pam.peak_values[5, 5, 5] = 0
+
+    mask = np.zeros(shape)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    metric = rng.rand(*shape) * mask
+    include = np.zeros(shape)
+    include[-2:] = 1
+    exclude = np.zeros(shape)
+    exclude[:, -2:] = 1
+    classifiers = [ThresholdTissueClassifier(metric, .1),
+                   BinaryTissueClassifier(mask),
+                   ActTissueClassifier(include, exclude)]
+
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [1, -2, 3]
+    seeds = rng.rand(200, 3) * 10
+    seeds = np.vstack([seeds, [[5, 5, 5]]]) * 2 + affine[:3, 3]
+
+    for tc in classifiers:
+        for kwargs in [{}, {'max_cross': 1, 'return_all': False},
+                       {'fixedstep': False, 'maxlen': 10}]:
+            expected = list(LocalTracking(pam, tc, seeds, affine, 1.,
+                                          **kwargs))
+            for step, num_threads in [(10000, None), (7, 1), (7, 2)]:
+                streamlines = track_batch(seeds, pam, tc, affine, 1.,
+                                          step=step, num_threads=num_threads,
+                                          **kwargs)
+                npt.assert_equal(len(streamlines), len(expected))
+                for sl, ex in zip(streamlines, expected):
+                    npt.assert_array_almost_equal(sl, ex)
+
+    # The seed without peaks only gives a streamline with return_all
+    streamlines = track_batch(seeds[-1:], pam, classifiers[0], affine, 1.)
+    npt.assert_array_almost_equal(streamlines._data, seeds[-1:])
+    streamlines = track_batch(seeds[-1:], pam, classifiers[0], affine, 1.,
+                              return_all=False)
+    npt.assert_equal(len(streamlines), 0)
+
+    npt.assert_raises(IndexError, track_batch, [[-5., 0, 0]], pam,
+                      classifiers[0], np.eye(4), 1.)
+
+    # Direction getters without the C-level interface are rejected
+    dg = ProbabilisticDirectionGetter.from_pmf(
+        np.ones(shape + (len(default_sphere.vertices),)), 90, default_sphere)
+    npt.assert_raises(TypeError, track_batch, seeds, dg, classifiers[0],
+                      affine, 1.)
+
+
 def test_MaximumDeterministicTracker():
     """This tests that the Maximum Deterministic Direction Getter plays nice
     LocalTracking and produces reasonable streamlines in a simple example.
@@ -6,7 +6,9 @@ import scipy.ndimage
 from dipy.core.ndindex import ndindex
 from dipy.tracking.local import (BinaryTissueClassifier,
                                  ThresholdTissueClassifier,
-                                 ActTissueClassifier)
+                                 ActTissueClassifier,
+                                 LookupTissueClassifier,
+                                 TissueClassifier)
 from dipy.tracking.local.localtracking import TissueTypes
 
 
@@ -150,5 +152,62 @@ def test_act_tissue_classifier():
         state = act_tc.check_point(pts)
         npt.assert_equal(state, TissueTypes.OUTSIDEIMAGE)
 
+
+def test_lookup_tissue_classifier():
+    """This tests that the lookup volumes of the classifiers give the tissue
+    types of the classifiers.
+    """
+    rng = np.random.RandomState(0)
+    gm = scipy.ndimage.gaussian_filter(rng.random_sample((10, 10, 10)), 1)
+    csf = scipy.ndimage.gaussian_filter(rng.random_sample((10, 10, 10)), 1)
+    gm = (gm - gm.min()) / (gm.max() - gm.min())
+    csf = (csf - csf.min()) / (csf.max() - csf.min())
+    points = rng.uniform(-0.5, 9.5, (2000, 3))
+    outside_pts = [[100, 100, 100], [0, -1, 1], [0, 10, 2],
+                   [0, 0.5, -0.51], [0, -0.51, 0.1], [np.nan, 1, 1]]
+
+    for tc in [ActTissueClassifier(include_map=gm, exclude_map=csf),
+               ThresholdTissueClassifier(gm, 0.5),
+               BinaryTissueClassifier(gm > 0.5)]:
+        agreement = []
+        for upsample in [1, 2, 5]:
+            lookup_tc = tc.to_lookup(upsample, num_threads=2)
+            npt.assert_equal(lookup_tc.upsample, upsample)
+            npt.assert_equal(lookup_tc.tissue_classes.shape,
+                             (10 * upsample,) * 3)
+            # The class of each cell is the class of its center
+            for ind in ndindex((10 * upsample,) * 3):
+                pts = (np.array(ind, dtype='float64') + 0.5) / upsample - 0.5
+                npt.assert_equal(lookup_tc.check_point(pts),
+                                 tc.check_point(pts))
+            for pts in outside_pts:
+                pts = np.array(pts, dtype='float64')
+                npt.assert_equal(lookup_tc.check_point(pts),
+                                 TissueTypes.OUTSIDEIMAGE)
+            agreement.append(np.mean([lookup_tc.check_point(pts) ==
+                                      tc.check_point(pts)
+                                      for pts in points]))
+        # Finer grids agree more with the interpolated maps
+        npt.assert_(agreement[-1] > 0.95)
+        npt.assert_(agreement[-1] >= agreement[0])
+
+    classes = np.array([[[TissueTypes.TRACKPOINT, TissueTypes.ENDPOINT]]])
+    lookup_tc = LookupTissueClassifier(classes)
+    npt.assert_equal(lookup_tc.check_point(np.array([0., 0, 0.4])),
+                     TissueTypes.TRACKPOINT)
+    npt.assert_equal(lookup_tc.check_point(np.array([0., 0, 0.6])),
+                     TissueTypes.ENDPOINT)
+    npt.assert_raises(ValueError, lookup_tc.check_point, np.zeros(2))
+    npt.assert_raises(ValueError, LookupTissueClassifier, classes + 5)
+    npt.assert_raises(ValueError, LookupTissueClassifier, classes[0])
+    npt.assert_raises(ValueError, LookupTissueClassifier, classes, 0)
+    npt.assert_raises(TypeError, TissueClassifier().to_lookup,
+                      shape=(2, 2, 2))
+    # The grid can be given explicitly
+    lookup_tc = ThresholdTissueClassifier(gm, 0.5).to_lookup(
+        1, shape=(5, 5, 5))
+    npt.assert_equal(lookup_tc.tissue_classes.shape, (5, 5, 5))
+
+
 if __name__ == '__main__':
     run_module_suite()
@@ -13,6 +13,7 @@ cdef class TissueClassifier:
         double interp_out_double[1]
         double[::1] interp_out_view
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR
+    cdef TissueClass check_point_c(self, double *point) nogil
 
 cdef class BinaryTissueClassifier(TissueClassifier):
     cdef:  
@@ -30,3 +31,8 @@ cdef class ActTissueClassifier(TissueClassifier):
         double[:, :, :] include_map, exclude_map
     pass
 
+cdef class LookupTissueClassifier(TissueClassifier):
+    cdef:
+        unsigned char[:, :, ::1] tissue_classes
+        readonly int upsample
+    pass
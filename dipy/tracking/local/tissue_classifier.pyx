@@ -1,18 +1,106 @@
 cimport cython
 cimport numpy as np
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
 
 cdef extern from "dpy_math.h" nogil:
     int dpy_rint(double)
 
 from .interpolation cimport(trilinear_interpolate4d,
-                            _trilinear_interpolate_c_4d)
+                            _trilinear_interpolate_c_4d,
+                            _trilinear_interpolate_c_3d)
 
 import numpy as np
 
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+
 cdef class TissueClassifier:
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
         pass
 
+    def _prepare_nogil(self):
+        """Returns True if ``check_point_c`` is implemented
+
+        ``check_point_c`` is the same as ``check_point`` but can be called
+        without the GIL and from several threads at once.
+        """
+        return False
+
+    cdef TissueClass check_point_c(self, double *point) nogil:
+        return PYERROR
+
+    def _map_shape(self):
+        """The shape of the maps of this classifier, None if it has none"""
+        return None
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def to_lookup(self, int upsample=2, num_threads=None, shape=None):
+        """Precomputes the tissue classes of an upsampled grid
+
+        Each voxel of ``shape`` is divided in ``upsample ** 3`` cells, and
+        each cell is given the tissue class of its center.
+
+        Parameters
+        ----------
+        upsample : int, optional
+            The number of cells per voxel along each axis. Default: 2.
+        num_threads : int, optional
+            Number of threads. If None (default) the default number of OpenMP
+            threads is used.
+        shape : tuple, optional
+            The shape of the grid of voxels. Default: the shape of the maps
+            of this classifier.
+
+        Returns
+        -------
+        tc : LookupTissueClassifier
+            Checks points in constant time, by looking up the class of the
+            cell they are in.
+        """
+        cdef:
+            np.npy_intp x, y, z, nx, ny, nz
+            double *point
+            unsigned char[:, :, ::1] tissue_classes
+            char[::1] failed
+
+        if not self._prepare_nogil():
+            raise TypeError("%s does not implement check_point_c" %
+                            type(self).__name__)
+        if upsample < 1:
+            raise ValueError("upsample must be a positive integer")
+        if shape is None:
+            shape = self._map_shape()
+            if shape is None:
+                raise ValueError("shape is needed for %s" %
+                                 type(self).__name__)
+        nx, ny, nz = [n * upsample for n in shape]
+        tissue_classes = np.empty((nx, ny, nz), dtype=np.uint8)
+        failed = np.zeros(nx, dtype=np.int8)
+        set_num_threads(num_threads)
+        try:
+            with nogil, parallel():
+                point = <double *> malloc(3 * sizeof(double))
+                for x in prange(nx, schedule='static'):
+                    if point == NULL:
+                        failed[x] = 1
+                        continue
+                    point[0] = (x + .5) / upsample - .5
+                    for y in range(ny):
+                        point[1] = (y + .5) / upsample - .5
+                        for z in range(nz):
+                            point[2] = (z + .5) / upsample - .5
+                            tissue_classes[x, y, z] = \
+                                <unsigned char> self.check_point_c(point)
+                free(point)
+        finally:
+            restore_default_num_threads()
+        if np.any(failed):
+            raise MemoryError("could not allocate the point buffers")
+        return LookupTissueClassifier(np.asarray(tissue_classes), upsample)
+
 
 cdef class BinaryTissueClassifier(TissueClassifier):
     """
@@ -52,6 +140,30 @@ cdef class BinaryTissueClassifier(TissueClassifier):
         else:
             return ENDPOINT
 
+    def _prepare_nogil(self):
+        return True
+
+    def _map_shape(self):
+        return (self.mask.shape[0], self.mask.shape[1],
+                self.mask.shape[2])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef TissueClass check_point_c(self, double *point) nogil:
+        cdef:
+            int voxel[3]
+
+        for i in range(3):
+            voxel[i] = int(dpy_rint(point[i]))
+            if voxel[i] < 0 or voxel[i] >= self.mask.shape[i]:
+                return OUTSIDEIMAGE
+
+        if self.mask[voxel[0], voxel[1], voxel[2]] > 0:
+            return TRACKPOINT
+        else:
+            return ENDPOINT
+
 
 cdef class ThresholdTissueClassifier(TissueClassifier):
     """
@@ -67,6 +179,10 @@ cdef class ThresholdTissueClassifier(TissueClassifier):
         self.metric_map = np.asarray(metric_map, 'float64')
         self.threshold = threshold
 
+    def _map_shape(self):
+        return (self.metric_map.shape[0], self.metric_map.shape[1],
+                self.metric_map.shape[2])
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.initializedcheck(False)
@@ -93,6 +209,20 @@ cdef class ThresholdTissueClassifier(TissueClassifier):
         else:
             return ENDPOINT
 
+    def _prepare_nogil(self):
+        return True
+
+    cdef TissueClass check_point_c(self, double *point) nogil:
+        cdef:
+            double result
+
+        if _trilinear_interpolate_c_3d(self.metric_map, point, &result) != 0:
+            return OUTSIDEIMAGE
+        if result > self.threshold:
+            return TRACKPOINT
+        else:
+            return ENDPOINT
+
 
 cdef class ActTissueClassifier(TissueClassifier):
     r"""
@@ -120,6 +250,10 @@ cdef class ActTissueClassifier(TissueClassifier):
         self.include_map = np.asarray(include_map, 'float64')
         self.exclude_map = np.asarray(exclude_map, 'float64')
 
+    def _map_shape(self):
+        return (self.include_map.shape[0], self.include_map.shape[1],
+                self.include_map.shape[2])
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.initializedcheck(False)
@@ -155,3 +289,82 @@ cdef class ActTissueClassifier(TissueClassifier):
             return INVALIDPOINT
         else:
             return TRACKPOINT
+
+    def _prepare_nogil(self):
+        return True
+
+    cdef TissueClass check_point_c(self, double *point) nogil:
+        cdef:
+            double include_result, exclude_result
+
+        if (_trilinear_interpolate_c_3d(self.include_map, point,
+                                        &include_result) != 0 or
+                _trilinear_interpolate_c_3d(self.exclude_map, point,
+                                            &exclude_result) != 0):
+            return OUTSIDEIMAGE
+
+        if include_result > 0.5:
+            return ENDPOINT
+        elif exclude_result > 0.5:
+            return INVALIDPOINT
+        else:
+            return TRACKPOINT
+
+
+cdef class LookupTissueClassifier(TissueClassifier):
+    """
+    Tissue classes looked up in a precomputed volume, usually made by the
+    ``to_lookup`` method of another classifier.
+
+    The volume has ``upsample`` cells per voxel along each axis. A point is
+    given the class of the cell it is in, so that checking a point takes a
+    constant time, whatever the number of maps of the original classifier.
+
+    cdef:
+        unsigned char[:, :, ::1] tissue_classes
+        readonly int upsample
+    """
+
+    def __cinit__(self, tissue_classes, upsample=1):
+        self.interp_out_view = self.interp_out_double
+        if upsample < 1:
+            raise ValueError("upsample must be a positive integer")
+        tissue_classes = np.ascontiguousarray(tissue_classes, 'uint8')
+        if tissue_classes.ndim != 3:
+            raise ValueError("tissue_classes should be a 3d array.")
+        if tissue_classes.size and tissue_classes.max() > ENDPOINT:
+            raise ValueError("tissue_classes should be INVALIDPOINT, "
+                             "TRACKPOINT or ENDPOINT")
+        self.tissue_classes = tissue_classes
+        self.upsample = upsample
+
+    @property
+    def tissue_classes(self):
+        """The tissue class of each cell"""
+        return np.asarray(self.tissue_classes)
+
+    cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
+        if point.shape[0] != 3:
+            raise ValueError("Point has wrong shape")
+        return self.check_point_c(&point[0])
+
+    def _prepare_nogil(self):
+        return True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef TissueClass check_point_c(self, double *point) nogil:
+        cdef:
+            np.npy_intp i
+            np.npy_intp index[3]
+            double p
+
+        for i in range(3):
+            p = (point[i] + .5) * self.upsample
+            # Written so that NaN coordinates are outside
+            if not (p >= 0 and p < self.tissue_classes.shape[i]):
+                return OUTSIDEIMAGE
+            index[i] = <np.npy_intp> p
+        return <TissueClass> self.tissue_classes[index[0], index[1],
+                                                 index[2]]
@@ -6,10 +6,15 @@
 # cython: embedsignature=True
 
 cimport cython
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
 
 import numpy as np
 cimport numpy as cnp
 
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
     float fabs(float x)
@@ -432,10 +437,9 @@ def eudx_both_directions(cnp.ndarray[double, ndim=1] seed,
         double *pverts = <double*> cnp.PyArray_DATA(odf_vertices)
         cnp.npy_intp *pstr = <cnp.npy_intp *> qa.strides
         cnp.npy_intp *qa_shape = <cnp.npy_intp *> qa.shape
-        cnp.npy_intp *pvstr = <cnp.npy_intp *> odf_vertices.strides
-        cnp.npy_intp d, i, j, cnt
-        double direction[3], dx[3], idirection[3], ps2[3]
-        double tmp, ftmp
+        cnp.npy_intp nf, nb
+        float *F
+        float *B
     if not cnp.PyArray_CHKFLAGS(seed, cnp.NPY_C_CONTIGUOUS):
         raise ValueError(u"seed is not C contiguous")
     if not cnp.PyArray_CHKFLAGS(qa, cnp.NPY_C_CONTIGUOUS):
@@ -445,74 +449,254 @@ def eudx_both_directions(cnp.ndarray[double, ndim=1] seed,
     if not cnp.PyArray_CHKFLAGS(odf_vertices, cnp.NPY_C_CONTIGUOUS):
         raise ValueError(u"odf_vertices is not C contiguous")
 
-    cnt = 0
-    d = _initial_direction(ps, pqa, pin, pverts, qa_thr, pstr, ref, idirection)
+    F = <float *> malloc(3 * (max_points + 2) * sizeof(float))
+    B = <float *> malloc(3 * (max_points + 1) * sizeof(float))
+    try:
+        nf = _eudx_track(ps, ref, pqa, pin, pverts, qa_thr, ang_thr, step_sz,
+                         total_weight, max_points, qa_shape, pstr, F, B, &nb)
+        if nf < 0:
+            return None
+        track = np.empty((nb + nf, 3), dtype=np.float32)
+        _join_track(F, nf, B, nb, <float *> cnp.PyArray_DATA(track))
+    finally:
+        free(F)
+        free(B)
+    # Return track for the current seed point and ref
+    return track
+
+
+cdef cnp.npy_intp _eudx_track(double *seed,
+                              cnp.npy_intp ref,
+                              double *pqa,
+                              double *pin,
+                              double *pverts,
+                              double qa_thr,
+                              double ang_thr,
+                              double step_sz,
+                              double total_weight,
+                              cnp.npy_intp max_points,
+                              cnp.npy_intp *qa_shape,
+                              cnp.npy_intp *pstr,
+                              float *F,
+                              float *B,
+                              cnp.npy_intp *nb) nogil:
+    """Tracks from a seed in both directions of the peak ``ref``.
+
+    The seed and the points reached forwards are written in ``F``, of size
+    ``max_points + 2``, and the points reached backwards in ``B``, of size
+    ``max_points + 1``. Returns the number of points in ``F`` (and sets
+    ``nb`` to the number of points in ``B``), or -1 if there is no initial
+    direction.
+    """
+    cdef:
+        cnp.npy_intp d, i, cnt, nf, sign
+        double direction[3], dx[3], idirection[3], ps[3], tmp
+
+    d = _initial_direction(seed, pqa, pin, pverts, qa_thr, pstr, ref,
+                           idirection)
     if d == 0:
-        return None
-    for i from 0 <= i < 3:
-        # store the initial direction
-        dx[i] = idirection[i]
-        # ps2 is for downwards and ps for upwards propagation
-        ps2[i] = ps[i]
-    point = seed.copy()
-    track = []
-    track.append(point.copy())
-    # track towards one direction
-    while d:
-        d = _propagation_direction(ps, dx, pqa, pin, pverts, qa_thr, ang_thr,
-                                   qa_shape, pstr, direction, total_weight)
-        if d == 0:
-            break
-        if cnt > max_points:
-            break
-        # update the track
-        for i from 0 <= i < 3:
-            dx[i] = direction[i]
-            # check for boundaries
-            tmp = ps[i] + step_sz * dx[i]
-            if tmp > qa_shape[i] - 1 or tmp < 0.:
-                 d = 0
-                 break
-            # propagate
-            ps[i] = tmp
-            point[i] = ps[i]
-
-        if d == 1:
-            track.append(point.copy())
-            cnt += 1
-    d = 1
-    for i from 0 <= i < 3:
-        dx[i] = -idirection[i]
-
-    cnt = 0
-    # track towards the opposite direction
-    while d:
-        d = _propagation_direction(ps2, dx, pqa, pin, pverts, qa_thr, ang_thr,
-                                   qa_shape, pstr, direction, total_weight)
-        if d == 0:
-            break
-        if cnt > max_points:
-            break
-        # update the track
-        for i from 0 <= i < 3:
-            dx[i] = direction[i]
-            # check for boundaries
-            tmp=ps2[i] + step_sz*dx[i]
-            if tmp > qa_shape[i] - 1 or tmp < 0.:
-                 d = 0
-                 break
-            # propagate
-            ps2[i] = tmp
-            point[i] = ps2[i] # to be changed
-        # add track point
-        if d == 1:
-            track.insert(0, point.copy())
-            cnt += 1
-    # prepare to return final track for the current seed
-    tmp_track = np.array(track, dtype=np.float32)
-
-    # Sometimes one of the ends takes small negative values; needs to be
-    # investigated further
+        return -1
+    for i in range(3):
+        F[i] = <float> seed[i]
+    nf = 1
+    nb[0] = 0
+    # track towards one direction, then towards the opposite direction
+    for sign in range(2):
+        for i in range(3):
+            # store the initial direction
+            dx[i] = idirection[i] if sign == 0 else -idirection[i]
+            ps[i] = seed[i]
+        d = 1
+        cnt = 0
+        while d:
+            d = _propagation_direction(ps, dx, pqa, pin, pverts, qa_thr,
+                                       ang_thr, qa_shape, pstr, direction,
+                                       total_weight)
+            if d == 0:
+                break
+            if cnt > max_points:
+                break
+            # update the track
+            for i in range(3):
+                dx[i] = direction[i]
+                # check for boundaries
+                tmp = ps[i] + step_sz * dx[i]
+                if tmp > qa_shape[i] - 1 or tmp < 0.:
+                    d = 0
+                    break
+                # propagate
+                ps[i] = tmp
+            if d == 1:
+                for i in range(3):
+                    if sign == 0:
+                        F[3 * nf + i] = <float> ps[i]
+                    else:
+                        B[3 * nb[0] + i] = <float> ps[i]
+                if sign == 0:
+                    nf += 1
+                else:
+                    nb[0] += 1
+                cnt += 1
+    return nf
+
+
+cdef void _join_track(float *F, cnp.npy_intp nf, float *B, cnp.npy_intp nb,
+                      float *track) nogil:
+    """Writes the points of ``B`` in reverse order followed by those of
+    ``F``"""
+    cdef cnp.npy_intp i, j
+    for i in range(nb):
+        for j in range(3):
+            track[3 * i + j] = B[3 * (nb - 1 - i) + j]
+    for i in range(3 * nf):
+        track[3 * nb + i] = F[i]
 
-    # Return track for the current seed point and ref
-    return tmp_track
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def eudx_tracks(seeds,
+                double[:, :, :, ::1] qa,
+                double[:, :, :, ::1] ind,
+                double[:, ::1] odf_vertices,
+                double qa_thr,
+                double ang_thr,
+                double step_sz,
+                double total_weight,
+                cnp.npy_intp max_points,
+                cnp.npy_intp step=10000,
+                num_threads=None):
+    """Tracks from a batch of seeds, in parallel, without the GIL.
+
+    Generates the same tracks as ``eudx_both_directions`` called for each
+    seed and each peak, keeping the tracks with more than one point. The
+    tracks are packed in a single array of points, in the order of the
+    seeds and peaks.
+
+    Parameters
+    ----------
+    seeds : array, shape (N, 3)
+        Points where the tracking starts, in voxel coordinates.
+    qa : array, float64 shape (X, Y, Z, Np)
+        Anisotropy matrix, where ``Np`` is the number of maximum allowed peaks.
+    ind : array, float64 shape(x, y, z, Np)
+        Index of the track orientation.
+    odf_vertices : double array shape (N, 3)
+        Sampling directions on the sphere.
+    qa_thr : float
+        Threshold for QA, we want everything higher than this threshold.
+    ang_thr : float
+        Angle threshold, we only select fiber orientation within this range.
+    step_sz : double
+    total_weight : double
+    max_points : cnp.npy_intp
+    step : int, optional
+        Number of seeds tracked between two copies of the tracks into the
+        packed output. Default: 10000.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    points : array, float32 shape (P, 3)
+        The points of all the tracks.
+    lengths : array, shape (M,)
+        The number of points of each track.
+    seed_ids : array, shape (M,)
+        The index of the seed of each track.
+    """
+    cdef:
+        double[:, ::1] vseeds
+        cnp.npy_intp n_seeds, n_peaks, start, stop, i, k, n, pos, total
+        cnp.npy_intp[::1] kept
+        cnp.npy_intp nf, nb
+        cnp.npy_intp *nb_slot
+        cnp.npy_intp *qa_shape = <cnp.npy_intp *> &qa.shape[0]
+        cnp.npy_intp *pstr = <cnp.npy_intp *> &qa.strides[0]
+        cnp.npy_intp[::1] track_lengths
+        float **tracks
+        float *F
+        float *B
+        float[:, ::1] packed
+
+    if qa.shape[3] > PEAK_NO:
+        raise ValueError("qa cannot have more than %d peaks" % PEAK_NO)
+    if step < 1:
+        raise ValueError("step must be a positive integer")
+    seeds = np.asarray(seeds, dtype=np.float64).reshape((-1, 3))
+    vseeds = np.ascontiguousarray(seeds)
+    n_seeds = vseeds.shape[0]
+    n_peaks = qa.shape[3]
+    step = min(step, max(n_seeds, 1))
+
+    track_lengths = np.empty(step * n_peaks, dtype=np.intp)
+    tracks = <float **> malloc(step * n_peaks * sizeof(float *))
+    if tracks == NULL:
+        raise MemoryError("could not allocate the track buffers")
+    chunks, chunk_lengths, chunk_ids = [], [], []
+    set_num_threads(num_threads)
+    try:
+        for start in range(0, n_seeds, step):
+            stop = min(start + step, n_seeds)
+            with nogil, parallel():
+                # The number of backward points is written through a
+                # per-thread slot, as variables only passed by address are
+                # shared by the threads
+                F = <float *> malloc(3 * (max_points + 2) * sizeof(float))
+                B = <float *> malloc(3 * (max_points + 1) * sizeof(float))
+                nb_slot = <cnp.npy_intp *> malloc(sizeof(cnp.npy_intp))
+                for n in prange((stop - start) * n_peaks,
+                                schedule='dynamic'):
+                    tracks[n] = NULL
+                    track_lengths[n] = 0
+                    if F == NULL or B == NULL or nb_slot == NULL:
+                        track_lengths[n] = -1
+                        continue
+                    i = start + n // n_peaks
+                    nf = _eudx_track(&vseeds[i, 0], n % n_peaks,
+                                     &qa[0, 0, 0, 0], &ind[0, 0, 0, 0],
+                                     &odf_vertices[0, 0], qa_thr, ang_thr,
+                                     step_sz, total_weight, max_points,
+                                     qa_shape, pstr, F, B, nb_slot)
+                    nb = nb_slot[0]
+                    if nf >= 0 and nf + nb >= 2:
+                        tracks[n] = <float *> malloc(3 * (nf + nb) *
+                                                     sizeof(float))
+                        if tracks[n] == NULL:
+                            track_lengths[n] = -1
+                        else:
+                            track_lengths[n] = nf + nb
+                            _join_track(F, nf, B, nb, tracks[n])
+                free(F)
+                free(B)
+                free(nb_slot)
+
+            # Pack the tracks of this batch in seed order
+            lengths = np.asarray(track_lengths[:(stop - start) * n_peaks])
+            if np.any(lengths < 0):
+                for n in np.flatnonzero(lengths > 0):
+                    free(tracks[n])
+                raise MemoryError("could not allocate the tracks")
+            kept = np.flatnonzero(lengths).astype(np.intp)
+            total = lengths.sum()
+            packed = np.empty((total, 3), dtype=np.float32)
+            pos = 0
+            for k in range(kept.shape[0]):
+                n = kept[k]
+                memcpy(&packed[pos, 0], tracks[n],
+                       3 * track_lengths[n] * sizeof(float))
+                free(tracks[n])
+                pos += track_lengths[n]
+            chunks.append(np.asarray(packed))
+            chunk_lengths.append(lengths[kept])
+            chunk_ids.append(start + np.asarray(kept) // n_peaks)
+    finally:
+        restore_default_num_threads()
+        free(tracks)
+
+    if not chunks:
+        return (np.empty((0, 3), dtype=np.float32),
+                np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp))
+    return (np.concatenate(chunks), np.concatenate(chunk_lengths),
+            np.concatenate(chunk_ids))
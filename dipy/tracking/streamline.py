@@ -9,10 +9,11 @@ from nibabel.streamlines import ArraySequence as Streamlines
 from dipy.tracking.streamlinespeed import set_number_of_points
 from dipy.tracking.streamlinespeed import length
 from dipy.tracking.streamlinespeed import compress_streamlines
+from dipy.tracking.streamlinespeed import sample_volume
 import dipy.tracking.utils as ut
-from dipy.tracking.utils import streamline_near_roi
+from dipy.tracking.utils import streamline_near_roi, _streamlines_near_roi
+from dipy.tracking._utils import _packed, _from_packed
 from dipy.core.geometry import dist_to_corner
-import dipy.align.vector_fields as vfu
 from dipy.testing import setup_test
 
 
@@ -29,6 +30,9 @@ def unlist_streamlines(streamlines):
     offsets : array
 
     """
+    if isinstance(streamlines, Streamlines):
+        points, _, lengths = _packed(streamlines)
+        return np.array(points), np.cumsum(lengths).astype('i8')
 
     points = np.concatenate(streamlines, axis=0)
     offsets = np.zeros(len(streamlines), dtype='i8')
@@ -74,17 +78,23 @@ def center_streamlines(streamlines):
 
     Parameters
     ----------
-    streamlines : list
+    streamlines : list or Streamlines
         List of 2D ndarrays of shape[-1]==3
 
     Returns
     -------
-    new_streamlines : list
-        List of 2D ndarrays of shape[-1]==3
+    new_streamlines : list or Streamlines
+        List of 2D ndarrays of shape[-1]==3, `Streamlines` if `streamlines`
+        is.
     inv_shift : ndarray
         Translation in x,y,z to go back in the initial position
 
     """
+    if isinstance(streamlines, Streamlines):
+        points, offsets, lengths = _packed(streamlines)
+        center = np.mean(points, axis=0)
+        return _from_packed(points - center, offsets, lengths), center
+
     center = np.mean(np.concatenate(streamlines, axis=0), axis=0)
     return [s - center for s in streamlines], center
 
@@ -94,16 +104,21 @@ def transform_streamlines(streamlines, mat):
 
     Parameters
     ----------
-    streamlines : list
+    streamlines : list or Streamlines
         List of 2D ndarrays of shape[-1]==3
     mat : array, (4, 4)
         transformation matrix
 
     Returns
     -------
-    new_streamlines : list
-        List of the transformed 2D ndarrays of shape[-1]==3
+    new_streamlines : list or Streamlines
+        List of the transformed 2D ndarrays of shape[-1]==3, `Streamlines`
+        if `streamlines` is. The points of `Streamlines` are transformed all
+        at once.
     """
+    if isinstance(streamlines, Streamlines):
+        points, offsets, lengths = _packed(streamlines)
+        return _from_packed(apply_affine(mat, points), offsets, lengths)
     return [apply_affine(mat, s) for s in streamlines]
 
 
@@ -133,15 +148,16 @@ def select_random_set_of_streamlines(streamlines, select):
 
 
 def select_by_rois(streamlines, rois, include, mode=None, affine=None,
-                   tol=None):
+                   tol=None, index=None):
     """Select streamlines based on logical relations with several regions of
     interest (ROIs). For example, select streamlines that pass near ROI1,
     but only if they do not pass near ROI2.
 
     Parameters
     ----------
-    streamlines : list
-        A list of candidate streamlines for selection
+    streamlines : list or Streamlines
+        A list of candidate streamlines for selection. The distances of the
+        points of `Streamlines` to the ROIs are all computed at once.
     rois : list or ndarray
         A list of 3D arrays, each with shape (x, y, z) corresponding to the
         shape of the brain volume, or a 4D array with shape (n_rois, x, y,
@@ -171,6 +187,12 @@ def select_by_rois(streamlines, rois, include, mode=None, affine=None,
         of any voxel in the ROI, the filtering criterion is set to True for
         this streamline, otherwise False. Defaults to the distance between
         the center of each voxel and the corner of the voxel.
+    index : StreamlineIndex, optional
+        Index of `streamlines` in the grid of the ROIs, built with `affine`.
+        Only the streamlines the index finds near the inclusion ROIs are
+        checked, and only those also found near the exclusion ROIs are
+        checked against them. `streamlines` must then be a list or
+        `Streamlines`.
 
     Notes
     -----
@@ -252,6 +274,26 @@ def select_by_rois(streamlines, rois, include, mode=None, affine=None,
 
     if mode is None:
         mode = "any"
+    if index is not None:
+        ut._check_index(index, streamlines)
+        selected = index.query(include_roi, tol)
+        ids = np.flatnonzero(selected)
+        selected[ids] = ut.near_roi(ut._subset(streamlines, ids),
+                                    include_roi, affine, tol, mode)
+        ids = np.flatnonzero(selected & index.query(exclude_roi, tol))
+        selected[ids] = ~ut.near_roi(ut._subset(streamlines, ids),
+                                     exclude_roi, affine, tol, mode)
+        for idx in np.where(selected)[0]:
+            yield streamlines[idx]
+        return
+    if isinstance(streamlines, Streamlines):
+        include = _streamlines_near_roi(streamlines, x_include_roi_coords,
+                                        tol=tol, mode=mode)
+        exclude = _streamlines_near_roi(streamlines, x_exclude_roi_coords,
+                                        tol=tol, mode=mode)
+        for idx in np.where(include & ~exclude)[0]:
+            yield streamlines[idx]
+        return
     for sl in streamlines:
         include = streamline_near_roi(sl, x_include_roi_coords, tol=tol,
                                       mode=mode)
@@ -377,79 +419,6 @@ def orient_by_rois(streamlines, roi1, roi2, in_place=False,
     return _orient_list(out, roi1, roi2)
 
 
-def _extract_vals(data, streamlines, affine=None, threedvec=False):
-    """
-    Helper function for use with `values_from_volume`.
-
-    Parameters
-    ----------
-    data : 3D or 4D array
-        Scalar (for 3D) and vector (for 4D) values to be extracted. For 4D
-        data, interpolation will be done on the 3 spatial dimensions in each
-        volume.
-
-    streamlines : ndarray or list
-        If array, of shape (n_streamlines, n_nodes, 3)
-        If list, len(n_streamlines) with (n_nodes, 3) array in
-        each element of the list.
-
-    affine : ndarray, shape (4, 4)
-        Affine transformation from voxels (image coordinates) to streamlines.
-        Default: identity.
-
-    threedvec : bool
-        Whether the last dimension has length 3. This is a special case in
-        which we can use :func:`vfu.interpolate_vector_3d` for the
-        interploation of 4D volumes without looping over the elements of the
-        last dimension.
-
-    Return
-    ------
-    array or list (depending on the input) : values interpolate to each
-        coordinate along the length of each streamline
-    """
-    data = data.astype(np.float)
-    if (isinstance(streamlines, list) or
-            isinstance(streamlines, types.GeneratorType)):
-        if affine is not None:
-            streamlines = ut.move_streamlines(streamlines,
-                                              np.linalg.inv(affine))
-
-        vals = []
-        for sl in streamlines:
-            if threedvec:
-                vals.append(list(vfu.interpolate_vector_3d(data,
-                                 sl.astype(np.float))[0]))
-            else:
-                vals.append(list(vfu.interpolate_scalar_3d(data,
-                                 sl.astype(np.float))[0]))
-
-    elif isinstance(streamlines, np.ndarray):
-        sl_shape = streamlines.shape
-        sl_cat = streamlines.reshape(sl_shape[0] *
-                                     sl_shape[1], 3).astype(np.float)
-
-        if affine is not None:
-            inv_affine = np.linalg.inv(affine)
-            sl_cat = (np.dot(sl_cat, inv_affine[:3, :3]) +
-                      inv_affine[:3, 3])
-
-        # So that we can index in one operation:
-        if threedvec:
-            vals = np.array(vfu.interpolate_vector_3d(data, sl_cat)[0])
-        else:
-            vals = np.array(vfu.interpolate_scalar_3d(data, sl_cat)[0])
-        vals = np.reshape(vals, (sl_shape[0], sl_shape[1], -1))
-        if vals.shape[-1] == 1:
-            vals = np.reshape(vals, vals.shape[:-1])
-    else:
-        raise RuntimeError("Extracting values from a volume ",
-                           "requires streamlines input as an array, ",
-                           "a list of arrays, or a streamline generator.")
-
-    return vals
-
-
 def values_from_volume(data, streamlines, affine=None):
     """Extract values of a scalar/vector along each streamline from a volume.
 
@@ -460,7 +429,7 @@ def values_from_volume(data, streamlines, affine=None):
         data, interpolation will be done on the 3 spatial dimensions in each
         volume.
 
-    streamlines : ndarray or list
+    streamlines : ndarray, list or :class:`dipy.tracking.Streamlines`
         If array, of shape (n_streamlines, n_nodes, 3)
         If list, len(n_streamlines) with (n_nodes, 3) array in
         each element of the list.
@@ -483,31 +452,25 @@ def values_from_volume(data, streamlines, affine=None):
     into segments between the nodes. Using this function with streamlines that
     have been resampled into a very small number of nodes will result in very
     few values.
+
+    See Also
+    --------
+    sample_volume : averages the values along streamlines or into tract
+        profiles without keeping the values at each node.
     """
     data = np.asarray(data)
-    if len(data.shape) == 4:
-        if data.shape[-1] == 3:
-            return _extract_vals(data, streamlines, affine=affine,
-                                 threedvec=True)
-        if isinstance(streamlines, types.GeneratorType):
-            streamlines = list(streamlines)
-        vals = []
-        for ii in range(data.shape[-1]):
-            vals.append(_extract_vals(data[..., ii], streamlines,
-                        affine=affine))
-
-        if isinstance(vals[-1], np.ndarray):
-            return np.swapaxes(np.array(vals), 2, 1).T
-        else:
-            new_vals = []
-            for sl_idx in range(len(streamlines)):
-                sl_vals = []
-                for ii in range(data.shape[-1]):
-                    sl_vals.append(vals[ii][sl_idx])
-                new_vals.append(np.array(sl_vals).T)
-            return new_vals
-
-    elif len(data.shape) == 3:
-        return _extract_vals(data, streamlines, affine=affine)
-    else:
+    if data.ndim not in (3, 4):
         raise ValueError("Data needs to have 3 or 4 dimensions")
+
+    if isinstance(streamlines, np.ndarray):
+        # All the nodes are sampled as a single streamline
+        sl_shape = streamlines.shape
+        vals = sample_volume(data, streamlines.reshape(-1, 3), affine=affine)
+        return vals.reshape(sl_shape[:2] + data.shape[3:])
+    elif isinstance(streamlines, types.GeneratorType):
+        streamlines = list(streamlines)
+    elif not isinstance(streamlines, (list, Streamlines)):
+        raise RuntimeError("Extracting values from a volume ",
+                           "requires streamlines input as an array, ",
+                           "a list of arrays, or a streamline generator.")
+    return sample_volume(data, streamlines, affine=affine)
@@ -3,12 +3,16 @@
 
 import cython
 import numpy as np
-from libc.math cimport sqrt
+from cython.parallel import parallel, prange, threadid
+from libc.math cimport floor, sqrt
 from libc.stdlib cimport malloc, free
 
 cimport numpy as np
 
 from dipy.tracking import Streamlines
+from dipy.tracking._utils import _from_packed
+from dipy.utils.omp import thread_count
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 
 cdef extern from "dpy_math.h" nogil:
@@ -35,26 +39,54 @@ cdef double c_length(Streamline streamline) nogil:
 cdef void c_arclengths_from_arraysequence(Streamline points,
                                           np.npy_intp[:] offsets,
                                           np.npy_intp[:] lengths,
-                                          double[:] arclengths) nogil:
-    cdef:
-        np.npy_intp i, j, k
-        np.npy_intp offset
-        double dn, sum_dn_sqr
+                                          double[:] arclengths):
+    cdef np.npy_intp i
 
-    for i in range(offsets.shape[0]):
-        offset = offsets[i]
+    with nogil:
+        for i in prange(offsets.shape[0], schedule='guided'):
+            arclengths[i] = c_length(
+                points[offsets[i]:offsets[i] + lengths[i]])
 
-        arclengths[i] = 0
-        for j in range(1, lengths[i]):
-            sum_dn_sqr = 0.0
-            for k in range(points.shape[1]):
-                dn = points[offset+j, k] - points[offset+j-1, k]
-                sum_dn_sqr += dn*dn
 
-            arclengths[i] += sqrt(sum_dn_sqr)
+def _packed_streamlines(streamlines):
+    """ Buffer, offsets and lengths of a sequence of streamlines
 
+    The points of :class:`dipy.tracking.Streamlines` are used in place, those
+    of other sequences are concatenated. Points are cast to float32 or
+    float64 like the streamlines given to the functions of this module.
 
-def length(streamlines):
+    Returns
+    -------
+    points : array (P, D) of float32 or float64
+    offsets : array (N,)
+        Index of the first point of each streamline in `points`.
+    lengths : array (N,)
+        Number of points of each streamline.
+
+    None is returned instead if the streamlines have different dtypes or
+    dimensions.
+    """
+    if isinstance(streamlines, Streamlines):
+        points = streamlines._data
+        offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+        lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    else:
+        dtype = streamlines[0].dtype
+        shape = streamlines[0].shape[1:]
+        for streamline in streamlines:
+            if streamline.dtype != dtype or streamline.shape[1:] != shape:
+                return None
+        lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+        offsets = np.cumsum(lengths) - lengths
+        points = np.concatenate(streamlines)
+    dtype = points.dtype
+    if dtype != np.float32 and dtype != np.float64:
+        is_integer = dtype == np.int64 or dtype == np.uint64
+        points = points.astype(np.float64 if is_integer else np.float32)
+    return points, offsets, lengths
+
+
+def length(streamlines, num_threads=None):
     ''' Euclidean length of streamlines
 
     Length is in mm only if streamlines are expressed in world coordinates.
@@ -67,6 +99,9 @@ def length(streamlines):
         If list, each item must be ndarray shape (Ni,3) where Ni is the number
         of points of streamline i.
         If :class:`dipy.tracking.Streamlines`, its `common_shape` must be 3.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
 
     Returns
     ---------
@@ -95,27 +130,8 @@ def length(streamlines):
     0.0
 
     '''
-    if isinstance(streamlines, Streamlines):
-        if len(streamlines) == 0:
-            return 0.0
-
-        arclengths = np.zeros(len(streamlines), dtype=np.float64)
-
-        if streamlines.data.dtype == np.float32:
-            c_arclengths_from_arraysequence[float2d](
-                                    streamlines.data,
-                                    streamlines._offsets.astype(np.intp),
-                                    streamlines._lengths.astype(np.intp),
-                                    arclengths)
-        else:
-            c_arclengths_from_arraysequence[double2d](
-                                      streamlines.data,
-                                      streamlines._offsets.astype(np.intp),
-                                      streamlines._lengths.astype(np.intp),
-                                      arclengths)
-
-
-        return arclengths
+    if isinstance(streamlines, Streamlines) and len(streamlines) == 0:
+        return 0.0
 
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
@@ -125,56 +141,46 @@ def length(streamlines):
     if len(streamlines) == 0:
         return 0.0
 
-    dtype = streamlines[0].dtype
-    for streamline in streamlines:
-        if streamline.dtype != dtype:
-            dtype = None
-            break
+    packed = _packed_streamlines(streamlines)
+    if packed is not None:
+        # Streamlines sharing a dtype are measured in parallel
+        points, offsets, lengths = packed
+        arclengths = np.empty(len(lengths), dtype=np.float64)
+        # The kernel writes through a temporary view so the buffer info
+        # numpy caches for it is not kept alive with the result
+        out = arclengths.view()
+        set_num_threads(num_threads)
+        try:
+            if points.dtype == np.float32:
+                c_arclengths_from_arraysequence[float2d](points, offsets,
+                                                         lengths, out)
+            else:
+                c_arclengths_from_arraysequence[double2d](points, offsets,
+                                                          lengths, out)
+        finally:
+            restore_default_num_threads()
+        if only_one_streamlines:
+            return arclengths[0]
+        return arclengths
 
     # Allocate memory for each streamline length.
     streamlines_length = np.empty(len(streamlines), dtype=np.float64)
     cdef np.npy_intp i
 
-    if dtype is None:
-        # List of streamlines having different dtypes
-        for i in range(len(streamlines)):
-            dtype = streamlines[i].dtype
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
+    # Streamlines having different dtypes or dimensions
+    for i in range(len(streamlines)):
+        dtype = streamlines[i].dtype
+        # HACK: To avoid memleaks we have to recast with astype(dtype).
+        streamline = streamlines[i].astype(dtype)
+        if dtype != np.float32 and dtype != np.float64:
+            is_integer = dtype == np.int64 or dtype == np.uint64
+            dtype = np.float64 if is_integer else np.float32
             streamline = streamlines[i].astype(dtype)
-            if dtype != np.float32 and dtype != np.float64:
-                is_integer = dtype == np.int64 or dtype == np.uint64
-                dtype = np.float64 if is_integer else np.float32
-                streamline = streamlines[i].astype(dtype)
 
-            if dtype == np.float32:
-                streamlines_length[i] = c_length[float2d](streamline)
-            else:
-                streamlines_length[i] = c_length[double2d](streamline)
-
-    elif dtype == np.float32:
-        # All streamlines have composed of float32 points
-        for i in range(len(streamlines)):
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            streamline = streamlines[i].astype(dtype)
+        if dtype == np.float32:
             streamlines_length[i] = c_length[float2d](streamline)
-    elif dtype == np.float64:
-        # All streamlines are composed of float64 points
-        for i in range(len(streamlines)):
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            streamline = streamlines[i].astype(dtype)
-            streamlines_length[i] = c_length[double2d](streamline)
-    elif dtype == np.int64 or dtype == np.uint64:
-        # All streamlines are composed of int64 or uint64 points so convert
-        # them in float64 one at the time.
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(np.float64)
+        else:
             streamlines_length[i] = c_length[double2d](streamline)
-    else:
-        # All streamlines are composed of points with a dtype fitting in
-        # 32 bits so convert them in float32 one at the time.
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(np.float32)
-            streamlines_length[i] = c_length[float2d](streamline)
 
     if only_one_streamlines:
         return streamlines_length[0]
@@ -243,7 +249,21 @@ cdef void c_set_number_of_points(Streamline streamline, Streamline out) nogil:
     free(arclengths)
 
 
-def set_number_of_points(streamlines, nb_points=3):
+cdef void c_set_number_of_points_from_arraysequence(
+        Streamline points, np.npy_intp[:] offsets, np.npy_intp[:] lengths,
+        Streamline out):
+    cdef:
+        np.npy_intp i
+        np.npy_intp nb_points = out.shape[0] // offsets.shape[0]
+
+    with nogil:
+        for i in prange(offsets.shape[0], schedule='guided'):
+            c_set_number_of_points(
+                points[offsets[i]:offsets[i] + lengths[i]],
+                out[i * nb_points:(i + 1) * nb_points])
+
+
+def set_number_of_points(streamlines, nb_points=3, num_threads=None):
     ''' Change the number of points of streamlines
         (either by downsampling or upsampling)
 
@@ -257,11 +277,16 @@ def set_number_of_points(streamlines, nb_points=3):
        array representing x,y,z of N points in a streamline
     nb_points : int
        integer representing number of points wanted along the curve.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
 
     Returns
     -------
     modified_streamlines : one or a list of array-like shape (`nb_points`,3)
        array representing x,y,z of `nb_points` points that were interpolated.
+       :class:`dipy.tracking.Streamlines` are resampled into
+       :class:`dipy.tracking.Streamlines`.
 
     Examples
     --------
@@ -296,11 +321,38 @@ def set_number_of_points(streamlines, nb_points=3):
     if nb_points < 2:
         raise ValueError("nb_points must be at least 2")
 
-    dtype = streamlines[0].dtype
-    for streamline in streamlines:
-        if streamline.dtype != dtype:
-            dtype = None
+    packed = _packed_streamlines(streamlines)
+    if packed is not None:
+        # Streamlines sharing a dtype are resampled in parallel
+        points, offsets, lengths = packed
+        if lengths.min() < 2:
+            raise ValueError("All streamlines must have at least 2 points.")
+        out = np.empty((len(lengths) * nb_points, points.shape[1]),
+                       dtype=points.dtype)
+        # The kernel writes through a temporary view so the buffer info
+        # numpy caches for it is not kept alive with the result
+        out_view = out.view()
+        set_num_threads(num_threads)
+        try:
+            if points.dtype == np.float32:
+                c_set_number_of_points_from_arraysequence[float2d](
+                    points, offsets, lengths, out_view)
+            else:
+                c_set_number_of_points_from_arraysequence[double2d](
+                    points, offsets, lengths, out_view)
+        finally:
+            restore_default_num_threads()
+        if isinstance(streamlines, Streamlines):
+            return _from_packed(out,
+                                np.arange(len(lengths)) * nb_points,
+                                np.full(len(lengths), nb_points, np.intp))
+        out = out.reshape((len(lengths), nb_points, points.shape[1]))
+        if only_one_streamlines:
+            return out[0]
+        # Each streamline owns its memory, as in the list based path
+        return [s.copy() for s in out]
 
+    for streamline in streamlines:
         if len(streamline) < 2:
             raise ValueError("All streamlines must have at least 2 points.")
 
@@ -308,57 +360,23 @@ def set_number_of_points(streamlines, nb_points=3):
     modified_streamlines = []
     cdef np.npy_intp i
 
-    if dtype is None:
-        # List of streamlines having different dtypes
-        for i in range(len(streamlines)):
-            dtype = streamlines[i].dtype
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            streamline = streamlines[i].astype(dtype)
-            if dtype != np.float32 and dtype != np.float64:
-                dtype = np.float64 if dtype == np.int64 or dtype == np.uint64 else np.float32
-                streamline = streamline.astype(dtype)
-
-            modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=dtype)
-            if dtype == np.float32:
-                c_set_number_of_points[float2d](streamline, modified_streamline)
-            else:
-                c_set_number_of_points[double2d](streamline, modified_streamline)
-
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            modified_streamlines.append(modified_streamline.astype(dtype))
+    # Streamlines having different dtypes or dimensions
+    for i in range(len(streamlines)):
+        dtype = streamlines[i].dtype
+        # HACK: To avoid memleaks we have to recast with astype(dtype).
+        streamline = streamlines[i].astype(dtype)
+        if dtype != np.float32 and dtype != np.float64:
+            dtype = np.float64 if dtype == np.int64 or dtype == np.uint64 else np.float32
+            streamline = streamline.astype(dtype)
 
-    elif dtype == np.float32:
-        # All streamlines have composed of float32 points
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(dtype)
-            modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=streamline.dtype)
+        modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=dtype)
+        if dtype == np.float32:
             c_set_number_of_points[float2d](streamline, modified_streamline)
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            modified_streamlines.append(modified_streamline.astype(dtype))
-    elif dtype == np.float64:
-        # All streamlines are composed of float64 points
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(dtype)
-            modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=streamline.dtype)
-            c_set_number_of_points[double2d](streamline, modified_streamline)
-            # HACK: To avoid memleaks we have to recast with astype(dtype).
-            modified_streamlines.append(modified_streamline.astype(dtype))
-    elif dtype == np.int64 or dtype == np.uint64:
-        # All streamlines are composed of int64 or uint64 points so convert them in float64 one at the time
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(np.float64)
-            modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=streamline.dtype)
+        else:
             c_set_number_of_points[double2d](streamline, modified_streamline)
-            # HACK: To avoid memleaks we have to recast with astype(np.float64).
-            modified_streamlines.append(modified_streamline.astype(np.float64))
-    else:
-        # All streamlines are composed of points with a dtype fitting in 32bits so convert them in float32 one at the time
-        for i in range(len(streamlines)):
-            streamline = streamlines[i].astype(np.float32)
-            modified_streamline = np.empty((nb_points, streamline.shape[1]), dtype=streamline.dtype)
-            c_set_number_of_points[float2d](streamline, modified_streamline)
-            # HACK: To avoid memleaks we have to recast with astype(np.float32).
-            modified_streamlines.append(modified_streamline.astype(np.float32))
+
+        # HACK: To avoid memleaks we have to recast with astype(dtype).
+        modified_streamlines.append(modified_streamline.astype(dtype))
 
     if only_one_streamlines:
         return modified_streamlines[0]
@@ -469,7 +487,30 @@ cdef np.npy_intp c_compress_streamline(Streamline streamline, Streamline out,
     return nb_points
 
 
-def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
+cdef void c_compress_from_arraysequence(
+        Streamline points, np.npy_intp[:] offsets, np.npy_intp[:] lengths,
+        double tol_error, double max_segment_length, Streamline out,
+        np.npy_intp[:] out_offsets, np.npy_intp[:] out_lengths):
+    """ Compresses each streamline into its slot of `out`, which has as many
+        points as the streamline. """
+    cdef np.npy_intp i, j, d
+
+    with nogil:
+        for i in prange(offsets.shape[0], schedule='guided'):
+            if lengths[i] <= 2:
+                for j in range(lengths[i]):
+                    for d in range(points.shape[1]):
+                        out[out_offsets[i] + j, d] = points[offsets[i] + j, d]
+                out_lengths[i] = lengths[i]
+            else:
+                out_lengths[i] = c_compress_streamline(
+                    points[offsets[i]:offsets[i] + lengths[i]],
+                    out[out_offsets[i]:out_offsets[i] + lengths[i]],
+                    tol_error, max_segment_length)
+
+
+def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10,
+                         num_threads=None):
     """ Compress streamlines by linearization as in [Presseau15]_.
 
     The compression consists in merging consecutive segments that are
@@ -498,11 +539,15 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     max_segment_length : float (optional)
         Maximum length in mm of any given segment produced by the compression.
         The default is 10mm. (In [Presseau15]_, they used a value of `np.inf`).
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
 
     Returns
     -------
     compressed_streamlines : one or a list of array-like
-        Results of the linearization process.
+        Results of the linearization process. :class:`dipy.tracking.Streamlines`
+        are compressed into :class:`dipy.tracking.Streamlines`.
 
     Examples
     --------
@@ -548,6 +593,38 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     if len(streamlines) == 0:
         return []
 
+    packed = _packed_streamlines(streamlines)
+    if packed is not None:
+        # Streamlines sharing a dtype are compressed in parallel
+        points, offsets, lengths = packed
+        out_offsets = np.cumsum(lengths) - lengths
+        out = np.empty((lengths.sum(), points.shape[1]), dtype=points.dtype)
+        out_lengths = np.empty_like(lengths)
+        set_num_threads(num_threads)
+        try:
+            if points.dtype == np.float32:
+                c_compress_from_arraysequence[float2d](
+                    points, offsets, lengths, tol_error, max_segment_length,
+                    out, out_offsets, out_lengths)
+            else:
+                c_compress_from_arraysequence[double2d](
+                    points, offsets, lengths, tol_error, max_segment_length,
+                    out, out_offsets, out_lengths)
+        finally:
+            restore_default_num_threads()
+        # Pack the compressed streamlines
+        starts = np.cumsum(out_lengths) - out_lengths
+        index = (np.repeat(out_offsets - starts, out_lengths) +
+                 np.arange(out_lengths.sum()))
+        out = out[index]
+        if isinstance(streamlines, Streamlines):
+            return _from_packed(out, starts, out_lengths)
+        if only_one_streamlines:
+            return out
+        # Each streamline owns its memory, as in the list based path
+        return [out[i:i + n].copy() for i, n in zip(starts, out_lengths)]
+
+    # Streamlines having different dtypes or dimensions
     compressed_streamlines = []
     cdef np.npy_intp i
     for i in range(len(streamlines)):
@@ -581,3 +658,338 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
         return compressed_streamlines[0]
     else:
         return compressed_streamlines
+
+
+cdef void c_sample_point(double[:, :, :, ::1] data, double[:, ::1] affine,
+                         double px, double py, double pz, double* out) nogil:
+    """ Trilinear interpolation of `data` at the point mapped by `affine`.
+
+    Voxels outside of the volume count as zeros, as in
+    :func:`dipy.align.vector_fields.interpolate_scalar_3d`.
+    """
+    cdef:
+        np.npy_intp nx = data.shape[0], ny = data.shape[1]
+        np.npy_intp nz = data.shape[2], nc = data.shape[3]
+        np.npy_intp i, j, k, ii, jj, kk, c
+        double x, y, z, fx, fy, fz, w
+
+    for c in range(nc):
+        out[c] = 0
+    x = (affine[0, 0] * px + affine[0, 1] * py + affine[0, 2] * pz +
+         affine[0, 3])
+    y = (affine[1, 0] * px + affine[1, 1] * py + affine[1, 2] * pz +
+         affine[1, 3])
+    z = (affine[2, 0] * px + affine[2, 1] * py + affine[2, 2] * pz +
+         affine[2, 3])
+    if not (-1 < x < nx and -1 < y < ny and -1 < z < nz):
+        return
+
+    i = <np.npy_intp> floor(x)
+    j = <np.npy_intp> floor(y)
+    k = <np.npy_intp> floor(z)
+    fx = x - i
+    fy = y - j
+    fz = z - k
+    for ii in range(i, i + 2):
+        if ii < 0 or ii >= nx:
+            continue
+        for jj in range(j, j + 2):
+            if jj < 0 or jj >= ny:
+                continue
+            for kk in range(k, k + 2):
+                if kk < 0 or kk >= nz:
+                    continue
+                w = ((fx if ii > i else 1 - fx) *
+                     (fy if jj > j else 1 - fy) *
+                     (fz if kk > k else 1 - fz))
+                for c in range(nc):
+                    out[c] += w * data[ii, jj, kk, c]
+
+
+def _sample_packed(Streamline points, np.npy_intp[:] offsets,
+                   np.npy_intp[:] lengths, double[:, :, :, ::1] data,
+                   double[:, ::1] affine, reduce=None, nb_points=100,
+                   double[:, ::1] weights=None, num_threads=None):
+    """ Samples a volume at the packed points of streamlines.
+
+    This function is private because it's supposed to be called only by
+    `sample_volume` and `dipy.tracking.streamline.values_from_volume`.
+
+    Parameters
+    ----------
+    points : array (P, 3)
+        Points of the streamlines, packed one streamline after the other.
+    offsets, lengths : arrays (N,)
+        Index of the first point and number of points of each streamline.
+    data : array (X, Y, Z, C)
+        Volume to sample.
+    affine : array (4, 4)
+        Mapping from the points to the voxel coordinates of `data`.
+    reduce : None, 'mean' or 'profile'
+        See `sample_volume`.
+    nb_points : int
+        Number of nodes of the profile.
+    weights : array (N, `nb_points`)
+        Weight of each streamline at each node of the profile. Required with
+        ``reduce='profile'``.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    values : array (P, C), (N, C) or (`nb_points`, C)
+    """
+    cdef:
+        np.npy_intp n = lengths.shape[0], nc = data.shape[3]
+        np.npy_intp nb = nb_points
+        np.npy_intp s, i, k, c, tid, start, n_threads
+        int mode
+        double *values
+        double[:, ::1] out
+        double[:, :, ::1] profiles
+        char[::1] failed
+        Streamline resampled
+
+    if reduce is None:
+        mode = 0
+    elif reduce == 'mean':
+        mode = 1
+    elif reduce == 'profile':
+        mode = 2
+    else:
+        raise ValueError("reduce must be None, 'mean' or 'profile'")
+
+    set_num_threads(num_threads)
+    try:
+        n_threads = thread_count()
+        # Only the values at the points are kept without reduction
+        if mode == 0:
+            out = np.zeros((points.shape[0], nc))
+        else:
+            out = np.zeros((n if mode == 1 else 0, nc))
+        failed = np.zeros(n_threads, dtype=np.int8)
+        profiles = np.zeros((n_threads if mode == 2 else 0, nb, nc))
+        resampled = np.empty((n_threads * nb if mode == 2 else 0, 3),
+                             dtype=np.asarray(points).dtype)
+        with nogil, parallel():
+            tid = threadid()
+            values = <double *> malloc(nc * sizeof(double))
+            for s in prange(n, schedule='guided'):
+                if values == NULL:
+                    failed[tid] = 1
+                    continue
+                if mode == 0:
+                    for i in range(offsets[s], offsets[s] + lengths[s]):
+                        c_sample_point(data, affine, points[i, 0],
+                                       points[i, 1], points[i, 2], &out[i, 0])
+                elif mode == 1:
+                    for i in range(offsets[s], offsets[s] + lengths[s]):
+                        c_sample_point(data, affine, points[i, 0],
+                                       points[i, 1], points[i, 2], values)
+                        for c in range(nc):
+                            out[s, c] = out[s, c] + values[c]
+                    for c in range(nc):
+                        out[s, c] = out[s, c] / lengths[s]
+                else:
+                    # Each thread resamples into its own rows
+                    start = tid * nb
+                    c_set_number_of_points(
+                        points[offsets[s]:offsets[s] + lengths[s]],
+                        resampled[start:start + nb])
+                    for k in range(nb):
+                        c_sample_point(data, affine, resampled[start + k, 0],
+                                       resampled[start + k, 1],
+                                       resampled[start + k, 2], values)
+                        for c in range(nc):
+                            profiles[tid, k, c] = (profiles[tid, k, c] +
+                                                   weights[s, k] * values[c])
+            free(values)
+    finally:
+        restore_default_num_threads()
+    if np.any(failed):
+        raise MemoryError("could not allocate the sampling buffers")
+    if mode == 2:
+        return np.asarray(profiles).sum(0)
+    return np.asarray(out)
+
+
+def sample_volume(data, streamlines, affine=None, reduce=None, nb_points=100,
+                  weights=None, num_threads=None):
+    """ Trilinear interpolation of a volume along streamlines
+
+    All the points are sampled in a single compiled call. With `reduce`, the
+    values are averaged on the fly without keeping one value per point.
+
+    Parameters
+    ----------
+    data : 3D or 4D array
+        Scalar (3D) or vector (4D) volume. For 4D data, the interpolation is
+        done on the 3 spatial dimensions.
+    streamlines : one or a list of array-like shape (N,3), or Streamlines
+        Streamlines, in the space mapped by `affine`. They can be
+        :class:`dipy.tracking.Streamlines`.
+    affine : array (4, 4), optional
+        Transformation from the voxel coordinates of `data` to the space of
+        the streamlines. Default: identity.
+    reduce : None, 'mean' or 'profile', optional
+        If None (default), the values at each point are returned. With
+        'mean', the values are averaged along each streamline, which must
+        have at least one point. With
+        'profile', each streamline is resampled into `nb_points` nodes of
+        equal spacing and the values at each node are averaged over the
+        streamlines, as in tract profiles [Yeatman12]_.
+    nb_points : int, optional
+        Number of nodes of the profile. Default: 100.
+    weights : array (N,) or (N, `nb_points`), optional
+        Weight of each streamline, or of each streamline at each node, in the
+        profile. Weights are normalized to sum to one at each node. Default:
+        all streamlines weigh the same.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    values : one or a list of arrays, Streamlines, or array
+        If `reduce` is None, the values at each point of each streamline,
+        of shape (Ni,) or (Ni, C) for 3D or 4D data. They are
+        :class:`dipy.tracking.Streamlines` if `streamlines` are.
+        If `reduce` is 'mean', an array (N,) or (N, C).
+        If `reduce` is 'profile', an array (`nb_points`,) or (`nb_points`, C).
+
+    Notes
+    -----
+    Points outside of the volume are interpolated with zeros.
+
+    References
+    ----------
+    .. [Yeatman12] Yeatman J.D. et al., Tract Profiles of White Matter
+                   Properties: Automating Fiber-Tract Quantification, PLoS
+                   One 7(11), 2012.
+
+    Examples
+    --------
+    >>> from dipy.tracking.streamline import sample_volume
+    >>> import numpy as np
+    >>> data = np.arange(27.).reshape((3, 3, 3))
+    >>> streamlines = [np.array([[0, 0, 0], [0, 0, 1.5]]),
+    ...                np.array([[1, 1, 1], [2, 2, 2], [2, 2, 1]])]
+    >>> sample_volume(data, streamlines)
+    [array([ 0. ,  1.5]), array([ 13.,  26.,  25.])]
+    >>> sample_volume(data, streamlines, reduce='mean')
+    array([  0.75      ,  21.33333333])
+    """
+    only_one_streamlines = False
+    if type(streamlines) is np.ndarray:
+        only_one_streamlines = True
+        streamlines = [streamlines]
+
+    data = np.asarray(data)
+    if data.ndim == 3:
+        data = data[..., None]
+    elif data.ndim != 4:
+        raise ValueError("Data needs to have 3 or 4 dimensions")
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    if affine is None:
+        affine = np.eye(4)
+    vox_affine = np.ascontiguousarray(np.linalg.inv(affine))
+
+    packed = _packed_streamlines(streamlines) if len(streamlines) else None
+    if packed is None:
+        # Streamlines having different dtypes
+        lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+        offsets = np.cumsum(lengths) - lengths
+        points = np.zeros((0, 3))
+        if len(streamlines):
+            points = np.concatenate([np.asarray(s, dtype=np.float64)
+                                     for s in streamlines])
+    else:
+        points, offsets, lengths = packed
+
+    if reduce == 'mean' and len(lengths) and lengths.min() < 1:
+        raise ValueError("All streamlines must have at least 1 point.")
+    if reduce == 'profile':
+        if nb_points < 2:
+            raise ValueError("nb_points must be at least 2")
+        if len(lengths) and lengths.min() < 2:
+            raise ValueError("All streamlines must have at least 2 points.")
+        if weights is None:
+            weights = np.ones(len(lengths))
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = np.broadcast_to(weights.reshape((len(lengths), -1)),
+                                  (len(lengths), nb_points))
+        weights = np.ascontiguousarray(weights / weights.sum(0))
+
+    values = _sample_packed(points, offsets, lengths, data, vox_affine,
+                            reduce, nb_points, weights, num_threads)
+    if values.shape[1] == 1:
+        values = values[:, 0]
+    if reduce is not None:
+        return values
+    if isinstance(streamlines, Streamlines):
+        return _from_packed(values, offsets, lengths)
+    values = np.split(values, offsets[1:])
+    if only_one_streamlines:
+        return values[0]
+    return values
+
+
+cdef inline np.npy_intp _record_count(np.int32_t *counts, np.npy_intp pos,
+                                      bint swap) nogil:
+    cdef np.uint32_t n = <np.uint32_t> counts[pos]
+    if swap:
+        n = (((n & 0xff) << 24) | ((n & 0xff00) << 8) |
+             ((n >> 8) & 0xff00) | (n >> 24))
+    return <np.int32_t> n
+
+
+def _trk_index(np.ndarray counts, np.npy_intp stride,
+               np.npy_intp n_properties, bint swap=False):
+    """Finds the offset and length of each record of a TrackVis file
+
+    Parameters
+    ----------
+    counts : array of int32
+        The values of the file after its header, seen as integers. It may be
+        a read-only memory map; its records are walked without the GIL.
+    stride : int
+        Number of values of each point of a record.
+    n_properties : int
+        Number of values after the points of a record.
+    swap : bool, optional
+        Whether the integers have the other byte order.
+
+    Returns
+    -------
+    offsets, lengths : ndarray of intp
+        Index of the first value of each record and its number of points.
+    """
+    cdef:
+        np.npy_intp n_values, pos = 0, k = 0, n_records = 0, n
+        np.int32_t *values
+        np.npy_intp[::1] offsets, lengths
+
+    counts = np.ascontiguousarray(counts, dtype=np.int32)
+    values = <np.int32_t *> np.PyArray_DATA(counts)
+    n_values = counts.shape[0]
+    with nogil:
+        while pos < n_values:
+            n = _record_count(values, pos, swap)
+            if n < 0:
+                break
+            pos += 1 + n * stride + n_properties
+            n_records += 1
+    if pos != n_values:
+        raise ValueError("TrackVis file is truncated")
+
+    offsets = np.empty(n_records, dtype=np.intp)
+    lengths = np.empty(n_records, dtype=np.intp)
+    pos = 0
+    with nogil:
+        for k in range(n_records):
+            n = _record_count(values, pos, swap)
+            offsets[k] = pos + 1
+            lengths[k] = n
+            pos += 1 + n * stride + n_properties
+    return np.asarray(offsets), np.asarray(lengths)
@@ -1,12 +1,15 @@
 from __future__ import division, print_function, absolute_import
 
+from functools import partial
+
 import numpy as np
 import nose
 from nose.tools import (assert_true, assert_false, assert_equal,
-                        assert_almost_equal)
+                        assert_almost_equal, assert_raises)
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from dipy.tracking import metrics as tm
 from dipy.tracking import distances as pf
+from dipy.tracking import Streamlines
 
 
 def test_LSCv2():
@@ -165,6 +168,78 @@ def test_bundles_distances_mdf():
     assert_array_almost_equal(DM, DM2, 4)
 
 
+def test_bundles_distances_threads():
+    rng = np.random.RandomState(0)
+    tracksA = [rng.randn(rng.randint(2, 20), 3) * 10 for i in range(150)]
+    tracksB = [rng.randn(rng.randint(2, 20), 3) * 10 for i in range(70)]
+    for metric in ('avg', 'min', 'max'):
+        DM = np.array([[pf.mam_distances(ta, tb, metric) for tb in tracksB]
+                       for ta in tracksA])
+        for num_threads in [1, 2]:
+            DM2 = pf.bundles_distances_mam(Streamlines(tracksA), tracksB,
+                                           metric, num_threads=num_threads)
+            assert_equal(DM2.dtype, np.float64)
+            assert_array_almost_equal(DM2, DM, 4)
+            DM2 = pf.bundles_distances_mam(tracksA, tracksB, metric,
+                                           np.float32, num_threads)
+            assert_equal(DM2.dtype, np.float32)
+            assert_array_almost_equal(DM2, DM, 4)
+
+    tracksA = [rng.randn(5, 3) * 10 for i in range(150)]
+    tracksB = [rng.randn(5, 3) * 10 for i in range(70)]
+    DM = np.array([[min(np.sqrt(((ta - tb) ** 2).sum(1)).mean(),
+                        np.sqrt(((ta - tb[::-1]) ** 2).sum(1)).mean())
+                    for tb in tracksB] for ta in tracksA])
+    for num_threads in [1, 2]:
+        DM2 = pf.bundles_distances_mdf(tracksA, Streamlines(tracksB),
+                                       np.float32, num_threads)
+        assert_equal(DM2.dtype, np.float32)
+        assert_array_almost_equal(DM2, DM, 4)
+    assert_equal(pf.bundles_distances_mdf([], tracksB).shape, (0, 70))
+    assert_raises(ValueError, pf.bundles_distances_mdf, tracksA,
+                  tracksB + [np.zeros((4, 3))])
+    assert_raises(ValueError, pf.bundles_distances_mdf, tracksA, tracksB,
+                  np.int32)
+
+    # Many threads on many tiles give the distances of a single thread
+    tracksA = [rng.randn(12, 3) * 10 for i in range(1500)]
+    tracksB = [rng.randn(12, 3) * 10 for i in range(300)]
+    DM = pf.bundles_distances_mdf(tracksA, tracksB, num_threads=1)
+    assert_array_equal(pf.bundles_distances_mdf(tracksA, tracksB,
+                                                num_threads=16), DM)
+    DM = pf.bundles_distances_mam(tracksA, tracksB, num_threads=1)
+    assert_array_equal(pf.bundles_distances_mam(tracksA, tracksB,
+                                                num_threads=16), DM)
+
+
+def test_bundles_neighbors():
+    rng = np.random.RandomState(1)
+    tracksA = [rng.randn(6, 3) * 10 for i in range(100)]
+    tracksB = [rng.randn(6, 3) * 10 for i in range(80)]
+    for neighbors, distances in [
+            (pf.bundles_neighbors_mdf, pf.bundles_distances_mdf),
+            (partial(pf.bundles_neighbors_mam, metric='max'),
+             partial(pf.bundles_distances_mam, metric='max'))]:
+        DM = distances(tracksA, tracksB, dtype=np.float32)
+        for k, max_dist in [(5, None), (None, 12.), (3, 12.), (100, None)]:
+            # Blocks of 1 and 7 rows, and all the rows at once
+            for block_size in [1, 7 * 80, 10 ** 6]:
+                indptr, indices, dist = neighbors(tracksA, tracksB, k=k,
+                                                  max_dist=max_dist,
+                                                  num_threads=2,
+                                                  block_size=block_size)
+                assert_equal(len(indptr), 101)
+                for i in range(100):
+                    row = slice(indptr[i], indptr[i + 1])
+                    expected = np.sort(DM[i])
+                    if max_dist is not None:
+                        expected = expected[expected <= max_dist]
+                    assert_array_equal(dist[row], expected[:k])
+                    assert_array_equal(DM[i, indices[row]], dist[row])
+        assert_raises(ValueError, neighbors, tracksA, tracksB)
+        assert_raises(ValueError, neighbors, tracksA, tracksB, k=0)
+
+
 def test_mam_distances():
     xyz1 = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 0, 0]])
     xyz2 = np.array([[0, 1, 1], [1, 0, 1], [2, 3, -2]])
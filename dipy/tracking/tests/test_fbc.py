@@ -6,6 +6,7 @@ from dipy.viz.colormap import line_colors
 from dipy.viz import window, actor
 
 from dipy.core.sphere import Sphere
+from dipy.tracking import Streamlines
 
 import numpy as np
 import numpy.testing as npt
@@ -47,5 +48,22 @@ def test_fbc():
     # check mean RFBC against tested value
     npt.assert_almost_equal(np.mean(rfbc_orig), 1.0500466494329224)
 
+    # Packed streamlines and any number of threads give the same FBC
+    for num_threads in [1, 2]:
+        fbc = FBCMeasures(Streamlines(streamlines), k,
+                          num_threads=num_threads)
+        fbc_sl, clrs, rfbc = fbc.get_points_rfbc_thresholded(0,
+                                                             emphasis=0.01)
+        npt.assert_array_almost_equal(rfbc, rfbc_orig)
+        for sl, sl_orig in zip(fbc_sl, fbc_sl_orig):
+            npt.assert_array_equal(sl, sl_orig)
+        for c, c_orig in zip(clrs, clrs_orig):
+            npt.assert_array_almost_equal(c, c_orig)
+
+    # Short fibers are removed
+    fbc = FBCMeasures([np.zeros((3, 3))] + streamlines, k)
+    fbc_sl, clrs, rfbc = fbc.get_points_rfbc_thresholded(0, emphasis=0.01)
+    npt.assert_array_almost_equal(rfbc, rfbc_orig)
+
 if __name__ == '__main__':
     npt.run_module_suite()
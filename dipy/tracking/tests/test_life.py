@@ -126,6 +126,49 @@ def test_FiberModel_init():
                                               len(streamline)))
 
 
+def test_FiberModel_setup():
+    bvals, bvecs = (np.load(f) for f in dpd.get_data('small_64D')[1:])
+    gtab = dpg.gradient_table(bvals, bvecs)
+    FM = life.FiberModel(gtab)
+    evals = [0.0015, 0.0005, 0.0003]
+    rng = np.random.RandomState(3)
+    streamline = [np.cumsum(rng.randn(rng.randint(2, 20), 3), 0) + 10
+                  for i in range(30)]
+    affine = np.diag([0.9, 1.1, 1., 1.])
+    affine[:3, 3] = [1, 2, -3]
+    xform_sl = life.transform_streamlines(streamline, affine)
+    v2f, v2fn = life.voxel2streamline(xform_sl, True)
+    n_bvecs = np.sum(~gtab.b0s_mask)
+
+    sphere = dpd.get_sphere('symmetric362')
+    for this_sphere in [sphere, False]:
+        # The matrix sums the signal of the nodes of each fiber in each voxel
+        if this_sphere is False:
+            fiber_signal = [life.streamline_signal(s, gtab, evals)
+                            for s in xform_sl]
+        else:
+            SignalMaker = life.LifeSignalMaker(gtab, evals, this_sphere)
+            fiber_signal = [SignalMaker.streamline_signal(s)
+                            for s in xform_sl]
+        for dtype in [np.float64, np.float32]:
+            for num_threads in [1, 2, None]:
+                fiber_matrix, vox_coords = FM.setup(
+                    streamline, affine, evals, this_sphere, dtype=dtype,
+                    num_threads=num_threads)
+                npt.assert_equal(fiber_matrix.dtype, dtype)
+                expected = np.zeros((len(vox_coords), n_bvecs,
+                                     len(streamline)))
+                for v_idx, f_indices in v2f.items():
+                    for f_idx in f_indices:
+                        nodes = v2fn[f_idx][v_idx]
+                        expected[v_idx, :, f_idx] = \
+                            fiber_signal[f_idx][nodes].sum(0)
+                npt.assert_almost_equal(
+                    fiber_matrix.toarray(),
+                    expected.reshape((-1, len(streamline))),
+                    decimal=5 if dtype == np.float32 else 10)
+
+
 def test_FiberFit():
     data_file, bval_file, bvec_file = dpd.get_data('small_64D')
     data_ni = nib.load(data_file)
@@ -165,6 +208,16 @@ def test_FiberFit():
         this_data[vox_coords[:, 0], vox_coords[:, 1], vox_coords[:, 2]],
         fit.data)
 
+    # The scalable solvers find the least-squares weights
+    expected = opt.opt.nnls(fit.life_matrix.toarray(), fit.fit_data)[0]
+    for solver in ['fista', 'bb', opt.SparseNonNegativeLeastSquares()]:
+        solver_fit = life.FiberModel(gtab, solver=solver,
+                                     num_threads=2).fit(this_data, streamline)
+        npt.assert_almost_equal(solver_fit.beta, expected, decimal=3)
+        npt.assert_almost_equal(solver_fit.predict(), fit.predict(),
+                                decimal=-1)
+    npt.assert_raises(ValueError, life.FiberModel, gtab, 'newton')
+
 def test_fit_data():
     fdata, fbval, fbvec = dpd.get_data('small_25')
     gtab = grad.gradient_table(fbval, fbvec)
@@ -180,6 +180,54 @@ def test_eudx_boundaries():
     assert_equal(len(track), 3)
 
 
+def test_eudx_to_streamlines():
+    # The streamlines tracked in parallel are those of the iterator
+    fimg, fbvals, fbvecs = get_data('small_101D')
+    img = ni.load(fimg)
+    gtab = gradient_table(fbvals, fbvecs)
+    ten = TensorModel(gtab).fit(img.get_data())
+    ind = quantize_evecs(ten.evecs)
+    sphere = get_sphere('symmetric724')
+    edge = np.array(ten.fa.shape) - 1.
+
+    for seeds in [300, np.dot(np.random.rand(300, 3) * edge,
+                              img.affine[:3, :3].T) + img.affine[:3, 3]]:
+        eu = EuDX(a=ten.fa, ind=ind, seeds=seeds,
+                  odf_vertices=sphere.vertices, a_low=.2, affine=img.affine)
+        np.random.seed(1234)
+        expected = list(eu)
+        np.random.seed(1234)
+        streamlines, seed_ids = eu.to_streamlines(return_seed_ids=True,
+                                                  step=70, num_threads=2)
+        assert_equal(len(streamlines), len(expected))
+        assert_equal(len(seed_ids), len(expected))
+        for sl, exp in zip(streamlines, expected):
+            assert_array_almost_equal(sl, exp)
+        assert_true(np.all(np.diff(seed_ids) >= 0))
+
+    # Many threads on many seeds give the tracks of a single thread
+    seeds = np.random.rand(20000, 3) * edge
+    eu = EuDX(a=ten.fa, ind=ind, seeds=seeds, odf_vertices=sphere.vertices,
+              a_low=.2)
+    expected = eu.to_streamlines(num_threads=1)
+    for _ in range(3):
+        streamlines = eu.to_streamlines(num_threads=16)
+        assert_array_equal(streamlines._lengths, expected._lengths)
+        assert_array_equal(streamlines._data, expected._data)
+
+    # The seed of each streamline is one of its points
+    seeds = np.random.rand(100, 3) * edge
+    eu = EuDX(a=ten.fa, ind=ind, seeds=seeds, odf_vertices=sphere.vertices,
+              a_low=.2)
+    streamlines, seed_ids = eu.to_streamlines(return_seed_ids=True)
+    for sl, i in zip(streamlines, seed_ids):
+        assert_almost_equal(np.abs(sl - seeds[i]).sum(-1).min(), 0, 5)
+
+    eu = EuDX(a=ten.fa, ind=ind, seeds=[[-1., 1000000., 1000000.]],
+              odf_vertices=sphere.vertices, a_low=.2)
+    assert_raises(ValueError, eu.to_streamlines)
+
+
 def test_eudx_both_directions_errors():
     # Test error conditions for both directions function
     sphere = get_sphere('symmetric724')
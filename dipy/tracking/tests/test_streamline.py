@@ -8,12 +8,14 @@ import numpy.testing as npt
 from dipy.testing.memory import get_type_refcount
 from dipy.testing import assert_arrays_equal
 
-from nose.tools import assert_true, assert_equal, assert_almost_equal
+from nose.tools import (assert_true, assert_false, assert_equal,
+                        assert_almost_equal)
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_raises, run_module_suite)
 
 from dipy.tracking import Streamlines
 import dipy.tracking.utils as ut
+import dipy.align.vector_fields as vfu
 from dipy.tracking.streamline import (set_number_of_points,
                                       length,
                                       relist_streamlines,
@@ -24,7 +26,8 @@ from dipy.tracking.streamline import (set_number_of_points,
                                       compress_streamlines,
                                       select_by_rois,
                                       orient_by_rois,
-                                      values_from_volume)
+                                      values_from_volume,
+                                      sample_volume)
 
 
 streamline = np.array([[82.20181274,  91.36505890,  43.15737152],
@@ -516,6 +519,78 @@ def test_center_and_transform():
     assert_array_equal(streamlines3[0], B)
 
 
+def test_packed_streamlines():
+    rng = np.random.RandomState(0)
+    streamlines = [rng.rand(rng.randint(2, 10), 3) * 4 for i in range(20)]
+    packed = Streamlines(streamlines)
+    # A view whose points are not packed in the order of the streamlines
+    index = rng.permutation(len(streamlines))[:12]
+    view = packed[index]
+    listed = [streamlines[i] for i in index]
+
+    affine = np.eye(4)
+    affine[:3] = rng.rand(3, 4)
+    for sls, sls_list in [(packed, streamlines), (view, listed)]:
+        new = transform_streamlines(sls, affine)
+        assert_true(isinstance(new, Streamlines))
+        assert_arrays_equal(new, transform_streamlines(sls_list, affine))
+
+        new, center = center_streamlines(sls)
+        expected, expected_center = center_streamlines(sls_list)
+        assert_true(isinstance(new, Streamlines))
+        assert_array_almost_equal(center, expected_center)
+        for a, b in zip(new, expected):
+            assert_array_almost_equal(a, b)
+
+        points, offsets = unlist_streamlines(sls)
+        expected_points, expected_offsets = unlist_streamlines(sls_list)
+        assert_array_equal(points, expected_points)
+        assert_array_equal(offsets, expected_offsets)
+        assert_equal(offsets.dtype, np.dtype('i8'))
+
+        mask1 = np.zeros((5, 5, 5), dtype=bool)
+        mask1[1, 1, 1] = True
+        mask2 = np.zeros_like(mask1)
+        mask2[3, 2:, 2] = True
+        for mode, tol in [("any", 1), ("all", 2.5), ("either_end", 1),
+                          ("both_end", 2.5)]:
+            for include in [[True, True], [True, False], [False, True]]:
+                selection = list(select_by_rois(sls, [mask1, mask2], include,
+                                                mode=mode, tol=tol))
+                expected = list(select_by_rois(sls_list, [mask1, mask2],
+                                               include, mode=mode, tol=tol))
+                assert_arrays_equal(selection, expected)
+        assert_raises(ValueError, list,
+                      select_by_rois(sls, [mask1], [True], mode="nope"))
+
+        # Resampling, length and compression, in parallel or not
+        expected_resampled = [set_number_of_points(s, 7) for s in sls_list]
+        expected_lengths = [length(s) for s in sls_list]
+        expected_compressed = [compress_streamlines(s, 0.1, 1.)
+                               for s in sls_list]
+        for num_threads in [1, 2, None]:
+            resampled = set_number_of_points(sls, 7, num_threads=num_threads)
+            assert_true(isinstance(resampled, Streamlines))
+            assert_arrays_equal(resampled, expected_resampled)
+            assert_arrays_equal(set_number_of_points(sls_list, 7,
+                                                     num_threads=num_threads),
+                                expected_resampled)
+            assert_array_almost_equal(length(sls, num_threads=num_threads),
+                                      expected_lengths)
+            compressed = compress_streamlines(sls, 0.1, 1.,
+                                              num_threads=num_threads)
+            assert_true(isinstance(compressed, Streamlines))
+            assert_arrays_equal(compressed, expected_compressed)
+            assert_arrays_equal(compress_streamlines(sls_list, 0.1, 1.,
+                                                     num_threads=num_threads),
+                                expected_compressed)
+
+        # Lists of streamlines don't share memory
+        for out in [set_number_of_points(sls_list, 7),
+                    compress_streamlines(sls_list, 0.1, 1.)]:
+            assert_false(np.may_share_memory(out[0], out[1]))
+
+
 def test_select_random_streamlines():
     streamlines = [np.random.rand(10, 3),
                    np.random.rand(20, 3),
@@ -816,6 +891,27 @@ def test_select_by_rois():
                         streamlines[1]])
 
 
+def test_select_by_rois_index():
+    rng = np.random.RandomState(0)
+    shape = (10, 10, 10)
+    affine = np.diag([2., 2., 2., 1.])
+    streamlines = [2 * (rng.rand(3) * 10 + np.cumsum(rng.randn(8, 3), 0))
+                   for i in range(100)]
+    rois = np.zeros((3,) + shape, dtype=bool)
+    rois[0, 2:4, 2:4, 2:4] = True
+    rois[1, 7, 6:9, 5] = True
+    rois[2, 4:6, 4:6, :] = True
+    index = ut.StreamlineIndex(streamlines, shape, affine, brick_size=2)
+    for sl in (streamlines, Streamlines(streamlines)):
+        for include in ([True, True, False], [True, False, False]):
+            for mode in ["any", "all", "either_end", "both_end"]:
+                expected = list(select_by_rois(sl, rois, include, mode,
+                                               affine, tol=4))
+                result = list(select_by_rois(sl, rois, include, mode,
+                                             affine, tol=4, index=index))
+                assert_arrays_equal(result, expected)
+
+
 def test_orient_by_rois():
     streamlines = [np.array([[0, 0., 0],
                              [1, 0., 0.],
@@ -1023,5 +1119,54 @@ def test_values_from_volume():
     npt.assert_equal(values_from_volume(data4D, streamlines).shape, (10, 1, 2))
 
 
+def test_sample_volume():
+    rng = np.random.RandomState(42)
+    data = rng.rand(10, 11, 12, 2)
+    affine = np.diag([1.5, 1, 2, 1.])
+    affine[:3, 3] = [1, -2, 3]
+    streamlines = [rng.rand(rng.randint(2, 30), 3) * 14 - 1
+                   for i in range(50)]
+    vox_streamlines = ut.move_streamlines(streamlines, np.linalg.inv(affine))
+    expected = [np.stack([vfu.interpolate_scalar_3d(data[..., c], s)[0]
+                          for c in range(2)], -1) for s in vox_streamlines]
+    weights = rng.rand(len(streamlines))
+    resampled = set_number_of_points(streamlines, 20)
+
+    for num_threads in [1, 2, None]:
+        # Points outside of the volume are interpolated with zeros
+        values = sample_volume(data, streamlines, affine,
+                               num_threads=num_threads)
+        for v, e in zip(values, expected):
+            npt.assert_array_almost_equal(v, e)
+        values = sample_volume(data[..., 1], Streamlines(streamlines),
+                               affine, num_threads=num_threads)
+        npt.assert_(isinstance(values, Streamlines))
+        for v, e in zip(values, expected):
+            npt.assert_array_almost_equal(v, e[:, 1])
+
+        mean = sample_volume(data, streamlines, affine, reduce='mean',
+                             num_threads=num_threads)
+        npt.assert_array_almost_equal(mean, [e.mean(0) for e in expected])
+
+        profile = sample_volume(data, streamlines, affine, reduce='profile',
+                                nb_points=20, weights=weights,
+                                num_threads=num_threads)
+        node_values = np.array([sample_volume(data, s, affine)
+                                for s in resampled])
+        npt.assert_array_almost_equal(
+            profile, np.tensordot(weights / weights.sum(), node_values, 1))
+        profile = sample_volume(data[..., 0], streamlines, affine,
+                                reduce='profile', nb_points=20,
+                                num_threads=num_threads)
+        npt.assert_array_almost_equal(profile, node_values[..., 0].mean(0))
+
+    npt.assert_raises(ValueError, sample_volume, data, streamlines,
+                      reduce='median')
+    npt.assert_raises(ValueError, sample_volume, data,
+                      [np.zeros((1, 3))], reduce='profile')
+    npt.assert_raises(ValueError, sample_volume, data,
+                      [np.zeros((1, 3)), np.zeros((0, 3))], reduce='mean')
+
+
 if __name__ == '__main__':
     run_module_suite()
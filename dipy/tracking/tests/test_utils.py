@@ -4,6 +4,8 @@ from dipy.utils.six.moves import xrange
 
 import numpy as np
 import nose
+from nibabel.affines import apply_affine
+from nibabel.tmpdirs import InTemporaryDirectory
 
 from dipy.io.bvectxt import orientation_from_string
 from dipy.tracking.utils import (affine_for_trackvis, connectivity_matrix,
@@ -11,13 +13,17 @@ from dipy.tracking.utils import (affine_for_trackvis, connectivity_matrix,
                                  ndbincount, reduce_labels,
                                  reorder_voxels_affine, seeds_from_mask,
                                  random_seeds_from_mask, target,
+                                 seed_blocks_from_mask,
+                                 random_seed_blocks_from_mask,
                                  target_line_based, _rmi, unique_rows, near_roi,
                                  reduce_rois, path_length, flexi_tvis_affine,
-                                 get_flexi_tvis_affine, _min_at)
+                                 get_flexi_tvis_affine,
+                                 StreamlineIndex, StreamlineGraph)
 
 from dipy.tracking._utils import _to_voxel_coordinates
 
 import dipy.tracking.metrics as metrix
+from dipy.tracking import Streamlines
 
 from dipy.tracking.vox2track import streamline_mapping
 import numpy.testing as npt
@@ -77,6 +83,48 @@ def test_density_map():
     assert_array_equal(dm, expected)
 
 
+def test_density_map_packed():
+    rng = np.random.RandomState(0)
+    shape = (8, 9, 10)
+    affine = np.diag([2., 1., 0.5, 1.])
+    affine[:3, 3] = [1, -2, 3]
+    streamlines = [apply_affine(affine, rng.rand(rng.randint(1, 30), 3) *
+                                (np.array(shape) - 1)) for i in range(200)]
+    expected = np.zeros(shape, dtype=int)
+    for sl in streamlines:
+        vox = np.round(apply_affine(np.linalg.inv(affine), sl)).astype(int)
+        vox = np.unique(vox, axis=0)
+        expected[tuple(vox.T)] += 1
+    for sl in (streamlines, Streamlines(streamlines)):
+        for num_threads in [1, 2, 3, 16, None]:
+            dm = density_map(sl, shape, affine=affine,
+                             num_threads=num_threads)
+            assert_equal(dm.dtype.kind, 'i')
+            assert_array_equal(dm, expected)
+    # A view of Streamlines
+    dm = density_map(Streamlines(streamlines)[::2], shape, affine=affine)
+    assert_array_equal(dm, density_map(streamlines[::2], shape,
+                                       affine=affine))
+
+    # Weighted counts
+    weights = rng.rand(len(streamlines))
+    expected = sum(w * density_map([sl], shape, affine=affine)
+                   for w, sl in zip(weights, streamlines))
+    dm = density_map(streamlines, shape, affine=affine, weights=weights,
+                     num_threads=2)
+    assert_array_almost_equal(dm, expected)
+    assert_raises(ValueError, density_map, streamlines, shape, affine=affine,
+                  weights=weights[1:])
+
+    # Points outside the volume
+    assert_raises(IndexError, density_map, streamlines, (8, 9, 9),
+                  affine=affine)
+    assert_raises(IndexError, density_map, [np.array([[-1., 0, 0]])],
+                  shape, affine=np.eye(4))
+    assert_array_equal(density_map([], shape, affine=np.eye(4)),
+                       np.zeros(shape))
+
+
 def test_to_voxel_coordinates_precision():
     # To simplify tests, use an identity affine. This would be the result of
     # a call to _mapping_to_voxel with another identity affine.
@@ -219,6 +267,36 @@ def test_move_streamlines():
         assert_array_equal(a, b)
 
 
+def test_packed_streamlines():
+    rng = np.random.RandomState(0)
+    streamlines = [rng.rand(rng.randint(1, 10), 3) * 4 for i in range(20)]
+    index = rng.permutation(len(streamlines))[:12]
+    packed = Streamlines(streamlines)
+    view = packed[index]
+    listed = [streamlines[i] for i in index]
+    affine = np.eye(4)
+    affine[:3, 3] = (4, 5, 6)
+    mask = np.zeros((5, 5, 5), dtype=bool)
+    mask[1:3, 1, 1:3] = True
+
+    for sls, sls_list in [(packed, streamlines), (view, listed)]:
+        for a, b in zip(move_streamlines(sls, affine), sls_list):
+            assert_array_almost_equal(a, b + (4, 5, 6))
+        for include in [True, False]:
+            selection = list(target(sls, mask, np.eye(4), include=include))
+            expected = list(target(sls_list, mask, np.eye(4),
+                                   include=include))
+            assert_equal(len(selection), len(expected))
+            for a, b in zip(selection, expected):
+                assert_array_equal(a, b)
+        for mode in ["any", "all", "either_end", "both_end"]:
+            assert_array_equal(near_roi(sls, mask, tol=1, mode=mode),
+                               near_roi(sls_list, mask, tol=1, mode=mode))
+
+    bad = Streamlines([np.array([[0., 0, 0], [-2, 0, 0]])])
+    assert_raises(ValueError, list, target(bad, mask, np.eye(4)))
+
+
 def test_target():
     streamlines = [np.array([[0., 0., 0.],
                              [1., 0., 0.],
@@ -293,6 +371,70 @@ def _target(target_f, streamlines, voxel_both_true, voxel_one_true,
     assert_true(exclude[0] is streamlines[1])
 
 
+def test_streamline_index():
+    rng = np.random.RandomState(42)
+    shape = (12, 10, 8)
+    affine = np.diag([2., 1.5, 1., 1.])
+    affine[:3, 3] = [-3, 4, 10]
+    streamlines = []
+    for i in range(200):
+        start = rng.rand(3) * shape
+        steps = rng.randn(rng.randint(1, 15), 3) * 0.7
+        streamlines.append(apply_affine(affine, start + np.cumsum(steps, 0)))
+    # Keep the streamlines in the image for target
+    inside = []
+    for sl in streamlines:
+        vox = np.floor(apply_affine(np.linalg.inv(affine), sl) + 0.5)
+        if (vox >= 0).all() and (vox < shape).all():
+            inside.append(sl)
+    roi = np.zeros(shape, dtype=bool)
+    roi[3:5, 2:4, 4] = True
+    roi[8, 8, 1:3] = True
+
+    for brick_size in [1, 3]:
+        index = StreamlineIndex(streamlines, shape, affine, brick_size)
+        index_packed = StreamlineIndex(Streamlines(streamlines), shape,
+                                       affine, brick_size)
+        assert_array_equal(index._indptr, index_packed._indptr)
+        assert_array_equal(index._indices, index_packed._indices)
+        candidates = index.query(roi)
+        assert_true(0 < candidates.sum() < len(streamlines))
+        for sl in (Streamlines(streamlines), streamlines):
+            for mode in ["any", "all", "either_end", "both_end"]:
+                for tol in [None, 2., 5.]:
+                    assert_array_equal(
+                        near_roi(sl, roi, affine, tol, mode, index=index),
+                        near_roi(sl, roi, affine, tol, mode))
+
+        index = StreamlineIndex(inside, shape, affine, brick_size)
+        for sl in (Streamlines(inside), inside):
+            for include in [True, False]:
+                expected = list(target(sl, roi, affine, include))
+                result = list(target(sl, roi, affine, include, index=index))
+                assert_equal(len(result), len(expected))
+                for a, b in zip(result, expected):
+                    assert_array_equal(a, b)
+
+    # Exact voxels with bricks of one voxel
+    index = StreamlineIndex(inside, shape, affine)
+    assert_array_equal(
+        index.query(roi),
+        [len(list(target([sl], roi, affine))) == 1 for sl in inside])
+
+    # Save and load
+    with InTemporaryDirectory():
+        index.save('index.npz')
+        loaded = StreamlineIndex.load('index.npz')
+    assert_equal(loaded.shape, shape)
+    assert_array_equal(loaded.affine, affine)
+    assert_array_equal(loaded.query(roi, 3.), index.query(roi, 3.))
+
+    assert_raises(ValueError, index.query, roi[1:])
+    assert_raises(ValueError, near_roi, streamlines, roi, affine,
+                  index=index)
+    assert_raises(ValueError, StreamlineIndex, streamlines, shape, affine, 0)
+
+
 def test_near_roi():
     streamlines = [np.array([[0., 0., 0.9],
                              [1.9, 0., 0.],
@@ -567,6 +709,116 @@ def test_random_seeds_from_mask():
     assert_true(np.all((seeds > 1.5) & (seeds < 2.5)))
 
 
+def test_seed_blocks_from_mask():
+    rng = np.random.RandomState(0)
+    mask = rng.randint(0, 2, size=(10, 10, 10))
+    affine = np.diag([2., 3., 4., 1.])
+    affine[:3, 3] = [1, 2, 3]
+    expected = seeds_from_mask(mask, density=[2, 3, 1], affine=affine)
+    for block_size in [1, 5, 6, 1000, 10 ** 6]:
+        blocks = list(seed_blocks_from_mask(mask, [2, 3, 1], affine=affine,
+                                            block_size=block_size))
+        assert_true(all(len(b) <= block_size for b in blocks))
+        assert_array_almost_equal(np.concatenate(blocks), expected)
+    # The deprecated voxel_size
+    expected = seeds_from_mask(mask, [2, 3, 1], [1.1, 1.1, 2.5])
+    blocks = seed_blocks_from_mask(mask, [2, 3, 1], [1.1, 1.1, 2.5],
+                                   block_size=7)
+    assert_array_almost_equal(np.concatenate(list(blocks)), expected)
+
+    mask[:] = 0
+    assert_equal(list(seed_blocks_from_mask(mask)), [])
+    assert_raises(ValueError, list, seed_blocks_from_mask(mask, [1, 2]))
+    assert_raises(ValueError, list, seed_blocks_from_mask(mask,
+                                                          block_size=0))
+
+
+def test_random_seed_blocks_from_mask():
+    rng = np.random.RandomState(0)
+    mask = rng.randint(0, 2, size=(4, 6, 3)).astype(bool)
+
+    def seeds(*args, **kwargs):
+        return np.concatenate(list(random_seed_blocks_from_mask(*args,
+                                                                **kwargs)))
+
+    s = seeds(mask, 24, random_seed=1)
+    assert_equal(mask.sum() * 24, len(s))
+    # Grouped by voxel, in each voxel of the mask
+    assert_array_equal(np.round(s).astype(int),
+                       np.repeat(np.argwhere(mask), 24, axis=0))
+    # Reproducible whatever the size of the blocks
+    big = 3 * 2 ** 16 + 5
+    s = seeds(mask, big, False, random_seed=2)
+    assert_equal(len(s), big)
+    for block_size in [7, 2 ** 16, 10 ** 6]:
+        assert_array_equal(seeds(mask, big, False, random_seed=2,
+                                 block_size=block_size), s)
+    assert_true(np.any(seeds(mask, big, False, random_seed=3) != s))
+
+    affine = np.diag([2., 3., 4., 1.])
+    affine[:3, 3] = [1, 2, 3]
+    assert_array_almost_equal(seeds(mask, 5, affine=affine, random_seed=4),
+                              apply_affine(affine,
+                                           seeds(mask, 5, random_seed=4)))
+
+    # Seeding densities from a weight map
+    weights = np.zeros(mask.shape)
+    weights[0, 0, 0] = 1.5
+    weights[1, 2, 0] = .5
+    mask[0, 0, 0] = mask[1, 2, 0] = True
+    s = seeds(mask, 100, weights=weights, random_seed=5)
+    counts = np.round(s).astype(int)
+    assert_equal(len(s), 200)
+    assert_equal((counts == [0, 0, 0]).all(1).sum(), 150)
+    assert_equal((counts == [1, 2, 0]).all(1).sum(), 50)
+    s = seeds(mask, 10, weights=weights * .1, random_seed=5)
+    assert_true(len(s) in [2, 3])
+    s = seeds(mask, 1000, False, weights=weights, random_seed=6)
+    in_000 = (np.round(s) == 0).all(1).sum()
+    assert_equal(len(s), 1000)
+    assert_true(650 < in_000 < 850)
+
+    assert_raises(ValueError, list,
+                  random_seed_blocks_from_mask(mask, weights=-weights))
+    assert_raises(ValueError, list,
+                  random_seed_blocks_from_mask(mask, weights=weights[0]))
+    assert_raises(ValueError, list,
+                  random_seed_blocks_from_mask(mask, block_size=0))
+
+
+def test_connectivity_matrix_packed():
+    rng = np.random.RandomState(1)
+    labels = rng.randint(0, 6, (5, 6, 7))
+    streamlines = [rng.rand(rng.randint(1, 10), 3) * [4, 5, 6]
+                   for i in range(100)]
+    weights = rng.rand(len(streamlines))
+    for symmetric in [True, False]:
+        matrix, mapping = connectivity_matrix(streamlines, labels,
+                                              affine=np.eye(4),
+                                              symmetric=symmetric,
+                                              return_mapping=True)
+        matrix_p, mapping_p = connectivity_matrix(Streamlines(streamlines),
+                                                  labels, affine=np.eye(4),
+                                                  symmetric=symmetric,
+                                                  return_mapping=True)
+        assert_array_equal(matrix_p, matrix)
+        assert_equal(dict(mapping_p), dict(mapping))
+        assert_equal(sum(len(v) for v in mapping.values()),
+                     len(streamlines))
+        for (a, b), ids in mapping.items():
+            assert_equal(ids, sorted(ids))
+
+        # Weighted
+        weighted = connectivity_matrix(streamlines, labels, affine=np.eye(4),
+                                       symmetric=symmetric, weights=weights)
+        expected = np.zeros(matrix.shape)
+        for (a, b), ids in mapping.items():
+            expected[a, b] += weights[ids].sum()
+        if symmetric:
+            expected = np.maximum(expected, expected.T)
+        assert_array_almost_equal(weighted, expected)
+
+
 def test_connectivity_matrix_shape():
     # Labels: z-planes have labels 0,1,2
     labels = np.zeros((3, 3, 3), dtype=int)
@@ -715,12 +967,43 @@ def test_path_length():
     npt.assert_array_almost_equal(pl, -12.)
 
 
-def test_min_at():
-    k = np.array([3, 2, 2, 2, 1, 1, 1])
-    values = np.array([10., 1, 2, 3, 31, 21, 11])
-    i = np.zeros(k.shape, int)
-    j = np.zeros(k.shape, int)
-    a = np.zeros([1, 1, 4]) + 100.
-
-    _min_at(a, (i, j, k), values)
-    npt.assert_array_equal(a, [[[100, 11, 1, 10]]])
+def test_streamline_graph():
+    i = np.arange(10)
+    x = i.astype(float)
+    z = np.zeros(10)
+    # Two streamlines crossing at [5, 5, 0], the second one with two points
+    # in each voxel
+    second = np.array([np.repeat(x, 2), 10 - np.repeat(x, 2),
+                       np.zeros(20)]).T
+    second[1::2, 0] += .4
+    streamlines = [np.array([x, x, z]).T, second]
+    shape = (10, 11, 1)
+    graph = StreamlineGraph(streamlines, shape)
+    graph_packed = StreamlineGraph(Streamlines(streamlines), shape)
+
+    aoi = np.zeros(shape, dtype=bool)
+    aoi[0, 0, 0] = True
+    pl = graph.path_length(aoi)
+    npt.assert_array_equal(pl, graph_packed.path_length(aoi))
+    npt.assert_array_equal(pl, path_length(streamlines, aoi, np.eye(4)))
+    npt.assert_array_almost_equal(pl[i, i, 0], x * np.sqrt(2))
+    # The second streamline is reached through the crossing. Its steps
+    # between voxels start from the first point in each voxel.
+    step = .4 + np.sqrt(.6 ** 2 + 1)
+    npt.assert_array_almost_equal(pl[i, 10 - i, 0],
+                                  5 * np.sqrt(2) + np.abs(x - 5) * step)
+    npt.assert_equal(pl[0, 1, 0], -1)
+
+    # Several areas of interest on the same graph
+    aoi[:] = False
+    aoi[9, 9, 0] = True
+    pl = graph.path_length(aoi, fill_value=np.inf)
+    npt.assert_array_almost_equal(pl[i, i, 0], (9 - x) * np.sqrt(2))
+    npt.assert_equal(pl[0, 1, 0], np.inf)
+    aoi[:] = False
+    npt.assert_array_equal(graph.path_length(aoi), -1)
+
+    assert_raises(ValueError, graph.path_length, np.zeros((10, 10, 1)))
+    assert_raises(IndexError, StreamlineGraph, streamlines, (9, 9, 1))
+    assert_raises(IndexError, StreamlineGraph, [-x[:, None] * [1, 1, 1]],
+                  shape)
@@ -52,6 +52,8 @@ from functools import wraps
 from warnings import warn
 
 from nibabel.affines import apply_affine
+from scipy.ndimage import maximum_filter
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 
 from dipy.core.geometry import dist_to_corner
@@ -62,12 +64,15 @@ from dipy.utils.six.moves import xrange, map
 import numpy as np
 from numpy import (asarray, ceil, dot, empty, eye, sqrt)
 from dipy.io.bvectxt import ornt_mapping
-from dipy.tracking import metrics
-from dipy.tracking.vox2track import _streamlines_in_mask
+from dipy.tracking import metrics, Streamlines
+from dipy.tracking.vox2track import (_streamlines_in_mask, _brick_index,
+                                     _density_map, _voxel_graph,
+                                     _graph_path_length)
 from dipy.testing import setup_test
 
 # Import helper functions shared with vox2track
-from dipy.tracking._utils import (_mapping_to_voxel, _to_voxel_coordinates)
+from dipy.tracking._utils import (_mapping_to_voxel, _to_voxel_coordinates,
+                                  _packed, _from_packed, _reduce_packed)
 from dipy.io.bvectxt import orientation_from_string
 import nibabel as nib
 
@@ -96,7 +101,22 @@ except ImportError:
     ravel_multi_index = _rmi
 
 
-def density_map(streamlines, vol_dims, voxel_size=None, affine=None):
+def _packed_points(streamlines):
+    """Points, offsets and lengths of a sequence or `Streamlines`"""
+    if isinstance(streamlines, Streamlines):
+        return _packed(streamlines)
+    streamlines = list(streamlines)
+    lengths = np.array([len(sl) for sl in streamlines], dtype=np.intp)
+    offsets = np.cumsum(lengths) - lengths
+    if len(streamlines):
+        points = np.concatenate(streamlines)
+    else:
+        points = np.zeros((0, 3))
+    return points, offsets, lengths
+
+
+def density_map(streamlines, vol_dims, voxel_size=None, affine=None,
+                weights=None, num_threads=None):
     """Counts the number of unique streamlines that pass through each voxel.
 
     Parameters
@@ -111,11 +131,18 @@ def density_map(streamlines, vol_dims, voxel_size=None, affine=None):
         This argument is deprecated.
     affine : array_like (4, 4)
         The mapping from voxel coordinates to streamline points.
+    weights : array_like (N,), optional
+        Weight of each streamline. If given, the weights of the streamlines
+        passing through each voxel are summed instead of counted.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
 
     Returns
     -------
     image_volume : ndarray, shape=vol_dims
-        The number of streamline points in each voxel of volume.
+        The number of streamline points in each voxel of volume, or the sum
+        of their weights.
 
     Raises
     ------
@@ -129,21 +156,29 @@ def density_map(streamlines, vol_dims, voxel_size=None, affine=None):
     [0,0,2] passes through [0,0,1]. Consider subsegmenting the streamlines when
     the edges of the voxels are smaller than the steps of the streamlines.
 
+    The streamlines are mapped to the volume in parallel, each thread summing
+    into its own slab of the volume.
+
     """
     lin_T, offset = _mapping_to_voxel(affine, voxel_size)
-    counts = np.zeros(vol_dims, 'int')
-    for sl in streamlines:
-        inds = _to_voxel_coordinates(sl, lin_T, offset)
-        i, j, k = inds.T
-        # this takes advantage of the fact that numpy's += operator only
-        # acts once even if there are repeats in inds
-        counts[i, j, k] += 1
+    offset = np.zeros(3) + offset
+    points, offsets, lengths = _packed_points(streamlines)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != lengths.shape:
+            raise ValueError("weights must have one value per streamline")
+    vol_dims = tuple(int(i) for i in vol_dims)
+    counts = _density_map(np.ascontiguousarray(points, dtype=float),
+                          offsets, lengths, np.ascontiguousarray(lin_T),
+                          offset, vol_dims, weights, num_threads)
+    if weights is None:
+        return counts.astype('int')
     return counts
 
 
 def connectivity_matrix(streamlines, label_volume, voxel_size=None,
                         affine=None, symmetric=True, return_mapping=False,
-                        mapping_as_streamlines=False):
+                        mapping_as_streamlines=False, weights=None):
     """Counts the streamlines that start and end at each label pair.
 
     Parameters
@@ -166,12 +201,15 @@ def connectivity_matrix(streamlines, label_volume, voxel_size=None,
     mapping_as_streamlines : bool, False by default
         If True voxel indices map to lists of streamline objects. Otherwise
         voxel indices map to lists of integers.
+    weights : array_like (N,), optional
+        Weight of each streamline. If given, the weights of the streamlines
+        connecting each pair of regions are summed instead of counted.
 
     Returns
     -------
     matrix : ndarray
         The number of connection between each pair of regions in
-        `label_volume`.
+        `label_volume`, or the sum of their weights.
     mapping : defaultdict(list)
         ``mapping[i, j]`` returns all the streamlines that connect region `i`
         to region `j`. If `symmetric` is True mapping will only have one key
@@ -192,7 +230,12 @@ def connectivity_matrix(streamlines, label_volume, voxel_size=None,
     if return_mapping and mapping_as_streamlines:
         streamlines = list(streamlines)
     # take the first and last point of each streamline
-    endpoints = [sl[0::len(sl)-1] for sl in streamlines]
+    if isinstance(streamlines, Streamlines):
+        points, offsets, lengths = _packed(streamlines)
+        endpoints = np.stack([points[offsets],
+                              points[offsets + lengths - 1]], 1)
+    else:
+        endpoints = [(sl[0], sl[-1]) for sl in streamlines]
 
     # Map the streamlines coordinates to voxel coordinates
     lin_T, offset = _mapping_to_voxel(affine, voxel_size)
@@ -204,19 +247,26 @@ def connectivity_matrix(streamlines, label_volume, voxel_size=None,
     if symmetric:
         endlabels.sort(0)
     mx = label_volume.max() + 1
-    matrix = ndbincount(endlabels, shape=(mx, mx))
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != endlabels.shape[1:]:
+            raise ValueError("weights must have one value per streamline")
+    matrix = ndbincount(endlabels, weights=weights, shape=(mx, mx))
     if symmetric:
         matrix = np.maximum(matrix, matrix.T)
 
     if return_mapping:
+        # Group the streamlines by pair of labels with a stable sort
+        pairs = np.ravel_multi_index(endlabels, (mx, mx))
+        order = np.argsort(pairs, kind='mergesort')
+        keys, starts = np.unique(pairs[order], return_index=True)
         mapping = defaultdict(list)
-        for i, (a, b) in enumerate(endlabels.T):
-            mapping[a, b].append(i)
-
-        # Replace each list of indices with the streamlines they index
-        if mapping_as_streamlines:
-            for key in mapping:
-                mapping[key] = [streamlines[i] for i in mapping[key]]
+        for key, ids in zip(keys, np.split(order, starts[1:])):
+            if mapping_as_streamlines:
+                mapping[np.unravel_index(key, (mx, mx))] = [
+                    streamlines[i] for i in ids]
+            else:
+                mapping[np.unravel_index(key, (mx, mx))] = ids.tolist()
 
         # Return the mapping matrix and the mapping
         return matrix, mapping
@@ -348,6 +398,27 @@ def subsegment(streamlines, max_segment_length):
         yield output_sl
 
 
+# Number of seeds drawn from each random generator by
+# random_seed_blocks_from_mask
+_SEED_CHUNK = 2 ** 16
+
+
+def _check_density(density):
+    density = asarray(density, int)
+    if density.size == 1:
+        return np.repeat(density.ravel(), 3)
+    elif density.shape != (3,):
+        raise ValueError("density should be in integer array of shape (3,)")
+    return density
+
+
+def _apply_affine_to_seeds(seeds, affine):
+    if affine is not None:
+        seeds = np.dot(seeds, affine[:3, :3].T)
+        seeds += affine[:3, 3]
+    return seeds
+
+
 def seeds_from_mask(mask, density=[1, 1, 1], voxel_size=None, affine=None):
     """Creates seeds for fiber tracking from a binary mask.
 
@@ -404,13 +475,7 @@ def seeds_from_mask(mask, density=[1, 1, 1], voxel_size=None, affine=None):
     if mask.ndim != 3:
         raise ValueError('mask cannot be more than 3d')
 
-    density = asarray(density, int)
-    if density.size == 1:
-        d = density
-        density = np.empty(3, dtype=int)
-        density.fill(d)
-    elif density.shape != (3,):
-        raise ValueError("density should be in integer array of shape (3,)")
+    density = _check_density(density)
 
     # Grid of points between -.5 and .5, centered at 0, with given density
     grid = np.mgrid[0:density[0], 0:density[1], 0:density[2]]
@@ -532,6 +597,191 @@ def random_seeds_from_mask(mask, seeds_count=1, seed_count_per_voxel=True,
     return seeds
 
 
+def seed_blocks_from_mask(mask, density=[1, 1, 1], voxel_size=None,
+                          affine=None, block_size=100000):
+    """Generates the seeds of ``seeds_from_mask`` block by block.
+
+    Only one block of seeds is in memory at a time, so that any number of
+    seeds can be streamed to a tracker.
+
+    Parameters
+    ----------
+    mask : binary 3d array_like
+        A binary array specifying where to place the seeds for fiber tracking.
+    density : int or array_like (3,)
+        Specifies the number of seeds to place along each dimension. A
+        ``density`` of `2` is the same as ``[2, 2, 2]`` and will result in a
+        total of 8 seeds per voxel.
+    voxel_size :
+        This argument is deprecated.
+    affine : array, (4, 4)
+        The mapping between voxel indices and the point space for seeds. A
+        seed point at the center the voxel ``[i, j, k]`` will be represented as
+        ``[x, y, z]`` where ``[x, y, z, 1] == np.dot(affine, [i, j, k , 1])``.
+    block_size : int
+        The maximum number of seeds of each block.
+
+    Yields
+    ------
+    seeds : array (N, 3)
+        The next seeds, in the order of ``seeds_from_mask``.
+
+    See Also
+    --------
+    seeds_from_mask, random_seed_blocks_from_mask
+
+    Examples
+    --------
+    >>> mask = np.zeros((3,3,3), 'bool')
+    >>> mask[0,0,0] = mask[0,1,2] = 1
+    >>> for seeds in seed_blocks_from_mask(mask, [1,1,2], block_size=3):
+    ...     print(seeds)
+    [[ 0.    0.   -0.25]
+     [ 0.    0.    0.25]
+     [ 0.    1.    1.75]]
+    [[ 0.    1.    2.25]]
+
+    The blocks can be tracked one seed after the other with
+    ``itertools.chain.from_iterable``.
+    """
+    mask = np.array(mask, dtype=bool, copy=False, ndmin=3)
+    if mask.ndim != 3:
+        raise ValueError('mask cannot be more than 3d')
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    density = _check_density(density)
+
+    grid = np.mgrid[0:density[0], 0:density[1], 0:density[2]]
+    grid = grid.T.reshape((-1, 3))
+    grid = grid / density
+    grid += (.5 / density - .5)
+
+    voxels = np.flatnonzero(mask)
+    n_grid = len(grid)
+    n_seeds = len(voxels) * n_grid
+    for start in xrange(0, n_seeds, block_size):
+        index = np.arange(start, min(start + block_size, n_seeds))
+        where = np.array(np.unravel_index(voxels[index // n_grid],
+                                          mask.shape)).T
+        seeds = where + grid[index % n_grid]
+        if affine is None and voxel_size is not None:
+            # Use voxel_size to move seeds into trackvis space
+            seeds += .5
+            seeds *= voxel_size
+        yield _apply_affine_to_seeds(seeds, affine)
+
+
+def random_seed_blocks_from_mask(mask, seeds_count=1,
+                                 seed_count_per_voxel=True, affine=None,
+                                 weights=None, random_seed=None,
+                                 block_size=100000):
+    """Generates randomly placed seeds block by block.
+
+    Only one block of seeds is in memory at a time, so that any number of
+    seeds can be streamed to a tracker. The seeds are grouped by voxel, in
+    the order of the voxels of ``mask``.
+
+    Parameters
+    ----------
+    mask : binary 3d array_like
+        A binary array specifying where to place the seeds for fiber tracking.
+    seeds_count : int
+        The number of seeds to generate. If ``seed_count_per_voxel`` is True,
+        specifies the number of seeds to place in each voxel. Otherwise,
+        specifies the total number of seeds to place in the mask.
+    seed_count_per_voxel: bool
+        If True, seeds_count is per voxel, else seeds_count is the total number
+        of seeds.
+    affine : array, (4, 4)
+        The mapping between voxel indices and the point space for seeds. A
+        seed point at the center the voxel ``[i, j, k]`` will be represented as
+        ``[x, y, z]`` where ``[x, y, z, 1] == np.dot(affine, [i, j, k , 1])``.
+    weights : 3d array_like, optional
+        Non-negative seeding density of each voxel, with the shape of ``mask``.
+        If ``seed_count_per_voxel`` is True, the number of seeds of a voxel is
+        ``seeds_count`` times its weight, rounded up or down at random so
+        that the expected number of seeds is exact. Otherwise the
+        ``seeds_count`` seeds are drawn in the voxels with probabilities
+        proportional to the weights. Default: 1 in each voxel of ``mask``.
+    random_seed : int, optional
+        Seed of the random number generator. The seeds are the same for the
+        same ``random_seed``, whatever ``block_size``. If None, a seed is
+        drawn from ``np.random``.
+    block_size : int
+        The maximum number of seeds of each block.
+
+    Yields
+    ------
+    seeds : array (N, 3)
+        The next seeds.
+
+    See Also
+    --------
+    random_seeds_from_mask, seed_blocks_from_mask
+
+    Examples
+    --------
+    >>> mask = np.zeros((3,3,3), 'bool')
+    >>> mask[0,0,0] = mask[0,1,2] = 1
+    >>> weights = np.zeros((3,3,3))
+    >>> weights[0,1,2] = 2
+    >>> blocks = random_seed_blocks_from_mask(mask, 3, weights=weights,
+    ...                                       random_seed=1, block_size=4)
+    >>> [len(seeds) for seeds in blocks]
+    [4, 2]
+    """
+    mask = np.array(mask, dtype=bool, copy=False, ndmin=3)
+    if mask.ndim != 3:
+        raise ValueError('mask cannot be more than 3d')
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer")
+    voxels = np.flatnonzero(mask)
+    if weights is None:
+        weights = np.ones(len(voxels))
+    else:
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != mask.shape:
+            raise ValueError("weights must have the shape of mask")
+        weights = weights.ravel()[voxels]
+        if (weights < 0).any():
+            raise ValueError("weights must be non-negative")
+    if random_seed is None:
+        random_seed = np.random.randint(np.iinfo(np.int32).max)
+
+    # The counts use the generator of chunk 0 and the positions the
+    # generator of chunks 1, 2... of _SEED_CHUNK seeds, so that blocks of
+    # any size give the same seeds
+    rng = np.random.RandomState([random_seed, 0])
+    if seed_count_per_voxel:
+        counts = weights * seeds_count
+        counts = np.floor(counts + rng.random_sample(len(counts)))
+        counts = counts.astype(np.int64)
+    elif weights.sum() > 0:
+        counts = rng.multinomial(seeds_count, weights / weights.sum())
+    else:
+        counts = np.zeros(len(voxels), dtype=np.int64)
+    ends = np.cumsum(counts)
+    n_seeds = ends[-1] if len(ends) else 0
+
+    chunk = None
+    for start in xrange(0, n_seeds, block_size):
+        stop = min(start + block_size, n_seeds)
+        index = np.arange(start, stop)
+        where = np.array(np.unravel_index(
+            voxels[np.searchsorted(ends, index, 'right')], mask.shape)).T
+        offsets = np.empty((stop - start, 3))
+        for c in xrange(start // _SEED_CHUNK, (stop - 1) // _SEED_CHUNK + 1):
+            if chunk is None or chunk[0] != c:
+                rng = np.random.RandomState([random_seed, c + 1])
+                chunk = c, rng.random_sample((_SEED_CHUNK, 3))
+            lo = max(start, c * _SEED_CHUNK)
+            hi = min(stop, (c + 1) * _SEED_CHUNK)
+            offsets[lo - start:hi - start] = \
+                chunk[1][lo - c * _SEED_CHUNK:hi - c * _SEED_CHUNK]
+        seeds = where + offsets - .5
+        yield _apply_affine_to_seeds(seeds, affine)
+
+
 def _with_initialize(generator):
     """Allows one to write a generator with initialization code.
 
@@ -547,15 +797,34 @@ def _with_initialize(generator):
     return helper
 
 
+def _in_target(streamlines, target_mask, lin_T, offset):
+    """Whether each streamline of a sequence or `Streamlines` has points in
+    `target_mask`"""
+    try:
+        if isinstance(streamlines, Streamlines):
+            points, offsets, lengths = _packed(streamlines)
+            i, j, k = _to_voxel_coordinates(points, lin_T, offset).T
+            return _reduce_packed(np.logical_or, target_mask[i, j, k],
+                                  offsets, lengths, False)
+        state = np.zeros(len(streamlines), dtype=bool)
+        for idx, sl in enumerate(streamlines):
+            i, j, k = _to_voxel_coordinates(sl, lin_T, offset).T
+            state[idx] = target_mask[i, j, k].any()
+        return state
+    except IndexError:
+        raise ValueError("streamlines points are outside of target_mask")
+
+
 @_with_initialize
-def target(streamlines, target_mask, affine, include=True):
+def target(streamlines, target_mask, affine, include=True, index=None):
     """Filters streamlines based on whether or not they pass through an ROI.
 
     Parameters
     ----------
     streamlines : iterable
         A sequence of streamlines. Each streamline should be a (N, 3) array,
-        where N is the length of the streamline.
+        where N is the length of the streamline. The points of `Streamlines`
+        are all mapped to the mask at once.
     target_mask : array-like
         A mask used as a target. Non-zero values are considered to be within
         the target region.
@@ -564,6 +833,9 @@ def target(streamlines, target_mask, affine, include=True):
     include : bool, default True
         If True, streamlines passing through `target_mask` are kept. If False,
         the streamlines not passing through `target_mask` are kept.
+    index : StreamlineIndex, optional
+        Index of `streamlines` in the grid of `target_mask`. Only the
+        streamlines the index finds in the target are checked.
 
     Returns
     -------
@@ -574,6 +846,7 @@ def target(streamlines, target_mask, affine, include=True):
     ------
     ValueError
         When the points of the streamlines lie outside of the `target_mask`.
+        With an `index`, only the streamlines near the target are checked.
 
     See Also
     --------
@@ -585,6 +858,22 @@ def target(streamlines, target_mask, affine, include=True):
     yield
     # End of initialization
 
+    if index is not None:
+        _check_index(index, streamlines)
+        ids = np.flatnonzero(index.query(target_mask))
+        state = np.zeros(len(streamlines), dtype=bool)
+        state[ids] = _in_target(_subset(streamlines, ids), target_mask,
+                                lin_T, offset)
+        for idx in np.where(state == include)[0]:
+            yield streamlines[idx]
+        return
+
+    if isinstance(streamlines, Streamlines):
+        state = _in_target(streamlines, target_mask, lin_T, offset)
+        for idx in np.where(state == include)[0]:
+            yield streamlines[idx]
+        return
+
     for sl in streamlines:
         try:
             ind = _to_voxel_coordinates(sl, lin_T, offset)
@@ -699,14 +988,48 @@ def streamline_near_roi(streamline, roi_coords, tol, mode='any'):
         return np.all(np.min(dist, -1) <= tol)
 
 
+def _streamlines_near_roi(streamlines, roi_coords, tol, mode='any'):
+    """Same as :func:`streamline_near_roi` for all the streamlines of a
+    `Streamlines` object at once
+
+    The distances from the points to the ROI are found with a k-d tree of the
+    ROI coordinates instead of a distance matrix per streamline.
+
+    Returns
+    -------
+    out : array of bool, shape (len(streamlines),)
+    """
+    if mode not in ("any", "all", "either_end", "both_end"):
+        e_s = "For determining relationship to an array, you can use "
+        e_s += "one of the following modes: 'any', 'all', 'both_end',"
+        e_s += "'either_end', but you entered: %s." % mode
+        raise ValueError(e_s)
+    points, offsets, lengths = _packed(streamlines)
+    if len(roi_coords) == 0:
+        return np.zeros(len(lengths), dtype=bool)
+    tree = cKDTree(roi_coords)
+    if mode == "any" or mode == "all":
+        near = tree.query(points)[0] <= tol
+        if mode == "any":
+            return _reduce_packed(np.logical_or, near, offsets, lengths,
+                                  False)
+        return _reduce_packed(np.logical_and, near, offsets, lengths, True)
+    # 'end' modes, only the first and last points are used
+    near_first = tree.query(points[offsets])[0] <= tol
+    near_last = tree.query(points[offsets + lengths - 1])[0] <= tol
+    if mode == "either_end":
+        return near_first | near_last
+    return near_first & near_last
+
+
 def near_roi(streamlines, region_of_interest, affine=None, tol=None,
-             mode="any"):
+             mode="any", index=None):
     """Provide filtering criteria for a set of streamlines based on whether
     they fall within a tolerance distance from an ROI
 
     Parameters
     ----------
-    streamlines : list or generator
+    streamlines : list or generator or Streamlines
         A sequence of streamlines. Each streamline should be a (N, 3) array,
         where N is the length of the streamline.
     region_of_interest : ndarray
@@ -732,6 +1055,12 @@ def near_roi(streamlines, region_of_interest, affine=None, tol=None,
 
         "both_end" : both end points are within tol from ROI.
 
+    index : StreamlineIndex, optional
+        Index of `streamlines` in the grid of `region_of_interest`, built
+        with `affine`. Only the streamlines the index finds within `tol` of
+        the ROI are checked. `streamlines` must then be a list or
+        `Streamlines`.
+
     Returns
     -------
     1D array of boolean dtype, shape (len(streamlines), )
@@ -754,6 +1083,16 @@ def near_roi(streamlines, region_of_interest, affine=None, tol=None,
     roi_coords = np.array(np.where(region_of_interest)).T
     x_roi_coords = apply_affine(affine, roi_coords)
 
+    if index is not None:
+        _check_index(index, streamlines)
+        ids = np.flatnonzero(index.query(region_of_interest, tol))
+        out = np.zeros(len(streamlines), dtype=bool)
+        out[ids] = near_roi(_subset(streamlines, ids), region_of_interest,
+                            affine, tol, mode)
+        return out
+    if isinstance(streamlines, Streamlines):
+        return _streamlines_near_roi(streamlines, x_roi_coords, tol=tol,
+                                     mode=mode)
     # If it's already a list, we can save time by preallocating the output
     if isinstance(streamlines, list):
         out = np.zeros(len(streamlines), dtype=bool)
@@ -771,6 +1110,145 @@ def near_roi(streamlines, region_of_interest, affine=None, tol=None,
         return(np.array(out, dtype=bool))
 
 
+class StreamlineIndex(object):
+    """Spatial index of the streamlines passing through the voxels of an image
+
+    The voxels of the image are grouped in cubic bricks of `brick_size`
+    voxels a side, and the index lists the streamlines with points in each
+    brick. Queries return the streamlines with points in the bricks of a
+    region of interest. These are only candidates which are then checked
+    exactly, so the functions using an index give the same results as
+    without one, but only look at the streamlines near the region.
+
+    Parameters
+    ----------
+    streamlines : sequence or Streamlines
+        The streamlines to index.
+    shape : tuple of 3 ints
+        Shape of the image.
+    affine : array (4, 4), optional
+        The mapping from voxel indices to streamline points. Default:
+        identity.
+    brick_size : int, optional
+        Size of the bricks in voxels. Larger bricks make a smaller index and
+        more candidates for each query. Default: 1.
+
+    Notes
+    -----
+    Points outside the image are indexed in the closest voxel of the image.
+
+    Examples
+    --------
+    >>> streamlines = [np.array([[0., 0., 0.], [1., 1., 1.]]),
+    ...                np.array([[3., 3., 3.], [3., 2., 1.]])]
+    >>> index = StreamlineIndex(streamlines, (4, 4, 4))
+    >>> roi = np.zeros((4, 4, 4), dtype=bool)
+    >>> roi[3, 2, 1] = True
+    >>> np.flatnonzero(index.query(roi))
+    array([1])
+    """
+    def __init__(self, streamlines, shape, affine=None, brick_size=1):
+        if brick_size < 1:
+            raise ValueError("brick_size must be a positive integer")
+        self.shape = tuple(int(i) for i in shape)
+        self.affine = np.eye(4) if affine is None else np.array(affine,
+                                                                dtype=float)
+        self.brick_size = int(brick_size)
+        if isinstance(streamlines, Streamlines):
+            points, _, lengths = _packed(streamlines)
+        else:
+            streamlines = list(streamlines)
+            lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+            points = (np.concatenate(streamlines) if len(streamlines)
+                      else np.zeros((0, 3)))
+        lin_T, offset = _mapping_to_voxel(self.affine, None)
+        vox = np.floor(np.dot(points, lin_T) + offset).astype(np.intp)
+        np.clip(vox, 0, np.array(self.shape) - 1, out=vox)
+        bricks = np.ravel_multi_index((vox // self.brick_size).T,
+                                      self.brick_shape)
+        self.n_streamlines = len(lengths)
+        self._indptr, self._indices = _brick_index(
+            bricks.astype(np.intp), np.asarray(lengths, dtype=np.intp),
+            int(np.prod(self.brick_shape)))
+
+    @property
+    def brick_shape(self):
+        return tuple(-(-i // self.brick_size) for i in self.shape)
+
+    def query(self, region_of_interest, tol=0):
+        """Finds the streamlines that can be near a region of interest
+
+        Parameters
+        ----------
+        region_of_interest : ndarray
+            A mask with the shape of the image. Non-zero values are
+            considered to be within the region.
+        tol : float, optional
+            Distance in the units of the streamlines. The bricks within this
+            distance from the region are also searched. Default: 0.
+
+        Returns
+        -------
+        candidates : array of bool, shape (n_streamlines,)
+            True for the streamlines with points in the bricks of the region
+            or within `tol` from them. Other streamlines have no points in
+            the voxels of the region, nor within `tol` of them.
+        """
+        roi = np.asarray(region_of_interest)
+        if roi.shape != self.shape:
+            raise ValueError("region_of_interest must have shape %s" %
+                             (self.shape,))
+        voxels = np.array(np.nonzero(roi)).T // self.brick_size
+        bricks = np.zeros(self.brick_shape, dtype=bool)
+        bricks[tuple(voxels.T)] = True
+        if tol > 0:
+            # Bound of the distance to the region in voxels along each axis
+            inv_lin = np.linalg.inv(self.affine[:3, :3])
+            radius = np.ceil(np.sqrt((inv_lin ** 2).sum(1)) * tol)
+            size = 2 * np.ceil(radius / self.brick_size).astype(int) + 1
+            bricks = maximum_filter(bricks, size, mode='constant')
+        rows = np.flatnonzero(bricks)
+        starts = self._indptr[rows]
+        counts = self._indptr[rows + 1] - starts
+        n = counts.sum()
+        index = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        candidates = np.zeros(self.n_streamlines, dtype=bool)
+        candidates[self._indices[index + np.arange(n)]] = True
+        return candidates
+
+    def save(self, fname):
+        """Saves the index to a ``.npz`` file"""
+        np.savez(fname, shape=self.shape, affine=self.affine,
+                 brick_size=self.brick_size, n_streamlines=self.n_streamlines,
+                 indptr=self._indptr, indices=self._indices)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads an index saved with ``save``"""
+        index = cls.__new__(cls)
+        with np.load(fname) as data:
+            index.shape = tuple(int(i) for i in data['shape'])
+            index.affine = data['affine']
+            index.brick_size = int(data['brick_size'])
+            index.n_streamlines = int(data['n_streamlines'])
+            index._indptr = data['indptr']
+            index._indices = data['indices']
+        return index
+
+
+def _subset(streamlines, ids):
+    """The streamlines of a sequence or `Streamlines` with indices `ids`"""
+    if isinstance(streamlines, Streamlines):
+        return streamlines[ids]
+    return [streamlines[i] for i in ids]
+
+
+def _check_index(index, streamlines):
+    if index.n_streamlines != len(streamlines):
+        raise ValueError("index was built for %d streamlines, got %d" %
+                         (index.n_streamlines, len(streamlines)))
+
+
 def reorder_voxels_affine(input_ornt, output_ornt, shape, voxel_size):
     """Calculates a linear transformation equivalent to changing voxel order.
 
@@ -939,7 +1417,8 @@ def move_streamlines(streamlines, output_space, input_space=None):
     Parameters
     ----------
     streamlines : sequence
-        A set of streamlines to be transformed.
+        A set of streamlines to be transformed. The points of `Streamlines`
+        are all transformed at once.
     output_space : array (4, 4)
         An affine matrix describing the target space to which the streamlines
         will be transformed.
@@ -966,6 +1445,14 @@ def move_streamlines(streamlines, output_space, input_space=None):
     yield
     # End of initialization
 
+    if isinstance(streamlines, Streamlines):
+        points, offsets, lengths = _packed(streamlines)
+        streamlines = _from_packed(np.dot(points, lin_T) + offset, offsets,
+                                   lengths)
+        for sl in streamlines:
+            yield sl
+        return
+
     for sl in streamlines:
         yield np.dot(sl, lin_T) + offset
 
@@ -1070,24 +1557,94 @@ def get_flexi_tvis_affine(tvis_hdr, nii_aff):
     return flexi_tvis_aff
 
 
-def _min_at(a, index, value):
-    index = np.asarray(index)
-    sort_keys = [value] + list(index)
-    order = np.lexsort(sort_keys)
-    index = index[:, order]
-    value = value[order]
-    uniq = np.ones(index.shape[1], dtype=bool)
-    uniq[1:] = (index[:, 1:] != index[:, :-1]).any(axis=0)
+class StreamlineGraph(object):
+    """Graph of the voxels visited one after the other by streamlines
 
-    index = index[:, uniq]
-    value = value[uniq]
+    The nodes of the graph are the voxels with streamline points, and two
+    voxels are connected when a streamline steps from one to the other. The
+    edges are weighted by the length of the streamlines between the voxels,
+    so that the graph is built once and many areas of interest can then be
+    queried with a shortest path search.
 
-    a[tuple(index)] = np.minimum(a[tuple(index)], value)
+    Parameters
+    ----------
+    streamlines : sequence or Streamlines
+        The streamlines. Their points must be inside the image.
+    shape : tuple of 3 ints
+        Shape of the image.
+    affine : array (4, 4), optional
+        The mapping from voxel indices to streamline points. Default:
+        identity.
 
-try:
-    minimum_at = np.minimum.at
-except AttributeError:
-    minimum_at = _min_at
+    Notes
+    -----
+    Paths can change streamline in the voxels that streamlines share. Along
+    a single streamline that does not come back to a voxel it left, the
+    lengths are the lengths along the streamline, between the points closest
+    to each other of the area of interest and of the voxel.
+
+    Examples
+    --------
+    >>> streamlines = [np.array([[0., 0., 0.], [1., 0., 0.], [2., 0., 0.]]),
+    ...                np.array([[2., 0., 0.], [2., 2., 0.]])]
+    >>> graph = StreamlineGraph(streamlines, (3, 3, 1))
+    >>> aoi = np.zeros((3, 3, 1), dtype=bool)
+    >>> aoi[0, 0, 0] = True
+    >>> graph.path_length(aoi)[:, :, 0]
+    array([[ 0., -1., -1.],
+           [ 1., -1., -1.],
+           [ 2., -1.,  4.]])
+    """
+    def __init__(self, streamlines, shape, affine=None):
+        self.shape = tuple(int(i) for i in shape)
+        self.affine = np.eye(4) if affine is None else np.array(affine,
+                                                                dtype=float)
+        points, offsets, lengths = _packed_points(streamlines)
+        points = np.ascontiguousarray(points, dtype=float)
+        lin_T, offset = _mapping_to_voxel(self.affine, None)
+        if len(points):
+            vox = _to_voxel_coordinates(points, lin_T, offset)
+        else:
+            vox = np.zeros((0, 3), dtype=int)
+        if (vox >= self.shape).any():
+            raise IndexError("streamline points are outside of the volume")
+        flat = np.ravel_multi_index(vox.T, self.shape)
+        self.voxels, nodes = np.unique(flat, return_inverse=True)
+        graph = _voxel_graph(points, np.asarray(offsets, dtype=np.intp),
+                             np.asarray(lengths, dtype=np.intp),
+                             nodes.astype(np.intp), len(self.voxels))
+        self._indptr, self._indices, self._through, self._exit = graph
+
+    def path_length(self, aoi, fill_value=-1):
+        """Computes the shortest path between aoi and each voxel
+
+        Parameters
+        ----------
+        aoi : array, 3d
+            A mask (binary array) of voxels from which to start computing
+            distance.
+        fill_value : float
+            The value of voxel in the path length map that are not connected
+            to the aoi.
+
+        Returns
+        -------
+        plm : array
+            Same shape as aoi. The length of the shortest path between aoi
+            and every voxel.
+        """
+        aoi = np.asarray(aoi, dtype=bool)
+        if aoi.shape != self.shape:
+            raise ValueError("aoi must have shape %s" % (self.shape,))
+        sources = np.flatnonzero(aoi.ravel()[self.voxels])
+        dist = _graph_path_length(self._indptr, self._indices,
+                                  self._through, self._exit, sources)
+        plm = np.empty(aoi.shape, dtype=float)
+        plm[:] = np.inf
+        plm.ravel()[self.voxels] = dist
+        if fill_value != np.inf:
+            plm = np.where(plm == np.inf, fill_value, plm)
+        return plm
 
 
 def path_length(streamlines, aoi, affine, fill_value=-1):
@@ -1111,48 +1668,13 @@ def path_length(streamlines, aoi, affine, fill_value=-1):
     -------
     plm : array
         Same shape as aoi. The minimum distance between every point and aoi
-        along the path of a streamline.
-    """
-    aoi = np.asarray(aoi, dtype=bool)
+        along the paths of the streamlines.
 
-    # path length map
-    plm = np.empty(aoi.shape, dtype=float)
-    plm[:] = np.inf
-    lin_T, offset = _mapping_to_voxel(affine, None)
-    for sl in streamlines:
-        seg_ind = _to_voxel_coordinates(sl, lin_T, offset)
-        i, j, k = seg_ind.T
-        # Get where streamlines passes through aoi
-        breaks = aoi[i, j, k]
-        # Where streamline passes aoi, dist is zero
-        i, j, k = seg_ind[breaks].T
-        plm[i, j, k] = 0
-
-        # If a streamline crosses aoi >1, re-start counting distance for each
-        for seg in _as_segments(sl, breaks):
-            i, j, k = _to_voxel_coordinates(seg[1:], lin_T, offset).T
-            # Get the distance, in mm, between streamline points
-            segment_length = np.sqrt(((seg[1:] - seg[:-1]) ** 2).sum(1))
-            dist = segment_length.cumsum()
-            # Updates path length map with shorter distances
-            minimum_at(plm, (i, j, k), dist)
-    if fill_value != np.inf:
-        plm = np.where(plm == np.inf, fill_value, plm)
-    return plm
-
-
-def _part_segments(streamline, break_points):
-    segments = np.split(streamline, break_points.nonzero()[0])
-    # Skip first segment, all points before first break
-    # first segment is empty when break_points[0] == 0
-    segments = segments[1:]
-    for each in segments:
-        if len(each) > 1:
-            yield each
-
-
-def _as_segments(streamline, break_points):
-    for seg in _part_segments(streamline, break_points):
-        yield seg
-    for seg in _part_segments(streamline[::-1], break_points[::-1]):
-        yield seg
+    Notes
+    -----
+    This builds a `StreamlineGraph` and searches it from aoi, so that paths
+    can change streamline in the voxels that streamlines share. Build the
+    graph once to compute the path lengths from several areas of interest.
+    """
+    graph = StreamlineGraph(streamlines, np.shape(aoi), affine)
+    return graph.path_length(aoi, fill_value)
@@ -3,77 +3,142 @@
 implemented in cython.
 """
 import cython
+from cython.parallel import parallel, prange, threadid
 
 cdef extern from "dpy_math.h" nogil:
     double fmin(double x, double y)
-from libc.math cimport ceil, floor, fabs, sqrt
+from libc.math cimport ceil, exp, floor, fabs, sqrt
+from libc.stdlib cimport malloc, free, qsort
 
 import numpy as np
 cimport numpy as cnp
 from ._utils import _mapping_to_voxel, _to_voxel_coordinates
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+from dipy.utils.omp import thread_count
 
 from ..utils.six.moves import xrange
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-@cython.profile(False)
-def _voxel2streamline(sl,
-                      cnp.ndarray[cnp.npy_intp, ndim=2] unique_idx):
-    """
-    Maps voxels to streamlines and streamlines to voxels, for setting up
-    the LiFE equations matrix
+cdef inline double _adc(double[:, :, ::1] tensors, cnp.npy_intp i,
+                        double[:, ::1] bvecs, cnp.npy_intp b) nogil:
+    """Apparent diffusion coefficient of tensor `i` along direction `b`"""
+    cdef:
+        cnp.npy_intp r, c
+        double q = 0
+    for r in range(3):
+        for c in range(3):
+            q += bvecs[b, r] * tensors[i, r, c] * bvecs[b, c]
+    return q
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _life_matrix(cnp.npy_intp[:] nodes, cnp.npy_intp[:] pair_starts,
+                 cnp.npy_intp[:] pair_voxel, cnp.npy_intp[:] pair_fiber,
+                 cnp.npy_intp[:] offsets, cnp.npy_intp[:] lengths,
+                 double[:, ::1] bvecs, double[::1] bvals,
+                 double[:, :, ::1] tensors=None, double[:, ::1] signals=None,
+                 cnp.npy_intp[:] node_signal=None, dtype=np.float64,
+                 num_threads=None):
+    """Assembles the LiFE matrix in COO format.
+
+    This function is private because it's supposed to be called only by
+    tracking.life.FiberModel.setup.
 
     Parameters
     ----------
-    sl : list
-        A collection of streamlines, each n by 3, with n being the number of
-        nodes in the fiber.
-
-    unique_idx : array.
-       The unique indices in the streamlines
+    nodes : array (P,)
+        Nodes of the streamlines, as indices into the packed points, grouped
+        by voxel and streamline.
+    pair_starts : array (K + 1,)
+        The nodes of the k-th voxel and streamline pair are
+        ``nodes[pair_starts[k]:pair_starts[k + 1]]``.
+    pair_voxel, pair_fiber : arrays (K,)
+        Voxel and streamline of each pair.
+    offsets, lengths : arrays (N,)
+        Index of the first point and number of points of each streamline.
+    bvecs, bvals : arrays (B, 3) and (B,)
+        Diffusion-weighted gradient directions and b-values.
+    tensors : array (P, 3, 3), optional
+        Tensor of each node. The signal of the node is computed from it and
+        demeaned over the whole streamline.
+    signals : array (M, B), optional
+        Table of demeaned signals, used instead of `tensors`.
+    node_signal : array (P,), optional
+        Row of `signals` giving the signal of each node.
+    dtype : float32 or float64
+        Type of the values of the matrix.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
 
     Returns
     -------
-    v2f, v2fn : tuple of dicts
-
-    The first dict in the tuple answers the question: Given a voxel (from
-    the unique indices in this model), which fibers pass through it?
-
-    The second answers the question: Given a streamline, for each voxel that
-    this streamline passes through, which nodes of that streamline are in that
-    voxel?
+    values, rows, cols : arrays (K * B,)
+        Entries of the matrix. The row of voxel ``v`` and direction ``b`` is
+        ``v * B + b``, the column is the streamline.
     """
-    # Define local counters:
-    cdef int s_idx, node_idx, voxel_id, ii
-    cdef dict vox_dict = {}
-    for ii in range(len(unique_idx)):
-        vox = unique_idx[ii]
-        vox_dict[vox[0], vox[1], vox[2]] = ii
-    # Outputs are these dicts:
-    cdef dict v2f = {}
-    cdef dict v2fn = {}
-    # In each fiber:
-    for s_idx in range(len(sl)):
-        sl_as_idx = np.round(sl[s_idx]).astype(int)
-        v2fn[s_idx] = {}
-        # In each voxel present in there:
-        for node_idx in range(len(sl_as_idx)):
-            node = sl_as_idx[node_idx]
-            # What serial number is this voxel in the unique voxel indices:
-            voxel_id = vox_dict[node[0], node[1], node[2]]
-            # Add that combination to the dict:
-            if voxel_id in v2f:
-                if s_idx not in v2f[voxel_id]:
-                    v2f[voxel_id].append(s_idx)
-            else:
-                v2f[voxel_id] = [s_idx]
-            # All the nodes going through this voxel get its number:
-            if voxel_id in v2fn[s_idx]:
-                v2fn[s_idx][voxel_id].append(node_idx)
-            else:
-                v2fn[s_idx][voxel_id] = [node_idx]
-    return v2f ,v2fn
+    cdef:
+        cnp.npy_intp n_pairs = pair_voxel.shape[0]
+        cnp.npy_intp n_fibers = lengths.shape[0]
+        cnp.npy_intp nb = bvals.shape[0]
+        cnp.npy_intp k, f, b, i, j, n, e
+        int exact = tensors is not None
+        int single = np.dtype(dtype) == np.float32
+        double acc
+        double[::1] fiber_mean = np.zeros(n_fibers)
+        float[::1] out32 = np.empty(n_pairs * nb if single else 0,
+                                    dtype=np.float32)
+        double[::1] out64 = np.empty(0 if single else n_pairs * nb)
+        cnp.npy_intp[::1] rows = np.empty(n_pairs * nb, dtype=np.intp)
+        cnp.npy_intp[::1] cols = np.empty(n_pairs * nb, dtype=np.intp)
+
+    if not exact and (signals is None or node_signal is None):
+        raise ValueError("tensors or signals and node_signal are required")
+
+    set_num_threads(num_threads)
+    try:
+        with nogil:
+            if exact:
+                # The signal of a streamline is demeaned over all its nodes
+                for f in prange(n_fibers, schedule='guided'):
+                    acc = 0
+                    for i in range(offsets[f], offsets[f] + lengths[f]):
+                        for b in range(nb):
+                            acc = acc + exp(-bvals[b] * _adc(tensors, i,
+                                                             bvecs, b))
+                    if lengths[f] > 0:
+                        fiber_mean[f] = acc / (lengths[f] * nb)
+
+            for k in prange(n_pairs, schedule='guided'):
+                f = pair_fiber[k]
+                n = pair_starts[k + 1] - pair_starts[k]
+                for b in range(nb):
+                    acc = 0
+                    for j in range(pair_starts[k], pair_starts[k + 1]):
+                        i = nodes[j]
+                        if exact:
+                            acc = acc + exp(-bvals[b] * _adc(tensors, i,
+                                                             bvecs, b))
+                        else:
+                            acc = acc + signals[node_signal[i], b]
+                    if exact:
+                        acc = acc - n * fiber_mean[f]
+                    e = k * nb + b
+                    if single:
+                        out32[e] = <float> acc
+                    else:
+                        out64[e] = acc
+                    rows[e] = pair_voxel[k] * nb + b
+                    cols[e] = f
+    finally:
+        restore_default_num_threads()
+    if single:
+        return np.asarray(out32), np.asarray(rows), np.asarray(cols)
+    return np.asarray(out64), np.asarray(rows), np.asarray(cols)
 
 
 def streamline_mapping(streamlines, voxel_size=None, affine=None,
@@ -182,6 +247,195 @@ cdef inline void c_get_closest_edge(cnp.double_t* p,
      edge[2] = floor(p[2] + eps) if direction[2] >= 0.0 else ceil(p[2] - eps)
 
 
+cdef int _compare_intp(const void *a, const void *b) nogil:
+    cdef cnp.npy_intp x = (<cnp.npy_intp *> a)[0]
+    cdef cnp.npy_intp y = (<cnp.npy_intp *> b)[0]
+    return (x > y) - (x < y)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _density_map(double[:, ::1] points, cnp.npy_intp[:] offsets,
+                 cnp.npy_intp[:] lengths, double[:, ::1] lin_T,
+                 double[::1] offset, shape, double[:] weights=None,
+                 num_threads=None):
+    """Sums the weights of the unique streamlines passing through each voxel.
+
+    This function is private because it's supposed to be called only by
+    tracking.utils.density_map.
+
+    Parameters
+    ----------
+    points : array (P, 3)
+        Points of the streamlines, packed one streamline after the other.
+    offsets, lengths : arrays (N,)
+        Index of the first point and number of points of each streamline.
+    lin_T, offset : arrays
+        Mapping to voxel space. Obtained with `_mapping_to_voxel`.
+    shape : tuple of 3 ints
+        Shape of the volume.
+    weights : array (N,), optional
+        Weight of each streamline. Default: 1.
+    num_threads : int, optional
+        Number of threads. If None (default) the default number of OpenMP
+        threads is used.
+
+    Returns
+    -------
+    density : array (X, Y, Z) of float
+
+    Notes
+    -----
+    The sorted unique voxels of each streamline are first found in parallel
+    and stored at the indices of its points. The volume is then split in one
+    slab per thread and each thread sums the streamlines into its own slab,
+    so only one volume is allocated whatever the number of threads.
+    """
+    cdef:
+        cnp.npy_intp n = lengths.shape[0]
+        cnp.npy_intp nx = shape[0], ny = shape[1], nz = shape[2]
+        cnp.npy_intp n_voxels = nx * ny * nz
+        cnp.npy_intp s, t, i, j, k, nu, start, lo, hi, a, b, m, n_slabs
+        int has_weights = weights is not None
+        double x, y, z, w
+        double[::1] density = np.zeros(n_voxels)
+        cnp.npy_intp[::1] voxels = np.empty(points.shape[0], dtype=np.intp)
+        cnp.npy_intp[::1] n_unique = np.empty(n, dtype=np.intp)
+
+    set_num_threads(num_threads)
+    try:
+        with nogil:
+            for s in prange(n, schedule='guided'):
+                start = offsets[s]
+                nu = 0
+                for i in range(start, start + lengths[s]):
+                    # Truncating is flooring, as the mapping is checked
+                    # to be non-negative
+                    x = (points[i, 0] * lin_T[0, 0] +
+                         points[i, 1] * lin_T[1, 0] +
+                         points[i, 2] * lin_T[2, 0] + offset[0])
+                    y = (points[i, 0] * lin_T[0, 1] +
+                         points[i, 1] * lin_T[1, 1] +
+                         points[i, 2] * lin_T[2, 1] + offset[1])
+                    z = (points[i, 0] * lin_T[0, 2] +
+                         points[i, 1] * lin_T[1, 2] +
+                         points[i, 2] * lin_T[2, 2] + offset[2])
+                    if (x < -5e-7 or y < -5e-7 or z < -5e-7 or
+                            <cnp.npy_intp> x >= nx or
+                            <cnp.npy_intp> y >= ny or
+                            <cnp.npy_intp> z >= nz):
+                        nu = -1
+                        break
+                    voxels[start + nu] = ((<cnp.npy_intp> x * ny +
+                                           <cnp.npy_intp> y) * nz +
+                                          <cnp.npy_intp> z)
+                    nu = nu + 1
+                # Each streamline is counted once in each voxel
+                if nu > 1:
+                    qsort(&voxels[start], nu, sizeof(cnp.npy_intp),
+                          _compare_intp)
+                    k = 1
+                    for i in range(start + 1, start + nu):
+                        if voxels[i] != voxels[start + k - 1]:
+                            voxels[start + k] = voxels[i]
+                            k = k + 1
+                    nu = k
+                n_unique[s] = nu
+        if n and np.min(n_unique) < 0:
+            raise IndexError("streamline points are outside of the volume")
+
+        n_slabs = min(thread_count(), nx)
+        with nogil:
+            for j in prange(n_slabs, schedule='static', chunksize=1):
+                lo = n_voxels * j // n_slabs
+                hi = n_voxels * (j + 1) // n_slabs
+                for t in range(n):
+                    start = offsets[t]
+                    w = weights[t] if has_weights else 1.
+                    # First voxel of the streamline in the slab
+                    a = 0
+                    b = n_unique[t]
+                    while a < b:
+                        m = (a + b) // 2
+                        if voxels[start + m] < lo:
+                            a = m + 1
+                        else:
+                            b = m
+                    while a < n_unique[t] and voxels[start + a] < hi:
+                        i = voxels[start + a]
+                        density[i] = density[i] + w
+                        a = a + 1
+    finally:
+        restore_default_num_threads()
+    return np.asarray(density).reshape(shape)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _brick_index(cnp.npy_intp[:] bricks, cnp.npy_intp[:] lengths,
+                 cnp.npy_intp n_bricks):
+    """Lists the streamlines passing through each brick of a grid.
+
+    This function is private because it's supposed to be called only by
+    tracking.utils.StreamlineIndex.
+
+    Parameters
+    ----------
+    bricks : array (P,)
+        Brick of each point of the streamlines, packed one streamline after
+        the other.
+    lengths : array (N,)
+        Number of points of each streamline.
+    n_bricks : int
+        Number of bricks of the grid.
+
+    Returns
+    -------
+    indptr : array (n_bricks + 1,)
+    indices : array
+        The streamlines passing through brick ``b`` are
+        ``indices[indptr[b]:indptr[b + 1]]``, in increasing order and without
+        repetitions.
+    """
+    cdef:
+        cnp.npy_intp s, i, b, p
+        cnp.npy_intp n = lengths.shape[0]
+        cnp.npy_intp[:] last = np.full(n_bricks, -1, dtype=np.intp)
+        cnp.npy_intp[:] indptr = np.zeros(n_bricks + 1, dtype=np.intp)
+        cnp.npy_intp[:] pos
+        cnp.npy_intp[:] indices
+
+    # Count the streamlines of each brick, `last` avoids counting a
+    # streamline twice in the same brick
+    with nogil:
+        p = 0
+        for s in range(n):
+            for i in range(lengths[s]):
+                b = bricks[p]
+                p += 1
+                if last[b] != s:
+                    last[b] = s
+                    indptr[b + 1] += 1
+        for b in range(n_bricks):
+            indptr[b + 1] += indptr[b]
+
+    indices = np.empty(indptr[n_bricks], dtype=np.intp)
+    pos = np.array(indptr[:n_bricks])
+    last[:] = -1
+    with nogil:
+        p = 0
+        for s in range(n):
+            for i in range(lengths[s]):
+                b = bricks[p]
+                p += 1
+                if last[b] != s:
+                    last[b] = s
+                    indices[pos[b]] = s
+                    pos[b] += 1
+    return np.asarray(indptr), np.asarray(indices)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -455,3 +709,220 @@ def track_counts(tracks, vol_dims, vox_sizes=(1,1,1), return_elements=True):
     if ret_elf:
         return tcs.reshape(vol_dims), el_inds
     return tcs.reshape(vol_dims)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _voxel_graph(double[:, ::1] points, cnp.npy_intp[:] offsets,
+                 cnp.npy_intp[:] lengths, cnp.npy_intp[:] nodes,
+                 cnp.npy_intp n_nodes):
+    """Builds the graph of the voxels visited one after the other by the
+    streamlines.
+
+    This function is private because it's supposed to be called only by
+    tracking.utils.StreamlineGraph.
+
+    The consecutive points of a streamline in the same voxel form a run.
+    Each pair of consecutive runs ``A``, ``B`` of a streamline gives an edge
+    from ``A`` to ``B`` and one from ``B`` to ``A``. An edge has two weights,
+    both lengths along the streamline:
+
+    - ``through`` is the length between the points where the streamline
+      enters ``A`` and ``B``, when coming from the other side of the
+      streamline. It is the length used for paths going through ``A``.
+    - ``exit`` is the length of the step between ``A`` and ``B``. It is the
+      length used for paths starting in ``A``.
+
+    The edges between the same voxels are merged, keeping the smallest
+    weights.
+
+    Parameters
+    ----------
+    points : array (P, 3)
+        Points of the streamlines, packed one streamline after the other.
+    offsets, lengths : arrays (N,)
+        Index of the first point and number of points of each streamline.
+    nodes : array (P,)
+        Node (voxel) of each point.
+    n_nodes : int
+        Number of nodes.
+
+    Returns
+    -------
+    indptr, indices : arrays
+        The edges in CSR format: the edges from node ``i`` go to
+        ``indices[indptr[i]:indptr[i + 1]]``.
+    through, exit : arrays of float
+        The weights of the edges.
+    """
+    cdef:
+        cnp.npy_intp n = lengths.shape[0]
+        cnp.npy_intp s, i, start, end, e = 0, n_edges
+        cnp.npy_intp prev_node = 0
+        int has_prev
+        double arc, arc_i, run_arc, prev_arc, dx, dy, dz
+        cnp.npy_intp[::1] src, dst
+        double[::1] through, exit
+
+    # Each run but the first of a streamline gives two edges
+    n_edges = 0
+    with nogil:
+        for s in range(n):
+            for i in range(offsets[s] + 1, offsets[s] + lengths[s]):
+                if nodes[i] != nodes[i - 1]:
+                    n_edges += 2
+    src = np.empty(n_edges, dtype=np.intp)
+    dst = np.empty(n_edges, dtype=np.intp)
+    through = np.empty(n_edges)
+    exit = np.empty(n_edges)
+    with nogil:
+        for s in range(n):
+            start = offsets[s]
+            end = start + lengths[s]
+            # arc is the length from the first point to point i - 1,
+            # run_arc the length to the first point of the current run and
+            # prev_arc the length to the last point of the previous run.
+            arc = arc_i = run_arc = prev_arc = 0
+            has_prev = 0
+            for i in range(start + 1, end + 1):
+                if i < end:
+                    dx = points[i, 0] - points[i - 1, 0]
+                    dy = points[i, 1] - points[i - 1, 1]
+                    dz = points[i, 2] - points[i - 1, 2]
+                    arc_i = arc + sqrt(dx * dx + dy * dy + dz * dz)
+                if i < end and nodes[i] == nodes[i - 1]:
+                    arc = arc_i
+                    continue
+                # The current run ends at point i - 1
+                if has_prev:
+                    src[e] = nodes[i - 1]
+                    dst[e] = prev_node
+                    through[e] = arc - prev_arc
+                    exit[e] = run_arc - prev_arc
+                    e += 1
+                if i < end:
+                    src[e] = nodes[i - 1]
+                    dst[e] = nodes[i]
+                    through[e] = arc_i - run_arc
+                    exit[e] = arc_i - arc
+                    e += 1
+                    prev_node = nodes[i - 1]
+                    prev_arc = arc
+                    run_arc = arc_i
+                    has_prev = 1
+                arc = arc_i
+
+    keys = np.asarray(src[:e]) * n_nodes + np.asarray(dst[:e])
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    first = np.ones(e, dtype=bool)
+    first[1:] = keys[1:] != keys[:e - 1]
+    starts = np.flatnonzero(first)
+    if e:
+        through_min = np.minimum.reduceat(np.asarray(through[:e])[order],
+                                          starts)
+        exit_min = np.minimum.reduceat(np.asarray(exit[:e])[order], starts)
+    else:
+        through_min = exit_min = np.zeros(0)
+    keys = keys[starts]
+    indptr = np.searchsorted(keys // n_nodes if e else keys,
+                             np.arange(n_nodes + 1)).astype(np.intp)
+    indices = (keys % n_nodes if e else keys).astype(np.intp)
+    return indptr, indices, through_min, exit_min
+
+
+cdef inline void _heap_push(double *keys, cnp.npy_intp *values,
+                            cnp.npy_intp *size, double key,
+                            cnp.npy_intp value) nogil:
+    cdef cnp.npy_intp i = size[0], parent
+    size[0] += 1
+    while i > 0:
+        parent = (i - 1) // 2
+        if keys[parent] <= key:
+            break
+        keys[i] = keys[parent]
+        values[i] = values[parent]
+        i = parent
+    keys[i] = key
+    values[i] = value
+
+
+cdef inline void _heap_pop(double *keys, cnp.npy_intp *values,
+                           cnp.npy_intp *size) nogil:
+    cdef:
+        cnp.npy_intp n = size[0] - 1, i = 0, child
+        double key = keys[n]
+        cnp.npy_intp value = values[n]
+    size[0] = n
+    while 2 * i + 1 < n:
+        child = 2 * i + 1
+        if child + 1 < n and keys[child + 1] < keys[child]:
+            child += 1
+        if key <= keys[child]:
+            break
+        keys[i] = keys[child]
+        values[i] = values[child]
+        i = child
+    keys[i] = key
+    values[i] = value
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _graph_path_length(cnp.npy_intp[:] indptr, cnp.npy_intp[:] indices,
+                       double[:] through, double[:] exit,
+                       cnp.npy_intp[:] sources):
+    """Shortest path lengths from a set of nodes of a graph made by
+    `_voxel_graph`.
+
+    Runs Dijkstra's algorithm from all the sources at once. The edges leaving
+    a source use their ``exit`` weight, the other edges their ``through``
+    weight.
+
+    Parameters
+    ----------
+    indptr, indices, through, exit : arrays
+        The graph, as returned by `_voxel_graph`.
+    sources : array of int
+        The nodes at distance 0.
+
+    Returns
+    -------
+    dist : array of float
+        Length of the shortest path from the sources to each node, inf for
+        the nodes that are not connected to the sources.
+    """
+    cdef:
+        cnp.npy_intp n_nodes = indptr.shape[0] - 1
+        cnp.npy_intp n_sources = sources.shape[0]
+        cnp.npy_intp i, j, u, v, size = 0
+        double d, w
+        double[::1] dist = np.full(n_nodes, np.inf)
+        cnp.uint8_t[::1] is_source = np.zeros(n_nodes, dtype=np.uint8)
+        # Each source and each relaxed edge is pushed at most once
+        double[::1] heap_keys = np.empty(n_sources + indices.shape[0] + 1)
+        cnp.npy_intp[::1] heap_values = np.empty(n_sources +
+                                                 indices.shape[0] + 1,
+                                                 dtype=np.intp)
+
+    with nogil:
+        for i in range(n_sources):
+            u = sources[i]
+            if not is_source[u]:
+                is_source[u] = 1
+                dist[u] = 0
+                _heap_push(&heap_keys[0], &heap_values[0], &size, 0, u)
+        while size > 0:
+            d = heap_keys[0]
+            u = heap_values[0]
+            _heap_pop(&heap_keys[0], &heap_values[0], &size)
+            if d > dist[u]:
+                # Already reached by a shorter path
+                continue
+            for j in range(indptr[u], indptr[u + 1]):
+                v = indices[j]
+                w = d + (exit[j] if is_source[u] else through[j])
+                if w < dist[v]:
+                    dist[v] = w
+                    _heap_push(&heap_keys[0], &heap_values[0], &size, w, v)
+    return np.asarray(dist)
@@ -19,9 +19,56 @@ from dipy.reconst.dti import (TensorModel, color_fa, fractional_anisotropy,
                               lower_triangular, mode as get_mode)
 from dipy.reconst.peaks import peaks_from_model
 from dipy.reconst.shm import CsaOdfModel
+from dipy.reconst.slabs import fit_nifti_slabs, peaks_from_model_slabs
 from dipy.workflows.workflow import Workflow
 
 
+def _dti_fa(tenfit):
+    FA = fractional_anisotropy(tenfit.evals)
+    FA[np.isnan(FA)] = 0
+    return np.clip(FA, 0, 1)
+
+
+def _dti_tensor(tenfit):
+    tensor_vals = lower_triangular(tenfit.quadratic_form)
+    correct_order = [0, 1, 3, 2, 4, 5]
+    return tensor_vals[..., correct_order].astype(np.float32)
+
+
+def _dti_rgb(tenfit):
+    RGB = color_fa(_dti_fa(tenfit), tenfit.evecs)
+    return np.array(255 * RGB, 'uint8')
+
+
+# Functions computing each DTI metric saved by the workflows from a TensorFit
+_dti_metrics = {
+    'tensor': _dti_tensor,
+    'fa': lambda tenfit: _dti_fa(tenfit).astype(np.float32),
+    'ga': lambda tenfit: geodesic_anisotropy(tenfit.evals).astype(np.float32),
+    'rgb': _dti_rgb,
+    'md': lambda tenfit: mean_diffusivity(tenfit.evals).astype(np.float32),
+    'ad': lambda tenfit: axial_diffusivity(tenfit.evals).astype(np.float32),
+    'rd': lambda tenfit: radial_diffusivity(tenfit.evals).astype(np.float32),
+    'mode': lambda tenfit: get_mode(tenfit.quadratic_form).astype(np.float32),
+    'evec': lambda tenfit: tenfit.evecs.astype(np.float32),
+    'eval': lambda tenfit: tenfit.evals.astype(np.float32)}
+
+
+def _peaks(model, data, mask, sh_order, slab_size=0):
+    """Peaks and metrics of the fiber odfs saved by the CSD/CSA workflows"""
+    kwargs = dict(relative_peak_threshold=.5, min_separation_angle=25,
+                  mask=mask, return_sh=True, sh_order=sh_order,
+                  normalize_peaks=True)
+    sphere = get_sphere('symmetric362')
+    if slab_size > 0:
+        logging.info('Peaks computation by slabs of {0} slices...'.
+                     format(slab_size))
+        return peaks_from_model_slabs(model, data, sphere,
+                                      slab_size=slab_size, **kwargs)
+    return peaks_from_model(model=model, data=data, sphere=sphere,
+                            parallel=False, **kwargs)
+
+
 class ReconstDtiFlow(Workflow):
     @classmethod
     def get_short_name(cls):
@@ -32,7 +79,7 @@ class ReconstDtiFlow(Workflow):
             out_dir='', out_tensor='tensors.nii.gz', out_fa='fa.nii.gz',
             out_ga='ga.nii.gz', out_rgb='rgb.nii.gz', out_md='md.nii.gz',
             out_ad='ad.nii.gz', out_rd='rd.nii.gz', out_mode='mode.nii.gz',
-            out_evec='evecs.nii.gz', out_eval='evals.nii.gz'):
+            out_evec='evecs.nii.gz', out_eval='evals.nii.gz', slab_size=0):
         """ Workflow for tensor reconstruction and for computing DTI metrics.
         Performs a tensor reconstruction on the files by 'globing'
         ``input_files`` and saves the DTI metrics in a directory specified by
@@ -86,6 +133,11 @@ class ReconstDtiFlow(Workflow):
             (default 'evecs.nii.gz')
         out_eval : string, optional
             Name of the eigenvalues to be saved (default 'evals.nii.gz')
+        slab_size : int, optional
+            If positive, the input volume is memory-mapped and the tensors are
+            fitted and the metrics saved this many slices at a time, so that
+            volumes larger than the available memory can be processed
+            (default 0 (the whole volume is loaded in memory))
         """
         io_it = self.get_io_iterator()
 
@@ -94,7 +146,6 @@ class ReconstDtiFlow(Workflow):
 
             logging.info('Computing DTI metrics for {0}'.format(dwi))
             img = nib.load(dwi)
-            data = img.get_data()
             affine = img.affine
 
             if mask is None:
@@ -102,66 +153,31 @@ class ReconstDtiFlow(Workflow):
             else:
                 mask = nib.load(mask).get_data().astype(np.bool)
 
-            tenfit, _ = self.get_fitted_tensor(data, mask, bval, bvec,
-                                               b0_threshold)
-
             if not save_metrics:
                 save_metrics = ['fa', 'md', 'rd', 'ad', 'ga', 'rgb', 'mode',
                                 'evec', 'eval', 'tensor']
 
-            FA = fractional_anisotropy(tenfit.evals)
-            FA[np.isnan(FA)] = 0
-            FA = np.clip(FA, 0, 1)
-
-            if 'tensor' in save_metrics:
-                tensor_vals = lower_triangular(tenfit.quadratic_form)
-                correct_order = [0, 1, 3, 2, 4, 5]
-                tensor_vals_reordered = tensor_vals[..., correct_order]
-                fiber_tensors = nib.Nifti1Image(tensor_vals_reordered.astype(
-                    np.float32), affine)
-                nib.save(fiber_tensors, otensor)
-
-            if 'fa' in save_metrics:
-                fa_img = nib.Nifti1Image(FA.astype(np.float32), affine)
-                nib.save(fa_img, ofa)
-
-            if 'ga' in save_metrics:
-                GA = geodesic_anisotropy(tenfit.evals)
-                ga_img = nib.Nifti1Image(GA.astype(np.float32), affine)
-                nib.save(ga_img, oga)
-
-            if 'rgb' in save_metrics:
-                RGB = color_fa(FA, tenfit.evecs)
-                rgb_img = nib.Nifti1Image(np.array(255 * RGB, 'uint8'), affine)
-                nib.save(rgb_img, orgb)
-
-            if 'md' in save_metrics:
-                MD = mean_diffusivity(tenfit.evals)
-                md_img = nib.Nifti1Image(MD.astype(np.float32), affine)
-                nib.save(md_img, omd)
-
-            if 'ad' in save_metrics:
-                AD = axial_diffusivity(tenfit.evals)
-                ad_img = nib.Nifti1Image(AD.astype(np.float32), affine)
-                nib.save(ad_img, oad)
-
-            if 'rd' in save_metrics:
-                RD = radial_diffusivity(tenfit.evals)
-                rd_img = nib.Nifti1Image(RD.astype(np.float32), affine)
-                nib.save(rd_img, orad)
-
-            if 'mode' in save_metrics:
-                MODE = get_mode(tenfit.quadratic_form)
-                mode_img = nib.Nifti1Image(MODE.astype(np.float32), affine)
-                nib.save(mode_img, omode)
-
-            if 'evec' in save_metrics:
-                evecs_img = nib.Nifti1Image(tenfit.evecs.astype(np.float32), affine)
-                nib.save(evecs_img, oevecs)
-
-            if 'eval' in save_metrics:
-                evals_img = nib.Nifti1Image(tenfit.evals.astype(np.float32), affine)
-                nib.save(evals_img, oevals)
+            out_fnames = {'tensor': otensor, 'fa': ofa, 'ga': oga,
+                          'rgb': orgb, 'md': omd, 'ad': oad, 'rd': orad,
+                          'mode': omode, 'evec': oevecs, 'eval': oevals}
+            metrics = dict((name, _dti_metrics[name]) for name in
+                           save_metrics)
+
+            if slab_size > 0:
+                logging.info('Tensor estimation by slabs of {0} slices...'.
+                             format(slab_size))
+                bvals, bvecs = read_bvals_bvecs(bval, bvec)
+                gtab = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
+                fit_nifti_slabs(self.get_tensor_model(gtab), dwi, metrics,
+                                out_fnames, mask, slab_size,
+                                dtypes={'rgb': np.uint8})
+            else:
+                data = img.get_data()
+                tenfit, _ = self.get_fitted_tensor(data, mask, bval, bvec,
+                                                   b0_threshold)
+                for name, func in metrics.items():
+                    metric_img = nib.Nifti1Image(func(tenfit), affine)
+                    nib.save(metric_img, out_fnames[name])
 
             logging.info('DTI metrics saved in {0}'.
                          format(os.path.dirname(oevals)))
@@ -191,7 +207,7 @@ class ReconstDtiRestoreFlow(ReconstDtiFlow):
             out_dir='', out_tensor='tensors.nii.gz', out_fa='fa.nii.gz',
             out_ga='ga.nii.gz', out_rgb='rgb.nii.gz', out_md='md.nii.gz',
             out_ad='ad.nii.gz', out_rd='rd.nii.gz', out_mode='mode.nii.gz',
-            out_evec='evecs.nii.gz', out_eval='evals.nii.gz'):
+            out_evec='evecs.nii.gz', out_eval='evals.nii.gz', slab_size=0):
 
         """ Workflow for tensor reconstruction and for computing DTI metrics.
             Performs a tensor reconstruction on the files by 'globing'
@@ -252,6 +268,11 @@ class ReconstDtiRestoreFlow(ReconstDtiFlow):
                 (default 'evecs.nii.gz')
             out_eval : string, optional
                 Name of the eigenvalues to be saved (default 'evals.nii.gz')
+            slab_size : int, optional
+                If positive, the input volume is memory-mapped and the tensors
+                are fitted and the metrics saved this many slices at a time, so
+                that volumes larger than the available memory can be processed
+                (default 0 (the whole volume is loaded in memory))
             """
         self.sigma = sigma
         self.jacobian = jacobian
@@ -259,7 +280,8 @@ class ReconstDtiRestoreFlow(ReconstDtiFlow):
         super(ReconstDtiRestoreFlow, self).\
             run(input_files, bvalues, bvectors, mask_files, b0_threshold,
                 save_metrics, out_dir, out_tensor, out_fa, out_ga, out_rgb,
-                out_md, out_ad, out_rd, out_mode, out_evec, out_eval)
+                out_md, out_ad, out_rd, out_mode, out_evec, out_eval,
+                slab_size)
 
 
 class ReconstCSDFlow(Workflow):
@@ -270,11 +292,13 @@ class ReconstCSDFlow(Workflow):
 
     def run(self, input_files, bvalues, bvectors, mask_files,
             b0_threshold=0.0,
-            frf=[15.0, 4.0, 4.0], extract_pam_values=False, out_dir='',
+            frf=[15.0, 4.0, 4.0], extract_pam_values=False,
+            out_dir='',
             out_pam='peaks.pam5', out_shm='shm.nii.gz',
             out_peaks_dir='peaks_dirs.nii.gz',
             out_peaks_values='peaks_values.nii.gz',
-            out_peaks_indices='peaks_indices.nii.gz', out_gfa='gfa.nii.gz'):
+            out_peaks_indices='peaks_indices.nii.gz', out_gfa='gfa.nii.gz',
+            slab_size=0):
         """ Workflow for peaks computation. Peaks computation is done by 'globing'
             ``input_files`` and saves the peaks in a directory specified by
             ``out_dir``.
@@ -317,6 +341,12 @@ class ReconstCSDFlow(Workflow):
             (default 'peaks_indices.nii.gz')
         out_gfa : string, optional
             Name of the generalise fa volume to be saved (default 'gfa.nii.gz')
+        slab_size : int, optional
+            If positive, the input volume is memory-mapped and the fiber odfs
+            are fitted this many slices at a time. Only the peaks and metrics
+            of the whole volume are kept in memory. As with parallel
+            ``peaks_from_model``, the QA is normalized within each slab
+            (default 0 (the whole volume is loaded in memory))
         """
         io_it = self.get_io_iterator()
 
@@ -325,7 +355,7 @@ class ReconstCSDFlow(Workflow):
 
             logging.info('Computing fiber odfs for {0}'.format(dwi))
             vol = nib.load(dwi)
-            data = vol.get_data()
+            data = vol.dataobj if slab_size > 0 else vol.get_data()
             affine = vol.get_affine()
 
             bvals, bvecs = read_bvals_bvecs(bval, bvec)
@@ -360,21 +390,11 @@ class ReconstCSDFlow(Workflow):
             logging.info('Ratio for smallest to largest eigen value is {0}'
                          .format(ratio))
 
-            peaks_sphere = get_sphere('symmetric362')
-
             csd_model = ConstrainedSphericalDeconvModel(gtab, response,
                                                         sh_order=sh_order)
 
-            peaks_csd = peaks_from_model(model=csd_model,
-                                         data=data,
-                                         sphere=peaks_sphere,
-                                         relative_peak_threshold=.5,
-                                         min_separation_angle=25,
-                                         mask=mask_vol,
-                                         return_sh=True,
-                                         sh_order=sh_order,
-                                         normalize_peaks=True,
-                                         parallel=False)
+            peaks_csd = _peaks(csd_model, data, mask_vol, sh_order,
+                               slab_size)
             peaks_csd.affine = affine
 
             save_peaks(opam, peaks_csd)
@@ -395,12 +415,13 @@ class ReconstCSAFlow(Workflow):
         return 'csa'
 
     def run(self, input_files, bvalues, bvectors, mask_files,
-            b0_threshold=0.0, extract_pam_values=False, out_dir='',
+            b0_threshold=0.0, extract_pam_values=False,
+            out_dir='',
             out_pam='peaks.pam5', out_shm='shm.nii.gz',
             out_peaks_dir='peaks_dirs.nii.gz',
             out_peaks_values='peaks_values.nii.gz',
             out_peaks_indices='peaks_indices.nii.gz',
-            out_gfa='gfa.nii.gz'):
+            out_gfa='gfa.nii.gz', slab_size=0):
         """ Workflow for peaks computation. Peaks computation is done by 'globing'
             ``input_files`` and saves the peaks in a directory specified by
             ``out_dir``.
@@ -441,6 +462,12 @@ class ReconstCSAFlow(Workflow):
             (default 'peaks_indices.nii.gz')
         out_gfa : string, optional
             Name of the generalise fa volume to be saved (default 'gfa.nii.gz')
+        slab_size : int, optional
+            If positive, the input volume is memory-mapped and the fiber odfs
+            are fitted this many slices at a time. Only the peaks and metrics
+            of the whole volume are kept in memory. As with parallel
+            ``peaks_from_model``, the QA is normalized within each slab
+            (default 0 (the whole volume is loaded in memory))
         """
         io_it = self.get_io_iterator()
 
@@ -449,7 +476,7 @@ class ReconstCSAFlow(Workflow):
 
             logging.info('Computing fiber odfs for {0}'.format(dwi))
             vol = nib.load(dwi)
-            data = vol.get_data()
+            data = vol.dataobj if slab_size > 0 else vol.get_data()
             affine = vol.get_affine()
 
             bvals, bvecs = read_bvals_bvecs(bval, bvec)
@@ -476,20 +503,10 @@ class ReconstCSAFlow(Workflow):
                 'Ratio for smallest to largest eigen value is {0}'
                     .format(ratio))
 
-            peaks_sphere = get_sphere('symmetric362')
-
             csa_model = CsaOdfModel(gtab, sh_order)
 
-            peaks_csa = peaks_from_model(model=csa_model,
-                                         data=data,
-                                         sphere=peaks_sphere,
-                                         relative_peak_threshold=.5,
-                                         min_separation_angle=25,
-                                         mask=mask_vol,
-                                         return_sh=True,
-                                         sh_order=sh_order,
-                                         normalize_peaks=True,
-                                         parallel=False)
+            peaks_csa = _peaks(csa_model, data, mask_vol, sh_order,
+                               slab_size)
             peaks_csa.affine = affine
 
             save_peaks(opam, peaks_csa)
@@ -29,8 +29,15 @@ def test_reconst_csa():
 def test_reconst_csd():
     reconst_flow_core(ReconstCSDFlow)
 
+
+@iftables
+def test_reconst_csa_csd_slabs():
+    reconst_flow_core(ReconstCSAFlow, slab_size=2)
+    reconst_flow_core(ReconstCSDFlow, slab_size=2)
+
+
 @iftables
-def reconst_flow_core(flow):
+def reconst_flow_core(flow, slab_size=0):
     with TemporaryDirectory() as out_dir:
         data_path, bval_path, bvec_path = get_data('small_64D')
         vol_img = nib.load(data_path)
@@ -43,7 +50,8 @@ def reconst_flow_core(flow):
         reconst_flow = flow()
 
         reconst_flow.run(data_path, bval_path, bvec_path, mask_path,
-                         out_dir=out_dir, extract_pam_values=True)
+                         out_dir=out_dir, extract_pam_values=True,
+                         slab_size=slab_size)
 
         gfa_path = reconst_flow.last_generated_outputs['out_gfa']
         gfa_data = nib.load(gfa_path).get_data()
@@ -19,7 +19,11 @@ def test_reconst_dti_nlls():
     reconst_flow_core(ReconstDtiFlow)
 
 
-def reconst_flow_core(flow, extra_args=[]):
+def test_reconst_dti_slabs():
+    reconst_flow_core(ReconstDtiFlow, slab_size=2)
+
+
+def reconst_flow_core(flow, extra_args=[], slab_size=0):
     with TemporaryDirectory() as out_dir:
         data_path, bval_path, bvec_path = get_data('small_25')
         vol_img = nib.load(data_path)
@@ -34,7 +38,7 @@ def reconst_flow_core(flow, extra_args=[]):
         args = [data_path, bval_path, bvec_path, mask_path]
         args.extend(extra_args)
 
-        dti_flow.run(*args, out_dir=out_dir)
+        dti_flow.run(*args, slab_size=slab_size, out_dir=out_dir)
 
         fa_path = dti_flow.last_generated_outputs['out_fa']
         fa_data = nib.load(fa_path).get_data()